@@ -0,0 +1,13 @@
+# Maintainer: harperic
+
+##################################
+## Find Threads
+
+# The python module runs sweeps on native threads, and the FFT planner
+# must be serialized when more than one simulation is solved at a time
+find_package(Threads REQUIRED)
+
+if (CMAKE_USE_PTHREADS_INIT)
+    set(CMAKE_C_FLAGS "${CMAKE_C_FLAGS} -DHAVE_LIBPTHREAD")
+    set(CMAKE_CXX_FLAGS "${CMAKE_CXX_FLAGS} -DHAVE_LIBPTHREAD")
+endif (CMAKE_USE_PTHREADS_INIT)
@@ -378,7 +378,7 @@ protected:
 		const size_t ncv = n_arnoldi;
 		const size_t nev = n_wanted;
 		
-		memset(workl, 0, sizeof(complex_type) * (ncv * ncv * 3 + ncv * 5));
+		std::fill(workl, workl + (ncv * ncv * 3 + ncv * 5), complex_type());
 
 		nconv = nev;
 		int info = Phase1(
@@ -0,0 +1,201 @@
+"""Performance benchmarks of S4, driven through :class:`S4.Simulation`.
+
+The classes follow the conventions of airspeed velocity (asv): ``setup`` is
+called with the parameters before timing, and every ``time_*`` method is
+timed for each combination of ``params``. They can be run by asv, or
+without it by ``benchmarks/run.py``, which writes the timings as JSON.
+
+Solve benchmarks rebuild the simulation from a spec inside the timed call,
+so that no epsilon matrices, modes or solutions are reused between runs.
+"""
+import numpy as np
+import S4
+
+
+def make_simulation(num_g=100, n_layers=1, shape="circle", n_shapes=1,
+                    options=()):
+    """
+    Build a square lattice photonic crystal slab stack: n_layers patterned
+    layers of silicon in oxide between vacuum half spaces. Each layer holds
+    n_shapes holes of the given shape on a regular grid, with sizes varying
+    between layers so that no two layers share their modes.
+
+    :param num_g: number of G-vectors
+    :type num_g: int
+    :param n_layers: number of patterned layers
+    :type n_layers: int
+    :param shape: "circle", "ellipse", "rectangle" or "polygon"
+    :type shape: str
+    :param n_shapes: number of shapes in each layer; must be a square
+    :type n_shapes: int
+    :param options: names of the Simulation.use_* options to enable
+    :type options: tuple
+    :return: simulation ready to be solved
+    :type: :class:`S4.Simulation`
+    """
+    S = S4.Simulation()
+    S.create_new()
+    S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+    S.set_num_g(num_g)
+    for option in options:
+        getattr(S, option)()
+    S.add_material("vacuum", [1.0, 0.0])
+    S.add_material("oxide", [2.1, 0.0])
+    S.add_material("silicon", [12.0, 0.1])
+    S.add_layer("top", 0.0, "vacuum")
+    n_side = int(round(np.sqrt(n_shapes)))
+    pitch = 1.0 / n_side
+    for i in range(n_layers):
+        name = "L%d" % i
+        S.add_layer(name, 0.1 + 0.01 * i, "oxide")
+        size = pitch * (0.2 + 0.2 * i / max(n_layers, 1))
+        for j in range(n_shapes):
+            center = [pitch * (j % n_side + 0.5) - 0.5,
+                      pitch * (j // n_side + 0.5) - 0.5]
+            if shape == "circle":
+                S.set_layer_pattern_circle(name, "silicon", center, size)
+            elif shape == "ellipse":
+                S.set_layer_pattern_ellipse(name, "silicon", center,
+                                            [size, 0.6 * size], angle=15.0)
+            elif shape == "rectangle":
+                S.set_layer_pattern_rectangle(name, "silicon", center,
+                                              [size, 0.6 * size], angle=15.0)
+            elif shape == "polygon":
+                t = np.linspace(0.0, 2.0 * np.pi, 6, endpoint=False)
+                vertices = size * np.column_stack([np.cos(t), np.sin(t)])
+                S.set_layer_pattern_polygon(name, "silicon", center,
+                                            vertices, angle=0.0)
+            else:
+                raise RuntimeError("unknown shape: %s" % shape)
+    S.add_layer("bottom", 0.0, "vacuum")
+    S.set_excitation_planewave([10.0, 5.0], [1.0, 0.0], [0.0, 0.0])
+    S.set_frequency(0.6)
+    return S
+
+
+def solve(spec):
+    S = S4.Simulation.from_spec(spec)
+    return S.get_poynting_flux("bottom")
+
+
+class NumGScaling:
+    params = [50, 100, 200, 400, 800, 1200, 2000]
+    param_names = ["num_g"]
+    timeout = 7200
+
+    def setup(self, num_g):
+        self.spec = make_simulation(num_g=num_g).to_spec()
+
+    def time_solve(self, num_g):
+        solve(self.spec)
+
+
+class LayerCountScaling:
+    params = [1, 2, 4, 8, 16, 32]
+    param_names = ["n_layers"]
+    timeout = 600
+
+    def setup(self, n_layers):
+        self.spec = make_simulation(n_layers=n_layers).to_spec()
+
+    def time_solve(self, n_layers):
+        solve(self.spec)
+
+
+class FMMOptions:
+    params = ["closed_form", "discretized", "subpixel_smoothing",
+              "polarization_decomposition", "jones_vector_basis",
+              "normal_vector_basis", "experimental"]
+    param_names = ["formulation"]
+    timeout = 600
+    options = {
+        "closed_form": (),
+        "discretized": ("use_discretized_epsilon",),
+        "subpixel_smoothing": ("use_discretized_epsilon",
+                               "use_subpixel_smoothing"),
+        "polarization_decomposition": ("use_polarization_decomposition",),
+        "jones_vector_basis": ("use_polarization_decomposition",
+                               "use_jones_vector_basis"),
+        "normal_vector_basis": ("use_polarization_decomposition",
+                                "use_normal_vector_basis"),
+        "experimental": ("use_experimental_FMM",),
+    }
+
+    def setup(self, formulation):
+        self.spec = make_simulation(
+            options=self.options[formulation]).to_spec()
+
+    def time_solve(self, formulation):
+        solve(self.spec)
+
+
+class LayerChange:
+    """Solves after changing the thickness of one layer of a solved stack."""
+    params = [2, 4, 8, 16]
+    param_names = ["n_layers"]
+    timeout = 600
+
+    def setup(self, n_layers):
+        self.S = make_simulation(n_layers=n_layers)
+        self.S.get_poynting_flux("bottom")
+        self.thickness = 0.1
+
+    def time_cold_solve(self, n_layers):
+        self.S.set_frequency(0.6)
+        self.S.get_poynting_flux("bottom")
+
+    def time_change_thickness(self, n_layers):
+        self.thickness = 0.2 - self.thickness
+        self.S.set_layer_thickness("L%d" % (n_layers // 2), self.thickness)
+        self.S.get_poynting_flux("bottom")
+
+
+class Patterns:
+    params = [["circle", "ellipse", "rectangle", "polygon"], [1, 4, 16]]
+    param_names = ["shape", "n_shapes"]
+    timeout = 600
+
+    def setup(self, shape, n_shapes):
+        self.spec = make_simulation(shape=shape,
+                                    n_shapes=n_shapes).to_spec()
+
+    def time_solve(self, shape, n_shapes):
+        solve(self.spec)
+
+
+class FieldPlane:
+    params = [16, 32, 64, 128, 256]
+    param_names = ["n_uv"]
+    timeout = 600
+
+    def setup(self, n_uv):
+        self.S = make_simulation()
+        self.S.get_poynting_flux("bottom")
+        self.e = np.empty((n_uv, n_uv, 3), dtype=np.complex128)
+        self.h = np.empty((n_uv, n_uv, 3), dtype=np.complex128)
+
+    def time_get_field_plane(self, n_uv):
+        self.S.get_field_plane(0.05, [n_uv, n_uv], out=(self.e, self.h))
+
+
+class WrapperOverhead:
+    """Cost of the Python wrapper around cheap setters and getters."""
+
+    def setup(self):
+        self.S = make_simulation(num_g=25)
+        self.S.get_poynting_flux("bottom")
+
+    def time_set_frequency(self):
+        self.S.set_frequency(0.6)
+
+    def time_set_excitation_planewave(self):
+        self.S.set_excitation_planewave([10.0, 5.0], [1.0, 0.0], [0.0, 0.0])
+
+    def time_set_layer_thickness(self):
+        self.S.set_layer_thickness("L0", 0.1)
+
+    def time_get_num_g(self):
+        self.S.get_num_g()
+
+    def time_get_poynting_flux_solved(self):
+        self.S.get_poynting_flux("bottom")
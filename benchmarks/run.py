@@ -0,0 +1,132 @@
+"""Run the S4 benchmarks without asv and write the timings as JSON.
+
+    python benchmarks/run.py -o results.json [-b REGEX] [--quick]
+    python benchmarks/run.py --compare old.json new.json
+
+Each benchmark is timed ``--repeat`` times after a warm-up call. Calls
+faster than 0.2 s are batched so that every sample takes at least that
+long. The JSON file records the S4 version, the machine and, for every
+benchmark and parameter combination, the minimum and median time per call
+in seconds. ``--compare`` prints the ratio of the medians of two such
+files.
+"""
+import argparse
+import datetime
+import inspect
+import itertools
+import json
+import os
+import platform
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmarks  # noqa: E402
+import S4  # noqa: E402
+
+
+def benchmark_classes():
+    for name, cls in inspect.getmembers(benchmarks, inspect.isclass):
+        if cls.__module__ == benchmarks.__name__:
+            yield name, cls
+
+
+def parameter_sets(cls, quick):
+    params = getattr(cls, "params", [])
+    names = getattr(cls, "param_names", [])
+    if len(names) == 0:
+        return [()]
+    if len(names) == 1:
+        params = [params]
+    if quick:
+        params = [values[:2] for values in params]
+    return list(itertools.product(*params))
+
+
+def time_call(func, repeat):
+    func()
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    if number > 1:
+        # autorange stops at the first batch over 0.2 s
+        number = max(1, number // 2)
+    samples = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    samples.sort()
+    return {"min": samples[0], "median": samples[len(samples) // 2],
+            "number": number, "repeat": repeat}
+
+
+def run(pattern, repeat, quick):
+    results = {}
+    for class_name, cls in benchmark_classes():
+        names = getattr(cls, "param_names", [])
+        for method_name, _ in inspect.getmembers(cls, inspect.isfunction):
+            if not method_name.startswith("time_"):
+                continue
+            key = "%s.%s" % (class_name, method_name)
+            if pattern is not None and re.search(pattern, key) is None:
+                continue
+            entries = []
+            for values in parameter_sets(cls, quick):
+                bench = cls()
+                if hasattr(bench, "setup"):
+                    bench.setup(*values)
+                method = getattr(bench, method_name)
+                timing = time_call(lambda: method(*values), repeat)
+                timing["params"] = dict(zip(names, values))
+                entries.append(timing)
+                print("%-45s %-40s %.6g s" % (key, timing["params"],
+                                              timing["median"]))
+                sys.stdout.flush()
+            results[key] = entries
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)["results"]
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    for key in sorted(set(old) & set(new)):
+        before = {json.dumps(e["params"], sort_keys=True): e for e in old[key]}
+        for entry in new[key]:
+            params = json.dumps(entry["params"], sort_keys=True)
+            if params in before:
+                ratio = entry["median"] / before[params]["median"]
+                print("%-45s %-40s %6.2fx" % (key, entry["params"], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-o", "--output", default="benchmarks.json",
+                        help="JSON file to write the results to")
+    parser.add_argument("-b", "--bench", default=None,
+                        help="only run benchmarks matching this regex")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of samples per benchmark")
+    parser.add_argument("--quick", action="store_true",
+                        help="only the two first values of each parameter")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+    results = run(args.bench, args.repeat, args.quick)
+    report = {
+        "version": S4.__version__,
+        "date": datetime.datetime.now().isoformat(),
+        "machine": {"node": platform.node(), "machine": platform.machine(),
+                    "processor": platform.processor(),
+                    "python": platform.python_version(),
+                    "cpu_count": os.cpu_count()},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
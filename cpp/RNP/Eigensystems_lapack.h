@@ -26,6 +26,11 @@ extern "C" void RNP_FORTRAN_NAME(dgeev,DGEEV)(const char *jobvl, const char *job
 	const integer &ldvl, double *vr, const integer &ldvr, double *work, 
 	const integer &lwork, integer *info);
 
+extern "C" void RNP_FORTRAN_NAME(zheevd,ZHEEVD)(const char *jobz, const char *uplo, const integer &n,
+	std::complex<double> *a, const integer &lda, double *w, std::complex<double> *work,
+	const integer &lwork, double *rwork, const integer &lrwork, integer *iwork,
+	const integer &liwork, integer *info);
+
 #include <iostream>
 
 namespace RNP{
@@ -209,14 +214,58 @@ inline int Eigensystem_real(size_t n,
 	return info;
 }
 
-/*
-// zheev
+// HermitianEigensystem computes all eigenvalues and eigenvectors of an
+// N-by-N complex Hermitian matrix A, using the divide and conquer
+// algorithm (zheevd). Only the triangle given by uplo is referenced.
+//
+// Arguments
+// =========
+//
+// n       The order of the matrix A. n >= 0.
+//
+// a       (input/output) dimension (lda,n)
+//         On entry, the Hermitian matrix A.
+//         On exit, the orthonormal eigenvectors of A, one per column.
+//
+// lda     The leading dimension of the array A.  lda >= n.
+//
+// eval    (output) dimension (n)
+//         The eigenvalues in ascending order.
+//
+// return  = 0:  successful exit
+//         < 0:  if INFO = -i, the i-th argument had an illegal value.
+//         > 0:  the algorithm failed to converge.
 template <char uplo>
-int HermitianEigensystem(size_t n, 
+inline int HermitianEigensystem(size_t n,
 	std::complex<double> *a, size_t lda,
-	std::complex<double> *eval,
-	std::complex<double> *work, double *rwork);
+	double *eval)
+{
+	if(n == 0) {
+		return 0;
+	}
+	const char uplo_[2] = { uplo, '\0' };
+	integer info;
+	std::complex<double> zlen;
+	double rlen;
+	integer ilen;
+	RNP_FORTRAN_NAME(zheevd,ZHEEVD)("V", uplo_, n, a, lda, eval, &zlen, -1, &rlen, -1, &ilen, -1, &info);
+	if(0 != info){
+		return info;
+	}
+	const integer lwork = (integer)zlen.real();
+	const integer lrwork = (integer)rlen;
+	const integer liwork = ilen;
+	std::complex<double> *work = new std::complex<double>[lwork];
+	double *rwork = new double[lrwork];
+	integer *iwork = new integer[liwork];
+	RNP_FORTRAN_NAME(zheevd,ZHEEVD)("V", uplo_, n, a, lda, eval, work, lwork, rwork, lrwork, iwork, liwork, &info);
+	delete [] iwork;
+	delete [] rwork;
+	delete [] work;
+	return info;
+}
 
+/*
 // dsyev
 template <char uplo>
 int SymmetricEigensystem(size_t n, 
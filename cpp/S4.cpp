@@ -37,7 +37,17 @@
 #endif
 #include "rcwa.h"
 #include "fmm/fmm.h"
+#include "profile.h"
 #include <iostream>
+#include <atomic>
+#include <thread>
+#include <algorithm>
+#include <vector>
+#include <limits>
+#include <list>
+#include <mutex>
+#include <string>
+#include <unordered_map>
 extern "C" {
 #include "gsel.h"
 }
@@ -89,20 +99,76 @@ static void geom_cross3d(const double *a, const double *b, double *result){
 }
 
 
+// The Fourier space epsilon matrices of a layer. They depend only on the
+// layer structure, the materials, the lattice and G basis, and the FMM
+// options, so they are kept across frequency and k-vector changes.
+struct LayerEpsilon{
+  std::complex<double> *Epsilon2; // size (2*glist.n)^2 (dielectric/normal-field matrix)
+  std::complex<double> *Epsilon_inv; // size (glist.n)^2 inverse of usual dielectric Fourier coupling matrix
+  int epstype;
+  int n; // number of G vectors the matrices were built for
+  S4_Options options; // options the matrices were built with
+  std::atomic<int> refcount; // shared like LayerModes
+};
 struct LayerModes{
   std::complex<double> *q; // length 2*glist.n
   std::complex<double> *kp; // size (2*glist.n)^2 (k-parallel matrix)
   std::complex<double> *phi; // size (2*glist.n)^2
-  std::complex<double> *Epsilon2; // size (2*glist.n)^2 (dielectric/normal-field matrix)
-  std::complex<double> *Epsilon_inv; // size (glist.n)^2 inverse of usual dielectric Fourier coupling matrix
+  std::complex<double> *Epsilon2; // points into eps
+  std::complex<double> *Epsilon_inv; // points into eps
   // max total size needed: 2n+13nn
   int epstype;
+  int n; // number of G vectors the modes were computed for
+  int n_exact; // the first n_exact of the 2n modes are exact eigenmodes
+  int n_valid; // the modes from n_valid on lie outside the symmetry sector
+  double residual; // relative residual of the modes of a partial eigensolve
+  double approx_residual; // and that of its approximate modes
+  LayerEpsilon *eps; // referenced epsilon matrices
+  // Modes are read-only once computed and may be shared between a
+  // simulation and its clones; the last owner to drop them frees them.
+  std::atomic<int> refcount;
+  unsigned long serial; // unique for every set of modes ever computed
 };
+static std::atomic<unsigned long> layer_modes_serial(0);
 struct Solution_{
   std::complex<double> *ab;
   int *solved;
 };
 
+// This structure caches S-matrices of partial layer stacks across changes
+// to the solution. It records the modes and thicknesses of the last solve
+// to find the layers that changed since. When the same single layer k
+// changes twice in a row, as in a parameter scan, the S-matrices S(0,k-1)
+// and S(k+1,N-1) of the unchanged stacks on either side of it are made,
+// and every further change of layer k only costs the two interfaces of k;
+// layer k and the two outermost layers are then solved from these, and the
+// stack is otherwise solved without them. These "halves" are dropped as
+// soon as another layer changes.
+// While pinned by S4_Simulation_SweepLayerThickness, the S-matrices S(0,l)
+// and S(l,N) before and after every layer l are kept instead, so that the
+// fluxes in any layer can be had for each thickness, which only rescales
+// them. They take (2N+1)(4n)^2 complex numbers and are freed after the
+// sweep.
+struct SMatrixCache{
+  int n, nlayers;
+  unsigned long *serial; // modes of each layer at the last solve
+  double *thickness; // thickness of each layer at the last solve
+  int *valid; // length 2*nlayers; prefix flags followed by suffix flags
+  int pinned; // make and keep the products, during thickness sweeps
+  std::complex<double> *pre; // S(0,l) for each layer l, each (4n)^2, or NULL
+  std::complex<double> *suf; // S(l,nlayers-1) for each layer l
+  int hole; // the layer of the last single-layer change, or -1
+  int halves_valid, full_valid; // whether left, right and a, b, full are current
+  std::complex<double> *halves; // block of the following, or NULL
+  std::complex<double> *left; // S(0,hole-1)
+  std::complex<double> *right; // S(hole+1,nlayers-1)
+  std::complex<double> *a, *b; // S(0,hole) and S(hole,nlayers-1)
+  std::complex<double> *full; // S(0,nlayers-1)
+  std::complex<double> *step; // (4n)^2; S-matrix of two adjacent layers
+  std::complex<double> *work; // 4n(4n+1) workspace
+  size_t *iwork; // length 4n
+};
+
 // This structure caches the Fourier transform of the polarization basis
 // field, allowing a substantial increase in speed when doing frequency
 // scans. Invalidates on SetNumG, and layer patterning
@@ -110,6 +176,7 @@ struct FieldCache{
   int n;
   const S4_Layer *layer;
   std::complex<double> *P; // 2n x 2n matrix, allocated along with this structure itself
+  size_t len; // length of P
   FieldCache *next;
 };
 
@@ -148,7 +215,7 @@ void Layer_Destroy(S4_Layer *L){
     L->pattern.shapes = NULL;
   }
   if(NULL != L->pattern.parent){ free(L->pattern.parent); L->pattern.parent = NULL; }
-  Simulation_DestroyLayerModes(L);
+  Simulation_DestroyLayerEpsilon(L);
   S4_TRACE("< Layer_Destroy\n");
 }
 void Material_Destroy(S4_Material *M){
@@ -221,11 +288,17 @@ S4_Simulation* S4_Simulation_New(const S4_real *Lr, unsigned int nG, int *G){
   S->options.verbosity = 0;
   S->options.use_experimental_fmm = 0;
   S->options.use_less_memory = 0;
+  S->options.use_hermitian_eigensolver = 0;
+  S->options.symmetry = 0;
+  S->options.symmetry_parity = 0;
+  S->options.num_modes = 0;
 
   S->options.lanczos_smoothing_width = 1.0;
   S->options.lanczos_smoothing_power = 1;
 
   S->field_cache = NULL;
+  S->smatrix_cache = NULL;
+  S->profile = new S4_Profile();
 
   S->msg = NULL;
   S->msgdata = NULL;
@@ -295,6 +368,8 @@ void S4_Simulation_Destroy(S4_Simulation *S){
   free(S->material);
   Simulation_SetExcitationType(S, -1);
   Simulation_InvalidateFieldCache(S);
+  Simulation_DestroySMatrixCache(S);
+  delete S->profile;
   if(NULL != S->options.vector_field_dump_filename_prefix){
     free(S->options.vector_field_dump_filename_prefix);
     S->options.vector_field_dump_filename_prefix = NULL;
@@ -316,33 +391,70 @@ S4_Simulation* S4_Simulation_Clone(const S4_Simulation *S){
   }
 
   memcpy(T, S, sizeof(S4_Simulation));
+  // Nothing computed is shared with the source simulation; the clone
+  // recomputes its own modes and solution on demand.
+  T->solution = NULL;
+  T->field_cache = NULL;
+  T->smatrix_cache = NULL;
+  T->profile = new S4_Profile();
+  T->profile->trace = S->profile->trace;
+
+  T->G = (int*)S4_malloc(sizeof(int)*2*S->n_G);
+  memcpy(T->G, S->G, sizeof(int)*2*S->n_G);
+  T->kx = (double*)S4_malloc(sizeof(double)*2*S->n_G);
+  T->ky = T->kx + T->n_G;
+  memcpy(T->kx, S->kx, sizeof(double)*2*S->n_G);
+  if(NULL != S->options.vector_field_dump_filename_prefix){
+    T->options.vector_field_dump_filename_prefix = strdup(S->options.vector_field_dump_filename_prefix);
+  }
 
+  T->n_materials = 0;
   T->n_materials_alloc = S->n_materials_alloc;
   T->material = (S4_Material*)malloc(sizeof(S4_Material) * T->n_materials_alloc);
   for(int i = 0; i < S->n_materials; ++i){
     const S4_Material *M = &(S->material[i]);
-    S4_Simulation_SetMaterial(T, -1, M->name, M->type, &M->eps.abcde[0]);
+    S4_MaterialID id = S4_Simulation_SetMaterial(T, -1, M->name, S4_MATERIAL_TYPE_XYTENSOR_COMPLEX, &M->eps.abcde[0]);
+    // the tensor copy above moves all 10 values verbatim; restore the type
+    T->material[id].type = M->type;
   }
 
+  T->n_layers = 0;
   T->n_layers_alloc = S->n_layers_alloc;
   T->layer = (S4_Layer*)malloc(sizeof(S4_Layer) * T->n_layers_alloc);
   for(int i = 0; i < S->n_layers; ++i){
     const S4_Layer *L = &(S->layer[i]);
     S4_LayerID id = S4_Simulation_SetLayer(T, -1, L->name, &L->thickness, L->copy, L->material);
     S4_Layer *L2 = &T->layer[id];
-    // Copy pattern
+    // Copy pattern; polygon vertices are separately allocated
     L2->pattern.nshapes = L->pattern.nshapes;
-    L2->pattern.shapes = (shape*)malloc(sizeof(shape)*L->pattern.nshapes);
-    memcpy(L2->pattern.shapes, L->pattern.shapes, sizeof(shape)*L->pattern.nshapes);
+    L2->pattern.shapes = NULL;
+    if(L->pattern.nshapes > 0){
+      L2->pattern.shapes = (shape*)malloc(sizeof(shape)*L->pattern.nshapes);
+      memcpy(L2->pattern.shapes, L->pattern.shapes, sizeof(shape)*L->pattern.nshapes);
+      for(int j = 0; j < L->pattern.nshapes; ++j){
+        shape *sh = &L2->pattern.shapes[j];
+        if(POLYGON == sh->type && NULL != sh->vtab.polygon.vertex){
+          const size_t nv = 2*sh->vtab.polygon.n_vertices;
+          sh->vtab.polygon.vertex = (double*)S4_malloc(sizeof(double)*nv);
+          memcpy(sh->vtab.polygon.vertex, L->pattern.shapes[j].vtab.polygon.vertex, sizeof(double)*nv);
+        }
+      }
+    }
     L2->pattern.parent = NULL;
-    L2->modes = NULL;
+    // Share the computed modes; whichever simulation changes the layer
+    // first drops its reference and recomputes a private copy.
+    L2->modes = L->modes;
+    if(NULL != L2->modes){
+      ++L2->modes->refcount;
+    }
+    L2->epsilon = L->epsilon;
+    if(NULL != L2->epsilon){
+      ++L2->epsilon->refcount;
+    }
   }
 
   Simulation_CopyExcitation(S, T);
 
-  T->solution = NULL;
-  T->field_cache = NULL;
-
   S4_TRACE("< S4_Simulation_Clone [omega=%f]\n", S->omega[0]);
   return T;
 }
@@ -359,6 +471,7 @@ int S4_Simulation_SetLattice(S4_Simulation *S, const S4_real *Lr){
   if(NULL == S){ return -1; }
   if(NULL == Lr){ return -2; }
   Simulation_DestroySolution(S);
+  S4_Simulation_DestroyLayerEpsilon(S, -1);
   memcpy(S->Lr, Lr, sizeof(S4_real) * 4);
   int ret = S4_Lattice_Reciprocate(S->Lr, S->Lk);
   if(1 == ret){
@@ -388,6 +501,7 @@ int S4_Simulation_SetBases(S4_Simulation *S, unsigned int nG, int *G){
 
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
+  S4_Simulation_DestroyLayerEpsilon(S, -1);
 
   S->n_G = nG;
   S->G = (int*)S4_realloc(S->G, sizeof(int)*2*S->n_G);
@@ -533,6 +647,18 @@ S4_MaterialID S4_Simulation_SetMaterial(
     }
     if(id >= S->n_materials){ return -1; }
     M = &S->material[id];
+    // Layers made of, or patterned with, this material must be rebuilt
+    Simulation_DestroySolution(S);
+    for(int i = 0; i < S->n_layers; ++i){
+      S4_Layer *L = &S->layer[i];
+      int uses = (id == L->material);
+      for(int j = 0; j < L->pattern.nshapes; ++j){
+        if(id == L->pattern.shapes[j].tag){ uses = 1; }
+      }
+      if(uses){
+        Simulation_DestroyLayerEpsilon(L);
+      }
+    }
   }
   if(NULL != name){
     if(NULL != M->name){
@@ -679,12 +805,16 @@ S4_LayerID S4_Simulation_SetLayer(
     L->pattern.shapes = NULL;
     L->pattern.parent = NULL;
     L->modes = NULL;
+    L->epsilon = NULL;
   }else{
     if(NULL != S->msg){
       S->msg(S->msgdata, "S4_Simulation_SetLayer", S4_MSG_INFO, "Updating existing layer");
     }
     if(id >= S->n_layers){ return -1; }
     L = &S->layer[id];
+    if(copy >= 0 || material >= 0){
+      Simulation_DestroyLayerEpsilon(L);
+    }
   }
 
   if(NULL != name){
@@ -763,7 +893,7 @@ int S4_Layer_ClearRegions(
     free(L->pattern.parent);
     L->pattern.parent = NULL;
   }
-  Simulation_DestroyLayerModes(L);
+  Simulation_DestroyLayerEpsilon(L);
   return 0;
 }
 
@@ -817,7 +947,7 @@ int S4_Layer_SetRegionHalfwidths(
   }
   S4_Layer *L = &S->layer[Lid];
 
-  Simulation_DestroyLayerModes(L);
+  Simulation_DestroyLayerEpsilon(L);
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
 
@@ -829,9 +959,14 @@ int S4_Layer_SetRegionHalfwidths(
   if(NULL != center){
     sh->center[0] = center[0];
     sh->center[1] = center[1];
+  }else{
+    sh->center[0] = 0;
+    sh->center[1] = 0;
   }
   if(NULL != angle_frac){
     sh->angle = 2*M_PI*(*angle_frac);
+  }else{
+    sh->angle = 0;
   }
   sh->tag = Mid;
   switch(type){
@@ -891,7 +1026,7 @@ int S4_Layer_SetRegionVertices(
   }
   S4_Layer *L = &S->layer[Lid];
 
-  Simulation_DestroyLayerModes(L);
+  Simulation_DestroyLayerEpsilon(L);
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
 
@@ -903,9 +1038,14 @@ int S4_Layer_SetRegionVertices(
   if(NULL != center){
     sh->center[0] = center[0];
     sh->center[1] = center[1];
+  }else{
+    sh->center[0] = 0;
+    sh->center[1] = 0;
   }
   if(NULL != angle_frac){
     sh->angle = 2*M_PI* (*angle_frac);
+  }else{
+    sh->angle = 0;
   }
   sh->tag = Mid;
   switch(type){
@@ -948,14 +1088,58 @@ int S4_Layer_IsCopy(S4_Simulation *S, S4_LayerID L){
   return (S->layer[L].copy >= 0) ? 1 : 0;
 }
 
+static void LayerEpsilon_Release(LayerEpsilon *eps){
+  if(NULL != eps && 0 == --eps->refcount){
+    S4_free(eps->Epsilon_inv);
+    delete eps;
+  }
+}
+// Returns nonzero if the cached epsilon matrices are still valid for the
+// current G basis and FMM options.
+static int LayerEpsilon_IsCurrent(const LayerEpsilon *eps, const S4_Simulation *S){
+  const S4_Options *a = &eps->options;
+  const S4_Options *b = &S->options;
+  return eps->n == S->n_G
+    && a->use_discretized_epsilon == b->use_discretized_epsilon
+    && a->use_subpixel_smoothing == b->use_subpixel_smoothing
+    && a->use_Lanczos_smoothing == b->use_Lanczos_smoothing
+    && a->use_polarization_basis == b->use_polarization_basis
+    && a->use_jones_vector_basis == b->use_jones_vector_basis
+    && a->use_normal_vector_basis == b->use_normal_vector_basis
+    && a->use_normal_vector_field == b->use_normal_vector_field
+    && a->resolution == b->resolution
+    && a->use_experimental_fmm == b->use_experimental_fmm
+    && a->lanczos_smoothing_width == b->lanczos_smoothing_width
+    && a->lanczos_smoothing_power == b->lanczos_smoothing_power;
+}
+static void LayerModes_Release(LayerModes *modes){
+  if(NULL != modes && 0 == --modes->refcount){
+    if(NULL != modes->q){ S4_free(modes->q); }
+    modes->q = NULL;
+    LayerEpsilon_Release(modes->eps);
+    delete modes;
+  }
+}
 void Simulation_DestroyLayerModes(S4_Layer *layer){
   if(NULL != layer->modes){
-    if(NULL != layer->modes->q){ S4_free(layer->modes->q); }
-    layer->modes->q = NULL;
-    free(layer->modes);
+    LayerModes_Release(layer->modes);
     layer->modes = NULL;
   }
 }
+void Simulation_DestroyLayerEpsilon(S4_Layer *layer){
+  Simulation_DestroyLayerModes(layer);
+  LayerEpsilon_Release(layer->epsilon);
+  layer->epsilon = NULL;
+}
+void S4_Simulation_DestroyLayerEpsilon(S4_Simulation *S, S4_LayerID id){
+  if(id < 0){
+    for(int i = 0; i < S->n_layers; ++i){
+      Simulation_DestroyLayerEpsilon(&S->layer[i]);
+    }
+  }else if(id < S->n_layers){
+    Simulation_DestroyLayerEpsilon(&S->layer[id]);
+  }
+}
 void S4_Simulation_DestroyLayerModes(S4_Simulation *S, S4_LayerID id){
   if(id < 0){
     for(int i = 0; i < S->n_layers; ++i){
@@ -966,6 +1150,160 @@ void S4_Simulation_DestroyLayerModes(S4_Simulation *S, S4_LayerID id){
   }
 }
 
+// Process-wide cache of layer modes, shared by all simulations. Modes are
+// addressed by their full content key: everything they depend on, namely
+// the layer structure and materials, the lattice, G basis and k-vectors,
+// the frequency and the FMM options. Identical layers in different
+// simulations, such as those rebuilt in every step of an optimization, are
+// then only solved once. Entries hold a reference to their modes and are
+// evicted least recently used first when over the byte budget, which is
+// zero (disabled) by default.
+struct LayerModesCache{
+  typedef std::list<std::pair<std::string, LayerModes*> > List;
+  std::mutex mutex;
+  List lru; // most recently used first
+  std::unordered_map<std::string, List::iterator> index;
+  size_t budget, bytes, hits, misses;
+  LayerModesCache():budget(0),bytes(0),hits(0),misses(0){}
+};
+static LayerModesCache modes_cache;
+
+template <class T>
+static void ModesKey_Append(std::string &key, const T *v, size_t n){
+  key.append((const char*)v, sizeof(T)*n);
+}
+static void ModesKey_AppendMaterial(std::string &key, const S4_Material *M){
+  ModesKey_Append(key, &M->type, 1);
+  if(0 == M->type){
+    ModesKey_Append(key, M->eps.s, 2);
+  }else{
+    ModesKey_Append(key, M->eps.abcde, 10);
+  }
+}
+static void LayerModesCache_MakeKey(const S4_Simulation *S, const S4_Layer *L, std::string &key){
+  if(L->copy >= 0){
+    L = &S->layer[L->copy];
+  }
+  const S4_Options *o = &S->options;
+  const int ioptions[15] = {
+    S->n_G, o->use_discretized_epsilon, o->use_subpixel_smoothing,
+    o->use_Lanczos_smoothing, o->use_polarization_basis,
+    o->use_jones_vector_basis, o->use_normal_vector_basis,
+    o->use_normal_vector_field, o->resolution, o->use_experimental_fmm,
+    o->use_less_memory, o->use_hermitian_eigensolver,
+    o->symmetry, o->symmetry_parity, o->num_modes
+  };
+  const double doptions[2] = { o->lanczos_smoothing_width, (double)o->lanczos_smoothing_power };
+  key.clear();
+  ModesKey_Append(key, ioptions, 15);
+  ModesKey_Append(key, doptions, 2);
+  ModesKey_Append(key, S->Lr, 4);
+  ModesKey_Append(key, S->omega, 2);
+  ModesKey_Append(key, S->G, 2*S->n_G);
+  ModesKey_Append(key, S->kx, S->n_G);
+  ModesKey_Append(key, S->ky, S->n_G);
+  ModesKey_AppendMaterial(key, &S->material[L->material]);
+  ModesKey_Append(key, &L->pattern.nshapes, 1);
+  for(int i = 0; i < L->pattern.nshapes; ++i){
+    const shape *sh = &L->pattern.shapes[i];
+    const int type = sh->type;
+    ModesKey_Append(key, &type, 1);
+    ModesKey_Append(key, sh->center, 2);
+    ModesKey_Append(key, &sh->angle, 1);
+    switch(sh->type){
+    case CIRCLE:
+      ModesKey_Append(key, &sh->vtab.circle.radius, 1);
+      break;
+    case ELLIPSE:
+      ModesKey_Append(key, sh->vtab.ellipse.halfwidth, 2);
+      break;
+    case RECTANGLE:
+      ModesKey_Append(key, sh->vtab.rectangle.halfwidth, 2);
+      break;
+    case POLYGON:
+      ModesKey_Append(key, &sh->vtab.polygon.n_vertices, 1);
+      ModesKey_Append(key, sh->vtab.polygon.vertex, 2*sh->vtab.polygon.n_vertices);
+      break;
+    }
+    ModesKey_AppendMaterial(key, &S->material[sh->tag]);
+  }
+}
+static size_t LayerModes_Bytes(const LayerModes *M){
+  const size_t n2 = 2*M->n;
+  return sizeof(std::complex<double>)*(n2
+    + (NULL != M->kp ? n2*n2 : 0)
+    + (NULL != M->phi ? n2*n2 : 0)
+    + 5*(size_t)M->eps->n*M->eps->n);
+}
+// Assumes the cache mutex is held
+static void LayerModesCache_Trim(size_t budget){
+  LayerModesCache *C = &modes_cache;
+  while(C->bytes > budget){
+    LayerModes *M = C->lru.back().second;
+    C->bytes -= LayerModes_Bytes(M);
+    C->index.erase(C->lru.back().first);
+    C->lru.pop_back();
+    LayerModes_Release(M);
+  }
+}
+// Makes the key of the modes of layer L if the cache is enabled (key is
+// left empty otherwise), and returns a new reference to the cached modes
+// if found, or NULL.
+static LayerModes* LayerModesCache_Lookup(const S4_Simulation *S, const S4_Layer *L, std::string &key){
+  LayerModesCache *C = &modes_cache;
+  key.clear();
+  {
+    std::lock_guard<std::mutex> lock(C->mutex);
+    if(0 == C->budget){ return NULL; }
+  }
+  LayerModesCache_MakeKey(S, L, key);
+  std::lock_guard<std::mutex> lock(C->mutex);
+  std::unordered_map<std::string, LayerModesCache::List::iterator>::iterator it = C->index.find(key);
+  if(C->index.end() == it){
+    C->misses++;
+    return NULL;
+  }
+  C->hits++;
+  C->lru.splice(C->lru.begin(), C->lru, it->second);
+  LayerModes *M = it->second->second;
+  ++M->refcount;
+  return M;
+}
+static void LayerModesCache_Insert(const std::string &key, LayerModes *M){
+  LayerModesCache *C = &modes_cache;
+  if(key.empty()){ return; }
+  const size_t bytes = LayerModes_Bytes(M);
+  std::lock_guard<std::mutex> lock(C->mutex);
+  if(bytes > C->budget || C->index.end() != C->index.find(key)){ return; }
+  ++M->refcount;
+  C->lru.push_front(std::make_pair(key, M));
+  C->index[key] = C->lru.begin();
+  C->bytes += bytes;
+  LayerModesCache_Trim(C->budget);
+}
+void Simulation_SetModesCacheBudget(size_t bytes){
+  LayerModesCache *C = &modes_cache;
+  std::lock_guard<std::mutex> lock(C->mutex);
+  C->budget = bytes;
+  LayerModesCache_Trim(C->budget);
+}
+void Simulation_GetModesCacheInfo(size_t info[5]){
+  LayerModesCache *C = &modes_cache;
+  std::lock_guard<std::mutex> lock(C->mutex);
+  info[0] = C->budget;
+  info[1] = C->bytes;
+  info[2] = C->lru.size();
+  info[3] = C->hits;
+  info[4] = C->misses;
+}
+void Simulation_ClearModesCache(){
+  LayerModesCache *C = &modes_cache;
+  std::lock_guard<std::mutex> lock(C->mutex);
+  LayerModesCache_Trim(0);
+  C->hits = 0;
+  C->misses = 0;
+}
+
 int Simulation_RemoveLayerPatterns(S4_Simulation *S, S4_Layer *layer){
   S4_TRACE("> Simulation_RemoveLayerPatterns(S=%p, layer=%p) [omega=%f]\n",
     S, layer, S->omega[0]);
@@ -988,7 +1326,7 @@ int Simulation_RemoveLayerPatterns(S4_Simulation *S, S4_Layer *layer){
     free(layer->pattern.parent);
     layer->pattern.parent = NULL;
   }
-  Simulation_DestroyLayerModes(layer);
+  Simulation_DestroyLayerEpsilon(layer);
 
   S4_TRACE("< Simulation_RemoveLayerPatterns [omega=%f]\n", S->omega[0]);
   return 0;
@@ -1023,6 +1361,7 @@ int Simulation_SetNumG(S4_Simulation *S, int n){
 
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
+  S4_Simulation_DestroyLayerEpsilon(S, -1);
 
   S->n_G = n;
   S->G = (int*)S4_realloc(S->G, sizeof(int)*2*S->n_G);
@@ -1088,7 +1427,7 @@ int Simulation_AddLayerPatternCircle(
     return ret;
   }
 
-  Simulation_DestroyLayerModes(layer);
+  Simulation_DestroyLayerEpsilon(layer);
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
 
@@ -1130,7 +1469,7 @@ int Simulation_AddLayerPatternEllipse(
     return ret;
   }
 
-  Simulation_DestroyLayerModes(layer);
+  Simulation_DestroyLayerEpsilon(layer);
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
 
@@ -1175,7 +1514,7 @@ int Simulation_AddLayerPatternRectangle(
     return ret;
   }
 
-  Simulation_DestroyLayerModes(layer);
+  Simulation_DestroyLayerEpsilon(layer);
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
 
@@ -1221,7 +1560,7 @@ int Simulation_AddLayerPatternPolygon(
     return ret;
   }
 
-  Simulation_DestroyLayerModes(layer);
+  Simulation_DestroyLayerEpsilon(layer);
   Simulation_DestroySolution(S);
   Simulation_InvalidateFieldCache(S);
 
@@ -1245,6 +1584,199 @@ int Simulation_AddLayerPatternPolygon(
   return 0;
 }
 
+// Whether a material keeps the x and y components of the field apart, so
+// that it is symmetric under the mirrors x -> -x and y -> -y
+static int Material_IsMirrorSymmetric(const S4_Material *M){
+  if(0 == M->type){
+    return 1;
+  }
+  const double *e = M->eps.abcde;
+  return 0 == e[2] && 0 == e[3] && 0 == e[4] && 0 == e[5];
+}
+
+// The vertices of a rectangle or polygon relative to its center
+static void Shape_GetVertices(const shape *sh, std::vector<double> &v){
+  const double c = cos(sh->angle), s = sin(sh->angle);
+  v.clear();
+  if(RECTANGLE == sh->type){
+    const double *hw = sh->vtab.rectangle.halfwidth;
+    const double corners[8] = { hw[0],hw[1], -hw[0],hw[1], -hw[0],-hw[1], hw[0],-hw[1] };
+    v.assign(corners, corners+8);
+  }else{
+    v.assign(sh->vtab.polygon.vertex, sh->vtab.polygon.vertex + 2*sh->vtab.polygon.n_vertices);
+  }
+  for(size_t i = 0; i < v.size(); i += 2){
+    const double x = v[i], y = v[i+1];
+    v[i+0] = c*x - s*y;
+    v[i+1] = s*x + c*y;
+  }
+}
+
+// Whether shape b is the mirror image of shape a under the mirror x -> -x
+// (axis 0) or y -> -y (axis 1), up to a lattice translation
+static int Shape_IsMirrorImage(const S4_Simulation *S, const shape *a, const shape *b, int axis){
+  const double tol = 1e-8;
+  const double len = tol * (hypot(S->Lr[0], S->Lr[1]) + hypot(S->Lr[2], S->Lr[3]));
+  if(a->type != b->type || a->tag != b->tag){
+    return 0;
+  }
+  double d[2] = { b->center[0] - a->center[0], b->center[1] - a->center[1] };
+  d[axis] = b->center[axis] + a->center[axis];
+  // a 1D pattern is uniform along the second direction
+  const int ndim = (0 == S->Lr[2] && 0 == S->Lr[3]) ? 1 : 2;
+  for(int i = 0; i < ndim; ++i){
+    const double u = d[0]*S->Lk[2*i+0] + d[1]*S->Lk[2*i+1];
+    if(fabs(u - floor(u + 0.5)) > tol){
+      return 0;
+    }
+  }
+  if(CIRCLE == a->type){
+    return fabs(a->vtab.circle.radius - b->vtab.circle.radius) <= len;
+  }else if(ELLIPSE == a->type){
+    // compare the matrices of the quadratic forms of the two ellipses
+    double Q[2][3];
+    const shape *sh[2] = { a, b };
+    for(int k = 0; k < 2; ++k){
+      const double c = cos(sh[k]->angle), s = sin(sh[k]->angle);
+      const double ia2 = 1. / (sh[k]->vtab.ellipse.halfwidth[0] * sh[k]->vtab.ellipse.halfwidth[0]);
+      const double ib2 = 1. / (sh[k]->vtab.ellipse.halfwidth[1] * sh[k]->vtab.ellipse.halfwidth[1]);
+      Q[k][0] = c*c*ia2 + s*s*ib2;
+      Q[k][1] = c*s*(ia2 - ib2);
+      Q[k][2] = s*s*ia2 + c*c*ib2;
+    }
+    const double scale = Q[0][0] + Q[0][2];
+    return fabs(Q[0][0] - Q[1][0]) <= tol*scale
+      && fabs(Q[0][1] + Q[1][1]) <= tol*scale
+      && fabs(Q[0][2] - Q[1][2]) <= tol*scale;
+  }
+  std::vector<double> va, vb;
+  Shape_GetVertices(a, va);
+  Shape_GetVertices(b, vb);
+  if(va.size() != vb.size()){
+    return 0;
+  }
+  for(size_t i = 0; i < va.size(); i += 2){
+    va[i+axis] = -va[i+axis];
+    bool found = false;
+    for(size_t j = 0; j < vb.size() && !found; j += 2){
+      found = fabs(va[i] - vb[j]) <= len && fabs(va[i+1] - vb[j+1]) <= len;
+    }
+    if(!found){
+      return 0;
+    }
+  }
+  return 1;
+}
+
+// Whether every shape of a layer has its mirror image in the layer and
+// none of its materials couples the x and y components of the field
+static int Layer_IsMirrorSymmetric(const S4_Simulation *S, const S4_Layer *L, int axis){
+  if(L->copy >= 0){
+    L = &S->layer[L->copy];
+  }
+  if(!Material_IsMirrorSymmetric(&S->material[L->material])){
+    return 0;
+  }
+  for(int i = 0; i < L->pattern.nshapes; ++i){
+    const shape *sh = &L->pattern.shapes[i];
+    if(!Material_IsMirrorSymmetric(&S->material[sh->tag])){
+      return 0;
+    }
+    bool found = false;
+    for(int j = 0; j < L->pattern.nshapes && !found; ++j){
+      found = Shape_IsMirrorImage(S, sh, &L->pattern.shapes[j], axis);
+    }
+    if(!found){
+      return 0;
+    }
+  }
+  return 1;
+}
+
+// Makes the symmetry basis (see rcwa.h) of the fields with the mirror
+// symmetries and parities of the options. It spans the [hx; hy] vectors
+// that the mirrors map to themselves times the parity: the mirror x -> -x
+// maps (hx, hy) at G to (hx, -hy) at the mirror image of G, and y -> -y
+// maps them to (-hx, hy). Urow and Uval are allocated with S4_malloc.
+// Returns 17 if the G basis is not closed under the mirrors.
+static int Simulation_GetSymmetryBasis(const S4_Simulation *S, size_t *m, int **Urow, double **Uval){
+  const int n = S->n_G;
+  const int sym = S->options.symmetry;
+  const int parity = S->options.symmetry_parity;
+
+  // The images of the G vectors under the identity, the two mirrors and
+  // their product
+  int *map = (int*)S4_malloc(sizeof(int)*4*n);
+  for(int i = 0; i < n; ++i){
+    map[i] = map[n+i] = map[2*n+i] = i;
+  }
+  for(int axis = 0; axis < 2; ++axis){
+    if((sym & (1 << axis)) && 0 != G_mirror(axis, n, S->Lk, S->G, map+(1+axis)*n)){
+      S4_free(map);
+      return 17;
+    }
+  }
+  for(int i = 0; i < n; ++i){
+    map[3*n+i] = map[2*n+map[n+i]];
+  }
+  const bool used[4] = { true, 0 != (sym & 1), 0 != (sym & 2), 3 == (sym & 3) };
+  const double sign[4][2] = { { 1, 1 }, { 1, -1 }, { -1, 1 }, { -1, -1 } };
+  const double px = (parity & 1) ? -1 : 1;
+  const double py = (parity & 2) ? -1 : 1;
+  const double character[4] = { 1, px, py, px*py };
+
+  *Urow = (int*)S4_malloc(sizeof(int)*4*2*n);
+  *Uval = (double*)S4_malloc(sizeof(double)*4*2*n);
+  std::vector<char> visited(2*n, 0);
+  size_t ncols = 0;
+  for(int c = 0; c < 2; ++c){
+    for(int g = 0; g < n; ++g){
+      if(visited[c*n+g]){ continue; }
+      // Project the unit vector of component c at G onto the sector
+      int rows[4];
+      double vals[4];
+      int nnz = 0;
+      for(int e = 0; e < 4; ++e){
+        if(!used[e]){ continue; }
+        const int r = c*n + map[e*n+g];
+        visited[r] = 1;
+        int k = 0;
+        while(k < nnz && rows[k] != r){ ++k; }
+        if(k == nnz){
+          rows[nnz] = r;
+          vals[nnz++] = 0;
+        }
+        vals[k] += character[e] * sign[e][c];
+      }
+      int *col = *Urow + 4*ncols;
+      double *val = *Uval + 4*ncols;
+      double norm = 0;
+      int len = 0;
+      for(int k = 0; k < nnz; ++k){
+        if(0 != vals[k]){
+          col[len] = rows[k];
+          val[len++] = vals[k];
+          norm += vals[k]*vals[k];
+        }
+      }
+      if(0 == len){ continue; }
+      norm = sqrt(norm);
+      for(int k = 0; k < 4; ++k){
+        if(k < len){
+          val[k] /= norm;
+        }else{
+          col[k] = -1;
+          val[k] = 0;
+        }
+      }
+      ++ncols;
+    }
+  }
+  S4_free(map);
+  *m = ncols;
+  return 0;
+}
+
 // Returns:
 // -n if n-th argument is invalid
 // 1  - allocation error
@@ -1256,6 +1788,9 @@ int Simulation_AddLayerPatternPolygon(
 // 14 - no layers
 // 15 - material not found
 // 16 - invalid 1D layer patterning
+// 17 - the G basis does not have the mirror symmetries of the options
+// 18 - the excitation is not a planewave with the mirror symmetries
+// 19 - a layer does not have the mirror symmetries
 int Simulation_InitSolution(S4_Simulation *S){
   S4_TRACE("> Simulation_InitSolution(S=%p) [omega=%f]\n", S, S->omega[0]);
 
@@ -1342,6 +1877,37 @@ int Simulation_InitSolution(S4_Simulation *S){
     }
     return 13;
   }
+  // Check the mirror symmetries the solution is reduced with
+  for(int axis = 0; axis < 2; ++axis){
+    if(0 == (S->options.symmetry & (1 << axis))){ continue; }
+    int *map = (int*)S4_malloc(sizeof(int)*S->n_G);
+    const int error = G_mirror(axis, S->n_G, S->Lk, S->G, map);
+    S4_free(map);
+    if(0 != error){
+      S4_TRACE("< Simulation_InitSolution (failed; G basis is not mirror symmetric) [omega=%f]\n", S->omega[0]);
+      if(NULL != S->msg){
+        S->msg(S->msgdata, "Simulation_InitSolution", S4_MSG_ERROR, "The lattice or G basis does not have the mirror symmetry");
+      }
+      return 17;
+    }
+    // k is only zero up to the rounding of the angles of incidence
+    if(0 != S->exc.type || fabs(S->k[axis]) > 1e-12){
+      S4_TRACE("< Simulation_InitSolution (failed; excitation is not mirror symmetric) [omega=%f]\n", S->omega[0]);
+      if(NULL != S->msg){
+        S->msg(S->msgdata, "Simulation_InitSolution", S4_MSG_ERROR, "The excitation must be a planewave with the mirror symmetry");
+      }
+      return 18;
+    }
+    for(int i = 0; i < S->n_layers; ++i){
+      if(!Layer_IsMirrorSymmetric(S, &S->layer[i], axis)){
+        S4_TRACE("< Simulation_InitSolution (failed; layer %s is not mirror symmetric) [omega=%f]\n", S->layer[i].name, S->omega[0]);
+        if(NULL != S->msg){
+          S->msg(S->msgdata, "Simulation_InitSolution", S4_MSG_ERROR, "A layer does not have the mirror symmetry");
+        }
+        return 19;
+      }
+    }
+  }
 
   if(NULL != S->solution){
     Simulation_DestroySolution(S);
@@ -1399,9 +1965,9 @@ int Simulation_GetLayerSolution(S4_Simulation *S, S4_Layer *layer, LayerModes **
     if(L == layer){
       if((NULL == L->modes && L->copy < 0) || (L->copy >= 0 && NULL == S->layer[L->copy].modes) || !sol->solved[i]){
         error = Simulation_ComputeLayerSolution(S, L, layer_modes, layer_solution);
-        if(0 != error){ // should never happen
+        if(0 != error){ // only when the mirror symmetries do not hold
           S4_TRACE("< Simulation_GetLayerSolution (failed; Simulation_ComputeLayerSolution returned %d) [omega=%f]\n", error, S->omega[0]);
-          return 2;
+          return error;
         }
         if(L->copy < 0){
           L->modes = *layer_modes;
@@ -1443,6 +2009,399 @@ int S4_Simulation_SolveLayer(S4_Simulation *S, S4_LayerID layer){
   return ret;
 }
 
+// Layer properties in stack order, as passed to the rcwa functions
+struct LayerStack{
+  const double *thickness;
+  const std::complex<double> **q, **Epsilon_inv, **kp, **phi;
+  int *epstype;
+};
+
+// Frees the partial products but keeps the record of the last solve
+static void SMatrixCache_FreeProducts(SMatrixCache *C){
+  S4_free(C->pre);
+  S4_free(C->halves);
+  S4_free(C->iwork);
+  C->pre = C->suf = C->step = C->work = NULL;
+  C->halves = C->left = C->right = C->a = C->b = C->full = NULL;
+  C->iwork = NULL;
+  C->halves_valid = C->full_valid = 0;
+}
+
+// Number of complex numbers in the block of the halves (see SMatrixCache)
+static size_t SMatrixCache_HalvesSize(size_t n4){
+  return 6*n4*n4 + n4*(n4+1);
+}
+
+// Returns the cache with the record of the last solve, (re)allocating it if
+// the stack changed shape, or NULL if out of memory.
+static SMatrixCache* SMatrixCache_Get(S4_Simulation *S){
+  const int N = S->n_layers;
+  SMatrixCache *C = S->smatrix_cache;
+  if(NULL != C && (C->n != S->n_G || C->nlayers != N)){
+    Simulation_DestroySMatrixCache(S);
+    C = NULL;
+  }
+  if(NULL == C){
+    C = new SMatrixCache;
+    C->n = S->n_G;
+    C->nlayers = N;
+    C->pinned = 0;
+    C->pre = C->suf = C->step = C->work = NULL;
+    C->halves = C->left = C->right = C->a = C->b = C->full = NULL;
+    C->iwork = NULL;
+    C->hole = -1;
+    C->halves_valid = C->full_valid = 0;
+    C->serial = (unsigned long*)S4_malloc(sizeof(unsigned long)*N + sizeof(double)*N + sizeof(int)*2*N);
+    if(NULL == C->serial){
+      delete C;
+      return NULL;
+    }
+    C->thickness = (double*)(C->serial + N);
+    C->valid = (int*)(C->thickness + N);
+    for(int i = 0; i < N; ++i){
+      C->serial[i] = 0; // no modes have serial 0
+      C->thickness[i] = -1;
+    }
+    S->smatrix_cache = C;
+  }
+  return C;
+}
+
+// Records the modes and thicknesses of the stack, makes or frees the
+// partial products depending on whether the cache is pinned and on the
+// layers that changed (see SMatrixCache), and marks those that involve a
+// changed layer as stale. See SMatrixCache_Covers for whether a layer can
+// then be solved with them.
+static int SMatrixCache_Update(S4_Simulation *S, const LayerStack &stack){
+  const int N = S->n_layers;
+  const size_t n4 = 4*S->n_G;
+  const size_t nn4 = n4*n4;
+  SMatrixCache *C = SMatrixCache_Get(S);
+  if(NULL == C){
+    return 1;
+  }
+
+  int lo = N, hi = -1;
+  for(int i = 0; i < N; ++i){
+    const S4_Layer *L = &S->layer[i];
+    if(L->copy >= 0){
+      L = &S->layer[L->copy];
+    }
+    if(C->serial[i] != L->modes->serial || C->thickness[i] != stack.thickness[i]){
+      C->serial[i] = L->modes->serial;
+      C->thickness[i] = stack.thickness[i];
+      if(i < lo){ lo = i; }
+      hi = i;
+    }
+  }
+  const bool same_hole = (lo == hi && lo == C->hole);
+  if(lo <= hi && !same_hole){
+    C->hole = (lo == hi ? lo : -1);
+  }
+  if(C->pinned){
+    if(NULL != C->halves){
+      SMatrixCache_FreeProducts(C);
+    }
+    if(NULL == C->pre){
+      C->pre = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>)*((2*N+1)*nn4 + n4*(n4+1)));
+      C->iwork = (size_t*)S4_malloc(sizeof(size_t)*n4);
+      if(NULL == C->pre || NULL == C->iwork){
+        // Not worth failing over; solve without the products
+        SMatrixCache_FreeProducts(C);
+        return 0;
+      }
+      C->suf = C->pre + N*nn4;
+      C->step = C->suf + N*nn4;
+      C->work = C->step + nn4;
+      for(int i = 0; i < 2*N; ++i){
+        C->valid[i] = 0;
+      }
+      // Single layer stacks have identity S-matrices
+      InitSMatrix(S->n_G, C->pre);
+      InitSMatrix(S->n_G, C->suf+(N-1)*nn4);
+      C->valid[0] = 1;
+      C->valid[N+N-1] = 1;
+      return 0;
+    }
+  }else{
+    if(NULL != C->pre){
+      SMatrixCache_FreeProducts(C);
+    }
+    if(lo > hi){ // nothing changed
+      return 0;
+    }
+    if(same_hole && N > 1){
+      // The same layer changed again; the halves around it still hold
+      if(NULL == C->halves){
+        C->halves = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>)*SMatrixCache_HalvesSize(n4));
+        C->iwork = (size_t*)S4_malloc(sizeof(size_t)*n4);
+        if(NULL == C->halves || NULL == C->iwork){
+          SMatrixCache_FreeProducts(C);
+          return 0;
+        }
+        C->left = C->halves;
+        C->right = C->left + nn4;
+        C->a = C->right + nn4;
+        C->b = C->a + nn4;
+        C->full = C->b + nn4;
+        C->step = C->full + nn4;
+        C->work = C->step + nn4;
+        C->halves_valid = 0;
+      }
+      C->full_valid = 0;
+    }else{
+      SMatrixCache_FreeProducts(C);
+    }
+    return 0;
+  }
+  // S(0,l) involves layers 0..l and S(l,N) involves layers l..N
+  for(int l = (lo > 1 ? lo : 1); l < N; ++l){
+    C->valid[l] = 0;
+  }
+  for(int l = 0; l <= hi && l < N-1; ++l){
+    C->valid[N+l] = 0;
+  }
+  return 0;
+}
+
+// Computes the S-matrix of layers i and i+1 into C->step
+static void SMatrixCache_Step(S4_Simulation *S, SMatrixCache *C, const LayerStack &stack, int i){
+  S4_ProfileScope profile_scope(S->profile, S4_PROFILE_SMATRIX);
+  GetSMatrix(2, S->n_G, S->kx, S->ky, std::complex<double>(S->omega[0], S->omega[1]),
+    stack.thickness+i, stack.q+i, stack.Epsilon_inv+i, stack.epstype+i, stack.kp+i, stack.phi+i,
+    C->step, C->work, C->iwork, 4*S->n_G*(4*S->n_G+1));
+}
+
+// Returns S(0,l), extending the longest valid prefix. The S-matrix of the
+// whole stack is instead bridged to the nearest valid suffix.
+static const std::complex<double>* SMatrixCache_Prefix(S4_Simulation *S, const LayerStack &stack, int l){
+  SMatrixCache *C = S->smatrix_cache;
+  const int N = C->nlayers;
+  const size_t n4 = 4*C->n;
+  const size_t nn4 = n4*n4;
+  if(C->valid[l]){
+    return C->pre+l*nn4;
+  }
+  int j = l-1;
+  while(!C->valid[j]){ --j; }
+  int stop = l;
+  if(N-1 == l){
+    stop = j+1;
+    while(stop < N-1 && !C->valid[N+stop]){ ++stop; }
+  }
+  for(int i = j; i < stop; ++i){
+    SMatrixCache_Step(S, C, stack, i);
+    CombineSMatrix(C->n, C->pre+i*nn4, C->step, C->pre+(i+1)*nn4, C->work, C->iwork);
+    C->valid[i+1] = 1;
+  }
+  if(stop != l){
+    CombineSMatrix(C->n, C->pre+stop*nn4, C->suf+stop*nn4, C->pre+l*nn4, C->work, C->iwork);
+    C->valid[l] = 1;
+  }
+  if(N-1 == l && !C->valid[N+0]){
+    memcpy(C->suf, C->pre+l*nn4, sizeof(std::complex<double>)*nn4);
+    C->valid[N+0] = 1;
+  }
+  return C->pre+l*nn4;
+}
+
+// Returns S(l,N), extending the longest valid suffix. The S-matrix of the
+// whole stack is instead bridged to the nearest valid prefix.
+static const std::complex<double>* SMatrixCache_Suffix(S4_Simulation *S, const LayerStack &stack, int l){
+  SMatrixCache *C = S->smatrix_cache;
+  const int N = C->nlayers;
+  const size_t n4 = 4*C->n;
+  const size_t nn4 = n4*n4;
+  if(C->valid[N+l]){
+    return C->suf+l*nn4;
+  }
+  int m = l+1;
+  while(!C->valid[N+m]){ ++m; }
+  int stop = l;
+  if(0 == l){
+    stop = m-1;
+    while(stop > 0 && !C->valid[stop]){ --stop; }
+  }
+  for(int i = m; i > stop; --i){
+    SMatrixCache_Step(S, C, stack, i-1);
+    CombineSMatrix(C->n, C->step, C->suf+i*nn4, C->suf+(i-1)*nn4, C->work, C->iwork);
+    C->valid[N+i-1] = 1;
+  }
+  if(stop != l){
+    CombineSMatrix(C->n, C->pre+stop*nn4, C->suf+stop*nn4, C->suf+l*nn4, C->work, C->iwork);
+    C->valid[N+l] = 1;
+  }
+  if(0 == l && !C->valid[N-1]){
+    memcpy(C->pre+(N-1)*nn4, C->suf, sizeof(std::complex<double>)*nn4);
+    C->valid[N-1] = 1;
+  }
+  return C->suf+l*nn4;
+}
+
+// Returns whether a layer can be solved with the cached products: any layer
+// while they are pinned, and otherwise the changed layer and the two
+// outermost ones once the halves around it are kept.
+static bool SMatrixCache_Covers(const SMatrixCache *C, int which_layer){
+  if(NULL != C->pre){
+    return true;
+  }
+  return NULL != C->halves && (
+    which_layer == C->hole || 0 == which_layer || C->nlayers-1 == which_layer
+  );
+}
+
+// Brings the halves around the changed layer up to date, building them on
+// first use, and forms S(0,hole), S(hole,N) and S(0,N) from them. Only the
+// two interfaces of the changed layer are recomputed once the halves hold.
+static void SMatrixCache_Around(S4_Simulation *S, const LayerStack &stack){
+  SMatrixCache *C = S->smatrix_cache;
+  const int N = C->nlayers;
+  const int k = C->hole;
+  const size_t n4 = 4*C->n;
+  const size_t nn4 = n4*n4;
+  if(!C->halves_valid){
+    InitSMatrix(C->n, C->left);
+    for(int i = 0; i+1 < k; ++i){
+      SMatrixCache_Step(S, C, stack, i);
+      CombineSMatrix(C->n, C->left, C->step, C->a, C->work, C->iwork);
+      memcpy(C->left, C->a, sizeof(std::complex<double>)*nn4);
+    }
+    InitSMatrix(C->n, C->right);
+    for(int i = N-2; i > k; --i){
+      SMatrixCache_Step(S, C, stack, i);
+      CombineSMatrix(C->n, C->step, C->right, C->b, C->work, C->iwork);
+      memcpy(C->right, C->b, sizeof(std::complex<double>)*nn4);
+    }
+    C->halves_valid = 1;
+  }
+  if(!C->full_valid){
+    if(k > 0){
+      SMatrixCache_Step(S, C, stack, k-1);
+      CombineSMatrix(C->n, C->left, C->step, C->a, C->work, C->iwork);
+    }else{
+      InitSMatrix(C->n, C->a);
+    }
+    if(k < N-1){
+      SMatrixCache_Step(S, C, stack, k);
+      CombineSMatrix(C->n, C->step, C->right, C->b, C->work, C->iwork);
+    }else{
+      InitSMatrix(C->n, C->b);
+    }
+    CombineSMatrix(C->n, C->a, C->b, C->full, C->work, C->iwork);
+    C->full_valid = 1;
+  }
+}
+
+// Solves for the mode amplitudes in one layer, using the cached partial
+// S-matrices if they cover it (see SMatrixCache_Covers), and SolveInterior
+// otherwise. The cache must have been updated with SMatrixCache_Update.
+static int Simulation_SolveLayerCached(
+  S4_Simulation *S, const LayerStack &stack, int which_layer,
+  std::complex<double> *a0, std::complex<double> *bN,
+  std::complex<double> *ab
+){
+  SMatrixCache *C = S->smatrix_cache;
+  if(NULL == C->pre && SMatrixCache_Covers(C, which_layer)){
+    SMatrixCache_Around(S, stack);
+    const std::complex<double> *S0l = C->a;
+    const std::complex<double> *SlN = C->b;
+    if(which_layer != C->hole){
+      // S(l,l) is the identity; step is free again at this point
+      InitSMatrix(C->n, C->step);
+      S0l = (0 == which_layer ? C->step : C->full);
+      SlN = (0 == which_layer ? C->full : C->step);
+    }
+    SolveInteriorSMatrix(S->n_G, S0l, SlN, a0, bN, ab, C->work, C->iwork);
+    return 0;
+  }
+  if(NULL == C->pre){
+    return SolveInterior(
+      S->n_layers, which_layer, S->n_G, S->kx, S->ky,
+      std::complex<double>(S->omega[0], S->omega[1]),
+      stack.thickness, stack.q, stack.Epsilon_inv, stack.epstype, stack.kp, stack.phi,
+      a0, bN, ab);
+  }
+  const std::complex<double> *S0l = SMatrixCache_Prefix(S, stack, which_layer);
+  const std::complex<double> *SlN = SMatrixCache_Suffix(S, stack, which_layer);
+  SolveInteriorSMatrix(S->n_G, S0l, SlN, a0, bN, ab, C->work, C->iwork);
+  return 0;
+}
+
+// Solves for the mode amplitudes in one layer for a planewave incident on
+// the front (or back) of the stack, restricted to the fields with the
+// mirror symmetries of the options. h = [hx; hy] is the incident field.
+// Returns 20 if it does not have the symmetries.
+static int Simulation_SolveLayerSymmetric(
+  S4_Simulation *S, const LayerStack &stack, int which_layer, bool backwards,
+  const std::complex<double> *h, std::complex<double> *ab
+){
+  size_t m;
+  int *Urow;
+  double *Uval;
+  int error = Simulation_GetSymmetryBasis(S, &m, &Urow, &Uval);
+  if(0 != error){
+    return error;
+  }
+  const int ind_fb = (backwards ? S->n_layers-1 : 0);
+  std::complex<double> *a = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>)*2*S->n_G);
+  if(0 != GetModeAmplitudes_projected(S->n_G, stack.phi[ind_fb], m, Urow, Uval, h, a)){
+    if(NULL != S->msg){
+      S->msg(S->msgdata, "Simulation_SolveLayerSymmetric", S4_MSG_ERROR, "The excitation does not have the mirror symmetry and parity");
+    }
+    error = 20;
+  }else{
+    error = SolveInterior_projected(
+      S->n_layers, which_layer, S->n_G, S->kx, S->ky,
+      std::complex<double>(S->omega[0], S->omega[1]),
+      stack.thickness, stack.q, stack.Epsilon_inv, stack.epstype, stack.kp, stack.phi,
+      m, Urow, Uval,
+      backwards ? NULL : a, backwards ? a : NULL, ab);
+  }
+  S4_free(a);
+  S4_free(Uval);
+  S4_free(Urow);
+  return error;
+}
+
+// Installs S(0,l) and S(l,N) for a new thickness d of an interior layer l,
+// given copies pre0 and suf0 made with layer l at zero thickness. The
+// thickness only scales the columns that carry amplitudes into layer l by
+// exp(i q d), so no interfaces are recomputed. The S-matrix of the whole
+// stack is remade from the two, and the other products through layer l are
+// marked stale.
+static void SMatrixCache_SetThickness(
+  S4_Simulation *S, int l, const std::complex<double> *q, double d,
+  const std::complex<double> *pre0, const std::complex<double> *suf0
+){
+  SMatrixCache *C = S->smatrix_cache;
+  const int N = C->nlayers;
+  const size_t n2 = 2*C->n;
+  const size_t n4 = 2*n2;
+  const size_t nn4 = n4*n4;
+  std::complex<double> *pre = C->pre+l*nn4;
+  std::complex<double> *suf = C->suf+l*nn4;
+  memcpy(pre, pre0, sizeof(std::complex<double>)*nn4);
+  memcpy(suf, suf0, sizeof(std::complex<double>)*nn4);
+  for(size_t i = 0; i < n2; ++i){
+    const std::complex<double> f = std::exp(q[i] * std::complex<double>(0,d));
+    RNP::TBLAS::Scale(n4, f, &pre[0+(n2+i)*n4], 1); // S12 and S22 of S(0,l)
+    RNP::TBLAS::Scale(n4, f, &suf[0+i*n4], 1); // S11 and S21 of S(l,N)
+  }
+  C->thickness[l] = d;
+  for(int k = l+1; k < N; ++k){
+    C->valid[k] = 0;
+  }
+  for(int k = 0; k < l; ++k){
+    C->valid[N+k] = 0;
+  }
+  C->valid[l] = 1;
+  C->valid[N+l] = 1;
+  CombineSMatrix(C->n, pre, suf, C->pre+(N-1)*nn4, C->work, C->iwork);
+  memcpy(C->suf, C->pre+(N-1)*nn4, sizeof(std::complex<double>)*nn4);
+  C->valid[N-1] = 1;
+  C->valid[N+0] = 1;
+}
+
 int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **layer_modes, std::complex<double> **layer_solution)
     {
   S4_TRACE("> Simulation_ComputeLayerSolution(S=%p, L=%p (%s), layer_modes=%p (%p), LayerSolution=%p (%p)) [omega=%f]\n",
@@ -1450,9 +2409,9 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
   if(NULL != layer_modes && NULL == layer_solution)
         {
     // only need to compute modes for L
-    Simulation_ComputeLayerModes(S, L, layer_modes);
+    const int error = Simulation_ComputeLayerModes(S, L, layer_modes);
     S4_TRACE("< Simulation_ComputeLayerSolution [omega=%f]\n", S->omega[0]);
-    return 0;
+    return error;
         }
   if(NULL == layer_solution)
         {
@@ -1462,6 +2421,7 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
   // At this point, layer_solution != NULL, we need to get all modes
 
   S4_VERB(1, "Computing solution in layer: %s\n", NULL != L->name ? L->name : "");
+  S4_ProfileScope profile_scope(S->profile, S4_PROFILE_SOLVE);
 
   const size_t n = S->n_G;
   const size_t n2 = 2*n;
@@ -1476,7 +2436,12 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
     S4_Layer *SL = &(S->layer[i]);
     if(NULL == SL->modes && SL->copy < 0)
             {
-      Simulation_ComputeLayerModes(S, SL, &SL->modes);
+      const int error = Simulation_ComputeLayerModes(S, SL, &SL->modes);
+      if(0 != error)
+                {
+        S4_TRACE("< Simulation_ComputeLayerSolution (failed; Simulation_ComputeLayerModes returned %d) [omega=%f]\n", error, S->omega[0]);
+        return error;
+                }
             }
     if(L == SL)
             {
@@ -1548,13 +2513,18 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
     // [     phi            phi       ] [ b ]   [ hx;hy ]
     // We assume b = 0 or a = 0.
     // ab = inv(phi)*[ hx;hy ]
-    if(NULL != lphi[ind_fb])
+    if(NULL != lphi[ind_fb] && 0 == S->options.symmetry)
             {
       RNP::TBLAS::CopyMatrix<'A'>(n2,n2, lphi[ind_fb],n2, phicopy,n2);
       RNP::LinearSolve<'N'>(n2,1, phicopy,n2, ab0,n2, NULL, NULL);
             }
 
-    if(S->options.use_less_memory)
+    if(0 != S->options.symmetry)
+            {
+      const LayerStack stack = { lthick, lq, lepsinv, lkp, lphi, lepstype };
+      error = Simulation_SolveLayerSymmetric(S, stack, which_layer, inc_back, ab0, (*layer_solution));
+            }
+    else if(S->options.use_less_memory)
             {
       S4_TRACE("I  Calling SolveInterior(layer_count=%d, which_layer=%d, n=%d, lthick,lq,lkp,lphi={\n", S->n_layers, which_layer, S->n_G);
       for(int i = 0; i < S->n_layers; ++i)
@@ -1578,32 +2548,45 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
             }
         else
             {
-      // Solve all at once
-      std::complex<double> *pab = sol->ab;
-      memset(pab, 0, sizeof(std::complex<double>) * S->n_layers * n4);
-      if(!inc_back)
+      const LayerStack stack = { lthick, lq, lepsinv, lkp, lphi, lepstype };
+      error = SMatrixCache_Update(S, stack);
+      if(0 == error && SMatrixCache_Covers(S->smatrix_cache, which_layer))
                 {
-        memcpy(pab, ab0, sizeof(std::complex<double>) * n2);
+        // Reuse the partial S-matrices of the layers that did not change
+        error = Simulation_SolveLayerCached(S, stack, which_layer,
+          inc_back ? NULL : ab0, // a0
+          inc_back ? ab0 : NULL, // bN
+          (*layer_solution));
                 }
-            else
+            else if(0 == error)
                 {
-        memcpy(&pab[S->n_layers*n4 - n2], ab0, sizeof(std::complex<double>) * n2);
-                }
-      const size_t lwork = 6*S->n_layers*n2*n2;
-      std::complex<double> *work = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>) * lwork);
-      size_t *iwork = (size_t*)S4_malloc(sizeof(size_t) * S->n_layers*n2);
-      SolveAll(
-        S->n_layers, S->n_G, S->kx, S->ky,
-        std::complex<double>(S->omega[0], S->omega[1]),
-        lthick, lq, lepsinv, lepstype, lkp, lphi,
-        pab,
-        work, iwork, lwork
-                );
-      S4_free(iwork);
-      S4_free(work);
-      for(size_t i = 0; i < S->n_layers; ++i)
-                {
-        sol->solved[i] = 1;
+        // Solve all at once
+        std::complex<double> *pab = sol->ab;
+        memset(pab, 0, sizeof(std::complex<double>) * S->n_layers * n4);
+        if(!inc_back)
+                    {
+          memcpy(pab, ab0, sizeof(std::complex<double>) * n2);
+                    }
+                else
+                    {
+          memcpy(&pab[S->n_layers*n4 - n2], ab0, sizeof(std::complex<double>) * n2);
+                    }
+        const size_t lwork = 6*S->n_layers*n2*n2;
+        std::complex<double> *work = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>) * lwork);
+        size_t *iwork = (size_t*)S4_malloc(sizeof(size_t) * S->n_layers*n2);
+        SolveAll(
+          S->n_layers, S->n_G, S->kx, S->ky,
+          std::complex<double>(S->omega[0], S->omega[1]),
+          lthick, lq, lepsinv, lepstype, lkp, lphi,
+          pab,
+          work, iwork, lwork
+                    );
+        S4_free(iwork);
+        S4_free(work);
+        for(size_t i = 0; i < S->n_layers; ++i)
+                    {
+          sol->solved[i] = 1;
+                    }
                 }
             }
     S4_free(ab0);
@@ -1656,15 +2639,23 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
     }
     S4_TRACE("I   }, a0[0]=%f,%f, a0[n]=%f,%f, ...) [omega=%f]\n", a0[0].real(), a0[0].imag(), a0[S->n_G].real(), a0[S->n_G].imag(), S->omega[0]);
 
-    error = SolveInterior(
-      S->n_layers, which_layer,
-      S->n_G,
-      S->kx, S->ky,
-      std::complex<double>(S->omega[0], S->omega[1]),
-      lthick, lq, lepsinv, lepstype, lkp, lphi,
-      a0, // length 2*n
-      bN, // bN
-      (*layer_solution));
+    if(S->options.use_less_memory){
+      error = SolveInterior(
+        S->n_layers, which_layer,
+        S->n_G,
+        S->kx, S->ky,
+        std::complex<double>(S->omega[0], S->omega[1]),
+        lthick, lq, lepsinv, lepstype, lkp, lphi,
+        a0, // length 2*n
+        bN, // bN
+        (*layer_solution));
+    }else{
+      const LayerStack stack = { lthick, lq, lepsinv, lkp, lphi, lepstype };
+      error = SMatrixCache_Update(S, stack);
+      if(0 == error){
+        error = Simulation_SolveLayerCached(S, stack, which_layer, a0, bN, (*layer_solution));
+      }
+    }
     S4_free(a0);
   }else if(1 == S->exc.type){
     S4_Layer *l[2];
@@ -1825,12 +2816,53 @@ int Simulation_ComputeLayerSolution(S4_Simulation *S, S4_Layer *L, LayerModes **
   return 0;
 }
 
-double Simulation_GetUnitCellSize(const S4_Simulation *S){
-  if(0 == S->Lr[2] && 0 == S->Lr[3]){
-    return hypot(S->Lr[0], S->Lr[1]);
-  }else{
-    return fabs(S->Lr[0]*S->Lr[3] - S->Lr[1]*S->Lr[2]);
+double Simulation_GetUnitCellSize(const S4_Simulation *S){
+  if(0 == S->Lr[2] && 0 == S->Lr[3]){
+    return hypot(S->Lr[0], S->Lr[1]);
+  }else{
+    return fabs(S->Lr[0]*S->Lr[3] - S->Lr[1]*S->Lr[2]);
+  }
+}
+
+// Whether the epsilon of a material is Hermitian
+static int Material_IsLossless(const S4_Material *M){
+  if(0 == M->type){
+    return 0 == M->eps.s[1];
+  }
+  const double *e = M->eps.abcde;
+  return 0 == e[1] && 0 == e[7] && 0 == e[9] && e[2] == e[4] && e[3] == -e[5];
+}
+
+// Whether every material of a layer is lossless, so that at a real
+// frequency its eigenoperator may be reduced to a Hermitian one
+static int Layer_IsLossless(const S4_Simulation *S, const S4_Layer *L){
+  if(L->copy >= 0){
+    L = &S->layer[L->copy];
+  }
+  if(!Material_IsLossless(&S->material[L->material])){
+    return 0;
+  }
+  for(int i = 0; i < L->pattern.nshapes; ++i){
+    if(!Material_IsLossless(&S->material[L->pattern.shapes[i].tag])){
+      return 0;
+    }
+  }
+  return 1;
+}
+
+// Computes the modes of a lossless layer with the Hermitian eigensolver.
+// Returns whether it succeeded; if not, the general eigensolver must be
+// used, and a failure of the Hermitian eigensolver itself is reported.
+static bool Simulation_SolveLayerHermitian(S4_Simulation *S, const S4_Layer *L, LayerModes *pB){
+  const int ret = SolveLayerEigensystem_hermitian(
+    S->omega[0], S->n_G, S->kx, S->ky,
+    pB->Epsilon_inv, pB->Epsilon2, pB->epstype, pB->q, pB->kp, pB->phi);
+  if(1 == ret){
+    S4_VERB(2, "Hermitian eigensolver does not apply to layer: %s\n", NULL != L->name ? L->name : "");
+  }else if(0 != ret && NULL != S->msg){
+    S->msg(S->msgdata, "Simulation_ComputeLayerModes", S4_MSG_WARNING, "Hermitian eigensolver failed; using the general eigensolver");
   }
+  return 0 == ret;
 }
 
 int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **layer_modes)
@@ -1852,10 +2884,25 @@ int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **lay
         return 0;
         }
 
+    std::string key;
+    *layer_modes = LayerModesCache_Lookup(S, L, key);
+    if(NULL != *layer_modes)
+        {
+        S4_TRACE("< Simulation_ComputeLayerModes (cached) [omega=%f]\n", S->omega[0]);
+        return 0;
+        }
+
     S4_VERB(1, "Computing modes of layer: %s\n", NULL != L->name ? L->name : "");
 
-    *layer_modes = (LayerModes*)malloc(sizeof(LayerModes));
+    *layer_modes = new LayerModes;
     LayerModes *pB = *layer_modes;
+    pB->refcount = 1;
+    pB->serial = ++layer_modes_serial;
+    pB->n = S->n_G;
+    pB->n_exact = 2*S->n_G;
+    pB->n_valid = 2*S->n_G;
+    pB->residual = 0;
+    pB->approx_residual = 0;
     const int n = S->n_G;
     const int n2 = 2*n;
     const int nn = n*n;
@@ -1865,10 +2912,10 @@ int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **lay
     size_t phi_size = n2n2;
     size_t Epsilon_inv_size = nn;
     size_t Epsilon2_size = n2n2;
-    pB->epstype = EPSILON2_TYPE_FULL;
+    int epstype = EPSILON2_TYPE_FULL;
+    const S4_Material *M = NULL; // background material of a uniform layer
     if(0 == L->pattern.nshapes)
         {
-        const S4_Material *M;
         if(L->copy < 0)
             {
             M = &S->material[L->material];
@@ -1880,7 +2927,7 @@ int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **lay
         if(0 == M->type)
             {
             phi_size = 0;
-            pB->epstype = EPSILON2_TYPE_BLKDIAG1_SCALAR;
+            epstype = EPSILON2_TYPE_BLKDIAG1_SCALAR;
             }
         }
     if(S->options.use_less_memory)
@@ -1890,13 +2937,10 @@ int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **lay
 
     pB->q = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>)*(
             2*n + // for q
-            kp_size + phi_size + Epsilon_inv_size + Epsilon2_size
+            kp_size + phi_size
             ));
     pB->kp = pB->q + n2;
     pB->phi = pB->kp + kp_size;
-    pB->Epsilon_inv = pB->phi + phi_size;
-    pB->Epsilon2 = pB->Epsilon_inv + Epsilon_inv_size;
-    //pB->Epsilon = pB->Epsilon2 + n2n2;
 
     if(0 == phi_size)
         {
@@ -1907,119 +2951,199 @@ int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **lay
         pB->kp = NULL;
         }
 
-    // Outline of the epsilon matrix generation code below:
-    //
-    // If no shapes
-    //   If background material is scalar epsilon
-    //     Solve uniform layer eigensystem
-    //   Else
-    //     Generate the 4 quadrants of Epsilon2 and solve the generic layer eigensystem
-    // Else -- not uniform layer
-    //   If discretize epsilon
-    //     If using subpixel smoothing
-    //       Apply Kottke
-    //     ElseIf polarization basis
-    //       If use complex basis
-    //         Apply PolBasisJones
-    //       Else
-    //         Apply PolBasisNV
-    //     Else
-    //       Apply FFT
-    //   Else
-    //     Apply ClosedForm
-    if(0 == L->pattern.nshapes)
+    // The epsilon matrices do not depend on the frequency or k-vector, so
+    // they are cached on the layer and only rebuilt when the structure, the
+    // G basis or the FMM options change. Copies are not cached since their
+    // structure belongs to another layer.
+    LayerEpsilon *E = (L->copy < 0) ? L->epsilon : NULL;
+    if(NULL != E && !LayerEpsilon_IsCurrent(E, S))
         {
-        const S4_Material *M;
-        if(L->copy < 0)
-            {
-            //eps_scalar = Simulation_GetEpsilonByName(S, L->material);
-            M = &S->material[L->material];
-            }
-        else
-            {
-            //eps_scalar = Simulation_GetEpsilonByName(S, Simulation_GetLayerByName(S, L->copy, NULL)->material);
-            M = &S->material[S->layer[L->copy].material];
-            }
-        if(0 == M->type)
-            {
-            std::complex<double> eps_scalar(M->eps.s[0], M->eps.s[1]);
-            RNP::TBLAS::SetMatrix<'A'>(n,n,0.,1./eps_scalar,pB->Epsilon_inv, n);
-            RNP::TBLAS::SetMatrix<'A'>(n2,n2,0.,eps_scalar,pB->Epsilon2, n2);
-            SolveLayerEigensystem_uniform(
-                std::complex<double>(S->omega[0],S->omega[1]), n, S->kx, S->ky,
-                eps_scalar, pB->q, pB->kp, pB->phi);
-            }
-        else
-            {
-            RNP::TBLAS::SetMatrix<'A'>(n,n,0.,1./std::complex<double>(M->eps.abcde[8],M->eps.abcde[9]),pB->Epsilon_inv, n);
-            RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[0],M->eps.abcde[1]),&pB->Epsilon2[0+0*n2], n2);
-            RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[4],M->eps.abcde[5]),&pB->Epsilon2[n+0*n2], n2);
-            RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[2],M->eps.abcde[3]),&pB->Epsilon2[0+n*n2], n2);
-            RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[6],M->eps.abcde[7]),&pB->Epsilon2[n+n*n2], n2);
-
-            S4_VERB(1, "Solving eigensystem of layer: %s\n", NULL != L->name ? L->name : "");
-            SolveLayerEigensystem(
-                std::complex<double>(S->omega[0],S->omega[1]), n, S->kx, S->ky,
-                pB->Epsilon_inv, pB->Epsilon2, pB->epstype, pB->q, pB->kp, pB->phi);
-            }
+        LayerEpsilon_Release(E);
+        L->epsilon = NULL;
+        E = NULL;
+        }
+    if(NULL != E)
+        {
+        ++E->refcount;
         }
     else
-        { // not a uniform layer
-        S4_VERB(1, "Generating epsilon matrix of layer: %s\n", NULL != L->name ? L->name : "");
-        if(S->options.use_experimental_fmm)
+        {
+        E = new LayerEpsilon;
+        E->refcount = 1;
+        E->n = n;
+        E->options = S->options;
+        E->epstype = epstype;
+        E->Epsilon_inv = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>)*(
+                Epsilon_inv_size + Epsilon2_size
+                ));
+        E->Epsilon2 = E->Epsilon_inv + Epsilon_inv_size;
+
+        // Outline of the epsilon matrix generation code below:
+        //
+        // If no shapes
+        //   If background material is scalar epsilon
+        //     Fill in the scalar (diagonal) matrices
+        //   Else
+        //     Generate the 4 quadrants of Epsilon2
+        // Else -- not uniform layer
+        //   If discretize epsilon
+        //     If using subpixel smoothing
+        //       Apply Kottke
+        //     ElseIf polarization basis
+        //       If use complex basis
+        //         Apply PolBasisJones
+        //       Else
+        //         Apply PolBasisNV
+        //     Else
+        //       Apply FFT
+        //   Else
+        //     Apply ClosedForm
+        if(NULL != M)
             {
-            FMMGetEpsilon_Experimental(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
+            if(0 == M->type)
+                {
+                std::complex<double> eps_scalar(M->eps.s[0], M->eps.s[1]);
+                RNP::TBLAS::SetMatrix<'A'>(n,n,0.,1./eps_scalar,E->Epsilon_inv, n);
+                RNP::TBLAS::SetMatrix<'A'>(n2,n2,0.,eps_scalar,E->Epsilon2, n2);
+                }
+            else
+                {
+                RNP::TBLAS::SetMatrix<'A'>(n,n,0.,1./std::complex<double>(M->eps.abcde[8],M->eps.abcde[9]),E->Epsilon_inv, n);
+                RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[0],M->eps.abcde[1]),&E->Epsilon2[0+0*n2], n2);
+                RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[4],M->eps.abcde[5]),&E->Epsilon2[n+0*n2], n2);
+                RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[2],M->eps.abcde[3]),&E->Epsilon2[0+n*n2], n2);
+                RNP::TBLAS::SetMatrix<'A'>(n,n,0.,std::complex<double>(M->eps.abcde[6],M->eps.abcde[7]),&E->Epsilon2[n+n*n2], n2);
+                }
             }
         else
-            {
-            if(S->options.use_discretized_epsilon)
+            { // not a uniform layer
+            S4_VERB(1, "Generating epsilon matrix of layer: %s\n", NULL != L->name ? L->name : "");
+            if(S->options.use_experimental_fmm)
+                {
+                FMMGetEpsilon_Experimental(S, L, n, E->Epsilon2, E->Epsilon_inv);
+                }
+            else
                 {
-                if(S->options.use_subpixel_smoothing)
+                if(S->options.use_discretized_epsilon)
                     {
-                    FMMGetEpsilon_Kottke(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
+                    if(S->options.use_subpixel_smoothing)
+                        {
+                        FMMGetEpsilon_Kottke(S, L, n, E->Epsilon2, E->Epsilon_inv);
+                        }
+                    else
+                        { // not using subpixel smoothing
+                        FMMGetEpsilon_FFT(S, L, n, E->Epsilon2, E->Epsilon_inv);
+                        if(S->options.use_polarization_basis)
+                            {
+                            if(S->options.use_jones_vector_basis)
+                                {
+                                FMMGetEpsilon_PolBasisJones(S, L, n, E->Epsilon2, E->Epsilon_inv);
+                                }
+                            else if(S->options.use_normal_vector_basis)
+                                {
+                                FMMGetEpsilon_PolBasisNV(S, L, n, E->Epsilon2, E->Epsilon_inv);
+                                }
+                            else
+                                {
+                                FMMGetEpsilon_PolBasisVL(S, L, n, E->Epsilon2, E->Epsilon_inv);
+                                }
+                            }
+                        }
                     }
                 else
-                    { // not using subpixel smoothing
-                    FMMGetEpsilon_FFT(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
+                    {
+                    FMMGetEpsilon_ClosedForm(S, L, n, E->Epsilon2, E->Epsilon_inv);
                     if(S->options.use_polarization_basis)
                         {
                         if(S->options.use_jones_vector_basis)
                             {
-                            FMMGetEpsilon_PolBasisJones(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
+                            FMMGetEpsilon_PolBasisJones(S, L, n, E->Epsilon2, E->Epsilon_inv);
                             }
                         else if(S->options.use_normal_vector_basis)
                             {
-                            FMMGetEpsilon_PolBasisNV(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
+                            FMMGetEpsilon_PolBasisNV(S, L, n, E->Epsilon2, E->Epsilon_inv);
                             }
                         else
                             {
-                            FMMGetEpsilon_PolBasisVL(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
+                            FMMGetEpsilon_PolBasisVL(S, L, n, E->Epsilon2, E->Epsilon_inv);
                             }
                         }
                     }
                 }
-            else
+            }
+        if(L->copy < 0)
+            {
+            L->epsilon = E;
+            ++E->refcount;
+            }
+        }
+    pB->eps = E;
+    pB->Epsilon_inv = E->Epsilon_inv;
+    pB->Epsilon2 = E->Epsilon2;
+    pB->epstype = E->epstype;
+
+    const int hermitian = S->options.use_hermitian_eigensolver
+        && 0 == S->omega[1] && Layer_IsLossless(S, L);
+    S4_ProfileScope profile_scope(S->profile, S4_PROFILE_EIGENSOLVE);
+    if(NULL != M && 0 == M->type)
+        {
+        std::complex<double> eps_scalar(M->eps.s[0], M->eps.s[1]);
+        SolveLayerEigensystem_uniform(
+            std::complex<double>(S->omega[0],S->omega[1]), n, S->kx, S->ky,
+            eps_scalar, pB->q, pB->kp, pB->phi);
+        }
+    else if(0 != S->options.symmetry)
+        {
+        // Only the modes of the symmetry sector are computed
+        S4_VERB(1, "Solving symmetric eigensystem of layer: %s\n", NULL != L->name ? L->name : "");
+        size_t m;
+        int *Urow;
+        double *Uval;
+        int error = Simulation_GetSymmetryBasis(S, &m, &Urow, &Uval);
+        if(0 == error)
+            {
+            if(0 != SolveLayerEigensystem_projected(
+                std::complex<double>(S->omega[0],S->omega[1]), n, S->kx, S->ky,
+                pB->Epsilon_inv, pB->Epsilon2, pB->epstype, m, Urow, Uval,
+                pB->q, pB->kp, pB->phi))
                 {
-                FMMGetEpsilon_ClosedForm(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
-                if(S->options.use_polarization_basis)
-                    {
-                    if(S->options.use_jones_vector_basis)
-                        {
-                        FMMGetEpsilon_PolBasisJones(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
-                        }
-                    else if(S->options.use_normal_vector_basis)
-                        {
-                        FMMGetEpsilon_PolBasisNV(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
-                        }
-                    else
-                        {
-                        FMMGetEpsilon_PolBasisVL(S, L, n, pB->Epsilon2, pB->Epsilon_inv);
-                        }
-                    }
+                error = 19;
                 }
+            pB->n_valid = (int)m;
+            S4_free(Uval);
+            S4_free(Urow);
+            }
+        if(0 != error)
+            {
+            LayerModes_Release(pB);
+            *layer_modes = NULL;
+            S4_TRACE("< Simulation_ComputeLayerModes (failed; layer is not mirror symmetric) [omega=%f]\n", S->omega[0]);
+            return error;
+            }
+        }
+    else if(NULL != M)
+        {
+        S4_VERB(1, "Solving eigensystem of layer: %s\n", NULL != L->name ? L->name : "");
+        if(!hermitian || !Simulation_SolveLayerHermitian(S, L, pB))
+            {
+            SolveLayerEigensystem(
+                std::complex<double>(S->omega[0],S->omega[1]), n, S->kx, S->ky,
+                pB->Epsilon_inv, pB->Epsilon2, pB->epstype, pB->q, pB->kp, pB->phi);
             }
+        }
+    else
+        {
 // std::cerr << pB->Epsilon2[0] << "\t" << pB->Epsilon2[1] << "\t" << pB->Epsilon_inv[0] << "\t" << pB->Epsilon_inv[1] << std::endl;
         S4_VERB(1, "Solving eigensystem of layer: %s\n", NULL != L->name ? L->name : "");
+        size_t n_exact = S->options.num_modes;
+        if(n_exact > 0 && 0 == SolveLayerEigensystem_partial(
+            std::complex<double>(S->omega[0],S->omega[1]), n, S->kx, S->ky,
+            pB->Epsilon_inv, pB->Epsilon2, pB->epstype, &n_exact,
+            pB->q, pB->kp, pB->phi, &pB->residual, &pB->approx_residual))
+            {
+            pB->n_exact = n_exact;
+            }
+        else if(!hermitian || !Simulation_SolveLayerHermitian(S, L, pB))
             {
             size_t lwork = (size_t)-1;
             double *rwork = (double*)S4_malloc(sizeof(double) * 4*n);
@@ -2046,6 +3170,7 @@ int Simulation_ComputeLayerModes(S4_Simulation *S, S4_Layer *L, LayerModes **lay
             }
         }
     S4_TRACE("I  q[0] = %f,%f [omega=%f]\n", pB->q[0].real(), pB->q[0].imag(), S->omega[0]);
+    LayerModesCache_Insert(key, pB);
 
     S4_TRACE("< Simulation_ComputeLayerModes [omega=%f]\n", S->omega[0]);
     return 0;
@@ -2101,6 +3226,80 @@ int S4_Simulation_GetPowerFlux(S4_Simulation *S, S4_LayerID id, const double *of
   return 0;
 }
 
+int S4_Simulation_SweepLayerThickness(
+  S4_Simulation *S, S4_LayerID id, int n, const double *thickness,
+  int nout, const S4_LayerID *out, const double *offset, double *powers
+){
+  S4_TRACE("> S4_Simulation_SweepLayerThickness(S=%p, layer=%d, n=%d, thickness=%p, nout=%d, out=%p, offset=%p, powers=%p) [omega=%f]\n",
+    S, id, n, thickness, nout, out, offset, powers, S->omega[0]);
+  int ret = 0;
+  if(NULL == S){ ret = -1; }
+  else if(id < 0 || id >= S->n_layers){ ret = -2; }
+  if(n < 0 || (n > 0 && NULL == thickness)){ ret = -4; }
+  if(nout < 0 || (nout > 0 && NULL == out)){ ret = -5; }
+  if(NULL == powers){ ret = -8; }
+  for(int i = 0; 0 == ret && i < n; ++i){
+    if(thickness[i] < 0){ ret = -4; }
+  }
+  for(int j = 0; 0 == ret && j < nout; ++j){
+    if(out[j] < 0 || out[j] >= S->n_layers){ ret = -6; }
+  }
+  if(0 != ret){
+    S4_TRACE("< S4_Simulation_SweepLayerThickness (failed; ret = %d) [omega=%f]\n", ret, S->omega[0]);
+    return ret;
+  }
+  S4_Layer *layer = &S->layer[id];
+  const double thick0 = layer->thickness;
+  const size_t n4 = 4*S->n_G;
+  const size_t nn4 = n4*n4;
+
+  // The modes of every layer are kept across thickness changes. For an
+  // interior layer the partial S-matrices on either side of it are also
+  // made once (at zero thickness) and only rescaled for each thickness.
+  const bool rescale = !S->options.use_less_memory && 0 == S->options.symmetry
+    && (0 == S->exc.type || 2 == S->exc.type)
+    && id > 0 && id < S->n_layers-1;
+  std::complex<double> *base = NULL;
+  const std::complex<double> *q = NULL;
+  SMatrixCache *C = (rescale && n > 0 ? SMatrixCache_Get(S) : NULL);
+  if(NULL != C){
+    const double zero = 0;
+    LayerModes *Lmodes;
+    std::complex<double> *Lsoln;
+    C->pinned = 1;
+    Simulation_ChangeLayerThickness(S, layer, &zero);
+    ret = Simulation_GetLayerSolution(S, layer, &Lmodes, &Lsoln);
+    if(0 == ret && NULL != S->smatrix_cache->pre){
+      base = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>)*2*nn4);
+      if(NULL == base){ ret = 1; }
+    }
+    if(NULL != base){
+      memcpy(base, S->smatrix_cache->pre+id*nn4, sizeof(std::complex<double>)*nn4);
+      memcpy(base+nn4, S->smatrix_cache->suf+id*nn4, sizeof(std::complex<double>)*nn4);
+      q = Lmodes->q;
+    }
+  }
+
+  for(int i = 0; 0 == ret && i < n; ++i){
+    Simulation_ChangeLayerThickness(S, layer, &thickness[i]);
+    if(NULL != base){
+      SMatrixCache_SetThickness(S, id, q, thickness[i], base, base+nn4);
+    }
+    for(int j = 0; 0 == ret && j < nout; ++j){
+      ret = S4_Simulation_GetPowerFlux(S, out[j], (NULL != offset ? &offset[j] : NULL), &powers[4*(j+nout*i)]);
+    }
+  }
+  S4_free(base);
+  if(NULL != C && NULL != S->smatrix_cache){
+    S->smatrix_cache->pinned = 0;
+    SMatrixCache_FreeProducts(S->smatrix_cache);
+  }
+  Simulation_ChangeLayerThickness(S, layer, &thick0);
+
+  S4_TRACE("< S4_Simulation_SweepLayerThickness (ret = %d) [omega=%f]\n", ret, S->omega[0]);
+  return ret;
+}
+
 int Simulation_GetPoyntingFluxByG(S4_Simulation *S, S4_Layer *layer, double offset, double *powers){
   S4_TRACE("> Simulation_GetPoyntingFluxByG(S=%p, layer=%p, offset=%f, powers=%p) [omega=%f]\n",
     S, layer, offset, powers, S->omega[0]);
@@ -2162,6 +3361,14 @@ int Simulation_GetPropagationConstants(S4_Simulation *S, S4_Layer *L, double *q)
     return ret;
   }
 
+  if(NULL == S->solution){
+    ret = Simulation_InitSolution(S);
+    if(0 != ret){
+      S4_TRACE("< Simulation_GetPropagationConstants (failed; Simulation_InitSolution returned %d) [omega=%f]\n", ret, S->omega[0]);
+      return ret;
+    }
+  }
+
   const int n = S->n_G;
 
   // compute all modes and then get solution
@@ -2170,7 +3377,11 @@ int Simulation_GetPropagationConstants(S4_Simulation *S, S4_Layer *L, double *q)
   for(int i = 0; i < S->n_layers; ++i){
     S4_Layer *SL = &(S->layer[i]);
     if(NULL == SL->modes && SL->copy < 0){
-      Simulation_ComputeLayerModes(S, SL, &SL->modes);
+      ret = Simulation_ComputeLayerModes(S, SL, &SL->modes);
+      if(0 != ret){
+        S4_TRACE("< Simulation_GetPropagationConstants (failed; Simulation_ComputeLayerModes returned %d) [omega=%f]\n", ret, S->omega[0]);
+        return ret;
+      }
     }
     if(L == SL){
       found_layer = true;
@@ -2187,14 +3398,68 @@ int Simulation_GetPropagationConstants(S4_Simulation *S, S4_Layer *L, double *q)
   }
 
   for(int i = 0; i < n; ++i){
-    q[2*i+0] = layer_modes->q[i].real();
-    q[2*i+1] = layer_modes->q[i].imag();
+    if(i < layer_modes->n_valid){
+      q[2*i+0] = layer_modes->q[i].real();
+      q[2*i+1] = layer_modes->q[i].imag();
+    }else{ // placeholder of a mode outside the symmetry sector
+      q[2*i+0] = std::numeric_limits<double>::quiet_NaN();
+      q[2*i+1] = std::numeric_limits<double>::quiet_NaN();
+    }
   }
 
   S4_TRACE("< Simulation_GetPropagationConstants [omega=%f]\n", S->omega[0]);
   return ret;
 }
 
+int Simulation_GetModeTruncation(S4_Simulation *S, S4_Layer *L, int *n_exact, double *decay, double *residual, double *approx_residual, double *interface_error){
+  S4_TRACE("> Simulation_GetModeTruncation(S=%p, layer=%p) [omega=%f]\n", S, L, S->omega[0]);
+  int ret = 0;
+  if(NULL == S){ ret = -1; }
+  if(NULL == L){ ret = -2; }
+  if(0 != ret){
+    S4_TRACE("< Simulation_GetModeTruncation (failed; ret = %d) [omega=%f]\n", ret, S->omega[0]);
+    return ret;
+  }
+
+  LayerModes *modes;
+  std::complex<double> *soln;
+  ret = Simulation_GetLayerSolution(S, L, &modes, &soln);
+  if(0 != ret){
+    S4_TRACE("< Simulation_GetModeTruncation (failed; Simulation_GetLayerSolution returned %d) [omega=%f]\n", ret, S->omega[0]);
+    return ret;
+  }
+
+  // The omitted modes decay at least as fast as the slowest exact one
+  *n_exact = modes->n_exact;
+  *decay = HUGE_VAL;
+  if(modes->n_exact < 2*modes->n){
+    *decay = 0;
+    for(int i = 0; i < modes->n_exact; ++i){
+      *decay = std::max(*decay, std::abs(modes->q[i].imag()));
+    }
+  }
+  *residual = modes->residual;
+  *approx_residual = modes->approx_residual;
+
+  // The approximate modes are off by about their residual, in proportion
+  // to the share of the solution they carry at either end of the layer
+  const int n2 = 2*modes->n;
+  double share = 0;
+  for(int h = 0; h < 2; ++h){
+    double total = 0, approx = 0;
+    for(int i = 0; i < n2; ++i){
+      const double a2 = std::norm(soln[i+h*n2]);
+      total += a2;
+      if(i >= modes->n_exact){ approx += a2; }
+    }
+    if(total > 0){ share = std::max(share, sqrt(approx / total)); }
+  }
+  *interface_error = modes->approx_residual * share;
+
+  S4_TRACE("< Simulation_GetModeTruncation [omega=%f]\n", S->omega[0]);
+  return 0;
+}
+
 int Simulation_GetAmplitudes(S4_Simulation *S, S4_Layer *layer, double offset, double *forw, double *back){
   S4_TRACE("> Simulation_GetAmplitudes(S=%p, layer=%p, offset=%f, forw=%p, back=%p) [omega=%f]\n",
     S, layer, offset, forw, back, S->omega[0]);
@@ -2452,6 +3717,107 @@ void Simulation_DestroyLayerSolutions(S4_Simulation *S){
   S4_TRACE("< Simulation_DestroyLayerSolutions [omega=%f]\n", S->omega[0]);
 }
 
+void Simulation_DestroySMatrixCache(S4_Simulation *S){
+  S4_TRACE("> Simulation_DestroySMatrixCache(S=%p) [omega=%f]\n", S, S->omega[0]);
+  if(NULL == S || NULL == S->smatrix_cache){
+    S4_TRACE("< Simulation_DestroySMatrixCache (early exit) [omega=%f]\n", S->omega[0]);
+    return;
+  }
+  SMatrixCache *C = S->smatrix_cache;
+  SMatrixCache_FreeProducts(C);
+  S4_free(C->serial);
+  delete C;
+  S->smatrix_cache = NULL;
+  S4_TRACE("< Simulation_DestroySMatrixCache [omega=%f]\n", S->omega[0]);
+}
+
+int Simulation_GetMemoryUsage(const S4_Simulation *S, size_t *layer, size_t shared[3]){
+  if(NULL == S){ return -1; }
+  if(NULL == layer){ return -2; }
+  const size_t zsize = sizeof(std::complex<double>);
+  const int N = S->n_layers;
+  const SMatrixCache *C = S->smatrix_cache;
+  // The record of the last solve is negligible next to the products
+  const SMatrixCache *H = (NULL != C && NULL != C->halves ? C : NULL);
+  if(NULL != C && NULL == C->pre){ C = NULL; }
+  const int nC = (NULL == C ? 0 : (C->nlayers < N ? C->nlayers : N));
+  for(int i = 0; i < N; ++i){
+    const S4_Layer *L = &S->layer[i];
+    size_t *m = &layer[S4_MEMORY_NCATEGORIES*i];
+    for(int j = 0; j < S4_MEMORY_NCATEGORIES; ++j){ m[j] = 0; }
+    // Copies hold no modes or epsilon matrices of their own
+    if(NULL != L->modes){
+      const LayerModes *M = L->modes;
+      const size_t n2 = 2*M->n;
+      m[S4_MEMORY_MODES] = zsize*(n2
+        + (NULL != M->kp ? n2*n2 : 0)
+        + (NULL != M->phi ? n2*n2 : 0));
+    }
+    // The modes may still reference older epsilon matrices than the layer
+    const LayerEpsilon *E[2] = { L->epsilon, (NULL != L->modes ? L->modes->eps : NULL) };
+    for(int j = 0; j < 2; ++j){
+      if(NULL != E[j] && (0 == j || E[j] != E[0])){
+        const size_t n = E[j]->n;
+        m[S4_MEMORY_EPSILON] += zsize*5*n*n;
+      }
+    }
+    if(i < nC){
+      const size_t n4 = 4*C->n;
+      m[S4_MEMORY_SMATRIX] = zsize*2*n4*n4 + sizeof(unsigned long) + sizeof(double) + 2*sizeof(int);
+    }
+    for(const FieldCache *f = S->field_cache; NULL != f; f = f->next){
+      if(L == f->layer){
+        m[S4_MEMORY_FIELD_CACHE] += sizeof(FieldCache) + zsize*f->len;
+      }
+    }
+  }
+  if(NULL != shared){
+    shared[0] = S->n_G*(2*sizeof(int) + 2*sizeof(double)); // G, kx, ky
+    shared[1] = 0;
+    if(NULL != C){
+      const size_t n4 = 4*C->n;
+      // workspace, the whole stack, and the products of layers since removed
+      shared[1] = sizeof(SMatrixCache) + zsize*(n4*n4 + n4*(n4+1)) + sizeof(size_t)*n4
+        + (C->nlayers - nC)*(zsize*2*n4*n4 + sizeof(unsigned long) + sizeof(double) + 2*sizeof(int));
+    }else if(NULL != H){
+      // the halves around the changed layer, which belong to no one layer
+      const size_t n4 = 4*H->n;
+      shared[1] = sizeof(SMatrixCache) + zsize*SMatrixCache_HalvesSize(n4) + sizeof(size_t)*n4;
+    }
+    shared[2] = 0;
+    if(NULL != S->solution){
+      shared[2] = sizeof(Solution_) + N*(zsize*4*S->n_G + sizeof(int));
+    }
+  }
+  return 0;
+}
+
+size_t Simulation_EstimatePeakMemory(int n_, int nlayers, int ncopies, int npatterned, int use_less_memory){
+  const size_t n = n_;
+  const size_t n2 = 2*n;
+  const size_t n4 = 2*n2;
+  // Counted in complex numbers. Every layer that is not a copy holds its
+  // epsilon matrices, q, kp unless use_less_memory, and phi if patterned.
+  // Every layer holds its amplitudes.
+  size_t resident = (nlayers-ncopies)*(5*n*n + n2 + (use_less_memory ? 0 : n2*n2))
+    + npatterned*n2*n2 + nlayers*n4;
+  size_t solve = n2*n2; // copy of phi for the excitation
+  if(use_less_memory){
+    solve += 2*n4*n4 + 2*n2 + n4*(n4+1); // SolveInterior workspace
+  }else{
+    solve += 6*nlayers*n2*n2; // SolveAll workspace
+    // SMatrixCache halves, made once the same layer changes repeatedly.
+    // The per-layer products of a thickness sweep are not counted.
+    resident += 6*n4*n4 + n4*(n4+1);
+  }
+  // The eigensolver needs the operator, the LAPACK workspace (roughly 64
+  // columns for a blocked zgeev) and the real workspace.
+  const size_t eig = n2*n2 + 64*n2 + n2;
+  const size_t transient = (solve > eig ? solve : eig);
+  return sizeof(std::complex<double>)*(resident + transient)
+    + n*(2*sizeof(int) + 2*sizeof(double));
+}
+
 S4_Material* Simulation_GetMaterialByName(const S4_Simulation *S, const char *name, int *index){
   S4_TRACE("> Simulation_GetMaterialByName(S=%p, name=%p (%s)) [omega=%f]\n",
     S, name, (NULL == name ? "" : name), S->omega[0]);
@@ -2952,6 +4318,20 @@ int Simulation_OutputLayerPatternRealization(S4_Simulation *S, S4_Layer *layer,
   S4_TRACE("< Simulation_OutputLayerPatternRealization\n");
   return 0;
 }
+// Returns the layer containing z, and the offset dz of z within it
+static S4_Layer* Simulation_GetLayerAtZ(S4_Simulation *S, double z_, double *dz_){
+  double dz = z_;
+  double z = 0;
+  int i;
+  for(i = 0; i < S->n_layers && z_ > z+S->layer[i].thickness; ++i){
+    z += S->layer[i].thickness;
+    if(i+1 == S->n_layers){ break; }
+    dz -= S->layer[i].thickness;
+  }
+  *dz_ = dz;
+  return &(S->layer[i]);
+}
+
 int Simulation_GetField(S4_Simulation *S, const double r[3], double fE[6], double fH[6]){
   S4_TRACE("> Simulation_GetField(S=%p, r=%p (%f,%f,%f), fE=%p, fH=%p)\n",
     S, r, (NULL == r ? 0 : r[0]), (NULL == r ? 0 : r[1]), (NULL == r ? 0 : r[2]), fE, fH);
@@ -2971,18 +4351,8 @@ int Simulation_GetField(S4_Simulation *S, const double r[3], double fE[6], doubl
   const size_t n2 = 2*S->n_G;
   const size_t n4 = 2*n2;
 
-  S4_Layer *L = NULL;
-  double dz = r[2];
-  {
-    double z = 0;
-    int i;
-    for(i = 0; i < S->n_layers && r[2] > z+S->layer[i].thickness; ++i){
-      z += S->layer[i].thickness;
-      if(i+1 == S->n_layers){ break; }
-      dz -= S->layer[i].thickness;
-    }
-    L = &(S->layer[i]);
-  }
+  double dz;
+  S4_Layer *L = Simulation_GetLayerAtZ(S, r[2], &dz);
   if(NULL == L){
     S4_TRACE("< Simulation_GetField (failed; no layers found)\n");
     return 14;
@@ -3004,6 +4374,7 @@ int Simulation_GetField(S4_Simulation *S, const double r[3], double fE[6], doubl
   }
   std::complex<double> *work = ab + n4;
 
+  S4_ProfileScope profile_scope(S->profile, S4_PROFILE_FIELDS);
   RNP::TBLAS::Copy(n4, Lsoln,1, ab,1);
   //RNP::IO::PrintVector(n4, ab, 1);
   TranslateAmplitudes(S->n_G, Lmodes->q, L->thickness, dz, ab);
@@ -3033,6 +4404,85 @@ int Simulation_GetField(S4_Simulation *S, const double r[3], double fE[6], doubl
   S4_TRACE("< Simulation_GetField\n");
   return 0;
 }
+int Simulation_GetFieldAtPoints(S4_Simulation *S, int npts, const double *r, double *E, double *H){
+  S4_TRACE("> Simulation_GetFieldAtPoints(S=%p, npts=%d, r=%p, E=%p, H=%p)\n", S, npts, r, E, H);
+  if(NULL == S){
+    S4_TRACE("< Simulation_GetFieldAtPoints (failed; S == NULL)\n");
+    return -1;
+  }
+  if(npts < 0 || (npts > 0 && NULL == r)){
+    S4_TRACE("< Simulation_GetFieldAtPoints (failed; r == NULL)\n");
+    return -2;
+  }
+  if(S->n_layers <= 0){
+    S4_TRACE("< Simulation_GetFieldAtPoints (failed; no layers found)\n");
+    return 14;
+  }
+  if(0 == npts || (NULL == E && NULL == H)){
+    S4_TRACE("< Simulation_GetFieldAtPoints (early exit; nothing to do)\n");
+    return 0;
+  }
+
+  const size_t n4 = 4*S->n_G;
+  std::complex<double> *fE = (std::complex<double>*)E;
+  std::complex<double> *fH = (std::complex<double>*)H;
+
+  // Points are solved in groups of equal z, so the amplitudes are only
+  // translated once per plane, and each plane is a single matrix product.
+  std::vector<int> order(npts);
+  for(int i = 0; i < npts; ++i){ order[i] = i; }
+  std::stable_sort(order.begin(), order.end(), [r](int a, int b){ return r[3*a+2] < r[3*b+2]; });
+
+  std::complex<double> *ab = (std::complex<double>*)S4_malloc(sizeof(std::complex<double>) * (n4 + 6*(size_t)npts) + sizeof(double) * 2*(size_t)npts);
+  if(NULL == ab){
+    S4_TRACE("< Simulation_GetFieldAtPoints (failed; allocation failed)\n");
+    return 1;
+  }
+  std::complex<double> *efield = ab + n4;
+  std::complex<double> *hfield = efield + 3*npts;
+  double *xy = (double*)(hfield + 3*npts);
+
+  int ret = 0;
+  for(int i0 = 0; i0 < npts; ){
+    const double z = r[3*order[i0]+2];
+    int m = 0;
+    for(; i0+m < npts && r[3*order[i0+m]+2] == z; ++m){
+      xy[2*m+0] = r[3*order[i0+m]+0];
+      xy[2*m+1] = r[3*order[i0+m]+1];
+    }
+
+    double dz;
+    S4_Layer *L = Simulation_GetLayerAtZ(S, z, &dz);
+    LayerModes *Lmodes;
+    std::complex<double> *Lsoln;
+    ret = Simulation_GetLayerSolution(S, L, &Lmodes, &Lsoln);
+    if(0 != ret){ break; }
+
+    S4_ProfileScope profile_scope(S->profile, S4_PROFILE_FIELDS);
+    RNP::TBLAS::Copy(n4, Lsoln,1, ab,1);
+    TranslateAmplitudes(S->n_G, Lmodes->q, L->thickness, dz, ab);
+    GetFieldAtPoints(
+      S->n_G, S->kx, S->ky, std::complex<double>(S->omega[0],S->omega[1]),
+      Lmodes->q, Lmodes->kp, Lmodes->phi, Lmodes->Epsilon_inv, Lmodes->epstype,
+      ab, m, xy, (NULL != fE ? efield : NULL), (NULL != fH ? hfield : NULL));
+    for(int j = 0; j < m; ++j){
+      const int k = order[i0+j];
+      for(int c = 0; c < 3; ++c){
+        if(NULL != fE){ fE[3*k+c] = efield[3*j+c]; }
+        if(NULL != fH){ fH[3*k+c] = hfield[3*j+c]; }
+      }
+    }
+    i0 += m;
+  }
+  S4_free(ab);
+
+  if(0 != ret){
+    S4_TRACE("< Simulation_GetFieldAtPoints (failed; Simulation_GetLayerSolution returned %d)\n", ret);
+    return ret;
+  }
+  S4_TRACE("< Simulation_GetFieldAtPoints\n");
+  return 0;
+}
 int Simulation_GetFieldPlane(S4_Simulation *S, int nxy[2], double zz, double *E, double *H)
     {
     S4_TRACE("> Simulation_GetFieldPlane(S=%p, nxy=%p (%d,%d), z=%f, E=%p, H=%p)\n",
@@ -3094,6 +4544,7 @@ int Simulation_GetFieldPlane(S4_Simulation *S, int nxy[2], double zz, double *E,
         }
     std::complex<double> *work = ab + n4;
 
+    S4_ProfileScope profile_scope(S->profile, S4_PROFILE_FIELDS);
     RNP::TBLAS::Copy(n4, Lsoln,1, ab,1);
     //RNP::IO::PrintVector(n4, ab, 1);
     TranslateAmplitudes(S->n_G, Lmodes->q, L->thickness, dz, ab);
@@ -3111,6 +4562,80 @@ int Simulation_GetFieldPlane(S4_Simulation *S, int nxy[2], double zz, double *E,
     return 0;
     }
 
+int Simulation_GetFieldVolume(S4_Simulation *S, int nxy[2], int nz, const double *z, double *E, double *H, int nthreads){
+  S4_TRACE("> Simulation_GetFieldVolume(S=%p, nxy=%p (%d,%d), nz=%d, z=%p, E=%p, H=%p, nthreads=%d)\n",
+    S, nxy, (NULL == nxy ? 0 : nxy[0]), (NULL == nxy ? 0 : nxy[1]), nz, z, E, H, nthreads);
+  if(NULL == S){
+    S4_TRACE("< Simulation_GetFieldVolume (failed; S == NULL)\n");
+    return -1;
+  }
+  if(NULL == nxy){
+    S4_TRACE("< Simulation_GetFieldVolume (failed; nxy == NULL)\n");
+    return -2;
+  }
+  if(nz < 0 || (nz > 0 && NULL == z)){
+    S4_TRACE("< Simulation_GetFieldVolume (failed; z == NULL)\n");
+    return -4;
+  }
+  if(NULL == E || NULL == H){
+    S4_TRACE("< Simulation_GetFieldVolume (early exit; E or H are NULL)\n");
+    return 0;
+  }
+  if(S->n_layers <= 0){
+    S4_TRACE("< Simulation_GetFieldVolume (failed; no layers found)\n");
+    return 14;
+  }
+  if(nthreads < 1){ nthreads = 1; }
+
+  const size_t snxy[2] = { (size_t)nxy[0], (size_t)nxy[1] };
+  const size_t N = snxy[0]*snxy[1];
+  std::vector<double> dz(nz);
+
+  // Consecutive slices in the same layer share the layer's modes and one
+  // set of FFT plans; long runs are split among the threads.
+  for(int k0 = 0; k0 < nz; ){
+    S4_Layer *L = Simulation_GetLayerAtZ(S, z[k0], &dz[k0]);
+    int m = 1;
+    while(k0+m < nz && Simulation_GetLayerAtZ(S, z[k0+m], &dz[k0+m]) == L){ ++m; }
+
+    LayerModes *Lmodes;
+    std::complex<double> *Lsoln;
+    int ret = Simulation_GetLayerSolution(S, L, &Lmodes, &Lsoln);
+    if(0 != ret){
+      S4_TRACE("< Simulation_GetFieldVolume (failed; Simulation_GetLayerSolution returned %d)\n", ret);
+      return ret;
+    }
+
+    auto slices = [&](int k, int count){
+      GetFieldOnGridSlices(
+        S->n_G, S->G, S->kx, S->ky, std::complex<double>(S->omega[0],S->omega[1]),
+        Lmodes->q, Lmodes->kp, Lmodes->phi, Lmodes->Epsilon_inv, Lmodes->epstype,
+        Lsoln, L->thickness, count, &dz[k], snxy,
+        reinterpret_cast<std::complex<double>*>(E) + 3*N*k,
+        reinterpret_cast<std::complex<double>*>(H) + 3*N*k);
+    };
+    S4_ProfileScope profile_scope(S->profile, S4_PROFILE_FIELDS);
+    const int nt = (nthreads < m ? nthreads : m);
+    if(nt <= 1){
+      slices(k0, m);
+    }else{
+      std::vector<std::thread> workers;
+      for(int t = 0; t < nt; ++t){
+        const int a = k0 + (m*t)/nt;
+        const int b = k0 + (m*(t+1))/nt;
+        workers.emplace_back(slices, a, b-a);
+      }
+      for(auto &worker : workers){
+        worker.join();
+      }
+    }
+    k0 += m;
+  }
+
+  S4_TRACE("< Simulation_GetFieldVolume\n");
+  return 0;
+}
+
 int Simulation_GetEpsilon(S4_Simulation *S, const double r[3], double eps[2]){
   S4_TRACE("> Simulation_GetEpsilon(S=%p, r=%p (%f,%f,%f), eps=%p)\n",
     S, r, (NULL == r ? 0 : r[0]), (NULL == r ? 0 : r[1]), (NULL == r ? 0 : r[2]), eps);
@@ -3405,9 +4930,6 @@ int Simulation_MakeExcitationPlanewave(S4_Simulation *S, const double angle[2],
   }
 
   Simulation_DestroySolution(S);
-    // Destroy current layer modes before setting new values
-    // required to ensure new layer modes are calculated the next time a solution is required
-    S4_Simulation_DestroyLayerModes(S, -1);
   S->exc.type = 0;
 
   const S4_Material *M = &S->material[S->layer[0].material];
@@ -3442,8 +4964,14 @@ int Simulation_MakeExcitationPlanewave(S4_Simulation *S, const double angle[2],
   const double c_p = cos(pol_p[1]);
   const double s_p = sin(pol_p[1]);
 
-  S->k[0] = c1*s0*root_eps;
-  S->k[1] = s1*s0*root_eps;
+  // The layer modes depend on the in-plane wavevector, but not on the
+  // polarization; only recompute them when the incidence direction changes
+  const double k_new[2] = { c1*s0*root_eps, s1*s0*root_eps };
+  if(k_new[0] != S->k[0] || k_new[1] != S->k[1]){
+    S4_Simulation_DestroyLayerModes(S, -1);
+  }
+  S->k[0] = k_new[0];
+  S->k[1] = k_new[1];
 
   S->exc.sub.planewave.hx[0] = -c0*c1*pol_s[0]*c_s - s1*pol_p[0]*c_p;
   S->exc.sub.planewave.hx[1] = -c0*c1*pol_s[0]*s_s - s1*pol_p[0]*s_p;
@@ -3562,6 +5090,7 @@ void Simulation_AddFieldToCache(S4_Simulation *S, const S4_Layer *layer, size_t
   memcpy(f->P, P, sizeof(std::complex<double>)*Plen);
   f->layer = layer;
   f->n = n;
+  f->len = Plen;
   f->next = S->field_cache;
   S->field_cache = f;
   S4_TRACE("< Simulation_AddFieldToCache [omega=%f]\n", S->omega[0]);
@@ -3599,6 +5128,8 @@ int Simulation_GetSMatrix(S4_Simulation *S, int from, int to, std::complex<doubl
   S4_TRACE("> Simulation_GetSMatrix(S=%p, from=%d, to=%d)\n", S, from, to);
 
   if(-1 != to && to < from){ return -3; }
+  // the modes of a symmetric solution do not give the full S-matrix
+  if(0 != S->options.symmetry){ return 18; }
 
   if(NULL == S->solution){
     int error = Simulation_InitSolution(S);
@@ -3638,7 +5169,10 @@ int Simulation_GetSMatrix(S4_Simulation *S, int from, int to, std::complex<doubl
     }
   }
 
-  GetSMatrix(S->n_layers, S->n_G, S->kx, S->ky, std::complex<double>(S->omega[0], S->omega[1]), lthick, lq, lepsinv, lepstype, lkp, lphi, M);
+  {
+    S4_ProfileScope profile_scope(S->profile, S4_PROFILE_SMATRIX);
+    GetSMatrix(S->n_layers, S->n_G, S->kx, S->ky, std::complex<double>(S->omega[0], S->omega[1]), lthick, lq, lepsinv, lepstype, lkp, lphi, M);
+  }
 
   S4_free(lq);
   S4_free(lepstype);
@@ -3811,6 +5345,7 @@ int S4_Simulation_GetFieldPlane(S4_Simulation *S, const int nxy[2], const S4_rea
   }
   std::complex<double> *work = ab + n4;
 
+  S4_ProfileScope profile_scope(S->profile, S4_PROFILE_FIELDS);
   RNP::TBLAS::Copy(n4, Lsoln,1, ab,1);
   //RNP::IO::PrintVector(n4, ab, 1);
   TranslateAmplitudes(S->n_G, Lmodes->q, L->thickness, dz, ab);
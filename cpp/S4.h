@@ -100,6 +100,31 @@ typedef struct S4_Options_{
 	// be stored in memory when possible.
 	int use_less_memory;
 
+	// Set use_hermitian_eigensolver to nonzero if the modes of layers made
+	// of lossless materials should be computed with a Hermitian eigensolver
+	// at real frequencies, when the eigenoperator can be reduced to a
+	// Hermitian one. This needs every diffraction order to propagate in
+	// the layer, so it is zero by default, always using the general
+	// non-Hermitian eigensolver.
+	int use_hermitian_eigensolver;
+
+	// Set symmetry to the mirror symmetries of the structure that should
+	// be used to reduce the problem: a bitwise or of 1 for the mirror
+	// x -> -x and 2 for the mirror y -> -y (0, the default, for none).
+	// Only the fields with the parities given by symmetry_parity are
+	// solved for: bit 1 (2) set for fields odd under the x (y) mirror.
+	// The electric field E is even under a mirror M when E(Mr) = M E(r).
+	// The structure and the excitation must have the symmetry.
+	int symmetry;
+	int symmetry_parity;
+
+	// Set num_modes to a positive number k to compute only the k modes
+	// with the smallest |Im q| of each patterned layer, by the implicitly
+	// restarted Arnoldi method, when this is cheaper than computing all of
+	// them. The other modes are approximated (see
+	// SolveLayerEigensystem_partial). 0, the default, computes all modes.
+	int num_modes;
+
 	S4_real lanczos_smoothing_width;
 	int lanczos_smoothing_power;
 } S4_Options;
@@ -235,6 +260,14 @@ int S4_Simulation_GetPowerFlux(
 	S4_Simulation *S, S4_LayerID layer, const S4_real *offset,
 	S4_real *power
 );
+// Gets the power flux in nout layers (at the given offsets, or zero if
+// offset is NULL) for each of n thicknesses of one layer. power should be
+// size 4*nout*n, with the flux of out[j] at thickness[i] at 4*(j+nout*i).
+// The layer modes are computed once, and the thickness is restored after.
+int S4_Simulation_SweepLayerThickness(
+	S4_Simulation *S, S4_LayerID layer, int n, const S4_real *thickness,
+	int nout, const S4_LayerID *out, const S4_real *offset, S4_real *power
+);
 int S4_Simulation_GetPowerFluxes(
 	S4_Simulation *S, S4_LayerID layer, const S4_real *offset,
 	S4_real *power
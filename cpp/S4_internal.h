@@ -80,6 +80,7 @@ typedef struct{
 } S4_Material;
 
 struct LayerModes;
+struct LayerEpsilon;
 typedef struct{
 	char *name;       // name of layer
 	double thickness; // thickness of layer
@@ -87,6 +88,7 @@ typedef struct{
 	Pattern pattern;  // See pattern.h
 	S4_LayerID copy;       // See below.
 	struct LayerModes *modes;
+	struct LayerEpsilon *epsilon; // Fourier epsilon matrices; survive frequency changes
 } S4_Layer;
 // If a layer is a copy, then `copy' is the name of the layer that should
 // be copied, and `material' and `pattern' are inherited, and so they can
@@ -123,6 +125,7 @@ typedef struct Excitation_{
 } Excitation;
 
 struct Solution_;
+struct SMatrixCache;
 struct S4_Simulation_{
 	double Lr[4]; // real space lattice:
 	              //  {Lr[0],Lr[1]} is the first basis vector's x and y coords.
@@ -148,6 +151,8 @@ struct S4_Simulation_{
 	S4_Options options;
 
 	struct FieldCache *field_cache; // Internal cache of vector field FT when using polarization bases
+	struct SMatrixCache *smatrix_cache; // Partial S-matrices of the layer stack; outlives the solution
+	struct S4_Profile *profile; // Per-phase timings, see profile.h
 	
 	S4_message_handler msg;
 	void *msgdata;
@@ -176,7 +181,37 @@ void Simulation_Clone(const S4_Simulation *S, S4_Simulation *T);
 */
 void Simulation_DestroySolution(S4_Simulation *S);
 void Simulation_DestroyLayerSolutions(S4_Simulation *S);
+void Simulation_DestroySMatrixCache(S4_Simulation *S);
+
+// Process-wide cache of layer modes shared by all simulations, evicting the
+// least recently used modes when over a budget in bytes. The cache is
+// disabled when the budget is zero, which is the default. info receives
+// the budget, the bytes held, the number of entries, and the hit and miss
+// counts.
+void Simulation_SetModesCacheBudget(size_t bytes);
+void Simulation_GetModesCacheInfo(size_t info[5]);
+void Simulation_ClearModesCache();
+
+// Memory accounting, in bytes. layer is length S4_MEMORY_NCATEGORIES*n_layers
+// and receives the memory attributed to each layer by category. shared, if
+// not NULL, receives the memory not attributed to any layer: the G basis,
+// the S-matrix cache workspace and the solution, whose amplitudes of all
+// layers are a single allocation. Modes shared with clones are counted by
+// every simulation that references them.
+#define S4_MEMORY_MODES       0
+#define S4_MEMORY_EPSILON     1
+#define S4_MEMORY_SMATRIX     2
+#define S4_MEMORY_FIELD_CACHE 3
+#define S4_MEMORY_NCATEGORIES 4
+int Simulation_GetMemoryUsage(const S4_Simulation *S, size_t *layer, size_t shared[3]);
+// Estimates the peak memory in bytes needed to solve a stack of nlayers
+// layers with n G vectors, ncopies of which are copies and npatterned of
+// which are patterned or of a tensor material.
+size_t Simulation_EstimatePeakMemory(int n, int nlayers, int ncopies, int npatterned, int use_less_memory);
 void Simulation_DestroyLayerModes(S4_Layer *layer);
+// Also drops the cached epsilon matrices; use when the structure changes.
+void Simulation_DestroyLayerEpsilon(S4_Layer *layer);
+void S4_Simulation_DestroyLayerEpsilon(S4_Simulation *S, S4_LayerID id);
 void S4_Simulation_DestroyLayerModes(S4_Simulation *S, S4_LayerID id);
 
 // Destroys the solution belonging to a given simulation and sets
@@ -280,8 +315,22 @@ int Simulation_GetPoyntingFluxByG(S4_Simulation *S, S4_Layer *layer, double offs
 
 // Returns a list of S->n_G complex numbers of mode propagation constants
 // q should be length 2*S->n_G
+// With the symmetry option, the modes outside the symmetry sector are not
+// computed and their entries are NaN.
 int Simulation_GetPropagationConstants(S4_Simulation *S, S4_Layer *layer, double *q);
 
+// Reports how the modes of a layer were truncated by the partial
+// eigensolver (see the num_modes option). n_exact receives the number of
+// exactly computed modes, out of 2*S->n_G. decay receives the largest
+// |Im q| of the exact modes, a lower bound on that of the omitted ones
+// (HUGE_VAL if no mode was omitted), residual the relative residual of
+// the exact modes and approx_residual that of the slowest decaying
+// approximate ones. interface_error receives approx_residual weighted by
+// the share of the layer solution in the approximate modes, a loose upper
+// bound on the relative error they cause at the interfaces of the layer;
+// it can exceed the actual error by two orders of magnitude.
+int Simulation_GetModeTruncation(S4_Simulation *S, S4_Layer *layer, int *n_exact, double *decay, double *residual, double *approx_residual, double *interface_error);
+
 // Returns lists of 2*S->n_G complex numbers of forward and backward amplitudes
 // forw and back should each be length 4*S->n_G
 int Simulation_GetAmplitudes(S4_Simulation *S, S4_Layer *layer, double offset, double *forw, double *back);
@@ -316,7 +365,15 @@ int Simulation_OutputLayerPatternRealization(S4_Simulation *S, S4_Layer *layer,
 // Returns a solution error code
 // E field is stored as {Exr,Eyr,Ezr,Exi,Eyi,Ezi}
 int Simulation_GetField(S4_Simulation *S, const double r[3], double fE[6], double fH[6]);
+// r holds the {x,y,z} of npts points. E and H are length 6*npts and hold
+// the complex field of each point as {Exr,Exi,Eyr,Eyi,Ezr,Ezi}; either
+// may be NULL.
+int Simulation_GetFieldAtPoints(S4_Simulation *S, int npts, const double *r, double *E, double *H);
 int Simulation_GetFieldPlane(S4_Simulation *S, int nxy[2], double z, double *E, double *H);
+// Gets the field planes at nz z-coordinates; E and H are laid out as nz
+// consecutive planes of Simulation_GetFieldPlane. Slices within a layer
+// are split among nthreads threads.
+int Simulation_GetFieldVolume(S4_Simulation *S, int nxy[2], int nz, const double *z, double *E, double *H, int nthreads);
 
 // Returns a solution error code
 int Simulation_GetEpsilon(S4_Simulation *S, const double r[3], double eps[2]); // eps is {real,imag}
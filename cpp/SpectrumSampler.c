@@ -180,13 +180,28 @@ int SpectrumSampler_Enumerator_Get(SpectrumSampler_Enumerator e, double pt[2]){
 	return NULL != p->next;
 }
 
-void SpectrumSampler_GetPoints(const SpectrumSampler sampler, double *pt){
-	if(NULL == sampler){ return; }
-	data_point *p = sampler->value;
-	while(NULL != p){
+int SpectrumSampler_GetPoints(const SpectrumSampler sampler, double *pt){
+	int n = 0, i = 0;
+	data_point *p;
+	if(NULL == sampler){ return 0; }
+	for(p = sampler->value; NULL != p; p = p->next){
+		if(sampler->options.parallelize){
+			// the active points are pending, and listed in increasing x
+			if(i < sampler->active_set.active_list.n_active && p == sampler->active_set.active_list.active[i]){
+				++i;
+				continue;
+			}
+		}else if(NULL == p->next){
+			// the last point is past x1 once the initial points are in
+			break;
+		}else if(!sampler->done && p == sampler->active_set.active){
+			continue;
+		}
 		*pt = p->x; ++pt;
 		*pt = p->y; ++pt;
+		++n;
 	}
+	return n;
 }
 
 // returns 0 if no refinement is needed
@@ -282,6 +297,7 @@ int SpectrumSampler_SubmitResult(SpectrumSampler sampler, double y){
 			found = 1;
 		}
 	}else{
+		sampler->state++;
 		if(sampler->active_set.active->prev->prev != NULL){
 			sampler->active_set.active = sampler->active_set.active->prev;
 		}
@@ -29,13 +29,23 @@ typedef struct{
 	int parallelize;
 } SpectrumSampler_Options;
 
+#ifdef __cplusplus
+extern "C" {
+#endif
+
 SpectrumSampler SpectrumSampler_New(double x0, double x1, const SpectrumSampler_Options *options);
 void SpectrumSampler_Destroy(SpectrumSampler sampler);
 int SpectrumSampler_IsDone(const SpectrumSampler sampler);
 int SpectrumSampler_IsParallelized(const SpectrumSampler sampler);
 double SpectrumSampler_GetFrequency(const SpectrumSampler sampler);
 int SpectrumSampler_SubmitResult(SpectrumSampler sampler, double y);
+/* returns the number of results submitted so far */
 int SpectrumSampler_GetNumPoints(const SpectrumSampler sampler);
+/* pt must hold 2*SpectrumSampler_GetNumPoints() values; it is filled
+ * with the x,y pairs of the submitted points in increasing x, skipping
+ * the points still waiting for a result. Returns the number of pairs.
+ */
+int SpectrumSampler_GetPoints(const SpectrumSampler sampler, double *pt);
 
 /* returns number of freqs */
 int SpectrumSampler_GetFrequencies(const SpectrumSampler sampler, const double **freqs);
@@ -46,4 +56,8 @@ typedef void* SpectrumSampler_Enumerator;
 SpectrumSampler_Enumerator SpectrumSampler_GetPointEnumerator(const SpectrumSampler sampler);
 int SpectrumSampler_Enumerator_Get(SpectrumSampler_Enumerator, double pt[2]);
 
+#ifdef __cplusplus
+} /* extern "C" */
+#endif
+
 #endif /* _SPECTRUM_SAMPLER_H_ */
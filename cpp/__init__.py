@@ -1,7 +1,11 @@
 # from ._S4 import S4_Simulation
 __version__ = "1.1.5"
 from ._S4 import S4_Simulation as _S4Sim
+from . import _S4
+from concurrent.futures import ThreadPoolExecutor
+import json
 import numpy as np
+import os
 import warnings
 # from . import S4
 
@@ -81,6 +85,75 @@ class Simulation:
         self._S4Sim._CreateNew()
         self._hasSim = True
 
+    def clone(self):
+        """
+        Create a copy of the simulation. Layer modes that have already been
+        computed are shared with the copy and only recomputed by whichever
+        simulation later changes something they depend on (frequency,
+        incidence direction, materials, patterns, ...). Changing only the
+        polarization of the excitation keeps the shared modes.
+
+        :return: independent copy of the simulation
+        :type: :class:`S4.Simulation`
+        """
+        self._check_for_sim()
+
+        other = Simulation()
+        other._S4Sim = self._S4Sim._Clone()
+        other._hasSim = True
+        return other
+
+    def to_spec(self):
+        """
+        Get a complete description of the simulation (lattice, G-vectors,
+        options, materials, layers, patterns, excitation and frequency) made
+        of plain python and numpy values. The spec can be stored, sent to
+        other processes and turned back into a simulation with
+        :meth:`from_spec`. Computed solutions are not included.
+
+        Shapes of all layers are stored as flat arrays: ``layer``,
+        ``material`` and ``type`` (0: circle, 1: ellipse, 2: rectangle,
+        3: polygon) indices, ``center``, ``angle`` (radians),
+        ``halfwidths`` and ``n_vertices``, with the vertices of every
+        polygon concatenated in ``vertices``.
+
+        :return: simulation spec
+        :type: dict
+        """
+        self._check_for_sim()
+
+        return self._S4Sim._GetSpec()
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Create a simulation from a spec made by :meth:`to_spec`. All
+        materials, layers and shapes are built in a single call.
+
+        :param spec: simulation spec
+        :type spec: dict
+        :return: new simulation
+        :type: :class:`S4.Simulation`
+        """
+        if not isinstance(spec, dict):
+            raise RuntimeError("spec must be a dict")
+        sim = cls()
+        sim._S4Sim._SetSpec(spec)
+        sim._hasSim = True
+        return sim
+
+    def __getstate__(self):
+        if not self._hasSim:
+            return None
+        return self.to_spec()
+
+    def __setstate__(self, state):
+        self._S4Sim = _S4Sim()
+        self._hasSim = False
+        if state is not None:
+            self._S4Sim._SetSpec(state)
+            self._hasSim = True
+
     def _material_array_check(self, eps):
         """
         Helper function to check values of the eps array
@@ -155,7 +228,11 @@ class Simulation:
 
     def set_lattice(self, basis_vectors):
         """
-        Set the basis vectors for a simulation
+        Set the basis vectors for a simulation. With a single number for a
+        1D lattice and the plane of incidence along it, the two
+        polarizations are solved as separate problems of half the size,
+        which is faster; the layer modes and S-matrices are still stored
+        at full size, so this does not save memory.
 
         :param basis_vectors: pair of vectors specifying the lattice basic
                               vectors
@@ -863,6 +940,138 @@ class Simulation:
 
         self._S4Sim._UseExperimentalFMM(l_use)
 
+    def use_less_memory(self, use=True):
+        """
+        Enables or disables saving memory at the cost of speed. The k-parallel
+        matrices of the layer modes are recomputed when needed instead of
+        stored, the stack is solved separately for each layer whose solution
+        is requested instead of for all layers at once, and
+        :meth:`sweep_layer_thickness` does not cache the partial S-matrices
+        of the layer stack. Layer modes computed before this is enabled keep
+        their matrices until they are recomputed.
+
+        :param use: set to `True` to enable
+        :type use: bool
+        """
+        self._check_for_sim()
+
+        l_use = use
+        if not isinstance(use, bool):
+            print("use is not of type bool; attempting to cast")
+            l_use = bool(use)
+            print("using value for use = {}".format(l_use))
+
+        self._S4Sim._UseLessMemory(l_use)
+
+    def use_hermitian_eigensolver(self, use=True):
+        """
+        Enables or disables the Hermitian eigensolver for layers made only of
+        lossless materials. It is disabled by default. At a real frequency,
+        the eigenvalue problem of such a layer can be reduced to a Hermitian
+        one when all diffraction orders are propagating in it, which is
+        solved faster and more accurately than the general problem. This is
+        usually only the case for few G-vectors or at high frequencies.
+        Layers with an evanescent order are detected cheaply and use the
+        general eigensolver, as do all layers when this is disabled. Layer
+        modes computed before this is changed are not recomputed.
+
+        :param use: set to `True` to enable
+        :type use: bool
+        """
+        self._check_for_sim()
+
+        l_use = use
+        if not isinstance(use, bool):
+            print("use is not of type bool; attempting to cast")
+            l_use = bool(use)
+            print("using value for use = {}".format(l_use))
+
+        self._S4Sim._UseHermitianEigensolver(l_use)
+
+    def use_symmetry(self, mirrors=None, parity="even"):
+        """
+        Restricts the solution to one symmetry sector of the mirror planes
+        x = 0 and/or y = 0. Only the Fourier combinations of the sector are
+        kept, which shrinks the eigenvalue problem of every patterned layer
+        by a factor of 2 for one mirror and about 4 for both. A field of
+        even parity satisfies E(-x, y) = (-Ex, Ey, Ez)(x, y) for the x
+        mirror and E(x, -y) = (Ex, -Ey, Ez)(x, y) for the y mirror; odd
+        fields pick up an extra sign.
+
+        Every layer pattern must be mirror symmetric, the G basis must be
+        closed under the mirrors (see :meth:`set_lattice` and
+        :meth:`set_num_g`) and the excitation must be a planewave in the
+        requested sector, i.e. at normal incidence along the mirror
+        normals. Otherwise the solution fails with a RuntimeError: code 17
+        when the G basis is not symmetric, 18 when the excitation cannot be
+        symmetric, 19 when a layer is not symmetric and 20 when the
+        planewave is not of the requested parity. Only the propagation
+        constants of the sector are computed for patterned layers; the
+        other entries of :meth:`get_propagation_constants` are NaN. The
+        full S-matrix cannot be computed in this mode.
+
+        :param mirrors: "x", "y", "xy", or None to disable the reduction
+        :type mirrors: str
+        :param parity: "even" or "odd", or one of them per mirror for "xy"
+        :type parity: str or tuple
+        """
+        self._check_for_sim()
+
+        if mirrors is None:
+            mirrors = ""
+        if mirrors not in ("", "x", "y", "xy", "yx"):
+            raise RuntimeError("mirrors must be 'x', 'y', 'xy' or None")
+        axes = sorted(mirrors)
+        if isinstance(parity, str):
+            parity = [parity] * len(axes)
+        if len(parity) != len(axes):
+            raise RuntimeError("expected one parity per mirror")
+        l_mirrors = 0
+        l_parity = 0
+        for axis, p in zip(axes, parity):
+            bit = 1 if axis == "x" else 2
+            if p not in ("even", "odd"):
+                raise RuntimeError("parity must be 'even' or 'odd'")
+            l_mirrors |= bit
+            if p == "odd":
+                l_parity |= bit
+
+        self._S4Sim._UseSymmetry(l_mirrors, l_parity)
+
+    def set_num_modes(self, n=0):
+        """
+        Compute only the n modes of each patterned layer with the smallest
+        :math:`|\\mathrm{Im}\\,q|` (the propagating and weakly evanescent
+        ones), with an implicitly restarted Arnoldi eigensolver, instead of
+        all 2 NumG of them with a dense eigensolver. This cuts the cost of
+        the eigensolve from :math:`O(N^3)` to about :math:`O(N^2 n)` for
+        large NumG N. The other modes are approximated within small groups
+        of Fourier orders of nearly equal :math:`|k|`, kept independent of
+        the computed ones, which is accurate for layers thick enough that
+        these strongly evanescent modes do not reach across them; see
+        :meth:`get_mode_truncation` for an estimate of the error. A few more
+        than n modes are computed when needed to keep modes of equal decay
+        together, such as the propagating modes of a lossless layer.
+
+        The full eigensolver is still used for layers whose polarizations
+        decouple, with :meth:`use_symmetry`, and when n is more than about
+        NumG/8 - 16, beyond which the Arnoldi method is not reliably
+        cheaper.
+
+        :param n: number of modes to compute per layer; 0 (the default)
+                  computes all of them
+        :type n: int
+        """
+        self._check_for_sim()
+
+        if not isinstance(n, int):
+            print("input n is not an int. Casting to int")
+            n = int(n)
+            print("using a value of n = {}".format(n))
+        if n < 0:
+            raise RuntimeError("n must be >= 0")
+        self._S4Sim._SetNumModes(n)
+
     def set_resolution(self, resolution=8):
         """
         Set the resolution of the system. Lots of notes here.
@@ -915,14 +1124,18 @@ class Simulation:
         powerFlux = self._S4Sim._GetPoyntingFlux(l_layer, l_offset)
         return powerFlux
 
-    def get_poynting_flux_by_G(self, layer, offset=0.0):
+    def get_poynting_flux_by_G(self, layer, offset=0.0, out=None):
         """
         Get the Poynting Flux by each wave vector
 
         :param layer: name of layer
         :param offset: offset from the beginning of the layer
+        :param out: optional array the result is written into and returned,
+                    to reuse one buffer across many calls
         :type layer: str
         :type offset: float
+        :type out: :class:`numpy.ndarray`, shape= :math:`\\left(n, 4
+                   \\right)`, dtype=float, C-contiguous
 
         :return: power flux [[forward_real, backward_real,
                  forward_imaginary, backward_imaginary]]
@@ -947,8 +1160,7 @@ class Simulation:
             print("using a value of offset = {}".format(l_offset))
 
         # get the data
-        powerFluxRaw = self._S4Sim._GetPoyntingFluxByG(l_layer, l_offset)
-        powerFlux = np.copy(powerFluxRaw.reshape((-1, 4)))
+        powerFlux = self._S4Sim._GetPoyntingFluxByG(l_layer, l_offset, out)
         return powerFlux
 
     def get_field_at_point(self, point):
@@ -976,10 +1188,11 @@ class Simulation:
             raise RuntimeError("Point must be a vector (1D array)")
         if not l_point.shape[0] == 3:
             raise RuntimeError("Point must be a 3 element vector (x, y, z)")
-        l_point = np.require(l_point, dtype=np.float64, requirements=["C"])
+        l_point = self._sanitize_array(l_point, dtype=np.float64,
+                                       warn_name="point")
 
         # get the data
-        raw_field = self._S4Sim._GetFieldAtPoint(point)
+        raw_field = self._S4Sim._GetFieldAtPoint(l_point)
 
         # reshape
         e_field_real = raw_field[0:3]
@@ -990,11 +1203,45 @@ class Simulation:
         e_field = e_field_real + 1j * e_field_imag
         h_field = h_field_real + 1j * h_field_imag
         e_field = np.ascontiguousarray(e_field, dtype=np.complex128)
-        h_field = np.ascontiguousarray(e_field, dtype=np.complex128)
+        h_field = np.ascontiguousarray(h_field, dtype=np.complex128)
 
         return e_field, h_field
 
-    def get_field_plane(self, z, n_uv):
+    def get_fields_at_points(self, points):
+        """
+        Get the electric and magnetic field at many points in the
+        structure. Points sharing a z-coordinate are evaluated together, so
+        this is much faster than calling :meth:`get_field_at_point` for each
+        point
+
+        :param points: :math:`\\left(x, y, z, \\right)` of each point in the
+                       structure
+        :type points: :class:`numpy.ndarray`, shape= :math:`\\left(N, 3
+                      \\right)`, dtype=float
+
+        :return: complex electric and magnetic field vectors at the points
+                 :math:`\\left( \\left[ E_x, E_y, E_z \\right], \\left[ H_x,
+                 H_y, H_z \\right] \\right)`
+        :type: tuple of :class:`numpy.ndarray`, shape= :math:`\\left(N, 3
+               \\right)`, dtype=complex
+        """
+
+        self._check_for_sim()
+
+        # check that points are valid
+        l_points = np.asarray(points)
+        if l_points.ndim == 1:
+            l_points = l_points.reshape((1, -1))
+        if not (l_points.ndim == 2 and l_points.shape[1] == 3):
+            raise RuntimeError("points must have shape (N, 3)")
+        l_points = self._sanitize_array(l_points, dtype=np.float64,
+                                        warn_name="points")
+
+        # get the data
+        e_field, h_field = self._S4Sim._GetFieldsAtPoints(l_points)
+        return e_field, h_field
+
+    def get_field_plane(self, z, n_uv, out=None):
         """
         Get the electric and magnetic field as a grid at a particular z
         coordinate. This is more efficient than get_field_at_point().
@@ -1005,6 +1252,11 @@ class Simulation:
         :param n_uv:
         :type n_uv: :class:`numpy.ndarray`, shape= :math:`\\left(2 \\right)`,
                     dtype=float
+        :param out: optional pair of arrays (e_field, h_field) the fields are
+                    written into and returned, to reuse buffers across many
+                    calls
+        :type out: tuple of :class:`numpy.ndarray`, shape= :math:`\\left(
+                   n_uv[1], n_uv[0], 3 \\right)`, dtype=complex, C-contiguous
 
         :return: complex electric and magnetic field vector at specified point
                  :math:`\\left( \\left[ E_x, E_y, E_z \\right], \\left[ H_x,
@@ -1028,21 +1280,141 @@ class Simulation:
         if not l_n_uv.shape[0] == 2:
             raise RuntimeError("n_uv must be a 2 element vector (nu, nv)")
         # recast n_uv
-        l_n_uv = np.require(l_n_uv, dtype=np.int64, requirements=["C"])
+        l_n_uv = self._sanitize_array(l_n_uv, dtype=np.int32,
+                                      warn_name="n_uv")
+        if out is None:
+            e_out, h_out = None, None
+        else:
+            e_out, h_out = out
+        # compute and return the e, h fields
+        efield, hfield = self._S4Sim._GetFieldPlane(l_z, l_n_uv, e_out, h_out)
+        return efield, hfield
+
+    def get_field_volume(self, z_values, n_uv, n_workers=1):
+        """
+        Get the electric and magnetic field on a stack of grids, one for each
+        z coordinate. This gives the same result as calling
+        get_field_plane() for each z, but the modes, FFT plans and buffers
+        are reused for all slices within a layer.
+
+        :param z_values: the :math:`z`-coordinates of the planes on which to
+                         obtain the field
+        :param n_uv: number of grid points along each lattice direction
+        :param n_workers: number of threads among which the slices of each
+                          layer are split. If <= 0, use the number of
+                          hardware threads
+        :type z_values: :class:`numpy.ndarray`, shape= :math:`\\left(n_z
+                        \\right)`, dtype=float
+        :type n_uv: :class:`numpy.ndarray`, shape= :math:`\\left(2 \\right)`,
+                    dtype=int
+        :type n_workers: int
+
+        :return: complex electric and magnetic field vectors
+                 :math:`\\left( \\left[ E_x, E_y, E_z \\right], \\left[ H_x,
+                 H_y, H_z \\right] \\right)` on every plane
+        :type: tuple of :class:`numpy.ndarray`, shape= :math:`\\left(n_z,
+               n_uv[1], n_uv[0], 3 \\right)`, dtype=complex
+        """
+
+        self._check_for_sim()
+
+        l_z = np.atleast_1d(np.asarray(z_values))
+        if not l_z.ndim == 1:
+            raise RuntimeError("z_values must be a vector (1D array)")
+        l_z = self._sanitize_array(l_z, dtype=np.float64,
+                                   warn_name="z_values")
+        # check that n_uv is valid
+        l_n_uv = np.asarray(n_uv)
+        if not l_n_uv.ndim == 1:
+            raise RuntimeError("n_uv must be a vector (1D array)")
+        if not l_n_uv.shape[0] == 2:
+            raise RuntimeError("n_uv must be a 2 element vector (nu, nv)")
+        l_n_uv = self._sanitize_array(l_n_uv, dtype=np.int32,
+                                      warn_name="n_uv")
+
+        l_n_workers = n_workers
+        if not isinstance(n_workers, int):
+            print("n_workers is not an integer; attempting to cast")
+            l_n_workers = int(n_workers)
+            print("using a value of n_workers = {}".format(l_n_workers))
+
         # compute and return the e, h fields
-        efield, hfield = self._S4Sim._GetFieldPlane(l_z, l_n_uv)
-        # reshape the nu*nv*3 array into 3D array
-        efield = efield.reshape(l_n_uv[1], l_n_uv[0], 3)
-        hfield = hfield.reshape(l_n_uv[1], l_n_uv[0], 3)
-        # return the arrays
+        efield, hfield = self._S4Sim._GetFieldVolume(l_z, l_n_uv,
+                                                     l_n_workers)
         return efield, hfield
 
-    def get_waves(self, layer):
+    def get_propagation_constants(self, layer):
+        """
+        Get the propagation constants q of the first NumG modes of a layer,
+        whose fields vary as :math:`e^{iqz}`. With :meth:`use_symmetry`,
+        the modes outside the symmetry sector are not computed for
+        patterned layers and their entries are NaN.
+
+        :param layer: name of layer
+        :type layer: str
+
+        :return: propagation constants
+        :type: numpy.ndarray of complex, shape (NumG,)
+        """
+        self._check_for_sim()
+
+        if not isinstance(layer, str):
+            raise RuntimeError("Layer must be a string")
+
+        return self._S4Sim._GetPropagationConstants(layer)
+
+    def get_mode_truncation(self, layer):
+        """
+        Get how the modes of a layer were truncated by
+        :meth:`set_num_modes`. The omitted modes decay at least as fast as
+        the slowest of the computed ones, by the rate "decay"
+        (:math:`\\max |\\mathrm{Im}\\,q|` over the computed modes), so
+        "attenuation", :math:`e^{-\\mathrm{decay} \\cdot d}` for a layer of
+        thickness d, bounds the relative amplitude with which they carry
+        fields across the layer, and estimates the error this causes. The
+        omitted modes are only approximated, neglecting the coupling between
+        groups of Fourier orders, which causes an error at the interfaces of
+        the layer. "interface_error" is a loose upper bound on it, which can
+        exceed the actual error by two orders of magnitude, formed from the
+        residuals of the n slowest decaying approximate modes
+        ("approx_residual") and the share of the solution in the layer that
+        they carry. Both errors shrink as n grows.
+
+        :param layer: name of layer
+        :type layer: str
+
+        :return: dict with keys "num_modes" (number of modes computed),
+                 "num_total" (2 NumG), "decay", "attenuation", "residual"
+                 (largest residual of the computed modes, relative to the
+                 norm of the eigenproblem), "approx_residual" (the same
+                 for the approximate modes) and "interface_error". If all
+                 modes were computed, decay is inf and the others are 0
+        :type: dict
+        """
+        self._check_for_sim()
+
+        if not isinstance(layer, str):
+            raise RuntimeError("Layer must be a string")
+
+        truncation = self._S4Sim._GetModeTruncation(layer)
+        thickness = truncation.pop("thickness")
+        if np.isinf(truncation["decay"]):
+            truncation["attenuation"] = 0.0
+        else:
+            truncation["attenuation"] = float(
+                np.exp(-truncation["decay"] * thickness))
+        return truncation
+
+    def get_waves(self, layer, out=None):
         """
         Get the Waves
 
         :param layer: name of layer
+        :param out: optional array the waves are written into and returned,
+                    to reuse one buffer across many calls
         :type layer: str
+        :type out: :class:`numpy.ndarray`, shape= :math:`\\left(n, 2, 11
+                   \\right)`, dtype=float, C-contiguous
 
         :return: waves [forward_real, backward_real,
                  forward_imaginary, backward_imaginary]
@@ -1068,12 +1440,1060 @@ class Simulation:
         l_layer = layer
 
         # get the data
-        rawWaves = self._S4Sim._GetWaves(l_layer)
-        # reformat the waves
-        waves = np.copy(rawWaves.reshape((-1, 2, 11)))
+        waves = self._S4Sim._GetWaves(l_layer, out)
         return waves
 
+    def sweep_frequencies(self, freqs, layers, offsets=None, n_workers=1):
+        """
+        Get the Poynting flux through several layers for a list of
+        frequencies. Each worker thread solves a private copy of the
+        simulation, so the frequencies are computed in parallel and the
+        frequency of this simulation is left untouched. Every point keeps
+        the imaginary part of the current frequency (see
+        :meth:`set_frequency`).
+
+        :param freqs: real parts of the frequencies to solve at (not
+                      angular frequencies)
+        :param layers: names of the layers in which to compute the flux
+        :param offsets: offset from the beginning of each layer; defaults to
+                        zero for every layer
+        :param n_workers: number of threads to use. If <= 0, use the number
+                          of hardware threads
+        :type freqs: :class:`numpy.ndarray`, shape= :math:`\\left(n_f,
+                     \\right)`, dtype=float
+        :type layers: list of str
+        :type offsets: :class:`numpy.ndarray`, shape= :math:`\\left(n_l,
+                       \\right)`, dtype=float
+        :type n_workers: int
+
+        :return: power flux [forward_real, backward_real,
+                 forward_imaginary, backward_imaginary] for each frequency
+                 and layer
+        :type: :class:`numpy.ndarray`, shape= :math:`\\left(n_f, n_l, 4
+               \\right)`, dtype=float
+        """
+        self._check_for_sim()
+
+        l_freqs = np.atleast_1d(np.asarray(freqs))
+        if not l_freqs.ndim == 1:
+            raise RuntimeError("freqs must be a vector (1D array)")
+        l_freqs = self._sanitize_array(l_freqs, dtype=np.float64,
+                                       warn_name="freqs")
+
+        if isinstance(layers, str):
+            layers = [layers]
+        l_layers = list(layers)
+        for layer in l_layers:
+            if not isinstance(layer, str):
+                raise RuntimeError("Layer must be a string")
+
+        if offsets is None:
+            l_offsets = np.zeros(len(l_layers), dtype=np.float64)
+        else:
+            l_offsets = np.atleast_1d(np.asarray(offsets))
+            if not l_offsets.shape == (len(l_layers),):
+                raise RuntimeError("offsets must have one value per layer")
+            l_offsets = self._sanitize_array(l_offsets, dtype=np.float64,
+                                             warn_name="offsets")
+
+        l_n_workers = n_workers
+        if not isinstance(n_workers, int):
+            print("n_workers is not an integer; attempting to cast")
+            l_n_workers = int(n_workers)
+            print("using a value of n_workers = {}".format(l_n_workers))
+
+        # get the data
+        powerFlux = self._S4Sim._SweepFrequencies(l_freqs, l_layers,
+                                                  l_offsets, l_n_workers)
+        return powerFlux
+
+    def sweep_angles(self, angles, pol_s, pol_p, layers, offsets=None,
+                     by_G=False, order=1, use_radians=False, n_workers=1):
+        """
+        Get the Poynting flux through several layers for a list of planewave
+        incidence angles. Each worker thread solves a private copy of the
+        simulation, and all copies share the epsilon matrices of the layers
+        (which do not depend on the k-vector), so they are only built once.
+        The excitation of this simulation is left untouched.
+
+        :param angles: :math:`\\left(\\phi, \\theta\\right)` for each
+                       planewave, as in :meth:`set_excitation_planewave`
+        :param pol_s: amplitude, phase of the s-polarization
+        :param pol_p: amplitude, phase of the p-polarization
+        :param layers: names of the layers in which to compute the flux
+        :param offsets: offset from the beginning of each layer; defaults to
+                        zero for every layer
+        :param by_G: if True, also return the flux of every diffracted
+                     order, as in :meth:`get_poynting_flux_by_G`
+        :param order: which order (mode index) to excite. Defaults to 1.
+        :param use_radians: set to `True` to input angles, phases in radians
+                            rather than the default degrees
+        :param n_workers: number of threads to use. If <= 0, use the number
+                          of hardware threads
+        :type angles: :class:`numpy.ndarray`, shape= :math:`\\left(n_a, 2
+                      \\right)`, dtype=float
+        :type pol_s: :class:`numpy.ndarray`, shape= :math:`\\left(2, \\right)`,
+                     dtype=float
+        :type pol_p: :class:`numpy.ndarray`, shape= :math:`\\left(2, \\right)`,
+                     dtype=float
+        :type layers: list of str
+        :type offsets: :class:`numpy.ndarray`, shape= :math:`\\left(n_l,
+                       \\right)`, dtype=float
+        :type by_G: bool
+        :type order: int
+        :type use_radians: bool
+        :type n_workers: int
+
+        :return: power flux [forward_real, backward_real,
+                 forward_imaginary, backward_imaginary] for each angle and
+                 layer, shape :math:`\\left(n_a, n_l, 4\\right)` (and, if
+                 by_G, the flux by G with shape :math:`\\left(n_a, n_l, n_G,
+                 4\\right)`)
+        :type: :class:`numpy.ndarray`, dtype=float
+        """
+        self._check_for_sim()
+
+        l_angles = np.asarray(angles)
+        if l_angles.ndim == 1:
+            l_angles = l_angles.reshape((1, -1))
+        if not (l_angles.ndim == 2 and l_angles.shape[1] == 2):
+            raise RuntimeError("angles must have shape (n_angles, 2)")
+        l_angles = self._sanitize_array(l_angles, dtype=np.float64,
+                                        warn_name="angles")
+
+        l_pol_s = np.asarray(pol_s)
+        if not l_pol_s.shape == (2,):
+            err_str = "pol_s must be a 2 element vector (amplitude, phase)"
+            raise RuntimeError(err_str)
+        l_pol_s = self._sanitize_array(l_pol_s, dtype=np.float64,
+                                       warn_name="pol_s")
+
+        l_pol_p = np.asarray(pol_p)
+        if not l_pol_p.shape == (2,):
+            err_str = "pol_p must be a 2 element vector (amplitude, phase)"
+            raise RuntimeError(err_str)
+        l_pol_p = self._sanitize_array(l_pol_p, dtype=np.float64,
+                                       warn_name="pol_p")
+
+        if isinstance(layers, str):
+            layers = [layers]
+        l_layers = list(layers)
+        for layer in l_layers:
+            if not isinstance(layer, str):
+                raise RuntimeError("Layer must be a string")
+
+        if offsets is None:
+            l_offsets = np.zeros(len(l_layers), dtype=np.float64)
+        else:
+            l_offsets = np.atleast_1d(np.asarray(offsets))
+            if not l_offsets.shape == (len(l_layers),):
+                raise RuntimeError("offsets must have one value per layer")
+            l_offsets = self._sanitize_array(l_offsets, dtype=np.float64,
+                                             warn_name="offsets")
+
+        l_order = int(order)
+        if l_order < 1:
+            raise RuntimeError("order must be >= 1")
+
+        # convert to radians as required
+        if not use_radians:
+            l_angles = l_angles * (np.pi/180.0)
+            l_pol_s = np.array([l_pol_s[0], l_pol_s[1] * (np.pi/180.0)])
+            l_pol_p = np.array([l_pol_p[0], l_pol_p[1] * (np.pi/180.0)])
+
+        l_n_workers = n_workers
+        if not isinstance(n_workers, int):
+            print("n_workers is not an integer; attempting to cast")
+            l_n_workers = int(n_workers)
+            print("using a value of n_workers = {}".format(l_n_workers))
+
+        # get the data
+        powerFlux, powerFluxByG = self._S4Sim._SweepAngles(
+            l_angles, l_pol_s, l_pol_p, l_order, l_layers, l_offsets,
+            bool(by_G), l_n_workers)
+        if by_G:
+            return powerFlux, powerFluxByG
+        return powerFlux
+
+    def sweep_layer_thickness(self, layer, thicknesses, out_layers,
+                              offsets=None):
+        """
+        Get the Poynting flux through several layers for a list of
+        thicknesses of one layer. The modes of every layer are computed
+        only once; for an interior layer the thickness only rescales the
+        S-matrices of the stacks above and below it. The thickness of the
+        layer is left untouched.
+
+        :param layer: name of the layer whose thickness is swept
+        :param thicknesses: thicknesses to solve at
+        :param out_layers: names of the layers in which to compute the flux
+        :param offsets: offset from the beginning of each output layer;
+                        defaults to zero for every layer
+        :type layer: str
+        :type thicknesses: :class:`numpy.ndarray`, shape= :math:`\\left(n_d,
+                           \\right)`, dtype=float
+        :type out_layers: list of str
+        :type offsets: :class:`numpy.ndarray`, shape= :math:`\\left(n_l,
+                       \\right)`, dtype=float
+
+        :return: power flux [forward_real, backward_real,
+                 forward_imaginary, backward_imaginary] for each thickness
+                 and output layer
+        :type: :class:`numpy.ndarray`, shape= :math:`\\left(n_d, n_l, 4
+               \\right)`, dtype=float
+        """
+        self._check_for_sim()
+
+        if not isinstance(layer, str):
+            raise RuntimeError("Layer must be a string")
+        l_layer = layer
+
+        l_thicknesses = np.atleast_1d(np.asarray(thicknesses))
+        if not l_thicknesses.ndim == 1:
+            raise RuntimeError("thicknesses must be a vector (1D array)")
+        l_thicknesses = self._sanitize_array(l_thicknesses, dtype=np.float64,
+                                             warn_name="thicknesses")
+
+        if isinstance(out_layers, str):
+            out_layers = [out_layers]
+        l_layers = list(out_layers)
+        for out_layer in l_layers:
+            if not isinstance(out_layer, str):
+                raise RuntimeError("Layer must be a string")
+
+        if offsets is None:
+            l_offsets = np.zeros(len(l_layers), dtype=np.float64)
+        else:
+            l_offsets = np.atleast_1d(np.asarray(offsets))
+            if not l_offsets.shape == (len(l_layers),):
+                raise RuntimeError("offsets must have one value per layer")
+            l_offsets = self._sanitize_array(l_offsets, dtype=np.float64,
+                                             warn_name="offsets")
+
+        # get the data
+        powerFlux = self._S4Sim._SweepLayerThickness(l_layer, l_thicknesses,
+                                                     l_layers, l_offsets)
+        return powerFlux
+
+    def sample_flux_map(self, freq_range, y_range, layer, pol_s, pol_p,
+                        offset=0.0, component=0, azimuth=0.0,
+                        k_parallel=True, initial_grid=(9, 9), batch_size=32,
+                        max_samples=5000, max_bend=20.0, z_tol_rel=0.001,
+                        use_radians=False, n_workers=1):
+        """
+        Adaptively sample the Poynting flux through a layer over a rectangle
+        of frequencies and in-plane wavevectors (or incidence angles), as in
+        reflectance maps and band diagrams. A uniform initial grid is
+        refined by a :class:`FunctionSampler2D` where the flux surface
+        bends, so that thin resonance curves are resolved with far fewer
+        points than a uniform grid. The rectangle is scaled to a unit
+        square for the sampler. Each batch of points is solved on n_workers
+        threads, each holding a clone of this simulation, whose frequency
+        and excitation are left untouched.
+
+        :param freq_range: first and last frequency
+        :param y_range: first and last in-plane wavevector :math:`k_\\|`
+                        (in the units of the frequency), or polar angle
+                        :math:`\\phi` if k_parallel is `False`
+        :param layer: name of the layer in which to compute the flux
+        :param pol_s: amplitude, phase of the s-polarization
+        :param pol_p: amplitude, phase of the p-polarization
+        :param offset: offset from the beginning of the layer
+        :param component: which entry of the flux to sample: 0
+                          (forward_real), 1 (backward_real), 2
+                          (forward_imaginary) or 3 (backward_imaginary)
+        :param azimuth: azimuthal angle :math:`\\theta` of the planewave
+        :param k_parallel: if `True`, the second coordinate is
+                           :math:`k_\\| = n f \\sin\\phi`, with n the
+                           refractive index of the first layer. Points
+                           outside its light cone get the value 0
+        :param initial_grid: number of frequencies and y values of the
+                             initial grid
+        :param batch_size: number of points requested from the sampler at
+                           a time
+        :param max_samples: stop refining once this many points are sampled
+        :param max_bend: maximum bend angle (in degrees) between the normals
+                         of adjacent triangles
+        :param z_tol_rel: triangles over which the flux changes by less than
+                          this fraction of its range are not refined
+        :param use_radians: set to `True` to input angles, phases in radians
+        :param n_workers: number of threads to use. If <= 0, use the number
+                          of hardware threads
+        :type freq_range: tuple
+        :type y_range: tuple
+        :type layer: str
+        :type pol_s: :class:`numpy.ndarray`, shape= :math:`\\left(2,
+                     \\right)`, dtype=float
+        :type pol_p: :class:`numpy.ndarray`, shape= :math:`\\left(2,
+                     \\right)`, dtype=float
+        :type offset: float
+        :type component: int
+        :type azimuth: float
+        :type k_parallel: bool
+        :type initial_grid: tuple
+        :type batch_size: int
+        :type max_samples: int
+        :type max_bend: float
+        :type z_tol_rel: float
+        :type use_radians: bool
+        :type n_workers: int
+
+        :return: points (frequency, y), flux at each point, and the
+                 triangles (indices of 3 points each), which can be passed
+                 to :class:`matplotlib.tri.Triangulation`
+        :type: tuple of :class:`numpy.ndarray`, shapes :math:`\\left(n,
+               2\\right)`, :math:`\\left(n, \\right)` and
+               :math:`\\left(n_t, 3\\right)`
+        """
+        self._check_for_sim()
+
+        if not isinstance(layer, str):
+            raise RuntimeError("Layer must be a string")
+        if component not in (0, 1, 2, 3):
+            raise RuntimeError("component must be 0, 1, 2 or 3")
+        f0, f1 = [float(f) for f in freq_range]
+        y0, y1 = [float(y) for y in y_range]
+        if f0 == f1 or y0 == y1:
+            raise RuntimeError("freq_range and y_range must not be empty")
+        if not min(f0, f1) > 0:
+            raise RuntimeError("Real-part of frequency must be positive")
+        nx, ny = [int(n) for n in initial_grid]
+        if nx < 2 or ny < 2:
+            raise RuntimeError("initial_grid needs at least 2 x 2 points")
+
+        to_radians = 1.0 if use_radians else np.pi/180.0
+        l_pol_s = [float(pol_s[0]), float(pol_s[1]) * to_radians]
+        l_pol_p = [float(pol_p[0]), float(pol_p[1]) * to_radians]
+        l_azimuth = float(azimuth) * to_radians
+        if k_parallel:
+            # the excitation is defined in the first layer
+            spec = self.to_spec()
+            material = spec["layers"]["material"][0]
+            eps = spec["materials"]["eps"][material]
+            if spec["materials"]["type"][material] != 0:
+                eps = eps[8:]
+            index = np.sqrt(complex(eps[0], eps[1])).real
+
+        l_n_workers = int(n_workers)
+        if l_n_workers <= 0:
+            l_n_workers = os.cpu_count() or 1
+        sims = [self.clone() for _ in range(l_n_workers)]
+
+        def solve(sim, points):
+            values = np.zeros(len(points), dtype=np.float64)
+            for i, (f, y) in enumerate(points):
+                if k_parallel:
+                    sin_phi = y / (index * f)
+                    if abs(sin_phi) > 1.0:
+                        continue
+                    phi = np.arcsin(sin_phi)
+                else:
+                    phi = y * to_radians
+                sim.set_frequency(f)
+                sim.set_excitation_planewave([phi, l_azimuth], l_pol_s,
+                                             l_pol_p, use_radians=True)
+                values[i] = sim.get_poynting_flux(layer, offset)[component]
+            return values
+
+        def evaluate(uv):
+            points = np.column_stack([f0 + (f1 - f0) * uv[:, 0],
+                                      y0 + (y1 - y0) * uv[:, 1]])
+            chunks = np.array_split(points, len(sims))
+            with ThreadPoolExecutor(max_workers=len(sims)) as pool:
+                return np.concatenate(list(pool.map(solve, sims, chunks)))
+
+        u, v = np.meshgrid(np.linspace(0.0, 1.0, nx),
+                           np.linspace(0.0, 1.0, ny), indexing="ij")
+        uv = np.column_stack([u.ravel(), v.ravel()])
+        sampler = FunctionSampler2D(uv, evaluate(uv), z_tol_rel=z_tol_rel,
+                                    max_bend=max_bend)
+        while len(sampler) < max_samples and not sampler.is_done():
+            uv = sampler.get_next(min(batch_size, max_samples - len(sampler)))
+            if len(uv) == 0:
+                break
+            sampler.add(uv, evaluate(uv))
+
+        uv, values = sampler.get_samples()
+        points = np.column_stack([f0 + (f1 - f0) * uv[:, 0],
+                                  y0 + (y1 - y0) * uv[:, 1]])
+        return points, values, sampler.get_triangles()
+
+    def auto_converge(self, target, layer=None, rtol=1e-3, atol=0.0,
+                      offset=0.0, extrapolate=False, num_g_start=5,
+                      max_num_g=1000, growth=1.5, max_resolution=64,
+                      apply=True):
+        """
+        Find the smallest number of G-vectors (and, for the FFT based
+        formulations, the smallest resolution) for which a quantity is
+        converged. NumG is raised along the closed shells of the G-vector
+        truncation, by at least the factor growth each step, until the
+        quantity changes by less than the tolerance. If the epsilon
+        coefficients come from an FFT (:meth:`use_discretized_epsilon` or
+        :meth:`use_polarization_decomposition`), the resolution is then
+        doubled in the same way, starting from its current value. The
+        solves run on a clone, so this simulation is only changed by
+        applying the settings found.
+
+        A value v is within tolerance of a reference r if
+        max(abs(v - r)) <= max(atol, rtol * max(abs(r))). The reference is
+        the value at the last step, or, if extrapolate is `True`, the limit
+        of the last two steps extrapolated linearly in 1/NumG (Richardson
+        extrapolation), which suits quantities that converge slowly and
+        monotonically. The settings returned are those of the earliest step
+        from which on every step is within tolerance of the reference.
+
+        :param target: "forward" or "backward" for the real part of the
+                       Poynting flux through layer, or a function taking the
+                       simulation and returning a float or an array
+        :param layer: name of the layer for a flux target
+        :param rtol: relative tolerance
+        :param atol: absolute tolerance, for quantities that converge to 0
+        :param offset: offset from the beginning of the layer
+        :param extrapolate: set to `True` to compare to the extrapolated
+                            limit instead of the last value
+        :param num_g_start: number of G-vectors of the first step
+        :param max_num_g: largest number of G-vectors to try
+        :param growth: minimal factor by which NumG grows between steps
+        :param max_resolution: largest resolution to try
+        :param apply: set to `True` to apply the settings found to this
+                      simulation
+        :type target: str or callable
+        :type layer: str
+        :type rtol: float
+        :type atol: float
+        :type offset: float
+        :type extrapolate: bool
+        :type num_g_start: int
+        :type max_num_g: int
+        :type growth: float
+        :type max_resolution: int
+        :type apply: bool
+
+        :return: dict with keys "num_g" and "resolution" (the settings
+                 found), "value" (the quantity at these settings),
+                 "extrapolated" (the extrapolated limit, or `None`),
+                 "converged" (`False` if max_num_g or max_resolution was
+                 reached first) and "history", a list of (num_g,
+                 resolution, value) for every step
+        :type: dict
+        """
+        self._check_for_sim()
+
+        if target in ("forward", "backward"):
+            if not isinstance(layer, str):
+                raise RuntimeError("Layer must be a string")
+            component = 0 if target == "forward" else 1
+            l_offset = float(offset)
+
+            def evaluate(sim):
+                return sim.get_poynting_flux(layer, l_offset)[component]
+        elif callable(target):
+            def evaluate(sim):
+                return target(sim)
+        else:
+            raise RuntimeError("target must be 'forward', 'backward' or a "
+                               "callable")
+        if growth <= 1.0:
+            raise RuntimeError("growth must be > 1")
+
+        options = self.to_spec()["options"]
+        use_fft = (options["use_discretized_epsilon"] != 0
+                   or options["use_polarization_basis"] != 0)
+        sim = self.clone()
+
+        def within(value, reference):
+            value, reference = np.asarray(value), np.asarray(reference)
+            error = np.max(np.abs(value - reference))
+            return bool(error <= max(atol, rtol * np.max(np.abs(reference))))
+
+        def solve(history):
+            num_g, resolution = history[-1][:2]
+            sim.set_num_g(num_g)
+            sim.set_resolution(resolution)
+            history[-1] = (num_g, resolution, evaluate(sim))
+
+        def reference(history, extrapolate):
+            if not extrapolate or len(history) < 2:
+                return history[-1][2]
+            # v(N) = v_inf + c / N through the last two points
+            (n0, _, v0), (n1, _, v1) = history[-2:]
+            return (n1 * np.asarray(v1) - n0 * np.asarray(v0)) / (n1 - n0)
+
+        def converged(history, extrapolate=False):
+            if len(history) < 2:
+                return False
+            if extrapolate:
+                return within(history[-1][2], reference(history, True))
+            return within(history[-2][2], history[-1][2])
+
+        def first_within(history, extrapolate=False):
+            # the earliest step after which all steps stay within tolerance,
+            # so that a value passing near the reference early is not taken
+            ref = reference(history, extrapolate)
+            first = history[-1]
+            for step in reversed(history):
+                if not within(step[2], ref):
+                    break
+                first = step
+            return first
+
+        # NumG, along the closed shells of the truncation
+        resolution = int(options["resolution"])
+        sim.set_num_g(max(1, int(num_g_start)))
+        num_g = sim.get_num_g()
+        num_g_history = [(num_g, resolution, None)]
+        solve(num_g_history)
+        while not converged(num_g_history, extrapolate):
+            request = max(num_g + 1, int(np.ceil(growth * num_g)))
+            next_num_g = num_g
+            while next_num_g <= num_g and request <= max_num_g:
+                sim.set_num_g(request)
+                next_num_g = sim.get_num_g()
+                request += 1
+            if next_num_g <= num_g:
+                break
+            num_g = next_num_g
+            num_g_history.append((num_g, resolution, None))
+            solve(num_g_history)
+        is_converged = converged(num_g_history, extrapolate)
+        if is_converged:
+            num_g = first_within(num_g_history, extrapolate)[0]
+        history = list(num_g_history)
+
+        # resolution of the FFT, at the largest NumG solved
+        if use_fft:
+            res_history = [num_g_history[-1]]
+            while not converged(res_history):
+                if 2 * resolution > max_resolution:
+                    break
+                resolution *= 2
+                res_history.append((res_history[0][0], resolution, None))
+                solve(res_history)
+            res_converged = converged(res_history)
+            is_converged = is_converged and res_converged
+            if res_converged:
+                resolution = first_within(res_history)[1]
+            history += res_history[1:]
+
+        value = None
+        for step in history:
+            if step[0] == num_g and step[1] == resolution:
+                value = step[2]
+        if value is None:
+            history.append((num_g, resolution, None))
+            solve(history)
+            value = history[-1][2]
+
+        extrapolated = None
+        if extrapolate and len(num_g_history) >= 2:
+            extrapolated = reference(num_g_history, True)
+
+        if apply:
+            self.set_num_g(num_g)
+            if use_fft:
+                self.set_resolution(resolution)
+        return {"num_g": num_g, "resolution": resolution, "value": value,
+                "extrapolated": extrapolated, "converged": is_converged,
+                "history": history}
+
+    def memory_report(self):
+        """
+        Get the memory held by the simulation, in bytes. Layer modes and
+        epsilon matrices shared with clones are counted by each simulation
+        referencing them. Temporary workspace used while solving is not
+        included; see :meth:`estimate_peak_memory`.
+
+        :return: dict with keys "layers", mapping each layer name to the bytes
+                 of its "modes", "epsilon", "smatrix_cache" and
+                 "field_cache"; "categories", the totals of each of these
+                 over all layers plus "solution" (the mode amplitudes of
+                 all layers, held together) and "basis" (the G vectors);
+                 and "total"
+        :type: dict
+        """
+        self._check_for_sim()
+
+        report = self._S4Sim._GetMemoryReport()
+        layers = {name: dict(usage) for name, usage in report["layers"].items()}
+        categories = {"modes": 0, "epsilon": 0,
+                      "solution": report["shared"]["solution"],
+                      "smatrix_cache": report["shared"]["smatrix_workspace"],
+                      "field_cache": 0, "basis": report["shared"]["basis"]}
+        for usage in layers.values():
+            for category, nbytes in usage.items():
+                categories[category] += nbytes
+        return {"layers": layers, "categories": categories,
+                "total": sum(categories.values())}
+
+    def estimate_peak_memory(self):
+        """
+        Estimate the peak memory, in bytes, needed to solve the simulation as
+        currently set up, including the temporary workspace of the
+        eigensolver and of the solve through the layer stack. This can be
+        called before solving.
+
+        :return: estimated peak memory in bytes
+        :type: int
+        """
+        self._check_for_sim()
+
+        return self._S4Sim._EstimatePeakMemory()
+
+    def reset_profile(self, trace=False):
+        """
+        Clear the timings gathered by the profiler, and optionally start
+        recording a trace of every timed call for :meth:`save_profile_trace`.
+        Tracing keeps one event per call, including every FFT, so it should
+        only be enabled for the runs being inspected.
+
+        :param trace: whether to record trace events
+        :type trace: bool
+        """
+        self._check_for_sim()
+
+        self._S4Sim._ResetProfile(bool(trace))
+
+    def get_profile(self):
+        """
+        Get the wall time and call count of each phase of the solves since
+        the simulation was created or :meth:`reset_profile` was called. The
+        phases are the epsilon matrix construction of each FMM formulation
+        ("epsilon_fft", "epsilon_kottke", "epsilon_closed_form",
+        "epsilon_experimental", "epsilon_pol_basis_jones",
+        "epsilon_pol_basis_nv", "epsilon_pol_basis_vl"), the layer
+        eigensolves ("eigensolve"), the solve through the layer stack
+        ("solve"), S-matrix products ("smatrix"), field reconstruction
+        ("fields") and FFTs ("fft"). Phases nest, e.g. the S-matrix products
+        of a solve and the FFTs of an epsilon matrix, so "seconds" includes
+        the nested phases while "self_seconds" excludes them. Sweeps over
+        several workers add up the time spent in every worker.
+
+        :return: dict mapping each phase to a dict with keys "count",
+                 "seconds" and "self_seconds"
+        :type: dict
+        """
+        self._check_for_sim()
+
+        return self._S4Sim._GetProfile()
+
+    def save_profile_trace(self, filename):
+        """
+        Save the events recorded since :meth:`reset_profile` was called with
+        trace=True as a Chrome trace-event JSON file, which can be opened in
+        chrome://tracing or Perfetto. Sweep workers appear as separate
+        threads.
+
+        :param filename: path of the JSON file
+        :type filename: str
+        """
+        self._check_for_sim()
+
+        events = self._S4Sim._GetProfileEvents()
+        if len(events) == 0:
+            raise RuntimeError("No trace events recorded; call "
+                               "reset_profile(trace=True) before solving")
+        trace = [{"name": name, "cat": "S4", "ph": "X", "pid": 0,
+                  "tid": thread, "ts": 1e6 * start, "dur": 1e6 * duration}
+                 for name, thread, start, duration in events]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
     def _test(self):
 
         x = self._S4Sim._TestArray()
         return x
+
+
+class SpectrumSampler:
+    """Adaptive sampler of a spectrum
+
+    Starts from a uniform grid of frequencies and keeps subdividing the
+    intervals around the points where the normalized plot of the spectrum
+    bends by more than a maximum angle, so that sharp features such as Fano
+    resonances are resolved with few points. Iterating over the sampler
+    yields the frequencies to compute next, and the results must be handed
+    back with :meth:`submit` before asking for more. A parallelized sampler
+    yields whole batches of frequencies (arrays) which can be computed
+    concurrently; otherwise single frequencies are yielded. :meth:`run`
+    drives the sampler with the Poynting flux of a simulation.
+
+    """
+    def __init__(self, f_start, f_end, initial_num_points=33,
+                 range_threshold=0.001, max_bend=10.0,
+                 min_spacing=1e-6, parallelize=True):
+        """
+        :param f_start: first frequency of the range
+        :param f_end: last frequency of the range
+        :param initial_num_points: number of uniformly spaced initial
+                                   points; features narrower than their
+                                   spacing may be missed
+        :param range_threshold: intervals over which the spectrum changes
+                                by less than this fraction of its total
+                                range are not subdivided
+        :param max_bend: maximum bend angle (in degrees) between adjacent
+                         segments of the normalized spectrum, as for
+                         :class:`FunctionSampler2D`
+        :param min_spacing: spacing (relative to the range) below which
+                            intervals are not subdivided
+        :param parallelize: set to `True` to yield batches of frequencies
+        :type f_start: float
+        :type f_end: float
+        :type initial_num_points: int
+        :type range_threshold: float
+        :type max_bend: float
+        :type min_spacing: float
+        :type parallelize: bool
+        """
+        if not max_bend > 0:
+            raise RuntimeError("max_bend must be a positive angle")
+        # the sampler compares the cosine of the bend
+        self._sampler = _S4.S4_SpectrumSampler(
+            float(f_start), float(f_end), int(initial_num_points),
+            float(range_threshold), float(np.cos(np.radians(max_bend))),
+            float(min_spacing), bool(parallelize))
+        # True while yielded frequencies wait for their results
+        self._pending = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._pending:
+            raise RuntimeError("Results of the previous frequencies were "
+                               "not submitted")
+        if self._sampler._IsDone():
+            raise StopIteration
+        self._pending = True
+        if self._sampler._IsParallelized():
+            return self._sampler._GetFrequencies()
+        return self._sampler._GetFrequency()
+
+    def is_done(self):
+        """
+        Check whether the spectrum is fully sampled
+
+        :return: `True` when no more frequencies are needed
+        :type: bool
+        """
+        return self._sampler._IsDone()
+
+    def get_num_points(self):
+        """
+        Get the number of results submitted so far
+
+        :return: number of points
+        :type: int
+        """
+        return self._sampler._GetNumPoints()
+
+    def submit(self, values):
+        """
+        Submit the results at the last frequencies yielded by the sampler
+
+        :param values: one value per frequency of the batch, or a single
+                       value if the sampler is not parallelized
+        :type values: :class:`numpy.ndarray`, shape= :math:`\\left(n_f,
+                      \\right)`, dtype=float
+        :return: `True` when no more frequencies are needed
+        :type: bool
+        """
+        if self._sampler._IsParallelized():
+            l_values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+            done = self._sampler._SubmitResults(l_values)
+        else:
+            done = self._sampler._SubmitResult(float(values))
+        self._pending = False
+        return done
+
+    def get_spectrum(self):
+        """
+        Get the points submitted so far, in increasing frequency
+
+        :return: frequencies, values
+        :type: tuple of :class:`numpy.ndarray`, shape= :math:`\\left(n,
+               \\right)`, dtype=float
+        """
+        spectrum = self._sampler._GetSpectrum()
+        return spectrum[:, 0].copy(), spectrum[:, 1].copy()
+
+    def run(self, sim, layer, n_workers=1, offset=0.0, component=0):
+        """
+        Sample the Poynting flux through a layer of a simulation until the
+        spectrum is resolved. Each batch of frequencies is solved with
+        :meth:`Simulation.sweep_frequencies` on n_workers threads, so a
+        parallelized sampler is needed to benefit from several workers.
+
+        :param sim: simulation to solve; its frequency is left untouched,
+                    and its imaginary part is kept at every point
+        :param layer: name of the layer in which to compute the flux
+        :param n_workers: number of threads to use. If <= 0, use the number
+                          of hardware threads
+        :param offset: offset from the beginning of the layer
+        :param component: which entry of the flux to sample: 0
+                          (forward_real), 1 (backward_real), 2
+                          (forward_imaginary) or 3 (backward_imaginary)
+        :type sim: :class:`Simulation`
+        :type layer: str
+        :type n_workers: int
+        :type offset: float
+        :type component: int
+        :return: frequencies, values
+        :type: tuple of :class:`numpy.ndarray`, shape= :math:`\\left(n,
+               \\right)`, dtype=float
+        """
+        if component not in (0, 1, 2, 3):
+            raise RuntimeError("component must be 0, 1, 2 or 3")
+        for freqs in self:
+            flux = sim.sweep_frequencies(np.atleast_1d(freqs), [layer],
+                                         [offset], n_workers=n_workers)
+            values = flux[:, 0, component]
+            if self._sampler._IsParallelized():
+                self.submit(values)
+            else:
+                self.submit(values[0])
+        return self.get_spectrum()
+
+
+class FunctionSampler2D:
+    """Adaptive sampler of a function of two variables
+
+    Keeps a Delaunay triangulation of the samples of z(x, y) and refines
+    the triangles next to the edges across which the surface bends by more
+    than a maximum angle, by requesting new samples at their centroids.
+    Since the bend is measured on the surface (x, y, z), the coordinates
+    should be scaled to comparable ranges. Samples are requested in
+    batches with :meth:`get_next` and handed back with :meth:`add`.
+    :meth:`Simulation.sample_flux_map` drives a sampler with the Poynting
+    flux of a simulation.
+
+    """
+    def __init__(self, xy, z, z_tol_abs=0.0, z_tol_rel=0.001, max_bend=20.0,
+                 xy_tol=1e-6):
+        """
+        :param xy: initial sample points; they must not all be collinear
+        :param z: function values at the initial points
+        :param z_tol_abs: triangles over which z changes by less than this
+                          are not refined
+        :param z_tol_rel: triangles over which z changes by less than this
+                          fraction of its range are not refined
+        :param max_bend: maximum bend angle (in degrees) between the normals
+                         of adjacent triangles
+        :param xy_tol: triangles narrower than this are not refined
+        :type xy: :class:`numpy.ndarray`, shape= :math:`\\left(n, 2
+                  \\right)`, dtype=float
+        :type z: :class:`numpy.ndarray`, shape= :math:`\\left(n,
+                 \\right)`, dtype=float
+        :type z_tol_abs: float
+        :type z_tol_rel: float
+        :type max_bend: float
+        :type xy_tol: float
+        """
+        if not max_bend > 0:
+            raise RuntimeError("max_bend must be a positive angle")
+        l_xy, l_z = self._sanitize_samples(xy, z)
+        self._sampler = _S4.S4_FunctionSampler2D(
+            l_xy, l_z, float(z_tol_abs), float(z_tol_rel), float(max_bend),
+            float(xy_tol))
+
+    def _sanitize_samples(self, xy, z):
+        l_xy = np.require(np.atleast_2d(np.asarray(xy, dtype=np.float64)),
+                          requirements=["C"])
+        l_z = np.require(np.atleast_1d(np.asarray(z, dtype=np.float64)),
+                         requirements=["C"])
+        return l_xy, l_z
+
+    def __len__(self):
+        return len(self._sampler._GetSamples()[1])
+
+    def add(self, xy, z):
+        """
+        Add samples of the function
+
+        :param xy: sample points
+        :param z: function values at the points
+        :type xy: :class:`numpy.ndarray`, shape= :math:`\\left(n, 2
+                  \\right)`, dtype=float
+        :type z: :class:`numpy.ndarray`, shape= :math:`\\left(n,
+                 \\right)`, dtype=float
+        """
+        l_xy, l_z = self._sanitize_samples(xy, z)
+        self._sampler._Add(l_xy, l_z)
+
+    def is_done(self):
+        """
+        Check whether any triangle still needs refinement
+
+        :return: `True` when no more samples are needed
+        :type: bool
+        """
+        return self._sampler._IsDone()
+
+    def get_next(self, n=0):
+        """
+        Get the points at which the function should be sampled next, worst
+        triangles first
+
+        :param n: maximum number of points; if <= 0, one for every triangle
+                  that needs refinement
+        :type n: int
+        :return: points to sample
+        :type: :class:`numpy.ndarray`, shape= :math:`\\left(m, 2
+               \\right)`, dtype=float
+        """
+        return self._sampler._GetNext(int(n))
+
+    def get_samples(self):
+        """
+        Get all samples: the initial ones (possibly reordered), then the
+        added ones in the order in which they were added
+
+        :return: points, values
+        :type: tuple of :class:`numpy.ndarray`, shapes :math:`\\left(n,
+               2\\right)` and :math:`\\left(n, \\right)`
+        """
+        return self._sampler._GetSamples()
+
+    def get_triangles(self):
+        """
+        Get the triangulation of the samples
+
+        :return: indices into the samples of the vertices of each
+                 triangle, counterclockwise
+        :type: :class:`numpy.ndarray`, shape= :math:`\\left(n_t, 3
+               \\right)`, dtype=int
+        """
+        return self._sampler._GetTriangles()
+
+
+def set_layer_modes_cache_budget(nbytes):
+    """
+    Set the memory budget of the process-wide layer mode cache. When
+    enabled, the modes of every layer solved are kept, keyed by everything
+    they depend on (layer pattern, material epsilons, lattice, G vectors,
+    frequency, k-vector and FMM options), and an identical layer in any
+    simulation reuses them instead of solving the eigenproblem again. The
+    least recently used modes are dropped when over budget.
+
+    :param nbytes: budget in bytes; 0 (the default) disables the cache
+    :type nbytes: int
+    """
+    if nbytes < 0:
+        raise RuntimeError("nbytes must be non-negative")
+    _S4._SetLayerModesCacheBudget(int(nbytes))
+
+
+def get_layer_modes_cache_info():
+    """
+    Get statistics of the layer mode cache.
+
+    :return: dict with the budget ("budget"), the bytes held ("bytes"), the
+        number of cached layer modes ("entries"), and the number of layer
+        solves served from the cache ("hits") or not ("misses")
+    :type: dict
+    """
+    return dict(_S4._GetLayerModesCacheInfo())
+
+
+def clear_layer_modes_cache():
+    """
+    Drop all modes held by the layer mode cache and reset its hit and miss
+    counts. The budget is unchanged.
+    """
+    _S4._ClearLayerModesCache()
+
+
+_fft_planner_efforts = {"estimate": 0, "measure": 1, "patient": 2}
+
+
+def load_fft_wisdom(filename):
+    """
+    Load FFTW wisdom from a file, so that FFT plans made later by any
+    simulation can reuse previously measured plans. Only available when
+    S4 is built against FFTW.
+
+    :param filename: path of the wisdom file
+    :type filename: str
+    """
+    _S4._LoadFFTWisdom(str(filename))
+
+
+def save_fft_wisdom(filename):
+    """
+    Save the FFTW wisdom accumulated by this process to a file. Only
+    available when S4 is built against FFTW.
+
+    :param filename: path of the wisdom file
+    :type filename: str
+    """
+    _S4._SaveFFTWisdom(str(filename))
+
+
+def set_fft_planner_effort(effort):
+    """
+    Set how hard FFTW searches for fast plans. "measure" and "patient"
+    plan slower but transform faster, and are worthwhile together with
+    :func:`save_fft_wisdom` and :func:`load_fft_wisdom`. Changing the
+    effort drops the cached plans. Has no effect without FFTW.
+
+    :param effort: one of "estimate" (default), "measure" or "patient"
+    :type effort: str
+    """
+    if effort not in _fft_planner_efforts:
+        raise RuntimeError("effort must be one of {}".format(
+            sorted(_fft_planner_efforts, key=_fft_planner_efforts.get)))
+    _S4._SetFFTPlannerEffort(_fft_planner_efforts[effort])
+
+
+def set_fft_plan_cache_size(size):
+    """
+    Set the maximum number of idle FFT plans kept for reuse. FFT plans are
+    shared by all simulations in the process and reused for transforms of
+    the same size and direction; the least recently used are freed first.
+
+    :param size: maximum number of cached plans (default 32)
+    :type size: int
+    """
+    if size < 0:
+        raise RuntimeError("size must be non-negative")
+    _S4._SetFFTPlanCacheCapacity(int(size))
+
+
+def get_fft_plan_cache_info():
+    """
+    Get statistics of the FFT plan cache.
+
+    :return: dict with the number of cached plans ("size"), the maximum
+        number of cached plans ("capacity"), and the number of plan requests
+        served from the cache ("hits") or planned anew ("misses")
+    :type: dict
+    """
+    return dict(_S4._GetFFTPlanCacheInfo())
+
+
+def estimate_peak_memory(num_g, n_layers, n_patterned=None, n_copies=0,
+                         use_less_memory=False):
+    """
+    Estimate the peak memory, in bytes, needed to solve a simulation without
+    setting it up. The number of G vectors actually used may be lower than
+    num_g, so the estimate is an upper bound in that respect.
+
+    :param num_g: number of G vectors
+    :type num_g: int
+    :param n_layers: total number of layers
+    :type n_layers: int
+    :param n_patterned: number of patterned layers (or layers of tensor
+                        materials); defaults to all layers that are not copies
+    :type n_patterned: int
+    :param n_copies: number of layers that are copies of other layers
+    :type n_copies: int
+    :param use_less_memory: whether :meth:`Simulation.use_less_memory` is
+                            enabled
+    :type use_less_memory: bool
+
+    :return: estimated peak memory in bytes
+    :type: int
+    """
+    if n_patterned is None:
+        n_patterned = n_layers - n_copies
+    return _S4._EstimatePeakMemory(int(num_g), int(n_layers), int(n_copies),
+                                   int(n_patterned), bool(use_less_memory))
@@ -18,6 +18,7 @@
  */
 
 #include "fft_iface.h"
+#include "../profile.h"
 #include <cstdlib>
 
 #ifdef HAVE_LIBFFTW3
@@ -29,7 +30,11 @@
 
 #ifdef HAVE_LIBPTHREAD
 #include <pthread.h>
-static pthread_mutex_t mutex;
+// Guards the plan cache and the FFTW planner, which is not re-entrant. The
+// mutex is statically initialized since fft_init() is not guaranteed to run
+// before the first plan is made (the python module never calls it), and
+// simulations may be solved from several threads at once.
+static pthread_mutex_t mutex = PTHREAD_MUTEX_INITIALIZER;
 #endif
 
 int fft_next_fast_size(int n){
@@ -61,85 +66,231 @@ void fft_free(void *p){
 #endif
 }
 
-struct tag_fft_plan{
+// Plans are kept in a pool of idle plans so that repeated transforms of the
+// same shape (every field plane, every epsilon FFT of a layer) do not pay
+// for planning again. A plan is checked out of the pool by
+// fft_plan_dft_2d and returned to it by fft_plan_destroy; a checked out
+// plan is never shared, since a kiss_fft configuration carries its own
+// scratch space. FFTW plans are made on scratch arrays with the same
+// alignment and placement as the caller's, and executed with the new-array
+// interface, so the planner never touches the caller's data.
+struct fft_plan_entry{
+	int n[2];
+	int sign;
+	int inplace;
+	int align_in, align_out;
 #ifdef HAVE_LIBFFTW3
 	fftw_plan plan;
 #else
 	kiss_fftnd_cfg cfg;
-	std::complex<double> *in, *out;
 #endif
+	fft_plan_entry *prev, *next;
+};
+
+struct tag_fft_plan{
+	fft_plan_entry *entry;
+	std::complex<double> *in, *out;
 };
 
+// Idle plans, most recently used first.
+static fft_plan_entry *cache_head = NULL;
+static fft_plan_entry *cache_tail = NULL;
+static size_t cache_size = 0;
+static size_t cache_capacity = 32;
+static size_t cache_hits = 0;
+static size_t cache_misses = 0;
+static int planner_effort = 0;
+
+static void fft_lock(){
+#ifdef HAVE_LIBPTHREAD
+	pthread_mutex_lock(&mutex);
+#endif
+}
+static void fft_unlock(){
+#ifdef HAVE_LIBPTHREAD
+	pthread_mutex_unlock(&mutex);
+#endif
+}
+
+static int fft_alignment_of(const std::complex<double> *p){
+#ifdef HAVE_LIBFFTW3
+	return fftw_alignment_of((double*)p);
+#else
+	(void)p;
+	return 0;
+#endif
+}
+
+// The following assume the mutex is held.
+static void fft_cache_unlink(fft_plan_entry *e){
+	if(NULL != e->prev){ e->prev->next = e->next; }else{ cache_head = e->next; }
+	if(NULL != e->next){ e->next->prev = e->prev; }else{ cache_tail = e->prev; }
+	e->prev = NULL;
+	e->next = NULL;
+	cache_size--;
+}
+static void fft_cache_push(fft_plan_entry *e){
+	e->prev = NULL;
+	e->next = cache_head;
+	if(NULL != cache_head){ cache_head->prev = e; }else{ cache_tail = e; }
+	cache_head = e;
+	cache_size++;
+}
+static void fft_entry_destroy(fft_plan_entry *e){
+#ifdef HAVE_LIBFFTW3
+	fftw_destroy_plan(e->plan);
+#else
+	free(e->cfg);
+#endif
+	free(e);
+}
+static void fft_cache_trim(size_t capacity){
+	while(cache_size > capacity){
+		fft_plan_entry *e = cache_tail;
+		fft_cache_unlink(e);
+		fft_entry_destroy(e);
+	}
+}
+
 fft_plan fft_plan_dft_2d(
 	int n[2],
 	std::complex<double> *in, std::complex<double> *out,
 	int sign
 ){
-	fft_plan plan = NULL;
-#ifdef HAVE_LIBFFTW3
-# ifdef HAVE_LIBPTHREAD
-	pthread_mutex_lock(&mutex);
-# endif
-	fftw_plan p;
-	p = fftw_plan_dft(2, n, (fftw_complex*)in, (fftw_complex*)out, sign, FFTW_ESTIMATE);
-# ifdef HAVE_LIBPTHREAD
-	pthread_mutex_unlock(&mutex);
-# endif
-	if(NULL != p){
-		plan = (fft_plan)malloc(sizeof(tag_fft_plan));
-		plan->plan = p;
+	const int inplace = (in == out);
+	const int align_in = fft_alignment_of(in);
+	const int align_out = fft_alignment_of(out);
+	fft_plan_entry *e;
+
+	fft_lock();
+	for(e = cache_head; NULL != e; e = e->next){
+		if(e->n[0] == n[0] && e->n[1] == n[1] && e->sign == sign &&
+			e->inplace == inplace && e->align_in == align_in &&
+			e->align_out == align_out
+		){ break; }
 	}
+	if(NULL != e){
+		fft_cache_unlink(e);
+		cache_hits++;
+	}else{
+		cache_misses++;
+		e = (fft_plan_entry*)malloc(sizeof(fft_plan_entry));
+		e->n[0] = n[0];
+		e->n[1] = n[1];
+		e->sign = sign;
+		e->inplace = inplace;
+		e->align_in = align_in;
+		e->align_out = align_out;
+		e->prev = NULL;
+		e->next = NULL;
+#ifdef HAVE_LIBFFTW3
+		// The FFTW planner is not re-entrant, so plan under the lock.
+		static const unsigned flags[3] = { FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT };
+		const size_t bytes = sizeof(fftw_complex) * n[0] * n[1];
+		char *buf_in = (char*)fftw_malloc(bytes + 64);
+		char *buf_out = inplace ? buf_in : (char*)fftw_malloc(bytes + 64);
+		e->plan = fftw_plan_dft(2, n,
+			(fftw_complex*)(buf_in + align_in),
+			(fftw_complex*)(buf_out + align_out),
+			sign, flags[planner_effort]
+		);
+		if(!inplace){ fftw_free(buf_out); }
+		fftw_free(buf_in);
+		if(NULL == e->plan){ free(e); e = NULL; }
 #else
-	kiss_fftnd_cfg cfg;
-	cfg = kiss_fftnd_alloc(n, 2, sign, NULL, NULL);
-	if(NULL != cfg){
-		plan = (fft_plan)malloc(sizeof(tag_fft_plan));
-		plan->cfg = cfg;
-		plan->in = in;
-		plan->out = out;
-	}
+		e->cfg = kiss_fftnd_alloc(n, 2, sign, NULL, NULL);
+		if(NULL == e->cfg){ free(e); e = NULL; }
 #endif
+	}
+	fft_unlock();
+
+	if(NULL == e){ return NULL; }
+	fft_plan plan = (fft_plan)malloc(sizeof(tag_fft_plan));
+	plan->entry = e;
+	plan->in = in;
+	plan->out = out;
 	return plan;
 }
 
 void fft_plan_exec(const fft_plan plan){
+	S4_ProfileScope profile_scope(NULL, S4_PROFILE_FFT);
 #ifdef HAVE_LIBFFTW3
-	fftw_execute(plan->plan);
+	fftw_execute_dft(plan->entry->plan, (fftw_complex*)plan->in, (fftw_complex*)plan->out);
 #else
-	kiss_fftnd(plan->cfg, (const kiss_fft_cpx *)plan->in, (kiss_fft_cpx *)plan->out);
+	kiss_fftnd(plan->entry->cfg, (const kiss_fft_cpx *)plan->in, (kiss_fft_cpx *)plan->out);
 #endif
 }
 
 void fft_plan_destroy(fft_plan plan){
 	if(NULL == plan){ return; }
+	fft_lock();
+	fft_cache_push(plan->entry);
+	fft_cache_trim(cache_capacity);
+	fft_unlock();
+	free(plan);
+}
+
+void fft_plan_cache_set_capacity(size_t capacity){
+	fft_lock();
+	cache_capacity = capacity;
+	fft_cache_trim(cache_capacity);
+	fft_unlock();
+}
+
+void fft_plan_cache_info(size_t *size, size_t *capacity, size_t *hits, size_t *misses){
+	fft_lock();
+	if(NULL != size){ *size = cache_size; }
+	if(NULL != capacity){ *capacity = cache_capacity; }
+	if(NULL != hits){ *hits = cache_hits; }
+	if(NULL != misses){ *misses = cache_misses; }
+	fft_unlock();
+}
+
+int fft_set_planner_effort(int effort){
+	if(effort < 0 || effort > 2){ return -1; }
+	fft_lock();
+	if(effort != planner_effort){
+		// Idle plans were made with the old effort; drop them.
+		fft_cache_trim(0);
+		planner_effort = effort;
+	}
+	fft_unlock();
+	return 0;
+}
+
+int fft_wisdom_import(const char *filename){
 #ifdef HAVE_LIBFFTW3
-# ifdef HAVE_LIBPTHREAD
-	pthread_mutex_lock(&mutex);
-# endif
-	fftw_destroy_plan(plan->plan);
-# ifdef HAVE_LIBPTHREAD
-	pthread_mutex_unlock(&mutex);
-# endif
+	fft_lock();
+	int ret = fftw_import_wisdom_from_filename(filename);
+	fft_unlock();
+	return ret ? 0 : 1;
 #else
-	free(plan->cfg);
+	(void)filename;
+	return -1;
 #endif
-	free(plan);
 }
 
-void fft_init(){
-#ifdef HAVE_LIBPTHREAD
-	if(pthread_mutex_init(&mutex, NULL)){
-        printf("Unable to initialize a mutex for FFT module\n");
-    }
+int fft_wisdom_export(const char *filename){
+#ifdef HAVE_LIBFFTW3
+	fft_lock();
+	int ret = fftw_export_wisdom_to_filename(filename);
+	fft_unlock();
+	return ret ? 0 : 1;
+#else
+	(void)filename;
+	return -1;
 #endif
 }
 
+void fft_init(){
+	/* nothing to do; the planner mutex is statically initialized */
+}
+
 void fft_destroy(){
+	fft_lock();
+	fft_cache_trim(0);
 #ifdef HAVE_LIBFFTW3
 	fftw_cleanup();
 #endif
-#ifdef HAVE_LIBPTHREAD
-    pthread_mutex_destroy(&mutex);
-#endif
+	fft_unlock();
 }
-
@@ -35,5 +35,19 @@ void fft_plan_destroy(fft_plan plan);
 
 int fft_next_fast_size(int n);
 
+// Destroyed plans are kept for reuse by later plans of the same size,
+// direction, placement and alignment. At most capacity idle plans are
+// kept; the least recently used are freed first.
+void fft_plan_cache_set_capacity(size_t capacity);
+void fft_plan_cache_info(size_t *size, size_t *capacity, size_t *hits, size_t *misses);
+
+// effort is 0 (estimate), 1 (measure) or 2 (patient); only used by FFTW.
+// Returns nonzero on an invalid effort.
+int fft_set_planner_effort(int effort);
+
+// Returns 0 on success, 1 on failure, and -1 if not built with FFTW.
+int fft_wisdom_import(const char *filename);
+int fft_wisdom_export(const char *filename);
+
 extern "C" void fft_init();
 extern "C" void fft_destroy();
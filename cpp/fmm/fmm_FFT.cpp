@@ -30,6 +30,7 @@
 # include "../RNP/LinearSolve_lapack.h"
 #endif
 #include "fmm.h"
+#include "../profile.h"
 
 #include <limits>
 #include <kiss_fft.h>
@@ -37,6 +38,7 @@
 #include "fft_iface.h"
 
 int FMMGetEpsilon_FFT(const S4_Simulation *S, const S4_Layer *L, const int n, std::complex<double> *Epsilon2, std::complex<double> *Epsilon_inv){
+	S4_ProfileScope profile_scope(S->profile, S4_PROFILE_EPSILON_FFT);
 	const int n2 = 2*n;
 	const int *G = S->G;
 
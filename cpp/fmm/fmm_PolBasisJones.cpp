@@ -30,6 +30,7 @@
 # include "../RNP/LinearSolve_lapack.h"
 #endif
 #include "fmm.h"
+#include "../profile.h"
 
 #include <limits>
 //#include <kiss_fft.h>
@@ -89,6 +90,7 @@ static void vfield_to_Jones_vector(double v[2], std::complex<double> j[2]){
 // where u is the Jones vector field, and each of the 4 blocks are the
 // Fourier transformed matrices.
 int FMMGetEpsilon_PolBasisJones(const S4_Simulation *S, const S4_Layer *L, const int n, std::complex<double> *Epsilon2, std::complex<double> *Epsilon_inv){
+	S4_ProfileScope profile_scope(S->profile, S4_PROFILE_EPSILON_POL_BASIS_JONES);
 	double mp1 = 0;
 	int pwr = S->options.lanczos_smoothing_power;
 	if(S->options.use_Lanczos_smoothing){
@@ -30,6 +30,7 @@
 # include "../RNP/LinearSolve_lapack.h"
 #endif
 #include "fmm.h"
+#include "../profile.h"
 
 //#include <iostream>
 #include <limits>
@@ -40,6 +41,7 @@
 #include <cstring>
 
 int FMMGetEpsilon_PolBasisNV(const S4_Simulation *S, const S4_Layer *L, const int n, std::complex<double> *Epsilon2, std::complex<double> *Epsilon_inv){
+	S4_ProfileScope profile_scope(S->profile, S4_PROFILE_EPSILON_POL_BASIS_NV);
 	double mp1 = 0;
 	int pwr = S->options.lanczos_smoothing_power;
 	if(S->options.use_Lanczos_smoothing){
@@ -30,15 +30,106 @@
 # include "../RNP/LinearSolve_lapack.h"
 #endif
 #include "fmm.h"
+#include "../profile.h"
 
 #include <limits>
 
+// The Fourier coefficients of the pattern depend only on the difference
+// G_i-G_j, which takes far fewer distinct values than there are pairs (i,j).
+// This collects the distinct differences so that each is transformed once.
+struct DeltaGTable{
+	int n; // number of distinct differences
+	int off[2], ld; // dense lookup: map[(dG[0]+off[0]) + (dG[1]+off[1])*ld]
+	int *map; // index of each difference into f
+	double *f; // length 2*n; distinct differences in reciprocal space (k/2pi)
+
+	DeltaGTable(const S4_Simulation *S, int nG):n(0),map(NULL),f(NULL){
+		const int *G = S->G;
+		int gmin[2] = {0,0}, gmax[2] = {0,0};
+		for(int i = 0; i < nG; ++i){
+			for(int d = 0; d < 2; ++d){
+				if(G[2*i+d] < gmin[d]){ gmin[d] = G[2*i+d]; }
+				if(G[2*i+d] > gmax[d]){ gmax[d] = G[2*i+d]; }
+			}
+		}
+		off[0] = gmax[0]-gmin[0];
+		off[1] = gmax[1]-gmin[1];
+		ld = 2*off[0]+1;
+		const int nmap = ld*(2*off[1]+1);
+		map = (int*)S4_malloc(sizeof(int)*nmap);
+		for(int i = 0; i < nmap; ++i){ map[i] = -1; }
+
+		int *udG = (int*)S4_malloc(sizeof(int)*2*nmap);
+		for(int j = 0; j < nG; ++j){
+			for(int i = 0; i < nG; ++i){
+				const int dG[2] = {G[2*i+0]-G[2*j+0],G[2*i+1]-G[2*j+1]};
+				int *m = &map[(dG[0]+off[0]) + (dG[1]+off[1])*ld];
+				if(*m < 0){
+					*m = n;
+					udG[2*n+0] = dG[0];
+					udG[2*n+1] = dG[1];
+					++n;
+				}
+			}
+		}
+		f = (double*)S4_malloc(sizeof(double)*2*n);
+		for(int u = 0; u < n; ++u){
+			f[2*u+0] = udG[2*u+0] * S->Lk[0] + udG[2*u+1] * S->Lk[2];
+			f[2*u+1] = udG[2*u+0] * S->Lk[1] + udG[2*u+1] * S->Lk[3];
+		}
+		S4_free(udG);
+	}
+	~DeltaGTable(){
+		S4_free(f);
+		S4_free(map);
+	}
+	int index(const int *G, int i, int j) const{
+		return map[(G[2*i+0]-G[2*j+0]+off[0]) + (G[2*i+1]-G[2*j+1]+off[1])*ld];
+	}
+};
+
+// Transforms nvalue sets of values (stride ldv) at every distinct difference,
+// applying Lanczos smoothing if requested. Returns an array of length
+// 2*nvalue*table.n laid out as for Pattern_GetFourierTransformBatch.
+static double *GetPatternTransforms(
+	const S4_Simulation *S, const S4_Layer *L, const DeltaGTable &table,
+	int nvalue, const double *values, int ldv, int ndim, double unit_cell_size,
+	double mp1, int pwr
+){
+	double *ft = (double*)S4_malloc(sizeof(double)*2*nvalue*table.n);
+	Pattern_GetFourierTransformBatch(&L->pattern, nvalue, values, ldv, table.n, table.f, ndim, unit_cell_size, ft);
+	if(S->options.use_Lanczos_smoothing){
+		for(int u = 0; u < table.n; ++u){
+			const double sigma = GetLanczosSmoothingFactor(mp1, pwr, &table.f[2*u]);
+			for(int k = 0; k < 2*nvalue; ++k){
+				ft[2*nvalue*u+k] *= sigma;
+			}
+		}
+	}
+	return ft;
+}
+
+// Fills the n x n matrix A (leading dimension lda) with value set k of ft.
+static void ScatterPatternTransform(
+	const int *G, const DeltaGTable &table, const double *ft, int nvalue, int k,
+	int n, std::complex<double> *A, int lda
+){
+	for(int j = 0; j < n; ++j){
+		for(int i = 0; i < n; ++i){
+			const double *v = &ft[2*(k+nvalue*table.index(G, i, j))];
+			A[i+j*lda] = std::complex<double>(v[0],v[1]);
+		}
+	}
+}
+
 int FMMGetEpsilon_ClosedForm(const S4_Simulation *S, const S4_Layer *L, const int n, std::complex<double> *Epsilon2, std::complex<double> *Epsilon_inv){
+	S4_ProfileScope profile_scope(S->profile, S4_PROFILE_EPSILON_CLOSED_FORM);
 	const int n2 = 2*n;
 	const int *G = S->G;
 	const int ndim = (0 == S->Lr[2] && 0 == S->Lr[3]) ? 1 : 2;
+	const int ldv = 2*(L->pattern.nshapes+1);
 	double *ivalues = (double*)S4_malloc(sizeof(double)*(2+10)*(L->pattern.nshapes+1));
-	double *values = ivalues + 2*(L->pattern.nshapes+1);
+	double *values = ivalues + ldv;
 
 	S4_TRACE("I  Closed-form epsilon\n");
 
@@ -73,58 +164,25 @@ int FMMGetEpsilon_ClosedForm(const S4_Simulation *S, const S4_Layer *L, const in
 	}
 
 	const double unit_cell_size = Simulation_GetUnitCellSize(S);
+	const DeltaGTable table(S, n);
+	S4_TRACE("I   %d distinct G differences\n", table.n);
 
 	if(!have_tensor){
+		// The transform of the inverse is needed by the 1D proper FFF rule
+		// and the polarization basis; ivalues and values are adjacent, so
+		// both are done in one pass.
+		const bool need_inv = S->options.use_polarization_basis || 1 == ndim;
+		const int nvalue = need_inv ? 2 : 1;
+		const int ieps = need_inv ? 1 : 0;
+		double *ft = GetPatternTransforms(S, L, table, nvalue, need_inv ? ivalues : values, ldv, ndim, unit_cell_size, mp1, pwr);
+
 		// Make Epsilon
-		for(int j = 0; j < n; ++j){
-			for(int i = 0; i < n; ++i){
-				int dG[2] = {G[2*i+0]-G[2*j+0],G[2*i+1]-G[2*j+1]};
-				double f[2] = {
-					dG[0] * S->Lk[0] + dG[1] * S->Lk[2],
-					dG[0] * S->Lk[1] + dG[1] * S->Lk[3]
-					};
-				double ft[2];
-				Pattern_GetFourierTransform(&L->pattern, values, f, ndim, unit_cell_size, ft);
-				if(S->options.use_Lanczos_smoothing){
-					double sigma = GetLanczosSmoothingFactor(mp1, pwr, f);
-					ft[0] *= sigma;
-					ft[1] *= sigma;
-				}
-				/*
-				if(abs(dG[0]) > 1 || abs(dG[1]) > 1){
-					ft[0] = 0; ft[1] = 0;
-				}*/
-				/*
-				{
-					double ftx = (fabs(ft[0]) < 2e-16)? 0 : ft[0];
-					double fty = (fabs(ft[1]) < 2e-16)? 0 : ft[1];
-					if(0 != ftx || 0 != fty)
-					std::cerr << G[2*i+0]-G[2*j+0] << "\t" << G[2*i+1]-G[2*j+1] << "\t" << ftx << "\t" << fty << std::endl;
-				}*/
-				Epsilon2[i+j*n2] = std::complex<double>(ft[0],ft[1]);
-			}
-		}
+		ScatterPatternTransform(G, table, ft, nvalue, ieps, n, Epsilon2, n2);
 		S4_TRACE("I  Epsilon(0,0) = %f,%f [omega=%f]\n", Epsilon2[0].real(), Epsilon2[0].imag(), S->omega[0]);
 
 		if(!S->options.use_polarization_basis){ // ordinary Laurent's rule
 			if(0 == S->Lr[2] && 0 == S->Lr[3]){ // 1D proper FFF rule
-				for(int j = 0; j < n; ++j){
-					for(int i = 0; i < n; ++i){
-						int dG[2] = {G[2*i+0]-G[2*j+0],G[2*i+1]-G[2*j+1]};
-						double f[2] = {
-							dG[0] * S->Lk[0] + dG[1] * S->Lk[2],
-							dG[0] * S->Lk[1] + dG[1] * S->Lk[3]
-						};
-						double ft[2];
-						Pattern_GetFourierTransform(&L->pattern, ivalues, f, ndim, unit_cell_size, ft);
-						if(S->options.use_Lanczos_smoothing){
-							double sigma = GetLanczosSmoothingFactor(mp1, pwr, f);
-							ft[0] *= sigma;
-							ft[1] *= sigma;
-						}
-						Epsilon_inv[i+j*n] = std::complex<double>(ft[0],ft[1]);
-					}
-				}
+				ScatterPatternTransform(G, table, ft, nvalue, 0, n, Epsilon_inv, n);
 				RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,1., &Epsilon2[n+n*n2],n2);
 				RNP::LinearSolve<'N'>(n,n, Epsilon_inv,n, &Epsilon2[n+n*n2],n2, NULL, NULL);
 				RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,1., Epsilon_inv,n);
@@ -141,29 +199,13 @@ int FMMGetEpsilon_ClosedForm(const S4_Simulation *S, const S4_Layer *L, const in
 			// Upper block of diagonal of Epsilon2 is already Epsilon
 			RNP::TBLAS::CopyMatrix<'A'>(n,n,&Epsilon2[0+0*n2],n2, &Epsilon2[n+n*n2],n2);
 			// Make Epsilon_inv
-			for(int j = 0; j < n; ++j){
-				for(int i = 0; i < n; ++i){
-					int dG[2] = {G[2*i+0]-G[2*j+0],G[2*i+1]-G[2*j+1]};
-					double f[2] = {
-						dG[0] * S->Lk[0] + dG[1] * S->Lk[2],
-						dG[0] * S->Lk[1] + dG[1] * S->Lk[3]
-					};
-					double ft[2];
-					Pattern_GetFourierTransform(&L->pattern, ivalues, f, ndim, unit_cell_size, ft);
-					if(S->options.use_Lanczos_smoothing){
-						double sigma = GetLanczosSmoothingFactor(mp1, pwr, f);
-						ft[0] *= sigma;
-						ft[1] *= sigma;
-					}
-					Epsilon_inv[i+j*n] = std::complex<double>(ft[0],ft[1]);
-				}
-			}
+			ScatterPatternTransform(G, table, ft, nvalue, 0, n, Epsilon_inv, n);
 		}
 		RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,0., &Epsilon2[n+0*n2],n2);
 		RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,0., &Epsilon2[0+n*n2],n2);
 		// Epsilon2 has Epsilon's on its diagonal
+		S4_free(ft);
 	}else{ // have tensor dielectric
-		const int ldv = 2*(1+L->pattern.nshapes);
 		for(int i = -1; i < L->pattern.nshapes; ++i){
 			const S4_Material *M;
 			if(-1 == i){
@@ -211,49 +253,20 @@ int FMMGetEpsilon_ClosedForm(const S4_Simulation *S, const S4_Layer *L, const in
 			}
 		}
 
+		// All five tensor components in one pass
+		double *ft = GetPatternTransforms(S, L, table, 5, values, ldv, ndim, unit_cell_size, mp1, pwr);
 		for(int k = -1; k < 4; ++k){
 			if(-1 == k){
-				for(int j = 0; j < n; ++j){
-					for(int i = 0; i < n; ++i){
-						int dG[2] = {G[2*i+0]-G[2*j+0],G[2*i+1]-G[2*j+1]};
-						double f[2] = {
-							dG[0] * S->Lk[0] + dG[1] * S->Lk[2],
-							dG[0] * S->Lk[1] + dG[1] * S->Lk[3]
-							};
-						double ft[2];
-						Pattern_GetFourierTransform(&L->pattern, &values[4*ldv], f, ndim, unit_cell_size, ft);
-						if(S->options.use_Lanczos_smoothing){
-							double sigma = GetLanczosSmoothingFactor(mp1, pwr, f);
-							ft[0] *= sigma;
-							ft[1] *= sigma;
-						}
-						Epsilon2[i+j*n2] = std::complex<double>(ft[0],ft[1]);
-					}
-				}
+				ScatterPatternTransform(G, table, ft, 5, 4, n, Epsilon2, n2);
 				RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,1., Epsilon_inv,n);
 				RNP::LinearSolve<'N'>(n,n, &Epsilon2[0+0*n2],n2, Epsilon_inv,n, NULL, NULL);
 			}else{
 				const int ib = k&1 ? n : 0;
 				const int jb = k&2 ? n : 0;
-				for(int j = 0; j < n; ++j){
-					for(int i = 0; i < n; ++i){
-						int dG[2] = {G[2*i+0]-G[2*j+0],G[2*i+1]-G[2*j+1]};
-						double f[2] = {
-							dG[0] * S->Lk[0] + dG[1] * S->Lk[2],
-							dG[0] * S->Lk[1] + dG[1] * S->Lk[3]
-							};
-						double ft[2];
-						Pattern_GetFourierTransform(&L->pattern, &values[k*ldv], f, ndim, unit_cell_size, ft);
-						if(S->options.use_Lanczos_smoothing){
-							double sigma = GetLanczosSmoothingFactor(mp1, pwr, f);
-							ft[0] *= sigma;
-							ft[1] *= sigma;
-						}
-						Epsilon2[ib+i+(jb+j)*n2] = std::complex<double>(ft[0],ft[1]);
-					}
-				}
+				ScatterPatternTransform(G, table, ft, 5, k, n, &Epsilon2[ib+jb*n2], n2);
 			}
 		}
+		S4_free(ft);
 	}
 
 	S4_free(ivalues);
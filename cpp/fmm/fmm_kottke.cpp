@@ -32,6 +32,7 @@
 # include "../RNP/LinearSolve_lapack.h"
 #endif
 #include "fmm.h"
+#include "../profile.h"
 
 #include <limits>
 //#include <kiss_fft.h>
@@ -53,6 +54,7 @@ static void sym2x2rot(const std::complex<double> M[4], const double nvec[2], std
 }
 
 int FMMGetEpsilon_Kottke(const S4_Simulation *S, const S4_Layer *L, const int n, std::complex<double> *Epsilon2, std::complex<double> *Epsilon_inv){
+	S4_ProfileScope profile_scope(S->profile, S4_PROFILE_EPSILON_KOTTKE);
 	const int n2 = 2*n;
 	const int *G = S->G;
 
@@ -182,3 +182,34 @@ int G_select(const int method, unsigned int *NG, const double Lk[4], int *G){
 	}
 	return -1;
 }
+
+int G_mirror(const int axis, const unsigned int NG, const double Lk[4], const int *G, int *map){
+	const double tol = 1e-8 * (hypot(Lk[0],Lk[1]) + hypot(Lk[2],Lk[3]));
+	unsigned int i, j;
+	if(0 != axis && 1 != axis){ return -1; }
+	if(NULL == Lk){ return -3; }
+	if(NULL == G){ return -4; }
+	if(NULL == map){ return -5; }
+
+	for(i = 0; i < NG; ++i){
+		// cartesian coordinates of the mirror image of G[i]
+		double u[2] = {
+			G[2*i+0]*Lk[0] + G[2*i+1]*Lk[2],
+			G[2*i+0]*Lk[1] + G[2*i+1]*Lk[3]
+		};
+		u[axis] = -u[axis];
+		map[i] = -1;
+		for(j = 0; j < NG; ++j){
+			const double v[2] = {
+				G[2*j+0]*Lk[0] + G[2*j+1]*Lk[2],
+				G[2*j+0]*Lk[1] + G[2*j+1]*Lk[3]
+			};
+			if(fabs(u[0]-v[0]) <= tol && fabs(u[1]-v[1]) <= tol){
+				map[i] = j;
+				break;
+			}
+		}
+		if(map[i] < 0){ return 1; }
+	}
+	return 0;
+}
@@ -36,3 +36,22 @@
 //   -n if the n-th argument is invalid
 //   0 on success
 int G_select(const int method, unsigned int *NG, const double Lk[4], int *G);
+
+// Purpose:
+//   Finds the mirror image of every G vector in a list, for a mirror plane
+//   through the origin and normal to the x or y axis.
+//
+// Arguments:
+//   axis   - (INPUT) 0 for the mirror x -> -x, 1 for the mirror y -> -y.
+//   NG     - (INPUT) Number of G vectors in G.
+//   Lk     - (INPUT) Primitive lattice vectors, as for G_select.
+//   G      - (INPUT) Size 2*NG. The G vectors, as returned by G_select.
+//   map    - (OUTPUT) Length NG. The mirror image of G vector i is
+//            G vector map[i].
+// Returns
+//   -n if the n-th argument is invalid
+//   0 on success
+//   1 if the mirror image of some G vector is not in the list; this is
+//     the case when the lattice does not have the mirror symmetry or the
+//     truncation breaks it.
+int G_mirror(const int axis, const unsigned int NG, const double Lk[4], const int *G, int *map);
@@ -0,0 +1,176 @@
+"""MPI-distributed parameter sweeps
+
+Every rank runs the same script and builds its own simulations; only the
+indices of the grid points and the results travel over MPI. Rank 0 hands
+out chunks of grid points on request (and solves chunks itself while no
+requests are pending), so slow regions of the grid do not stall the sweep.
+
+"""
+import itertools
+import numpy as np
+from mpi4py import MPI
+
+_TAG_REQUEST = 1
+_TAG_WORK = 2
+
+
+def _grid_points(grid):
+    """
+    Helper function to expand a parameter grid into its names, shape and
+    an indexable list of points
+
+    :param grid: mapping of parameter name to the values it takes
+    :type grid: dict
+    :return: names, shape of the grid, list of points (dicts)
+    :type: tuple
+    """
+    names = list(grid.keys())
+    values = []
+    for name in names:
+        l_values = grid[name]
+        if np.ndim(l_values) == 0:
+            l_values = [l_values]
+        # a 2D array (e.g. material epsilons) gives one value per row
+        l_values = list(l_values)
+        if len(l_values) == 0:
+            raise RuntimeError(f"grid parameter {name} has no values")
+        values.append(l_values)
+    shape = tuple(len(v) for v in values)
+    points = [dict(zip(names, p)) for p in itertools.product(*values)]
+    return names, shape, points
+
+
+def _solve_chunk(factory, points, indices, layers, offsets, by_G):
+    """
+    Helper function to solve a chunk of grid points
+
+    :return: list of (index, flux, flux_by_G) tuples
+    :type: list
+    """
+    results = []
+    for i in indices:
+        sim = factory(**points[i])
+        flux = np.empty((len(layers), 4), dtype=np.float64)
+        flux_by_G = [] if by_G else None
+        for j, layer in enumerate(layers):
+            flux[j] = sim.get_poynting_flux(layer, offsets[j])
+            if by_G:
+                flux_by_G.append(sim.get_poynting_flux_by_G(layer,
+                                                            offsets[j]))
+        if by_G:
+            flux_by_G = np.ascontiguousarray(flux_by_G, dtype=np.float64)
+        results.append((i, flux, flux_by_G))
+    return results
+
+
+def sweep(factory, grid, layers, offsets=None, by_G=False, chunk_size=1,
+          comm=None):
+    """
+    Solve a simulation over the outer product of a parameter grid,
+    distributing the grid points over all ranks of the communicator.
+    Must be called collectively by every rank.
+
+    :param factory: called as ``factory(**point)`` for every grid point,
+                    where ``point`` maps each grid parameter name to one
+                    of its values (e.g. a frequency, an angle, a layer
+                    thickness or a material epsilon). Must return a
+                    ready-to-solve :class:`S4.Simulation`
+    :param grid: mapping of parameter name to the sequence of values it
+                 takes
+    :param layers: names of the layers in which to compute the flux
+    :param offsets: offset from the beginning of each layer; defaults to
+                    zero for every layer
+    :param by_G: if True, also gather get_poynting_flux_by_G for every
+                 layer
+    :param chunk_size: number of grid points handed out per request
+    :param comm: communicator to use; defaults to ``MPI.COMM_WORLD``
+    :type factory: callable
+    :type grid: dict
+    :type layers: list of str
+    :type offsets: :class:`numpy.ndarray`, shape= :math:`\\left(n_l,
+                   \\right)`, dtype=float
+    :type by_G: bool
+    :type chunk_size: int
+    :type comm: :class:`mpi4py.MPI.Comm`
+
+    :return: on rank 0, the power flux with shape ``grid_shape + (n_l, 4)``
+             (and, if by_G, the flux by G with shape ``grid_shape + (n_l,
+             n_G, 4)``); None on all other ranks
+    :type: :class:`numpy.ndarray`, dtype=float
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    if isinstance(layers, str):
+        layers = [layers]
+    l_layers = list(layers)
+    for layer in l_layers:
+        if not isinstance(layer, str):
+            raise RuntimeError("Layer must be a string")
+    if offsets is None:
+        l_offsets = [0.0] * len(l_layers)
+    else:
+        l_offsets = [float(o) for o in np.atleast_1d(offsets)]
+        if not len(l_offsets) == len(l_layers):
+            raise RuntimeError("offsets must have one value per layer")
+    l_chunk_size = int(chunk_size)
+    if l_chunk_size < 1:
+        raise RuntimeError("chunk_size must be >= 1")
+
+    names, shape, points = _grid_points(grid)
+    n_points = len(points)
+    chunks = [range(i, min(i + l_chunk_size, n_points))
+              for i in range(0, n_points, l_chunk_size)]
+
+    def solve(chunk):
+        return _solve_chunk(factory, points, chunk, l_layers, l_offsets,
+                            by_G)
+
+    if comm.rank != 0:
+        # worker: report results, receive the next chunk until told to stop
+        results = []
+        while True:
+            comm.send(results, dest=0, tag=_TAG_REQUEST)
+            chunk = comm.recv(source=0, tag=_TAG_WORK)
+            if chunk is None:
+                break
+            results = solve(chunk)
+        return None
+
+    # rank 0: schedule chunks and solve some itself when nobody is waiting
+    collected = []
+    next_chunk = 0
+    n_active = comm.size - 1
+    status = MPI.Status()
+    while n_active > 0 or next_chunk < len(chunks):
+        if n_active > 0 and (next_chunk >= len(chunks) or
+                             comm.Iprobe(source=MPI.ANY_SOURCE,
+                                         tag=_TAG_REQUEST)):
+            results = comm.recv(source=MPI.ANY_SOURCE, tag=_TAG_REQUEST,
+                                status=status)
+            collected.extend(results)
+            if next_chunk < len(chunks):
+                comm.send(chunks[next_chunk], dest=status.Get_source(),
+                          tag=_TAG_WORK)
+                next_chunk += 1
+            else:
+                comm.send(None, dest=status.Get_source(), tag=_TAG_WORK)
+                n_active -= 1
+        else:
+            collected.extend(solve(chunks[next_chunk]))
+            next_chunk += 1
+
+    # assemble contiguous arrays in grid order
+    flux = np.empty((n_points, len(l_layers), 4), dtype=np.float64)
+    flux_by_G = None
+    for i, l_flux, l_flux_by_G in collected:
+        flux[i] = l_flux
+        if by_G:
+            if flux_by_G is None:
+                flux_by_G = np.empty((n_points,) + l_flux_by_G.shape,
+                                     dtype=np.float64)
+            flux_by_G[i] = l_flux_by_G
+    flux = flux.reshape(shape + flux.shape[1:])
+    if by_G:
+        flux_by_G = flux_by_G.reshape(shape + flux_by_G.shape[1:])
+        return flux, flux_by_G
+    return flux
@@ -883,6 +883,109 @@ int Pattern_GetShape(
 	return pattern_get_shape(p->nshapes, p->shapes, p->parent, x, shape_index, n);
 }
 
+/* Fourier component of a single shape with unit interior value, including
+ * the area and the phase due to the shape center, but not the division by
+ * the unit cell size. `DC' is nonzero if k_ is the origin.
+ */
+static void shape_get_fourier_transform(
+	const shape *s,
+	const double k_[2], /* remember, this is k/2pi */
+	int ndim,
+	int DC,
+	double t[2]
+){
+	double phase_angle = -2*M_PI*(k_[0]*s->center[0] + k_[1]*s->center[1]); /* phase = exp(i*phase_angle); */
+	double z[2] = {0,0};
+	double area;
+	double k[2];
+
+	const double ca = cos(s->angle);
+	const double sa = sin(s->angle);
+	k[0] = k_[0] * ca + k_[1] * sa;
+	k[1] = k_[0] *-sa + k_[1] * ca;
+
+	/* Each shape should set z to be the Fourier component, but without dval, and without area. */
+	switch(s->type){
+	case CIRCLE:
+		area = M_PI*s->vtab.circle.radius*s->vtab.circle.radius;
+		z[0] =Jinc(s->vtab.circle.radius*hypot(k[0],k[1]));
+		break;
+	case ELLIPSE:
+		area = M_PI*s->vtab.ellipse.halfwidth[0]*s->vtab.ellipse.halfwidth[1];
+		if(s->vtab.ellipse.halfwidth[0] >= s->vtab.ellipse.halfwidth[1]){
+			double r = s->vtab.ellipse.halfwidth[1] /  s->vtab.ellipse.halfwidth[0] * k[1];
+			z[0] = Jinc(s->vtab.ellipse.halfwidth[0]*hypot(k[0],r));
+		}else{
+			double r = s->vtab.ellipse.halfwidth[0] /  s->vtab.ellipse.halfwidth[1] * k[0];
+			z[0] =Jinc(s->vtab.ellipse.halfwidth[1]*hypot(r,k[1]));
+		}
+		break;
+	case RECTANGLE:
+		if(1 == ndim){
+			area = 2*s->vtab.rectangle.halfwidth[0];
+			z[0] = Sinc(2*k[0]*s->vtab.rectangle.halfwidth[0]);
+		}else{
+			area = 4*s->vtab.rectangle.halfwidth[0]*s->vtab.rectangle.halfwidth[1];
+			z[0] = Sinc(2*k[0]*s->vtab.rectangle.halfwidth[0])*Sinc(2*k[1]*s->vtab.rectangle.halfwidth[1]);
+		}
+		break;
+	case POLYGON:
+		{
+			area = polygon_area(s->vtab.polygon.n_vertices, s->vtab.polygon.vertex);
+			if(DC){
+				z[0] = 1;
+				z[1] = 0;
+			}else{
+				/* For k != 0,
+				 * S(k) = i/|k|^2 * Sum_{i=0,n-1} z.((v_{i+1}-v_{i}) x k) j0(k.(v_{i+1}-v_{i})/2) e^{ik.(v_{i+1}+v_{i})/2}
+				 */
+				int p,q;
+				double num, pa;
+				double rc[2], u[2];
+				for(p=s->vtab.polygon.n_vertices-1,q=0; q < s->vtab.polygon.n_vertices; p = q++){
+					u[0] = s->vtab.polygon.vertex[2*q+0]-s->vtab.polygon.vertex[2*p+0];
+					u[1] = s->vtab.polygon.vertex[2*q+1]-s->vtab.polygon.vertex[2*p+1];
+					rc[0] = 0.5*(s->vtab.polygon.vertex[2*q+0]+s->vtab.polygon.vertex[2*p+0]);
+					rc[1] = 0.5*(s->vtab.polygon.vertex[2*q+1]+s->vtab.polygon.vertex[2*p+1]);
+
+					num = (u[0]*k[1]-u[1]*k[0]) * Sinc(k[0]*u[0]+k[1]*u[1]);
+					pa = -2*M_PI*(k[0]*rc[0]+k[1]*rc[1]);
+
+					// Multiplication by i means we mess up the order here
+					z[0] += num * sin(pa);
+					z[1] -= num * cos(pa);
+				}
+				// Our k lacks a 2pi factor
+				//z[0] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1])*area;
+				//z[1] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1])*area;
+				area = 1;
+				z[0] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1]);
+				z[1] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1]);
+			}
+		}
+		break;
+	default:
+		area = 0;
+		break;
+	}
+	//f += dval*z*phase/area;
+	//f += dval*(z[0]+i*z[1])*(cos(phase_angle)+i*sin(phase_angle)) / area;
+	//f += dval*( z[0]*cos-z[1]*sin + i*(z[1]*cos+z[0]*sin) ) / area;
+	{
+		double cpa = cos(phase_angle);
+		double spa = sin(phase_angle);
+		t[0] = area;
+		t[1] = area;
+		if(DC){
+			t[0] *= cpa;
+			t[1] *= spa;
+		}else{
+			t[0] *= ( z[0]*cpa-z[1]*spa );
+			t[1] *= ( z[1]*cpa+z[0]*spa );
+		}
+	}
+}
+
 /* returns 0 on success
  * returns -n if n-th argument is invalid
  */
@@ -899,7 +1002,6 @@ int pattern_get_fourier_transform(
 	int i;
 	const int DC = (0 == k_[0] && 0 == k_[1]) ? 1 : 0;
 	double inv_size;
-	double k[2];
 	
 	if(nshapes < 0){ return -1; }
 	if(nshapes > 0 && NULL == shapes){ return -2; }
@@ -933,112 +1035,103 @@ int pattern_get_fourier_transform(
 
 	
 	for(i = 0; i < nshapes; ++i){
-		const shape *s = &shapes[i];
-
 		double dval[2] = {value[2*(i+1)+0]-value[2*(parent[i]+1)+0], value[2*(i+1)+1]-value[2*(parent[i]+1)+1]};
+		double t[2];
+		shape_get_fourier_transform(&shapes[i], k_, ndim, DC, t);
+		f[0] += inv_size*(t[0]*dval[0]-t[1]*dval[1]);
+		f[1] += inv_size*(t[0]*dval[1]+t[1]*dval[0]);
+	}
+	return 0;
+}
+int Pattern_GetFourierTransform(
+	const Pattern *p,
+	const double *value,
+	const double k[2],
+	int ndim,
+	double unit_cell_size,
+	double f[2]
+){
+	return pattern_get_fourier_transform(p->nshapes, p->shapes, p->parent, value, k, ndim, unit_cell_size, f);
+}
 
-		double phase_angle = -2*M_PI*(k_[0]*s->center[0] + k_[1]*s->center[1]); /* phase = exp(i*phase_angle); */
-		double z[2] = {0,0};
-		double area;
-
-		const double ca = cos(s->angle);
-		const double sa = sin(s->angle);
-		k[0] = k_[0] * ca + k_[1] * sa;
-		k[1] = k_[0] *-sa + k_[1] * ca;
+int pattern_get_fourier_transform_batch(
+	int nshapes,
+	const shape *shapes,
+	const int *parent,
+	int nvalue,
+	const double *value,
+	int ldv,
+	int nk,
+	const double *k,
+	int ndim,
+	double unit_cell_size,
+	double *f
+){
+	int i, j, ik;
+	double inv_size;
 
-		/* Each shape should set z to be the Fourier component, but without dval, and without area. */
-		switch(s->type){
-		case CIRCLE:
-			area = M_PI*s->vtab.circle.radius*s->vtab.circle.radius;
-			z[0] =Jinc(s->vtab.circle.radius*hypot(k[0],k[1]));
-			break;
-		case ELLIPSE:
-			area = M_PI*s->vtab.ellipse.halfwidth[0]*s->vtab.ellipse.halfwidth[1];
-			if(s->vtab.ellipse.halfwidth[0] >= s->vtab.ellipse.halfwidth[1]){
-				double r = s->vtab.ellipse.halfwidth[1] /  s->vtab.ellipse.halfwidth[0] * k[1];
-				z[0] = Jinc(s->vtab.ellipse.halfwidth[0]*hypot(k[0],r));
-			}else{
-				double r = s->vtab.ellipse.halfwidth[0] /  s->vtab.ellipse.halfwidth[1] * k[0];
-				z[0] =Jinc(s->vtab.ellipse.halfwidth[1]*hypot(r,k[1]));
-			}
-			break;
-		case RECTANGLE:
-			if(1 == ndim){
-				area = 2*s->vtab.rectangle.halfwidth[0];
-				z[0] = Sinc(2*k[0]*s->vtab.rectangle.halfwidth[0]);
-			}else{
-				area = 4*s->vtab.rectangle.halfwidth[0]*s->vtab.rectangle.halfwidth[1];
-				z[0] = Sinc(2*k[0]*s->vtab.rectangle.halfwidth[0])*Sinc(2*k[1]*s->vtab.rectangle.halfwidth[1]);
-			}
-			break;
-		case POLYGON:
-			{
-				area = polygon_area(s->vtab.polygon.n_vertices, s->vtab.polygon.vertex);
-				if(DC){
-					z[0] = 1;
-					z[1] = 0;
-				}else{
-					/* For k != 0,
-					 * S(k) = i/|k|^2 * Sum_{i=0,n-1} z.((v_{i+1}-v_{i}) x k) j0(k.(v_{i+1}-v_{i})/2) e^{ik.(v_{i+1}+v_{i})/2}
-					 */
-					int p,q;
-					double num, pa;
-					double rc[2], u[2];
-					for(p=s->vtab.polygon.n_vertices-1,q=0; q < s->vtab.polygon.n_vertices; p = q++){
-						u[0] = s->vtab.polygon.vertex[2*q+0]-s->vtab.polygon.vertex[2*p+0];
-						u[1] = s->vtab.polygon.vertex[2*q+1]-s->vtab.polygon.vertex[2*p+1];
-						rc[0] = 0.5*(s->vtab.polygon.vertex[2*q+0]+s->vtab.polygon.vertex[2*p+0]);
-						rc[1] = 0.5*(s->vtab.polygon.vertex[2*q+1]+s->vtab.polygon.vertex[2*p+1]);
-
-						num = (u[0]*k[1]-u[1]*k[0]) * Sinc(k[0]*u[0]+k[1]*u[1]);
-						pa = -2*M_PI*(k[0]*rc[0]+k[1]*rc[1]);
-
-						// Multiplication by i means we mess up the order here
-						z[0] += num * sin(pa);
-						z[1] -= num * cos(pa);
-					}
-					// Our k lacks a 2pi factor
-					//z[0] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1])*area;
-					//z[1] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1])*area;
-					area = 1;
-					z[0] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1]);
-					z[1] /= 2*M_PI*(k[0]*k[0]+k[1]*k[1]);
-				}
+	if(nshapes < 0){ return -1; }
+	if(nshapes > 0 && NULL == shapes){ return -2; }
+	if(NULL == parent){ return -3; }
+	if(nvalue < 1){ return -4; }
+	if(NULL == value){ return -5; }
+	if(ldv < 2*(nshapes+1)){ return -6; }
+	if(nk < 0){ return -7; }
+	if(nk > 0 && NULL == k){ return -8; }
+	if(ndim < 1 || ndim > 2){ return -9; }
+	if(unit_cell_size <= 0){ return -10; }
+	if(nk > 0 && NULL == f){ return -11; }
+	if(1 == ndim){
+		for(ik = 0; ik < nk; ++ik){
+			if(k[2*ik+1] != 0){ return -8; }
+		}
+		for(i = 0; i < nshapes; ++i){
+			if(RECTANGLE != shapes[i].type){
+				return -2;
 			}
-			break;
-		default:
-			area = 0;
-			break;
 		}
-		//f += dval*z*phase/area;
-		//f += dval*(z[0]+i*z[1])*(cos(phase_angle)+i*sin(phase_angle)) / area;
-		//f += dval*( z[0]*cos-z[1]*sin + i*(z[1]*cos+z[0]*sin) ) / area;
-		{
-			double cpa = cos(phase_angle);
-			double spa = sin(phase_angle);
-			double t[2] = {area, area};
+	}
+
+	inv_size = 1./unit_cell_size;
+
+	for(ik = 0; ik < nk; ++ik){
+		const double *k_ = &k[2*ik];
+		const int DC = (0 == k_[0] && 0 == k_[1]) ? 1 : 0;
+		double *fk = &f[2*nvalue*ik];
+		for(j = 0; j < nvalue; ++j){
 			if(DC){
-				t[0] *= cpa;
-				t[1] *= spa;
+				fk[2*j+0] = value[j*ldv+0]; fk[2*j+1] = value[j*ldv+1];
 			}else{
-				t[0] *= ( z[0]*cpa-z[1]*spa );
-				t[1] *= ( z[1]*cpa+z[0]*spa );
+				fk[2*j+0] = 0; fk[2*j+1] = 0;
+			}
+		}
+		for(i = 0; i < nshapes; ++i){
+			double t[2];
+			shape_get_fourier_transform(&shapes[i], k_, ndim, DC, t);
+			t[0] *= inv_size;
+			t[1] *= inv_size;
+			for(j = 0; j < nvalue; ++j){
+				const double *v = &value[j*ldv];
+				double dval[2] = {v[2*(i+1)+0]-v[2*(parent[i]+1)+0], v[2*(i+1)+1]-v[2*(parent[i]+1)+1]};
+				fk[2*j+0] += t[0]*dval[0]-t[1]*dval[1];
+				fk[2*j+1] += t[0]*dval[1]+t[1]*dval[0];
 			}
-			f[0] += inv_size*(t[0]*dval[0]-t[1]*dval[1]);
-			f[1] += inv_size*(t[0]*dval[1]+t[1]*dval[0]);
 		}
 	}
 	return 0;
 }
-int Pattern_GetFourierTransform(
+int Pattern_GetFourierTransformBatch(
 	const Pattern *p,
+	int nvalue,
 	const double *value,
-	const double k[2],
+	int ldv,
+	int nk,
+	const double *k,
 	int ndim,
 	double unit_cell_size,
-	double f[2]
+	double *f
 ){
-	return pattern_get_fourier_transform(p->nshapes, p->shapes, p->parent, value, k, ndim, unit_cell_size, f);
+	return pattern_get_fourier_transform_batch(p->nshapes, p->shapes, p->parent, nvalue, value, ldv, nk, k, ndim, unit_cell_size, f);
 }
 
 int pattern_discretize_cell(
@@ -216,6 +216,49 @@ int Pattern_GetFourierTransform(
 	double FT[2]
 );
 
+/* Batched version of pattern_get_fourier_transform. Each shape transform is
+ * evaluated once per point and applied to several sets of values at once.
+ *
+ * Arguments:
+ *    nvalue       IN   Number of sets of values.
+ *    value        IN   The j-th set of values (laid out as for
+ *                      pattern_get_fourier_transform) starts at
+ *                      `value[j*ldv]'.
+ *    ldv          IN   Stride between sets of values, >= 2*(nshapes+1).
+ *    nk           IN   Number of points in reciprocal space.
+ *    k            IN   Length `2*nk'. The points, scaled as `f' above.
+ *    FT           OUT  Length `2*nvalue*nk'. The F.T. of value set j at
+ *                      point i is `FT[2*(j+nvalue*i)+0]+i*FT[2*(j+nvalue*i)+1]'.
+ * Return values:
+ *    0: If successful.
+ *   -n: If n-th argument is invalid.
+ */
+int pattern_get_fourier_transform_batch(
+	int nshapes,
+	const shape *shapes,
+	const int *parent,
+	int nvalue,
+	const double *value,
+	int ldv,
+	int nk,
+	const double *k,
+	int ndim,
+	double unit_cell_size,
+	double *FT
+);
+/* Convenience version of the above. */
+int Pattern_GetFourierTransformBatch(
+	const Pattern *p,
+	int nvalue,
+	const double *value,
+	int ldv,
+	int nk,
+	const double *k,
+	int ndim,
+	double unit_cell_size,
+	double *FT
+);
+
 /* Returns an area weighting of each shape within one cell of a uniform
  * discretization of the origin-centered unit square.
  *  The area-fraction of each shape within the rectangle
@@ -0,0 +1,161 @@
+/* Copyright (C) 2009-2011, Stanford University
+ * This file is part of S4
+ * Written by Victor Liu (vkl@stanford.edu)
+ *
+ * S4 is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * S4 is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+ */
+
+#ifndef _S4_PROFILE_H_
+#define _S4_PROFILE_H_
+
+// Runtime profiler: wall time and call counts of each phase of a solve.
+//
+// Every simulation owns an S4_Profile. A phase is timed by an
+// S4_ProfileScope on the stack; scopes nest per thread, so code that has no
+// simulation at hand (rcwa.cpp, the FFT interface) passes NULL and charges
+// the profile of the enclosing scope, or nothing at all when there is none.
+// A scope directly inside another scope of the same phase is folded into
+// it, so entry points may be timed at several levels without counting a
+// call twice. Both the inclusive and the self (children excluded) time are
+// kept; trace events are only recorded when requested.
+
+#include <chrono>
+#include <cstddef>
+#include <vector>
+
+enum{
+  S4_PROFILE_EPSILON_FFT,
+  S4_PROFILE_EPSILON_KOTTKE,
+  S4_PROFILE_EPSILON_CLOSED_FORM,
+  S4_PROFILE_EPSILON_EXPERIMENTAL,
+  S4_PROFILE_EPSILON_POL_BASIS_JONES,
+  S4_PROFILE_EPSILON_POL_BASIS_NV,
+  S4_PROFILE_EPSILON_POL_BASIS_VL,
+  S4_PROFILE_EIGENSOLVE,
+  S4_PROFILE_SOLVE,
+  S4_PROFILE_SMATRIX,
+  S4_PROFILE_FIELDS,
+  S4_PROFILE_FFT,
+  S4_PROFILE_NPHASES
+};
+
+inline const char* S4_Profile_PhaseName(int phase){
+  static const char *const names[S4_PROFILE_NPHASES] = {
+    "epsilon_fft",
+    "epsilon_kottke",
+    "epsilon_closed_form",
+    "epsilon_experimental",
+    "epsilon_pol_basis_jones",
+    "epsilon_pol_basis_nv",
+    "epsilon_pol_basis_vl",
+    "eigensolve",
+    "solve",
+    "smatrix",
+    "fields",
+    "fft"
+  };
+  return names[phase];
+}
+
+struct S4_ProfileEvent{
+  int phase;
+  int thread; // 0 for the simulation itself, > 0 for sweep workers
+  double start; // seconds since the profile was reset
+  double duration; // seconds
+};
+
+struct S4_Profile{
+  size_t count[S4_PROFILE_NPHASES];
+  double seconds[S4_PROFILE_NPHASES]; // inclusive wall time
+  double self_seconds[S4_PROFILE_NPHASES]; // excluding nested phases
+  int trace; // whether to record events
+  std::vector<S4_ProfileEvent> events;
+  std::chrono::steady_clock::time_point origin;
+
+  S4_Profile(){ Reset(0); }
+  void Reset(int record_trace){
+    for(int i = 0; i < S4_PROFILE_NPHASES; ++i){
+      count[i] = 0;
+      seconds[i] = 0;
+      self_seconds[i] = 0;
+    }
+    trace = record_trace;
+    events.clear();
+    origin = std::chrono::steady_clock::now();
+  }
+  // Adds the timings of a worker's copy of the simulation
+  void Merge(const S4_Profile &from, int thread){
+    for(int i = 0; i < S4_PROFILE_NPHASES; ++i){
+      count[i] += from.count[i];
+      seconds[i] += from.seconds[i];
+      self_seconds[i] += from.self_seconds[i];
+    }
+    if(trace){
+      const double offset = std::chrono::duration<double>(from.origin - origin).count();
+      for(size_t i = 0; i < from.events.size(); ++i){
+        S4_ProfileEvent event = from.events[i];
+        event.start += offset;
+        event.thread = thread;
+        events.push_back(event);
+      }
+    }
+  }
+};
+
+class S4_ProfileScope{
+  S4_ProfileScope *parent;
+  S4_Profile *profile; // NULL when nothing is recorded
+  int phase;
+  double children;
+  std::chrono::steady_clock::time_point start;
+
+  static S4_ProfileScope*& Current(){
+    static thread_local S4_ProfileScope *current = NULL;
+    return current;
+  }
+public:
+  S4_ProfileScope(S4_Profile *P, int which):parent(Current()),profile(P),phase(which),children(0){
+    if(NULL == profile && NULL != parent){
+      profile = parent->profile;
+    }
+    if(NULL == profile || (NULL != parent && parent->profile == profile && parent->phase == phase)){
+      profile = NULL;
+      return;
+    }
+    Current() = this;
+    start = std::chrono::steady_clock::now();
+  }
+  ~S4_ProfileScope(){
+    if(NULL == profile){ return; }
+    const std::chrono::steady_clock::time_point end = std::chrono::steady_clock::now();
+    const double dt = std::chrono::duration<double>(end - start).count();
+    profile->count[phase]++;
+    profile->seconds[phase] += dt;
+    profile->self_seconds[phase] += dt - children;
+    if(profile->trace){
+      S4_ProfileEvent event = { phase, 0, std::chrono::duration<double>(start - profile->origin).count(), dt };
+      profile->events.push_back(event);
+    }
+    if(NULL != parent && parent->profile == profile){
+      parent->children += dt;
+    }
+    Current() = parent;
+  }
+private:
+  S4_ProfileScope(const S4_ProfileScope&);
+  S4_ProfileScope& operator=(const S4_ProfileScope&);
+};
+
+#endif // _S4_PROFILE_H_
@@ -1,6 +1,12 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
+#include <pybind11/stl.h>
 #include <iostream>
+#include <algorithm>
+#include <atomic>
+#include <mutex>
+#include <thread>
+#include <vector>
 
 namespace py = pybind11;
 
@@ -28,7 +34,8 @@ namespace py = pybind11;
 #include "cubature.h"
 #include "Interpolator.h"
 #include "rcwa.h"
-// #include "fmm/fft_iface.h"
+#include "fmm/fft_iface.h"
+#include "profile.h"
 // #include "kiss_fft/kiss_fft.h"
 // #include "kiss_fft/tools/kiss_fftnd.h"
 
@@ -40,6 +47,57 @@ namespace py = pybind11;
 #define Bool unsigned char
 #endif
 
+// Returns pyOut if it is an array the results can be written into directly,
+// or a new array of the given shape if pyOut is None.
+template <typename T>
+static py::array_t<T> OutputArray(py::object pyOut, const std::vector<size_t> &shape, const char *name)
+    {
+    if (pyOut.is_none())
+        {
+        return py::array_t<T>(shape);
+        }
+    if (!py::isinstance<py::array_t<T>>(pyOut))
+        {
+        std::ostringstream s;
+        s << name << " must be an array of dtype " << std::string(py::str(py::dtype::of<T>()));
+        throw std::runtime_error(s.str());
+        }
+    auto out = py::reinterpret_borrow<py::array_t<T>>(pyOut);
+    bool sameShape = (size_t)out.ndim() == shape.size();
+    for (size_t i = 0; sameShape && i < shape.size(); i++)
+        {
+        sameShape = (size_t)out.shape(i) == shape[i];
+        }
+    if (!sameShape)
+        {
+        std::ostringstream s;
+        s << name << " must have shape (";
+        for (size_t i = 0; i < shape.size(); i++)
+            {
+            s << (i > 0 ? ", " : "") << shape[i];
+            }
+        s << (shape.size() == 1 ? ",)" : ")");
+        throw std::runtime_error(s.str());
+        }
+    if (!(out.flags() & py::array::c_style) || !out.writeable())
+        {
+        std::ostringstream s;
+        s << name << " must be a writeable C-contiguous array";
+        throw std::runtime_error(s.str());
+        }
+    return out;
+    }
+
+// Drops everything computed with the previous options, after an option
+// that changes the layer modes
+static void DestroyModesAndSolution(S4_Simulation *S)
+    {
+    S4_Simulation_DestroyLayerModes(S, -1);
+    Simulation_DestroySolution(S);
+    Simulation_InvalidateFieldCache(S);
+    Simulation_DestroySMatrixCache(S);
+    }
+
 PySimulation::PySimulation()
     {
     // these are dummy/default values for the simulation
@@ -49,19 +107,439 @@ PySimulation::PySimulation()
     Lr[2] = 0;
     Lr[3] = 1;
     nG = 1;
+    S = NULL;
     }
 
 PySimulation::~PySimulation()
     {
     delete[] Lr;
-    S4_Simulation_Destroy(S);
+    if (S != NULL)
+        {
+        S4_Simulation_Destroy(S);
+        }
     }
 
 void PySimulation::CreateNew()
     {
+    std::lock_guard<std::mutex> lock(mutex);
     S = S4_Simulation_New(Lr, nG, NULL);
     }
 
+PySimulation* PySimulation::Clone()
+    {
+    // the clone shares any layer modes computed so far; they are copied
+    // lazily when either simulation changes something that invalidates them
+    PySimulation *T = new PySimulation();
+    std::memcpy(T->Lr, Lr, 4 * sizeof(double));
+    T->nG = nG;
+        {
+        std::lock_guard<std::mutex> lock(mutex);
+        T->S = S4_Simulation_Clone(S);
+        }
+    if (T->S == NULL)
+        {
+        delete T;
+        std::ostringstream s;
+        s << "S4_Simulation_Clone failed";
+        throw std::runtime_error(s.str());
+        }
+    return T;
+    }
+
+// integer options of S4_Options that are carried by a simulation spec
+#define S4_SPEC_INT_OPTIONS(X) \
+    X(use_discretized_epsilon) \
+    X(use_subpixel_smoothing) \
+    X(use_Lanczos_smoothing) \
+    X(use_polarization_basis) \
+    X(use_jones_vector_basis) \
+    X(use_normal_vector_basis) \
+    X(use_normal_vector_field) \
+    X(resolution) \
+    X(lattice_truncation) \
+    X(verbosity) \
+    X(use_experimental_fmm) \
+    X(use_less_memory) \
+    X(lanczos_smoothing_power)
+
+py::dict PySimulation::GetSpec()
+    {
+    std::lock_guard<std::mutex> lock(mutex);
+    py::dict spec;
+    spec["version"] = 1;
+
+    auto pyLattice = py::array_t<double>({(size_t)2, (size_t)2});
+    std::memcpy(pyLattice.request().ptr, S->Lr, 4*sizeof(double));
+    spec["lattice"] = pyLattice;
+    auto pyG = py::array_t<int>({(size_t)S->n_G, (size_t)2});
+    std::memcpy(pyG.request().ptr, S->G, 2*S->n_G*sizeof(int));
+    spec["G"] = pyG;
+    auto pyFreq = py::array_t<double>(2);
+    double *freqPtr = static_cast<double *>(pyFreq.request().ptr);
+    freqPtr[0] = S->omega[0] / (2*M_PI);
+    freqPtr[1] = S->omega[1] / (2*M_PI);
+    spec["frequency"] = pyFreq;
+
+    // only plane wave excitations can be set from python
+    if (S->exc.type != 0)
+        {
+        std::ostringstream s;
+        s << "GetSpec: only plane wave excitations can be serialized";
+        throw std::runtime_error(s.str());
+        }
+    py::dict excitation;
+    auto pyK = py::array_t<double>(2);
+    std::memcpy(pyK.request().ptr, S->k, 2*sizeof(double));
+    excitation["k"] = pyK;
+    auto pyHx = py::array_t<double>(2);
+    std::memcpy(pyHx.request().ptr, S->exc.sub.planewave.hx, 2*sizeof(double));
+    excitation["hx"] = pyHx;
+    auto pyHy = py::array_t<double>(2);
+    std::memcpy(pyHy.request().ptr, S->exc.sub.planewave.hy, 2*sizeof(double));
+    excitation["hy"] = pyHy;
+    excitation["order"] = (int)S->exc.sub.planewave.order;
+    excitation["backwards"] = S->exc.sub.planewave.backwards;
+    spec["excitation"] = excitation;
+
+    py::dict options;
+#define S4_SPEC_GET_OPTION(name) options[#name] = S->options.name;
+    S4_SPEC_INT_OPTIONS(S4_SPEC_GET_OPTION)
+#undef S4_SPEC_GET_OPTION
+    options["lanczos_smoothing_width"] = S->options.lanczos_smoothing_width;
+    options["use_hermitian_eigensolver"] = S->options.use_hermitian_eigensolver;
+    options["symmetry"] = S->options.symmetry;
+    options["symmetry_parity"] = S->options.symmetry_parity;
+    options["num_modes"] = S->options.num_modes;
+    spec["options"] = options;
+
+    // materials: every epsilon is stored as the 10 tensor values; for
+    // scalar materials only the first two are meaningful
+    const size_t nMat = S->n_materials;
+    py::list matNames;
+    auto pyMatType = py::array_t<int>(nMat);
+    auto pyMatEps = py::array_t<double>({nMat, (size_t)10});
+    int *matTypePtr = static_cast<int *>(pyMatType.request().ptr);
+    double *matEpsPtr = static_cast<double *>(pyMatEps.request().ptr);
+    for (size_t i = 0; i < nMat; i++)
+        {
+        matNames.append(py::str(S->material[i].name));
+        matTypePtr[i] = S->material[i].type;
+        std::memcpy(matEpsPtr + 10*i, S->material[i].eps.abcde, 10*sizeof(double));
+        }
+    py::dict materials;
+    materials["names"] = matNames;
+    materials["type"] = pyMatType;
+    materials["eps"] = pyMatEps;
+    spec["materials"] = materials;
+
+    // layers, and the shapes of all layers flattened into parallel arrays
+    const size_t nLayers = S->n_layers;
+    size_t nShapes = 0;
+    size_t nVert = 0;
+    for (size_t i = 0; i < nLayers; i++)
+        {
+        const Pattern *P = &S->layer[i].pattern;
+        nShapes += P->nshapes;
+        for (int j = 0; j < P->nshapes; j++)
+            {
+            if (P->shapes[j].type == POLYGON)
+                {
+                nVert += P->shapes[j].vtab.polygon.n_vertices;
+                }
+            }
+        }
+    py::list layerNames;
+    auto pyThickness = py::array_t<double>(nLayers);
+    auto pyLayerMat = py::array_t<int>(nLayers);
+    auto pyLayerCopy = py::array_t<int>(nLayers);
+    double *thicknessPtr = static_cast<double *>(pyThickness.request().ptr);
+    int *layerMatPtr = static_cast<int *>(pyLayerMat.request().ptr);
+    int *layerCopyPtr = static_cast<int *>(pyLayerCopy.request().ptr);
+
+    auto pyShapeLayer = py::array_t<int>(nShapes);
+    auto pyShapeMat = py::array_t<int>(nShapes);
+    auto pyShapeType = py::array_t<int>(nShapes);
+    auto pyShapeCenter = py::array_t<double>({nShapes, (size_t)2});
+    auto pyShapeAngle = py::array_t<double>(nShapes);
+    auto pyShapeHalfwidths = py::array_t<double>({nShapes, (size_t)2});
+    auto pyShapeNVert = py::array_t<int>(nShapes);
+    auto pyVertices = py::array_t<double>({nVert, (size_t)2});
+    int *shapeLayerPtr = static_cast<int *>(pyShapeLayer.request().ptr);
+    int *shapeMatPtr = static_cast<int *>(pyShapeMat.request().ptr);
+    int *shapeTypePtr = static_cast<int *>(pyShapeType.request().ptr);
+    double *shapeCenterPtr = static_cast<double *>(pyShapeCenter.request().ptr);
+    double *shapeAnglePtr = static_cast<double *>(pyShapeAngle.request().ptr);
+    double *shapeHalfwidthsPtr = static_cast<double *>(pyShapeHalfwidths.request().ptr);
+    int *shapeNVertPtr = static_cast<int *>(pyShapeNVert.request().ptr);
+    double *verticesPtr = static_cast<double *>(pyVertices.request().ptr);
+
+    size_t k = 0;
+    for (size_t i = 0; i < nLayers; i++)
+        {
+        const S4_Layer *L = &S->layer[i];
+        layerNames.append(py::str(L->name));
+        thicknessPtr[i] = L->thickness;
+        layerMatPtr[i] = L->material;
+        layerCopyPtr[i] = L->copy;
+        for (int j = 0; j < L->pattern.nshapes; j++, k++)
+            {
+            const shape *sh = &L->pattern.shapes[j];
+            shapeLayerPtr[k] = (int)i;
+            shapeMatPtr[k] = sh->tag;
+            shapeTypePtr[k] = (int)sh->type;
+            shapeCenterPtr[2*k+0] = sh->center[0];
+            shapeCenterPtr[2*k+1] = sh->center[1];
+            shapeAnglePtr[k] = sh->angle;
+            shapeHalfwidthsPtr[2*k+0] = 0;
+            shapeHalfwidthsPtr[2*k+1] = 0;
+            shapeNVertPtr[k] = 0;
+            switch (sh->type)
+                {
+                case CIRCLE:
+                    shapeHalfwidthsPtr[2*k+0] = sh->vtab.circle.radius;
+                    shapeHalfwidthsPtr[2*k+1] = sh->vtab.circle.radius;
+                    break;
+                case ELLIPSE:
+                    shapeHalfwidthsPtr[2*k+0] = sh->vtab.ellipse.halfwidth[0];
+                    shapeHalfwidthsPtr[2*k+1] = sh->vtab.ellipse.halfwidth[1];
+                    break;
+                case RECTANGLE:
+                    shapeHalfwidthsPtr[2*k+0] = sh->vtab.rectangle.halfwidth[0];
+                    shapeHalfwidthsPtr[2*k+1] = sh->vtab.rectangle.halfwidth[1];
+                    break;
+                case POLYGON:
+                    shapeNVertPtr[k] = sh->vtab.polygon.n_vertices;
+                    std::memcpy(verticesPtr, sh->vtab.polygon.vertex, 2*sh->vtab.polygon.n_vertices*sizeof(double));
+                    verticesPtr += 2*sh->vtab.polygon.n_vertices;
+                    break;
+                }
+            }
+        }
+    py::dict layers;
+    layers["names"] = layerNames;
+    layers["thickness"] = pyThickness;
+    layers["material"] = pyLayerMat;
+    layers["copy"] = pyLayerCopy;
+    spec["layers"] = layers;
+
+    py::dict shapes;
+    shapes["layer"] = pyShapeLayer;
+    shapes["material"] = pyShapeMat;
+    shapes["type"] = pyShapeType;
+    shapes["center"] = pyShapeCenter;
+    shapes["angle"] = pyShapeAngle;
+    shapes["halfwidths"] = pyShapeHalfwidths;
+    shapes["n_vertices"] = pyShapeNVert;
+    shapes["vertices"] = pyVertices;
+    spec["shapes"] = shapes;
+    return spec;
+    }
+
+void PySimulation::SetSpec(py::dict pySpec)
+    {
+    if (pySpec["version"].cast<int>() != 1)
+        {
+        std::ostringstream s;
+        s << "SetSpec: unsupported spec version";
+        throw std::runtime_error(s.str());
+        }
+    auto pyLattice = pySpec["lattice"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyG = pySpec["G"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyFreq = pySpec["frequency"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    if (pyLattice.size() != 4 || pyG.ndim() != 2 || pyG.shape(1) != 2 || pyG.shape(0) < 1 || pyFreq.size() != 2)
+        {
+        std::ostringstream s;
+        s << "SetSpec: lattice must be 2x2, G must be (n, 2) and frequency must have 2 elements";
+        throw std::runtime_error(s.str());
+        }
+
+    py::dict materials = pySpec["materials"].cast<py::dict>();
+    auto matNames = materials["names"].cast<std::vector<std::string>>();
+    auto pyMatType = materials["type"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyMatEps = materials["eps"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    const size_t nMat = matNames.size();
+    if ((size_t)pyMatType.size() != nMat || (size_t)pyMatEps.size() != 10*nMat)
+        {
+        std::ostringstream s;
+        s << "SetSpec: material arrays must have one entry per material name";
+        throw std::runtime_error(s.str());
+        }
+
+    py::dict layers = pySpec["layers"].cast<py::dict>();
+    auto layerNames = layers["names"].cast<std::vector<std::string>>();
+    auto pyThickness = layers["thickness"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyLayerMat = layers["material"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyLayerCopy = layers["copy"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    const size_t nLayers = layerNames.size();
+    if ((size_t)pyThickness.size() != nLayers || (size_t)pyLayerMat.size() != nLayers || (size_t)pyLayerCopy.size() != nLayers)
+        {
+        std::ostringstream s;
+        s << "SetSpec: layer arrays must have one entry per layer name";
+        throw std::runtime_error(s.str());
+        }
+    const double *thicknessPtr = pyThickness.data();
+    const int *layerMatPtr = pyLayerMat.data();
+    const int *layerCopyPtr = pyLayerCopy.data();
+    for (size_t i = 0; i < nLayers; i++)
+        {
+        const bool isCopy = layerCopyPtr[i] >= 0;
+        if ((isCopy && (size_t)layerCopyPtr[i] >= i) || (!isCopy && (layerMatPtr[i] < 0 || (size_t)layerMatPtr[i] >= nMat)))
+            {
+            std::ostringstream s;
+            s << "SetSpec: layer " << layerNames[i] << " refers to an unknown material or layer";
+            throw std::runtime_error(s.str());
+            }
+        }
+
+    py::dict shapes = pySpec["shapes"].cast<py::dict>();
+    auto pyShapeLayer = shapes["layer"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyShapeMat = shapes["material"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyShapeType = shapes["type"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyShapeCenter = shapes["center"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyShapeAngle = shapes["angle"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyShapeHalfwidths = shapes["halfwidths"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyShapeNVert = shapes["n_vertices"].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+    auto pyVertices = shapes["vertices"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    const size_t nShapes = pyShapeLayer.size();
+    if ((size_t)pyShapeMat.size() != nShapes || (size_t)pyShapeType.size() != nShapes ||
+        (size_t)pyShapeCenter.size() != 2*nShapes || (size_t)pyShapeAngle.size() != nShapes ||
+        (size_t)pyShapeHalfwidths.size() != 2*nShapes || (size_t)pyShapeNVert.size() != nShapes)
+        {
+        std::ostringstream s;
+        s << "SetSpec: shape arrays must have one entry per shape";
+        throw std::runtime_error(s.str());
+        }
+    const int *shapeLayerPtr = pyShapeLayer.data();
+    const int *shapeMatPtr = pyShapeMat.data();
+    const int *shapeTypePtr = pyShapeType.data();
+    const int *shapeNVertPtr = pyShapeNVert.data();
+    std::vector<int> layerShapeCount(nLayers, 0);
+    size_t nVert = 0;
+    for (size_t k = 0; k < nShapes; k++)
+        {
+        if (shapeLayerPtr[k] < 0 || (size_t)shapeLayerPtr[k] >= nLayers || layerCopyPtr[shapeLayerPtr[k]] >= 0 ||
+            shapeMatPtr[k] < 0 || (size_t)shapeMatPtr[k] >= nMat ||
+            shapeTypePtr[k] < CIRCLE || shapeTypePtr[k] > POLYGON ||
+            (shapeTypePtr[k] == POLYGON && shapeNVertPtr[k] < 3))
+            {
+            std::ostringstream s;
+            s << "SetSpec: shape " << k << " is invalid";
+            throw std::runtime_error(s.str());
+            }
+        layerShapeCount[shapeLayerPtr[k]]++;
+        if (shapeTypePtr[k] == POLYGON)
+            {
+            nVert += shapeNVertPtr[k];
+            }
+        }
+    if ((size_t)pyVertices.size() != 2*nVert)
+        {
+        std::ostringstream s;
+        s << "SetSpec: vertices must hold the vertices of every polygon";
+        throw std::runtime_error(s.str());
+        }
+
+    // everything is validated; build the new simulation in one go
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S != NULL)
+        {
+        S4_Simulation_Destroy(S);
+        }
+    std::memcpy(Lr, pyLattice.data(), 4*sizeof(double));
+    nG = pyG.shape(0);
+    S = S4_Simulation_New(Lr, nG, const_cast<int *>(pyG.data()));
+
+    py::dict options = pySpec["options"].cast<py::dict>();
+#define S4_SPEC_SET_OPTION(name) S->options.name = options[#name].cast<int>();
+    S4_SPEC_INT_OPTIONS(S4_SPEC_SET_OPTION)
+#undef S4_SPEC_SET_OPTION
+    S->options.lanczos_smoothing_width = options["lanczos_smoothing_width"].cast<double>();
+    // not present in specs written before the option was added
+    if (options.contains("use_hermitian_eigensolver"))
+        {
+        S->options.use_hermitian_eigensolver = options["use_hermitian_eigensolver"].cast<int>();
+        }
+    if (options.contains("symmetry"))
+        {
+        S->options.symmetry = options["symmetry"].cast<int>();
+        S->options.symmetry_parity = options["symmetry_parity"].cast<int>();
+        }
+    if (options.contains("num_modes"))
+        {
+        S->options.num_modes = options["num_modes"].cast<int>();
+        }
+
+    const int *matTypePtr = pyMatType.data();
+    const double *matEpsPtr = pyMatEps.data();
+    for (size_t i = 0; i < nMat; i++)
+        {
+        S4_MaterialID M = S4_Simulation_SetMaterial(S, -1, matNames[i].c_str(), S4_MATERIAL_TYPE_XYTENSOR_COMPLEX, matEpsPtr + 10*i);
+        S->material[M].type = matTypePtr[i];
+        }
+    for (size_t i = 0; i < nLayers; i++)
+        {
+        S4_Simulation_SetLayer(S, -1, layerNames[i].c_str(), &thicknessPtr[i], layerCopyPtr[i], layerMatPtr[i]);
+        }
+
+    // allocate each layer's shapes once and fill them in directly
+    for (size_t i = 0; i < nLayers; i++)
+        {
+        if (layerShapeCount[i] > 0)
+            {
+            S->layer[i].pattern.shapes = (shape*)malloc(sizeof(shape)*layerShapeCount[i]);
+            }
+        }
+    const double *shapeCenterPtr = pyShapeCenter.data();
+    const double *shapeAnglePtr = pyShapeAngle.data();
+    const double *shapeHalfwidthsPtr = pyShapeHalfwidths.data();
+    const double *verticesPtr = pyVertices.data();
+    for (size_t k = 0; k < nShapes; k++)
+        {
+        Pattern *P = &S->layer[shapeLayerPtr[k]].pattern;
+        shape *sh = &P->shapes[P->nshapes++];
+        sh->type = (shape_type)shapeTypePtr[k];
+        sh->center[0] = shapeCenterPtr[2*k+0];
+        sh->center[1] = shapeCenterPtr[2*k+1];
+        sh->angle = shapeAnglePtr[k];
+        sh->tag = shapeMatPtr[k];
+        switch (sh->type)
+            {
+            case CIRCLE:
+                sh->vtab.circle.radius = shapeHalfwidthsPtr[2*k+0];
+                break;
+            case ELLIPSE:
+                sh->vtab.ellipse.halfwidth[0] = shapeHalfwidthsPtr[2*k+0];
+                sh->vtab.ellipse.halfwidth[1] = shapeHalfwidthsPtr[2*k+1];
+                break;
+            case RECTANGLE:
+                sh->vtab.rectangle.halfwidth[0] = shapeHalfwidthsPtr[2*k+0];
+                sh->vtab.rectangle.halfwidth[1] = shapeHalfwidthsPtr[2*k+1];
+                break;
+            case POLYGON:
+                sh->vtab.polygon.n_vertices = shapeNVertPtr[k];
+                sh->vtab.polygon.vertex = (double*)S4_malloc(sizeof(double)*2*shapeNVertPtr[k]);
+                std::memcpy(sh->vtab.polygon.vertex, verticesPtr, 2*shapeNVertPtr[k]*sizeof(double));
+                verticesPtr += 2*shapeNVertPtr[k];
+                break;
+            }
+        }
+
+    py::dict excitation = pySpec["excitation"].cast<py::dict>();
+    auto pyK = excitation["k"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyHx = excitation["hx"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    auto pyHy = excitation["hy"].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+    S->exc.type = 0;
+    std::memcpy(S->k, pyK.data(), 2*sizeof(double));
+    std::memcpy(S->exc.sub.planewave.hx, pyHx.data(), 2*sizeof(double));
+    std::memcpy(S->exc.sub.planewave.hy, pyHy.data(), 2*sizeof(double));
+    S->exc.sub.planewave.order = excitation["order"].cast<int>();
+    S->exc.sub.planewave.backwards = excitation["backwards"].cast<int>();
+
+    const double *freqPtr = pyFreq.data();
+    S->omega[0] = 2*M_PI*freqPtr[0];
+    S->omega[1] = 2*M_PI*freqPtr[1];
+    }
+
 PySimulation::EPSData PySimulation::SetEPS(py::array_t<double> pyEPS)
     {
     S4_real eps[18];
@@ -180,6 +658,7 @@ void PySimulation::AddMaterial(std::string pyName, py::array_t<double> pyEPS)
     std::memcpy(eps, sEPS.eps, sizeof(double)*18);
     type = sEPS.type;
     // set the material
+    std::lock_guard<std::mutex> lock(mutex);
     M = S4_Simulation_SetMaterial(S, -1, name, type, eps);
     if(M < 0)
         {
@@ -210,6 +689,7 @@ void PySimulation::SetMaterial(std::string pyName, py::array_t<double> pyEPS)
     // get the material index; this will return a -1 if it's not yet defined
     // and thus operate like the add code
     // you know, I could probably just run this as if it were the add code...ugh
+    std::lock_guard<std::mutex> lock(mutex);
     M = S4_Simulation_GetMaterialByName(S, name);
     // use shared code to interpret the EPS
     struct PySimulation::EPSData sEPS = SetEPS(pyEPS);
@@ -258,7 +738,11 @@ void PySimulation::SetLattice(py::array_t<double> pyLattice)
             Lr[i] = ptr[i];
             }
         }
-    int setLatticeReturn = S4_Simulation_SetLattice(S, Lr);
+    int setLatticeReturn;
+        {
+        std::lock_guard<std::mutex> lock(mutex);
+        setLatticeReturn = S4_Simulation_SetLattice(S, Lr);
+        }
     if(0 != setLatticeReturn)
         {
         std::ostringstream s;
@@ -283,6 +767,7 @@ void PySimulation::SetNumG(int n)
         s << "n must be >= 1";
             throw std::runtime_error(s.str());
         }
+    std::lock_guard<std::mutex> lock(mutex);
     Simulation_SetNumG(S, n);
     }
 
@@ -302,6 +787,7 @@ void PySimulation::AddLayer(std::string pyName, double pyThickness, std::string
     name = pyName.c_str();
     matname = pyBackground.c_str();
     // get the material by name
+    std::lock_guard<std::mutex> lock(mutex);
     S4_MaterialID M = S4_Simulation_GetMaterialByName(S, matname);
     if (M < 0)
         {
@@ -327,6 +813,7 @@ void PySimulation::SetLayer(std::string pyName, double pyThickness, std::string
     // set the name to the pyName;
     name = pyName.c_str();
     // attempt to access the layer by name
+    std::lock_guard<std::mutex> lock(mutex);
     layer = S4_Simulation_GetLayerByName(S, name);
     // handle if no layer is found
     if (layer < 0)
@@ -363,6 +850,7 @@ void PySimulation::SetLayerThickness(std::string pyName, double pyThickness)
     // set the name to the pyName;
     name = pyName.c_str();
     // attempt to access the layer by name
+    std::lock_guard<std::mutex> lock(mutex);
     layer = S4_Simulation_GetLayerByName(S, name);
     // handle if no layer is found
     if (layer < 0)
@@ -379,7 +867,8 @@ void PySimulation::SetLayerThickness(std::string pyName, double pyThickness)
             s << "SetLayerThickness: Thickness must be non-negative";
             throw std::runtime_error(s.str());
             }
-        S4_Simulation_SetLayer(S, layer, NULL, &thickness, -1, -1);
+        // only the thickness changes; the layer keeps its modes
+        Simulation_ChangeLayerThickness(S, &S->layer[layer], &thickness);
         }
     }
 
@@ -408,6 +897,7 @@ void PySimulation::SetLayerPatternCircle(std::string pyName, std::string pyMater
         }
     double *ptr = static_cast<double *>(info.ptr);
 
+    std::lock_guard<std::mutex> lock(mutex);
     layer = S4_Simulation_GetLayerByName(S, layer_name);
     // can't find layer
     if (layer < 0)
@@ -459,6 +949,7 @@ void PySimulation::SetLayerPatternRectangle(std::string pyName, std::string pyMa
     py::buffer_info halfwidth_info = pyWidths.request();
     double *halfwidth_ptr = static_cast<double *>(halfwidth_info.ptr);
 
+    std::lock_guard<std::mutex> lock(mutex);
     layer = S4_Simulation_GetLayerByName(S, layer_name);
 
     if (layer < 0)
@@ -521,6 +1012,7 @@ void PySimulation::SetLayerPatternEllipse(std::string pyName, std::string pyMate
     py::buffer_info halfwidth_info = pyWidths.request();
     double *halfwidth_ptr = static_cast<double *>(halfwidth_info.ptr);
 
+    std::lock_guard<std::mutex> lock(mutex);
     layer = S4_Simulation_GetLayerByName(S, layer_name);
 
     if (layer < 0)
@@ -582,6 +1074,7 @@ void PySimulation::SetLayerPatternPolygon(std::string pyName, std::string pyMate
     // resize vert list
     vert.resize((int)(vertex_info.shape[0]*vertex_info.shape[1]));
 
+    std::lock_guard<std::mutex> lock(mutex);
     layer = S4_Simulation_GetLayerByName(S, layer_name);
     // can't find layer
     if (layer < 0)
@@ -629,6 +1122,7 @@ void PySimulation::SetExcitationPlaneWave(py::array_t<double> pyAngle, py::array
     int order = pyOrder;
 
     // destroy previous soltion
+    std::lock_guard<std::mutex> lock(mutex);
     Simulation_DestroySolution(S);
     // check and set memory for inputs
     // Make the design decision to handle the conversion to radians at the
@@ -719,49 +1213,133 @@ void PySimulation::SetFrequency(double pyFreqr, double pyFreqi)
         s << "Imaginary-part of frequency must be Negative";
         throw std::runtime_error(s.str());
         }
+    std::lock_guard<std::mutex> lock(mutex);
     S4_Simulation_SetFrequency(S, freq);
     }
 
 void PySimulation::UseDiscretizedEpsilon(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_discretized_epsilon = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_discretized_epsilon != (int)use)
+        {
+        S->options.use_discretized_epsilon = use;
+        DestroyModesAndSolution(S);
+        }
     }
 
 void PySimulation::UseSubpixelSmoothing(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_subpixel_smoothing = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_subpixel_smoothing != (int)use)
+        {
+        S->options.use_subpixel_smoothing = use;
+        DestroyModesAndSolution(S);
+        }
     }
 
 void PySimulation::UseLanczosSmoothing(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_Lanczos_smoothing = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_Lanczos_smoothing != (int)use)
+        {
+        S->options.use_Lanczos_smoothing = use;
+        DestroyModesAndSolution(S);
+        }
     }
 
 void PySimulation::UsePolarizationDecomposition(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_polarization_basis = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_polarization_basis != (int)use)
+        {
+        S->options.use_polarization_basis = use;
+        DestroyModesAndSolution(S);
+        }
     }
 
 void PySimulation::UseJonesVectorBasis(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_jones_vector_basis = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_jones_vector_basis != (int)use)
+        {
+        S->options.use_jones_vector_basis = use;
+        DestroyModesAndSolution(S);
+        }
     }
 
 void PySimulation::UseNormalVectorBasis(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_normal_vector_basis = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_normal_vector_basis != (int)use)
+        {
+        S->options.use_normal_vector_basis = use;
+        DestroyModesAndSolution(S);
+        }
     }
 
 void PySimulation::UseExperimentalFMM(bool pyUse)
     {
     bool use = pyUse;
-    S->options.use_experimental_fmm = use;
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.use_experimental_fmm != (int)use)
+        {
+        S->options.use_experimental_fmm = use;
+        DestroyModesAndSolution(S);
+        }
+    }
+
+void PySimulation::UseLessMemory(bool pyUse)
+    {
+    bool use = pyUse;
+    std::lock_guard<std::mutex> lock(mutex);
+    S->options.use_less_memory = use;
+    // the partial S-matrices are only kept when not saving memory
+    if (use)
+        {
+        Simulation_DestroySMatrixCache(S);
+        }
+    }
+
+void PySimulation::UseHermitianEigensolver(bool pyUse)
+    {
+    bool use = pyUse;
+    std::lock_guard<std::mutex> lock(mutex);
+    S->options.use_hermitian_eigensolver = use;
+    }
+
+void PySimulation::UseSymmetry(int pyMirrors, int pyParity)
+    {
+    if (pyMirrors < 0 || pyMirrors > 3)
+        {
+        std::ostringstream s;
+        s << "Mirrors must be a combination of 1 (x) and 2 (y), got " << pyMirrors;
+        throw std::runtime_error(s.str());
+        }
+    std::lock_guard<std::mutex> lock(mutex);
+    S->options.symmetry = pyMirrors;
+    S->options.symmetry_parity = pyParity & pyMirrors;
+    // the modes and solutions of another symmetry sector cannot be reused
+    DestroyModesAndSolution(S);
+    }
+
+void PySimulation::SetNumModes(int pyNumModes)
+    {
+    if (pyNumModes < 0)
+        {
+        std::ostringstream s;
+        s << "Number of modes must be >= 0, got " << pyNumModes;
+        throw std::runtime_error(s.str());
+        }
+    std::lock_guard<std::mutex> lock(mutex);
+    S->options.num_modes = pyNumModes;
+    // modes computed with another truncation cannot be reused
+    DestroyModesAndSolution(S);
     }
 
 void PySimulation::SetResolution(int pyResolution)
@@ -773,6 +1351,12 @@ void PySimulation::SetResolution(int pyResolution)
         s << "Resolution must be an integer > 2";
         throw std::runtime_error(s.str());
         }
+    std::lock_guard<std::mutex> lock(mutex);
+    if (S->options.resolution != res)
+        {
+        S->options.resolution = res;
+        DestroyModesAndSolution(S);
+        }
     }
 
 py::array_t<double> PySimulation::TestArray()
@@ -839,7 +1423,13 @@ py::array_t<double> PySimulation::GetPoyntingFlux(std::string pyLayer, double py
         s << "S4_Layer named " << pyLayer.c_str() << " not found";
         throw std::runtime_error(s.str());
         }
-    int ret = S4_Simulation_GetPowerFlux(S, layer, &offset, power);
+    int ret;
+        {
+        // the GIL is not needed while solving
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = S4_Simulation_GetPowerFlux(S, layer, &offset, power);
+        }
 
     if (ret != 0)
         {
@@ -855,7 +1445,7 @@ py::array_t<double> PySimulation::GetPoyntingFlux(std::string pyLayer, double py
 
     }
 
-py::array_t<double> PySimulation::GetPoyntingFluxByG(std::string pyLayer, double pyZOffset)
+py::array_t<double> PySimulation::GetPoyntingFluxByG(std::string pyLayer, double pyZOffset, py::object pyOut)
     {
     // make sure python sends in pyZOffset as 0 by default
     const char *layer_name = pyLayer.c_str();
@@ -873,9 +1463,15 @@ py::array_t<double> PySimulation::GetPoyntingFluxByG(std::string pyLayer, double
     S4_Layer *layer = &S->layer[layer_id];
     // get the number of bases
     int n = S4_Simulation_GetBases(S, NULL);
-    double *powers;
-    powers = (double*)malloc(sizeof(double)*4*n);
-    int ret = Simulation_GetPoyntingFluxByG(S, layer, offset, powers);
+    // the fluxes are written straight into the returned array
+    auto pyPower = OutputArray<double>(pyOut, {(size_t)n, (size_t)4}, "out");
+    double *powers = pyPower.mutable_data();
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetPoyntingFluxByG(S, layer, offset, powers);
+        }
 
     if (ret != 0)
         {
@@ -883,12 +1479,7 @@ py::array_t<double> PySimulation::GetPoyntingFluxByG(std::string pyLayer, double
         s << "GetPowerFluxByG returned code " << ret;
         throw std::runtime_error(s.str());
         }
-    // format the return value
-    auto pyPower = py::array_t<double>(4*n);
-    auto pyBuffer = pyPower.request();
-    std::memcpy(pyBuffer.ptr, powers, 4*sizeof(double)*n);
     return pyPower;
-
     }
 
 py::array_t<double> PySimulation::GetFieldAtPoint(py::array_t<double> pyPoint)
@@ -917,7 +1508,12 @@ py::array_t<double> PySimulation::GetFieldAtPoint(py::array_t<double> pyPoint)
     S4_real eField[6];
     S4_real hField[6];
 
-    int ret = Simulation_GetField(S, point, eField, hField);
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetField(S, point, eField, hField);
+        }
 
     if (ret != 0)
         {
@@ -935,7 +1531,40 @@ py::array_t<double> PySimulation::GetFieldAtPoint(py::array_t<double> pyPoint)
     return pyField;
     }
 
-std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> PySimulation::GetFieldPlane(double pyZ, py::array_t<int> pyNUV)
+std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> PySimulation::GetFieldsAtPoints(py::array_t<double> pyPoints)
+    {
+    py::buffer_info pointInfo = pyPoints.request();
+    // check that the points are appropriately formatted
+    if (pointInfo.ndim != 2 || pointInfo.shape[1] != 3)
+        {
+        std::ostringstream s;
+        s << "points must be a 2D array with 3 columns: [x, y, z]";
+        throw std::runtime_error(s.str());
+        }
+    const size_t nPoints = pointInfo.shape[0];
+    const double *pointPtr = static_cast<double *>(pointInfo.ptr);
+
+    // the fields are written straight into the returned arrays
+    auto pyEField = py::array_t<std::complex<double>>({nPoints, (size_t)3});
+    auto pyHField = py::array_t<std::complex<double>>({nPoints, (size_t)3});
+    double *eField = static_cast<double *>(pyEField.request().ptr);
+    double *hField = static_cast<double *>(pyHField.request().ptr);
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetFieldAtPoints(S, nPoints, pointPtr, eField, hField);
+        }
+    if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "GetFieldAtPoints returned code " << ret;
+        throw std::runtime_error(s.str());
+        }
+    return std::make_tuple(pyEField, pyHField);
+    }
+
+std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> PySimulation::GetFieldPlane(double pyZ, py::array_t<int> pyNUV, py::object pyEOut, py::object pyHOut)
     {
     // This will return the double in the exact same form as the
     double z = pyZ;
@@ -958,19 +1587,26 @@ std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>>
     int *nUVPtr = static_cast<int *>(nUVInfo.ptr);
     std::memcpy(nUV, nUVPtr, 2 * sizeof(int));
 
-    // double eField[6];
-    // double hField[6];
-    int fieldArrSize = 6 * nUV[0] * nUV[1];
-    int complexArrSize = 3 * nUV[0] * nUV[1];
-    // extract electric, magnetic fields and convert to complex arrays
-    // start with the electric
-    double *eField;
-    eField = (double *)malloc(sizeof(double) * fieldArrSize);
-    // and now magnetic field
-    double *hField;
-    hField = (double *)malloc(sizeof(double) * fieldArrSize);
+    if (nUV[0] <= 0 || nUV[1] <= 0)
+        {
+        std::ostringstream s;
+        s << "n_uv must be positive";
+        throw std::runtime_error(s.str());
+        }
+
+    // the fields are written straight into the returned arrays
+    const std::vector<size_t> shape = {(size_t)nUV[1], (size_t)nUV[0], (size_t)3};
+    auto pyEField = OutputArray<std::complex<double>>(pyEOut, shape, "e_out");
+    auto pyHField = OutputArray<std::complex<double>>(pyHOut, shape, "h_out");
+    double *eField = reinterpret_cast<double *>(pyEField.mutable_data());
+    double *hField = reinterpret_cast<double *>(pyHField.mutable_data());
     // do the calculation
-    int ret = Simulation_GetFieldPlane(S, nUV, z, eField, hField);
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetFieldPlane(S, nUV, z, eField, hField);
+        }
     // check for errors
     if (ret != 0)
         {
@@ -978,35 +1614,65 @@ std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>>
         s << "GetField returned code " << ret;
         throw std::runtime_error(s.str());
         }
-    // and now convert
-    // first electric
-    std::complex<double> *complexEField;
-    complexEField = reinterpret_cast<std::complex<double>*>(eField);
-    // and now magnetic
-    std::complex<double> *complexHField;
-    complexHField = reinterpret_cast<std::complex<double>*>(hField);
-    // convert to python arrays
-    // first electric
-    auto pyEField = py::array_t<std::complex<double>>(complexArrSize);
-    auto pyEFieldBuffer = pyEField.request();
-    std::memcpy(pyEFieldBuffer.ptr, complexEField, complexArrSize * sizeof(std::complex<double>));
-    // and now magnetic
-    auto pyHField = py::array_t<std::complex<double>>(complexArrSize);
-    auto pyHFieldBuffer = pyHField.request();
-    std::memcpy(pyHFieldBuffer.ptr, complexHField, complexArrSize * sizeof(std::complex<double>));
     return std::make_tuple(pyEField, pyHField);
+    }
+
+std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> PySimulation::GetFieldVolume(py::array_t<double> pyZ, py::array_t<int> pyNUV, int pyNWorkers)
+    {
+    py::buffer_info zInfo = pyZ.request();
+    if (zInfo.ndim != 1)
+        {
+        std::ostringstream s;
+        s << "z_values must be a 1D array";
+        throw std::runtime_error(s.str());
+        }
+    const size_t nZ = zInfo.shape[0];
+    const double *zPtr = static_cast<double *>(zInfo.ptr);
+
+    py::buffer_info nUVInfo = pyNUV.request();
+    if (nUVInfo.ndim != 1 || nUVInfo.shape[0] != 2)
+        {
+        std::ostringstream s;
+        s << "n_uv must be a 1D array with 2 elements: [nu, nv]";
+        throw std::runtime_error(s.str());
+        }
+    int nUV[2];
+    std::memcpy(nUV, nUVInfo.ptr, 2 * sizeof(int));
+    if (nUV[0] <= 0 || nUV[1] <= 0)
+        {
+        std::ostringstream s;
+        s << "n_uv must be positive";
+        throw std::runtime_error(s.str());
+        }
+
+    int nWorkers = pyNWorkers;
+    if (pyNWorkers <= 0)
+        {
+        nWorkers = std::thread::hardware_concurrency();
+        }
 
-    // old code
-    // std::memcpy(fields, eField, fieldArrSize * sizeof(double));
-    // std::memcpy(fields+fieldArrSize, hField, fieldArrSize * sizeof(double));
-    // // format the return value. will be a 12-element array
-    // auto pyField = py::array_t<double>(2*fieldArrSize);
-    // auto pyBuffer = pyField.request();
-    // std::memcpy(pyBuffer.ptr, fields, 2*fieldArrSize * sizeof(double));
-    // return pyField;
+    // the fields are written straight into the returned arrays
+    const std::vector<size_t> shape = {nZ, (size_t)nUV[1], (size_t)nUV[0], (size_t)3};
+    auto pyEField = py::array_t<std::complex<double>>(shape);
+    auto pyHField = py::array_t<std::complex<double>>(shape);
+    double *eField = static_cast<double *>(pyEField.request().ptr);
+    double *hField = static_cast<double *>(pyHField.request().ptr);
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetFieldVolume(S, nUV, nZ, zPtr, eField, hField, nWorkers);
+        }
+    if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "GetFieldVolume returned code " << ret;
+        throw std::runtime_error(s.str());
+        }
+    return std::make_tuple(pyEField, pyHField);
     }
 
-py::array_t<double> PySimulation::GetWaves(std::string pyLayer)
+py::array_t<double> PySimulation::GetWaves(std::string pyLayer, py::object pyOut)
     {
     const char *layer_name = pyLayer.c_str();
     S4_LayerID layer;
@@ -1020,25 +1686,896 @@ py::array_t<double> PySimulation::GetWaves(std::string pyLayer)
         throw std::runtime_error(s.str());
         }
     int n, ret;
-    S4_real* waves = NULL;
     // get the number of bases
     n = S4_Simulation_GetBases(S, NULL);
-    const int n2 = 2*n;
-    // create array to hold waves object
-    waves = (S4_real*)malloc(sizeof(S4_real)*11*n2);
-    ret = S4_Simulation_GetWaves(S, layer, waves);
+    // the waves are written straight into the returned array
+    auto pyWaves = OutputArray<double>(pyOut, {(size_t)n, (size_t)2, (size_t)11}, "out");
+    S4_real *waves = pyWaves.mutable_data();
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = S4_Simulation_GetWaves(S, layer, waves);
+        }
     if (ret != 0)
         {
         std::ostringstream s;
         s << "GetWaves returned code " << ret;
         throw std::runtime_error(s.str());
         }
-    // format the return value
-    auto pyWaves = py::array_t<double>(11*n2);
-    auto pyBuffer = pyWaves.request();
-    std::memcpy(pyBuffer.ptr, waves, 11*n2*sizeof(double));
     return pyWaves;
+    }
+
+py::array_t<std::complex<double>> PySimulation::GetPropagationConstants(std::string pyLayer)
+    {
+    S4_LayerID layer = S4_Simulation_GetLayerByName(S, pyLayer.c_str());
+    if (layer < 0)
+        {
+        std::ostringstream s;
+        s << "S4_Layer named " << pyLayer.c_str() << " not found";
+        throw std::runtime_error(s.str());
+        }
+    auto pyQ = py::array_t<std::complex<double>>(S->n_G);
+    double *q = static_cast<double *>(pyQ.request().ptr);
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetPropagationConstants(S, &S->layer[layer], q);
+        }
+    if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "GetPropagationConstants returned code " << ret;
+        throw std::runtime_error(s.str());
+        }
+    return pyQ;
+    }
 
+py::dict PySimulation::GetModeTruncation(std::string pyLayer)
+    {
+    S4_LayerID layer = S4_Simulation_GetLayerByName(S, pyLayer.c_str());
+    if (layer < 0)
+        {
+        std::ostringstream s;
+        s << "S4_Layer named " << pyLayer.c_str() << " not found";
+        throw std::runtime_error(s.str());
+        }
+    int nExact, ret;
+    double decay, residual, approxResidual, interfaceError;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = Simulation_GetModeTruncation(S, &S->layer[layer], &nExact, &decay, &residual, &approxResidual, &interfaceError);
+        }
+    if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "GetModeTruncation returned code " << ret;
+        throw std::runtime_error(s.str());
+        }
+    py::dict truncation;
+    truncation["num_modes"] = nExact;
+    truncation["num_total"] = 2*S->n_G;
+    truncation["decay"] = decay;
+    truncation["residual"] = residual;
+    truncation["approx_residual"] = approxResidual;
+    truncation["interface_error"] = interfaceError;
+    truncation["thickness"] = S->layer[layer].thickness;
+    return truncation;
+    }
+
+py::array_t<double> PySimulation::SweepFrequencies(py::array_t<double> pyFreqs, std::vector<std::string> pyLayers, py::array_t<double> pyOffsets, int pyNWorkers)
+    {
+    py::buffer_info freqInfo = pyFreqs.request();
+    if (freqInfo.ndim != 1)
+        {
+        std::ostringstream s;
+        s << "freqs must be a 1D array";
+        throw std::runtime_error(s.str());
+        }
+    const size_t nFreq = freqInfo.shape[0];
+    const double *freqPtr = static_cast<double *>(freqInfo.ptr);
+    for (size_t i = 0; i < nFreq; i++)
+        {
+        if (freqPtr[i] <= 0)
+            {
+            std::ostringstream s;
+            s << "Real-part of frequency must be positive";
+            throw std::runtime_error(s.str());
+            }
+        }
+
+    // resolve the layer names up front; the clones share layer ordering
+    const size_t nLayers = pyLayers.size();
+    std::vector<S4_LayerID> layerIDs(nLayers);
+    for (size_t j = 0; j < nLayers; j++)
+        {
+        layerIDs[j] = S4_Simulation_GetLayerByName(S, pyLayers[j].c_str());
+        if (layerIDs[j] < 0)
+            {
+            std::ostringstream s;
+            s << "S4_Layer named " << pyLayers[j].c_str() << " not found";
+            throw std::runtime_error(s.str());
+            }
+        }
+
+    py::buffer_info offsetInfo = pyOffsets.request();
+    if (offsetInfo.ndim != 1 || (size_t)offsetInfo.shape[0] != nLayers)
+        {
+        std::ostringstream s;
+        s << "offsets must be a 1D array with one element per layer";
+        throw std::runtime_error(s.str());
+        }
+    const double *offsetPtr = static_cast<double *>(offsetInfo.ptr);
+    std::vector<S4_real> offsets(offsetPtr, offsetPtr + nLayers);
+
+    // format the return value: (n_freq, n_layers, 4)
+    auto pyFlux = py::array_t<double>({nFreq, nLayers, (size_t)4});
+    auto pyBuffer = pyFlux.request();
+    double *fluxPtr = static_cast<double *>(pyBuffer.ptr);
+    if (nFreq == 0 || nLayers == 0)
+        {
+        return pyFlux;
+        }
+
+    size_t nWorkers = pyNWorkers;
+    if (pyNWorkers <= 0)
+        {
+        nWorkers = std::thread::hardware_concurrency();
+        }
+    if (nWorkers == 0)
+        {
+        nWorkers = 1;
+        }
+    if (nWorkers > nFreq)
+        {
+        nWorkers = nFreq;
+        }
+
+    // every worker gets a private copy of the simulation so that no layer
+    // modes, solutions or field caches are shared between threads
+    std::vector<S4_Simulation*> clones(nWorkers, NULL);
+    std::unique_lock<std::mutex> lock(mutex);
+    for (size_t w = 0; w < nWorkers; w++)
+        {
+        clones[w] = S4_Simulation_Clone(S);
+        if (clones[w] == NULL)
+            {
+            for (size_t k = 0; k < w; k++)
+                {
+                S4_Simulation_Destroy(clones[k]);
+                }
+            std::ostringstream s;
+            s << "S4_Simulation_Clone failed";
+            throw std::runtime_error(s.str());
+            }
+        }
+    // the points share the imaginary part of the current frequency
+    S4_real current[2];
+    S4_Simulation_GetFrequency(S, current);
+    const S4_real freqi = current[1];
+    lock.unlock();
+
+    // frequencies are handed out one at a time so that slow points (e.g.
+    // near resonances) do not stall a statically assigned worker
+    std::atomic<size_t> next(0);
+    std::atomic<int> err(0);
+        {
+        py::gil_scoped_release release;
+        std::vector<std::thread> workers;
+        for (size_t w = 0; w < nWorkers; w++)
+            {
+            workers.emplace_back([&, w]()
+                {
+                S4_Simulation *T = clones[w];
+                for (size_t i = next++; i < nFreq && err == 0; i = next++)
+                    {
+                    S4_real freq[2] = {freqPtr[i], freqi};
+                    S4_Simulation_SetFrequency(T, freq);
+                    for (size_t j = 0; j < nLayers; j++)
+                        {
+                        int ret = S4_Simulation_GetPowerFlux(T, layerIDs[j], &offsets[j], fluxPtr + 4*(i*nLayers + j));
+                        if (ret != 0)
+                            {
+                            int expected = 0;
+                            err.compare_exchange_strong(expected, ret);
+                            break;
+                            }
+                        }
+                    }
+                });
+            }
+        for (auto &worker : workers)
+            {
+            worker.join();
+            }
+        }
+
+    lock.lock();
+    for (size_t w = 0; w < nWorkers; w++)
+        {
+        S->profile->Merge(*clones[w]->profile, w + 1);
+        S4_Simulation_Destroy(clones[w]);
+        }
+    lock.unlock();
+    if (err != 0)
+        {
+        std::ostringstream s;
+        s << "GetPowerFlux returned code " << err;
+        throw std::runtime_error(s.str());
+        }
+    return pyFlux;
+    }
+
+py::array_t<double> PySimulation::SweepLayerThickness(std::string pyLayer, py::array_t<double> pyThicknesses, std::vector<std::string> pyLayers, py::array_t<double> pyOffsets)
+    {
+    S4_LayerID layer = S4_Simulation_GetLayerByName(S, pyLayer.c_str());
+    if (layer < 0)
+        {
+        std::ostringstream s;
+        s << "S4_Layer named " << pyLayer.c_str() << " not found";
+        throw std::runtime_error(s.str());
+        }
+
+    py::buffer_info thickInfo = pyThicknesses.request();
+    if (thickInfo.ndim != 1)
+        {
+        std::ostringstream s;
+        s << "thicknesses must be a 1D array";
+        throw std::runtime_error(s.str());
+        }
+    const size_t nThick = thickInfo.shape[0];
+    const double *thickPtr = static_cast<double *>(thickInfo.ptr);
+    for (size_t i = 0; i < nThick; i++)
+        {
+        if (thickPtr[i] < 0)
+            {
+            std::ostringstream s;
+            s << "SweepLayerThickness: Thickness must be non-negative";
+            throw std::runtime_error(s.str());
+            }
+        }
+
+    const size_t nLayers = pyLayers.size();
+    std::vector<S4_LayerID> layerIDs(nLayers);
+    for (size_t j = 0; j < nLayers; j++)
+        {
+        layerIDs[j] = S4_Simulation_GetLayerByName(S, pyLayers[j].c_str());
+        if (layerIDs[j] < 0)
+            {
+            std::ostringstream s;
+            s << "S4_Layer named " << pyLayers[j].c_str() << " not found";
+            throw std::runtime_error(s.str());
+            }
+        }
+
+    py::buffer_info offsetInfo = pyOffsets.request();
+    if (offsetInfo.ndim != 1 || (size_t)offsetInfo.shape[0] != nLayers)
+        {
+        std::ostringstream s;
+        s << "offsets must be a 1D array with one element per layer";
+        throw std::runtime_error(s.str());
+        }
+    const double *offsetPtr = static_cast<double *>(offsetInfo.ptr);
+
+    // format the return value: (n_thicknesses, n_layers, 4)
+    auto pyFlux = py::array_t<double>({nThick, nLayers, (size_t)4});
+    auto pyBuffer = pyFlux.request();
+    double *fluxPtr = static_cast<double *>(pyBuffer.ptr);
+    int ret;
+        {
+        py::gil_scoped_release release;
+        std::lock_guard<std::mutex> lock(mutex);
+        ret = S4_Simulation_SweepLayerThickness(S, layer, nThick, thickPtr, nLayers, layerIDs.data(), offsetPtr, fluxPtr);
+        }
+    if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "SweepLayerThickness returned code " << ret;
+        throw std::runtime_error(s.str());
+        }
+    return pyFlux;
+    }
+
+std::tuple<py::array_t<double>, py::array_t<double>> PySimulation::SweepAngles(py::array_t<double> pyAngles, py::array_t<double> pyPolS, py::array_t<double> pyPolP, int pyOrder, std::vector<std::string> pyLayers, py::array_t<double> pyOffsets, bool pyByG, int pyNWorkers)
+    {
+    py::buffer_info angleInfo = pyAngles.request();
+    if (angleInfo.ndim != 2 || angleInfo.shape[1] != 2)
+        {
+        std::ostringstream s;
+        s << "angles must be a 2D array with 2 columns: [phi, theta]";
+        throw std::runtime_error(s.str());
+        }
+    const size_t nAngles = angleInfo.shape[0];
+    const double *anglePtr = static_cast<double *>(angleInfo.ptr);
+
+    py::buffer_info polSInfo = pyPolS.request();
+    py::buffer_info polPInfo = pyPolP.request();
+    if (polSInfo.ndim != 1 || polSInfo.shape[0] != 2)
+        {
+        std::ostringstream s;
+        s << "PolS must be a 1D array with 2 elements: [Amplitude, Phase]";
+        throw std::runtime_error(s.str());
+        }
+    if (polPInfo.ndim != 1 || polPInfo.shape[0] != 2)
+        {
+        std::ostringstream s;
+        s << "PolP must be a 1D array with 2 elements: [Amplitude, Phase]";
+        throw std::runtime_error(s.str());
+        }
+    const double *polSPtr = static_cast<double *>(polSInfo.ptr);
+    const double *polPPtr = static_cast<double *>(polPInfo.ptr);
+    const double pol_s[2] = {polSPtr[0], polSPtr[1]};
+    const double pol_p[2] = {polPPtr[0], polPPtr[1]};
+    const size_t order = (pyOrder > 0 ? pyOrder-1 : 0);
+
+    // resolve the layer names up front; the clones share layer ordering
+    const size_t nLayers = pyLayers.size();
+    std::vector<S4_LayerID> layerIDs(nLayers);
+    for (size_t j = 0; j < nLayers; j++)
+        {
+        layerIDs[j] = S4_Simulation_GetLayerByName(S, pyLayers[j].c_str());
+        if (layerIDs[j] < 0)
+            {
+            std::ostringstream s;
+            s << "S4_Layer named " << pyLayers[j].c_str() << " not found";
+            throw std::runtime_error(s.str());
+            }
+        }
+
+    py::buffer_info offsetInfo = pyOffsets.request();
+    if (offsetInfo.ndim != 1 || (size_t)offsetInfo.shape[0] != nLayers)
+        {
+        std::ostringstream s;
+        s << "offsets must be a 1D array with one element per layer";
+        throw std::runtime_error(s.str());
+        }
+    const double *offsetPtr = static_cast<double *>(offsetInfo.ptr);
+    std::vector<S4_real> offsets(offsetPtr, offsetPtr + nLayers);
+
+    // format the return values: (n_angles, n_layers, 4) and, if requested,
+    // (n_angles, n_layers, n_G, 4)
+    const size_t nG = S4_Simulation_GetBases(S, NULL);
+    auto pyFlux = py::array_t<double>({nAngles, nLayers, (size_t)4});
+    auto pyFluxByG = py::array_t<double>({pyByG ? nAngles : 0, nLayers, nG, (size_t)4});
+    double *fluxPtr = static_cast<double *>(pyFlux.request().ptr);
+    double *fluxByGPtr = static_cast<double *>(pyFluxByG.request().ptr);
+    if (nAngles == 0 || nLayers == 0)
+        {
+        return std::make_tuple(pyFlux, pyFluxByG);
+        }
+
+    size_t nWorkers = pyNWorkers;
+    if (pyNWorkers <= 0)
+        {
+        nWorkers = std::thread::hardware_concurrency();
+        }
+    if (nWorkers == 0)
+        {
+        nWorkers = 1;
+        }
+    if (nWorkers > nAngles)
+        {
+        nWorkers = nAngles;
+        }
+
+    // solves angle i on the simulation T; returns an error code
+    auto solve = [&](S4_Simulation *T, size_t i)
+        {
+        int ret = Simulation_MakeExcitationPlanewave(T, anglePtr + 2*i, pol_s, pol_p, order);
+        for (size_t j = 0; j < nLayers && ret == 0; j++)
+            {
+            ret = S4_Simulation_GetPowerFlux(T, layerIDs[j], &offsets[j], fluxPtr + 4*(i*nLayers + j));
+            if (ret == 0 && pyByG)
+                {
+                ret = Simulation_GetPoyntingFluxByG(T, &T->layer[layerIDs[j]], offsets[j], fluxByGPtr + 4*nG*(i*nLayers + j));
+                }
+            }
+        return ret;
+        };
+
+    // every worker gets a private copy of the simulation. The first angle
+    // is solved before the other copies are made, so that they all share
+    // the epsilon matrices of its layers, which do not depend on the
+    // k-vector; each layer's epsilon matrices are built only once
+    std::vector<S4_Simulation*> clones(nWorkers, NULL);
+    std::atomic<int> err(0);
+        {
+        std::unique_lock<std::mutex> lock(mutex);
+        clones[0] = S4_Simulation_Clone(S);
+        lock.unlock();
+        if (clones[0] != NULL)
+            {
+            py::gil_scoped_release release;
+            err = solve(clones[0], 0);
+            }
+        }
+    for (size_t w = 1; w < nWorkers && clones[w-1] != NULL; w++)
+        {
+        clones[w] = S4_Simulation_Clone(clones[0]);
+        }
+    if (clones[nWorkers-1] == NULL)
+        {
+        for (size_t w = 0; w < nWorkers; w++)
+            {
+            if (clones[w] != NULL)
+                {
+                S4_Simulation_Destroy(clones[w]);
+                }
+            }
+        std::ostringstream s;
+        s << "S4_Simulation_Clone failed";
+        throw std::runtime_error(s.str());
+        }
+
+    // the remaining angles are handed out one at a time
+    std::atomic<size_t> next(1);
+        {
+        py::gil_scoped_release release;
+        std::vector<std::thread> workers;
+        for (size_t w = 0; w < nWorkers; w++)
+            {
+            workers.emplace_back([&, w]()
+                {
+                for (size_t i = next++; i < nAngles && err == 0; i = next++)
+                    {
+                    int ret = solve(clones[w], i);
+                    if (ret != 0)
+                        {
+                        int expected = 0;
+                        err.compare_exchange_strong(expected, ret);
+                        }
+                    }
+                });
+            }
+        for (auto &worker : workers)
+            {
+            worker.join();
+            }
+        }
+
+        {
+        std::lock_guard<std::mutex> lock(mutex);
+        for (size_t w = 0; w < nWorkers; w++)
+            {
+            S->profile->Merge(*clones[w]->profile, w + 1);
+            S4_Simulation_Destroy(clones[w]);
+            }
+        }
+    if (err != 0)
+        {
+        std::ostringstream s;
+        s << "SweepAngles returned code " << err;
+        throw std::runtime_error(s.str());
+        }
+    return std::make_tuple(pyFlux, pyFluxByG);
+    }
+
+py::dict PySimulation::GetMemoryReport()
+    {
+    static const char *categories[S4_MEMORY_NCATEGORIES] = {
+        "modes", "epsilon", "smatrix_cache", "field_cache"
+        };
+    std::lock_guard<std::mutex> lock(mutex);
+    std::vector<size_t> layerBytes(S4_MEMORY_NCATEGORIES * S->n_layers);
+    size_t shared[3];
+    Simulation_GetMemoryUsage(S, layerBytes.data(), shared);
+
+    py::dict layers;
+    for (int i = 0; i < S->n_layers; i++)
+        {
+        py::dict layer;
+        for (int j = 0; j < S4_MEMORY_NCATEGORIES; j++)
+            {
+            layer[categories[j]] = layerBytes[S4_MEMORY_NCATEGORIES * i + j];
+            }
+        layers[S->layer[i].name] = layer;
+        }
+    py::dict pyShared;
+    pyShared["basis"] = shared[0];
+    pyShared["smatrix_workspace"] = shared[1];
+    pyShared["solution"] = shared[2];
+    py::dict report;
+    report["layers"] = layers;
+    report["shared"] = pyShared;
+    return report;
+    }
+
+size_t PySimulation::EstimatePeakMemory()
+    {
+    int nCopies = 0;
+    int nPatterned = 0;
+    for (int i = 0; i < S->n_layers; i++)
+        {
+        const S4_Layer *L = &S->layer[i];
+        if (L->copy >= 0)
+            {
+            nCopies++;
+            }
+        else if (L->pattern.nshapes > 0 || S->material[L->material].type != 0)
+            {
+            nPatterned++;
+            }
+        }
+    return Simulation_EstimatePeakMemory(S->n_G, S->n_layers, nCopies, nPatterned, S->options.use_less_memory);
+    }
+
+void PySimulation::ResetProfile(bool pyTrace)
+    {
+    std::lock_guard<std::mutex> lock(mutex);
+    S->profile->Reset(pyTrace);
+    }
+
+py::dict PySimulation::GetProfile()
+    {
+    std::lock_guard<std::mutex> lock(mutex);
+    py::dict profile;
+    for (int i = 0; i < S4_PROFILE_NPHASES; i++)
+        {
+        py::dict phase;
+        phase["count"] = S->profile->count[i];
+        phase["seconds"] = S->profile->seconds[i];
+        phase["self_seconds"] = S->profile->self_seconds[i];
+        profile[S4_Profile_PhaseName(i)] = phase;
+        }
+    return profile;
+    }
+
+py::list PySimulation::GetProfileEvents()
+    {
+    std::lock_guard<std::mutex> lock(mutex);
+    py::list events;
+    for (const S4_ProfileEvent &event : S->profile->events)
+        {
+        events.append(py::make_tuple(S4_Profile_PhaseName(event.phase), event.thread, event.start, event.duration));
+        }
+    return events;
+    }
+
+size_t EstimatePeakMemory(int pyNumG, int pyNLayers, int pyNCopies, int pyNPatterned, bool pyUseLessMemory)
+    {
+    if (pyNumG < 1 || pyNLayers < 1 || pyNCopies < 0 || pyNPatterned < 0 || pyNCopies + pyNPatterned > pyNLayers)
+        {
+        std::ostringstream s;
+        s << "Invalid layer counts";
+        throw std::runtime_error(s.str());
+        }
+    return Simulation_EstimatePeakMemory(pyNumG, pyNLayers, pyNCopies, pyNPatterned, pyUseLessMemory);
+    }
+
+void SetLayerModesCacheBudget(size_t budget)
+    {
+    Simulation_SetModesCacheBudget(budget);
+    }
+
+py::dict GetLayerModesCacheInfo()
+    {
+    size_t info[5];
+    Simulation_GetModesCacheInfo(info);
+    py::dict pyInfo;
+    pyInfo["budget"] = info[0];
+    pyInfo["bytes"] = info[1];
+    pyInfo["entries"] = info[2];
+    pyInfo["hits"] = info[3];
+    pyInfo["misses"] = info[4];
+    return pyInfo;
+    }
+
+void LoadFFTWisdom(std::string filename)
+    {
+    int ret = fft_wisdom_import(filename.c_str());
+    if (ret < 0)
+        {
+        throw std::runtime_error("S4 was built without FFTW; wisdom is not supported");
+        }
+    else if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "Could not load FFTW wisdom from " << filename;
+        throw std::runtime_error(s.str());
+        }
+    }
+
+void SaveFFTWisdom(std::string filename)
+    {
+    int ret = fft_wisdom_export(filename.c_str());
+    if (ret < 0)
+        {
+        throw std::runtime_error("S4 was built without FFTW; wisdom is not supported");
+        }
+    else if (ret != 0)
+        {
+        std::ostringstream s;
+        s << "Could not save FFTW wisdom to " << filename;
+        throw std::runtime_error(s.str());
+        }
+    }
+
+void SetFFTPlannerEffort(int effort)
+    {
+    if (fft_set_planner_effort(effort) != 0)
+        {
+        std::ostringstream s;
+        s << "Invalid FFT planner effort " << effort;
+        throw std::runtime_error(s.str());
+        }
+    }
+
+void SetFFTPlanCacheCapacity(size_t capacity)
+    {
+    fft_plan_cache_set_capacity(capacity);
+    }
+
+py::dict GetFFTPlanCacheInfo()
+    {
+    size_t size, capacity, hits, misses;
+    fft_plan_cache_info(&size, &capacity, &hits, &misses);
+    py::dict info;
+    info["size"] = size;
+    info["capacity"] = capacity;
+    info["hits"] = hits;
+    info["misses"] = misses;
+    return info;
+    }
+
+PySpectrumSampler::PySpectrumSampler(double pyX0, double pyX1, int pyInitialNumPoints, double pyRangeThreshold, double pyMaxBend, double pyMinDx, bool pyParallelize)
+    {
+    SpectrumSampler_Options options;
+    options.initial_num_points = pyInitialNumPoints;
+    options.range_threshold = pyRangeThreshold;
+    options.max_bend = pyMaxBend;
+    options.min_dx = pyMinDx;
+    options.parallelize = pyParallelize;
+    sampler = SpectrumSampler_New(pyX0, pyX1, &options);
+    }
+
+PySpectrumSampler::~PySpectrumSampler()
+    {
+    SpectrumSampler_Destroy(sampler);
+    }
+
+bool PySpectrumSampler::IsDone()
+    {
+    return SpectrumSampler_IsDone(sampler);
+    }
+
+bool PySpectrumSampler::IsParallelized()
+    {
+    return SpectrumSampler_IsParallelized(sampler);
+    }
+
+int PySpectrumSampler::GetNumPoints()
+    {
+    return SpectrumSampler_GetNumPoints(sampler);
+    }
+
+double PySpectrumSampler::GetFrequency()
+    {
+    if (SpectrumSampler_IsParallelized(sampler))
+        {
+        throw std::runtime_error("GetFrequency cannot be used with a parallelized sampler");
+        }
+    return SpectrumSampler_GetFrequency(sampler);
+    }
+
+bool PySpectrumSampler::SubmitResult(double pyY)
+    {
+    if (SpectrumSampler_IsParallelized(sampler))
+        {
+        throw std::runtime_error("SubmitResult cannot be used with a parallelized sampler");
+        }
+    if (SpectrumSampler_IsDone(sampler))
+        {
+        throw std::runtime_error("The sampler is done; no result was requested");
+        }
+    return SpectrumSampler_SubmitResult(sampler, pyY);
+    }
+
+py::array_t<double> PySpectrumSampler::GetFrequencies()
+    {
+    if (!SpectrumSampler_IsParallelized(sampler))
+        {
+        throw std::runtime_error("GetFrequencies needs a parallelized sampler");
+        }
+    const double *freqs = NULL;
+    const int n = SpectrumSampler_GetFrequencies(sampler, &freqs);
+    py::array_t<double> pyFreqs(n);
+    if (n > 0)
+        {
+        memcpy(pyFreqs.mutable_data(), freqs, sizeof(double) * n);
+        }
+    return pyFreqs;
+    }
+
+bool PySpectrumSampler::SubmitResults(py::array_t<double> pyY)
+    {
+    if (!SpectrumSampler_IsParallelized(sampler))
+        {
+        throw std::runtime_error("SubmitResults needs a parallelized sampler");
+        }
+    if (SpectrumSampler_IsDone(sampler))
+        {
+        throw std::runtime_error("The sampler is done; no results were requested");
+        }
+    // (re)sizes the submission buffer to the current batch
+    const double *freqs = NULL;
+    const int n = SpectrumSampler_GetFrequencies(sampler, &freqs);
+    if (pyY.ndim() != 1 || pyY.shape(0) != n)
+        {
+        std::ostringstream s;
+        s << "Expected " << n << " results, one per requested frequency";
+        throw std::runtime_error(s.str());
+        }
+    double *y = NULL;
+    SpectrumSampler_GetSubmissionBuffer(sampler, &y);
+    auto pyYData = pyY.unchecked<1>();
+    for (int i = 0; i < n; i++)
+        {
+        y[i] = pyYData(i);
+        }
+    return SpectrumSampler_SubmitResults(sampler);
+    }
+
+py::array_t<double> PySpectrumSampler::GetSpectrum()
+    {
+    const int n = SpectrumSampler_GetNumPoints(sampler);
+    std::vector<double> pts(2 * n + 2);
+    const int m = SpectrumSampler_GetPoints(sampler, pts.data());
+    py::array_t<double> pySpectrum({m, 2});
+    if (m > 0)
+        {
+        memcpy(pySpectrum.mutable_data(), pts.data(), sizeof(double) * 2 * m);
+        }
+    return pySpectrum;
+    }
+
+// checks that xy is (n, 2) and z is (n,); returns n
+static size_t CheckSamples(py::buffer_info &xyInfo, py::buffer_info &zInfo)
+    {
+    if (xyInfo.ndim != 2 || xyInfo.shape[1] != 2)
+        {
+        std::ostringstream s;
+        s << "xy must be a 2D array with 2 columns: [x, y]";
+        throw std::runtime_error(s.str());
+        }
+    if (zInfo.ndim != 1 || zInfo.shape[0] != xyInfo.shape[0])
+        {
+        std::ostringstream s;
+        s << "z must be a 1D array with one value per row of xy";
+        throw std::runtime_error(s.str());
+        }
+    return xyInfo.shape[0];
+    }
+
+PyFunctionSampler2D::PyFunctionSampler2D(py::array_t<double> pyXY, py::array_t<double> pyZ, double pyZTolAbs, double pyZTolRel, double pyMaxBend, double pyXYTol)
+    {
+    py::buffer_info xyInfo = pyXY.request();
+    py::buffer_info zInfo = pyZ.request();
+    const size_t n = CheckSamples(xyInfo, zInfo);
+    const double *xyPtr = static_cast<double *>(xyInfo.ptr);
+    const double *zPtr = static_cast<double *>(zInfo.ptr);
+
+    // a sample landing exactly on an edge of the convex hull of the
+    // previous ones leaves a flat triangle behind (e.g. the boundary of a
+    // grid), which cannot happen when they are added in lexicographic order
+    std::vector<size_t> order(n);
+    for (size_t i = 0; i < n; i++)
+        {
+        order[i] = i;
+        }
+    std::stable_sort(order.begin(), order.end(), [&](size_t i, size_t j)
+        {
+        return xyPtr[2*i] < xyPtr[2*j] || (xyPtr[2*i] == xyPtr[2*j] && xyPtr[2*i+1] < xyPtr[2*j+1]);
+        });
+    // the first three samples make the initial triangle, so they must not
+    // be collinear; move the first sample off the line of 0 and 1 forward
+    size_t third = n;
+    for (size_t i = 2; i < n && third == n; i++)
+        {
+        const double *a = xyPtr + 2*order[0], *b = xyPtr + 2*order[1], *c = xyPtr + 2*order[i];
+        const double area = (b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0]);
+        if (area != 0)
+            {
+            third = i;
+            }
+        }
+    if (third == n)
+        {
+        std::ostringstream s;
+        s << "FunctionSampler2D needs at least 3 distinct samples that are "
+          << "not all collinear";
+        throw std::runtime_error(s.str());
+        }
+    std::rotate(order.begin() + 2, order.begin() + third, order.begin() + third + 1);
+    std::vector<double> xy(2*n), z(n);
+    for (size_t i = 0; i < n; i++)
+        {
+        xy[2*i+0] = xyPtr[2*order[i]+0];
+        xy[2*i+1] = xyPtr[2*order[i]+1];
+        z[i] = zPtr[order[i]];
+        }
+
+    function_sampler_2d_options options;
+    function_sampler_2d_options_defaults(&options);
+    options.min_dz_abs = pyZTolAbs;
+    options.min_dz_rel = pyZTolRel;
+    options.max_principal_curvature = sin(pyMaxBend * M_PI / 180.0);
+    options.min_dxy = pyXYTol;
+    sampler = function_sampler_2d_new(&options, n, xy.data(), z.data(), NULL);
+    }
+
+PyFunctionSampler2D::~PyFunctionSampler2D()
+    {
+    function_sampler_2d_destroy(sampler);
+    }
+
+void PyFunctionSampler2D::Add(py::array_t<double> pyXY, py::array_t<double> pyZ)
+    {
+    py::buffer_info xyInfo = pyXY.request();
+    py::buffer_info zInfo = pyZ.request();
+    const size_t n = CheckSamples(xyInfo, zInfo);
+    const double *xyPtr = static_cast<double *>(xyInfo.ptr);
+    const double *zPtr = static_cast<double *>(zInfo.ptr);
+    for (size_t i = 0; i < n; i++)
+        {
+        function_sampler_2d_add(sampler, xyPtr + 2*i, zPtr[i], 0);
+        }
+    }
+
+bool PyFunctionSampler2D::IsDone()
+    {
+    return function_sampler_2d_is_done(sampler);
+    }
+
+int PyFunctionSampler2D::GetNumRefine()
+    {
+    return function_sampler_2d_num_refine(sampler);
+    }
+
+py::array_t<double> PyFunctionSampler2D::GetNext(int pyN)
+    {
+    int n = pyN;
+    if (n <= 0)
+        {
+        n = function_sampler_2d_num_refine(sampler);
+        }
+    std::vector<double> xy(2*n + 2);
+    if (n > 0)
+        {
+        n = function_sampler_2d_get_refine(sampler, n, xy.data());
+        }
+    auto pyNext = py::array_t<double>({(size_t)n, (size_t)2});
+    if (n > 0)
+        {
+        memcpy(pyNext.mutable_data(), xy.data(), sizeof(double) * 2 * n);
+        }
+    return pyNext;
+    }
+
+std::tuple<py::array_t<double>, py::array_t<double>> PyFunctionSampler2D::GetSamples()
+    {
+    const size_t n = function_sampler_2d_num_samples(sampler);
+    auto pyXY = py::array_t<double>({n, (size_t)2});
+    auto pyZ = py::array_t<double>(n);
+    double *xyPtr = pyXY.mutable_data();
+    double *zPtr = pyZ.mutable_data();
+    for (size_t i = 0; i < n; i++)
+        {
+        int id;
+        function_sampler_2d_get(sampler, i, xyPtr + 2*i, zPtr + i, &id);
+        }
+    return std::make_tuple(pyXY, pyZ);
+    }
+
+py::array_t<int> PyFunctionSampler2D::GetTriangles()
+    {
+    const size_t n = function_sampler_2d_num_faces(sampler);
+    auto pyTri = py::array_t<int>({n, (size_t)3});
+    if (n > 0)
+        {
+        function_sampler_2d_get_faces(sampler, pyTri.mutable_data());
+        }
+    return pyTri;
     }
 
 PYBIND11_MODULE(_S4, m)
@@ -1048,6 +2585,9 @@ this module. End-users should use the python wrapper instead.";
     py::class_<PySimulation>(m, "S4_Simulation")
         .def(py::init<>())
         .def("_CreateNew", &PySimulation::CreateNew)
+        .def("_Clone", &PySimulation::Clone)
+        .def("_GetSpec", &PySimulation::GetSpec)
+        .def("_SetSpec", &PySimulation::SetSpec)
         .def("_AddMaterial", &PySimulation::AddMaterial)
         .def("_SetMaterial", &PySimulation::SetMaterial)
         .def("_SetLattice", &PySimulation::SetLattice)
@@ -1069,16 +2609,58 @@ this module. End-users should use the python wrapper instead.";
         .def("_UseJonesVectorBasis", &PySimulation::UseJonesVectorBasis)
         .def("_UseNormalVectorBasis", &PySimulation::UseNormalVectorBasis)
         .def("_UseExperimentalFMM", &PySimulation::UseExperimentalFMM)
+        .def("_UseLessMemory", &PySimulation::UseLessMemory)
+        .def("_UseHermitianEigensolver", &PySimulation::UseHermitianEigensolver)
+        .def("_UseSymmetry", &PySimulation::UseSymmetry)
+        .def("_SetNumModes", &PySimulation::SetNumModes)
         .def("_SetResolution", &PySimulation::SetResolution)
         .def("_TestArray", &PySimulation::TestArray)
         .def("_GetPoyntingFlux", &PySimulation::GetPoyntingFlux)
         .def("_GetPoyntingFluxByG", &PySimulation::GetPoyntingFluxByG)
         .def("_GetFieldAtPoint", &PySimulation::GetFieldAtPoint)
+        .def("_GetFieldsAtPoints", &PySimulation::GetFieldsAtPoints)
         .def("_GetFieldPlane", &PySimulation::GetFieldPlane)
+        .def("_GetFieldVolume", &PySimulation::GetFieldVolume)
         .def("_GetWaves", &PySimulation::GetWaves)
-        // .def("Clone", &S4_Simulation_Clone)
+        .def("_GetPropagationConstants", &PySimulation::GetPropagationConstants)
+        .def("_GetModeTruncation", &PySimulation::GetModeTruncation)
+        .def("_SweepFrequencies", &PySimulation::SweepFrequencies)
+        .def("_SweepLayerThickness", &PySimulation::SweepLayerThickness)
+        .def("_SweepAngles", &PySimulation::SweepAngles)
+        .def("_GetMemoryReport", &PySimulation::GetMemoryReport)
+        .def("_EstimatePeakMemory", &PySimulation::EstimatePeakMemory)
+        .def("_ResetProfile", &PySimulation::ResetProfile)
+        .def("_GetProfile", &PySimulation::GetProfile)
+        .def("_GetProfileEvents", &PySimulation::GetProfileEvents)
         // .def("New", &S4_Simulation_New)
         ;
+    m.def("_EstimatePeakMemory", &EstimatePeakMemory);
+    m.def("_SetLayerModesCacheBudget", &SetLayerModesCacheBudget);
+    m.def("_GetLayerModesCacheInfo", &GetLayerModesCacheInfo);
+    m.def("_ClearLayerModesCache", &Simulation_ClearModesCache);
+    m.def("_LoadFFTWisdom", &LoadFFTWisdom);
+    m.def("_SaveFFTWisdom", &SaveFFTWisdom);
+    m.def("_SetFFTPlannerEffort", &SetFFTPlannerEffort);
+    m.def("_SetFFTPlanCacheCapacity", &SetFFTPlanCacheCapacity);
+    m.def("_GetFFTPlanCacheInfo", &GetFFTPlanCacheInfo);
+    py::class_<PySpectrumSampler>(m, "S4_SpectrumSampler")
+        .def(py::init<double, double, int, double, double, double, bool>())
+        .def("_IsDone", &PySpectrumSampler::IsDone)
+        .def("_IsParallelized", &PySpectrumSampler::IsParallelized)
+        .def("_GetNumPoints", &PySpectrumSampler::GetNumPoints)
+        .def("_GetFrequency", &PySpectrumSampler::GetFrequency)
+        .def("_SubmitResult", &PySpectrumSampler::SubmitResult)
+        .def("_GetFrequencies", &PySpectrumSampler::GetFrequencies)
+        .def("_SubmitResults", &PySpectrumSampler::SubmitResults)
+        .def("_GetSpectrum", &PySpectrumSampler::GetSpectrum);
+    py::class_<PyFunctionSampler2D>(m, "S4_FunctionSampler2D")
+        .def(py::init<py::array_t<double>, py::array_t<double>, double, double, double, double>())
+        .def("_Add", &PyFunctionSampler2D::Add)
+        .def("_IsDone", &PyFunctionSampler2D::IsDone)
+        .def("_GetNumRefine", &PyFunctionSampler2D::GetNumRefine)
+        .def("_GetNext", &PyFunctionSampler2D::GetNext)
+        .def("_GetSamples", &PyFunctionSampler2D::GetSamples)
+        .def("_GetTriangles", &PyFunctionSampler2D::GetTriangles);
     // py::class_<Interpolator>(m, "Interpolator");
 
     // py::class_<data_point>(m, "data_point")
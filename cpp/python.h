@@ -2,6 +2,9 @@
 #define PYTHON_H
 
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+#include <mutex>
+#include <vector>
 
 namespace py = pybind11;
 
@@ -23,6 +26,7 @@ namespace py = pybind11;
 #include "convert.h"
 // #include "test_func.h"
 #include "SpectrumSampler.h"
+#include "function_sampler_2d.h"
 #include "cubature.h"
 #include "Interpolator.h"
 #include "rcwa.h"
@@ -36,6 +40,9 @@ class PySimulation
     PySimulation();
     ~PySimulation();
     void CreateNew();
+    PySimulation* Clone();
+    py::dict GetSpec();
+    void SetSpec(py::dict pySpec);
     struct EPSData
         {
         S4_real eps[18];
@@ -65,21 +72,76 @@ class PySimulation
     void UseJonesVectorBasis(bool pyUse);
     void UseNormalVectorBasis(bool pyUse);
     void UseExperimentalFMM(bool pyUse);
+    void UseLessMemory(bool pyUse);
+    void UseHermitianEigensolver(bool pyUse);
+    void UseSymmetry(int pyMirrors, int pyParity);
+    void SetNumModes(int pyNumModes);
     void SetResolution(int pyResolution);
     /* py::array_t<std::complex<double>> TestArray(); */
     py::array_t<double> TestArray();
     py::array_t<double> GetPoyntingFlux(std::string pyLayer, double pyZOffset);
-    py::array_t<double> GetPoyntingFluxByG(std::string pyLayer, double pyZOffset);
+    py::array_t<double> GetPoyntingFluxByG(std::string pyLayer, double pyZOffset, py::object pyOut);
     py::array_t<double> GetFieldAtPoint(py::array_t<double> pyPoint);
-    std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> GetFieldPlane(double pyZ, py::array_t<int> pyNUV);
-    py::array_t<double> GetWaves(std::string pyLayer);
+    std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> GetFieldsAtPoints(py::array_t<double> pyPoints);
+    std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> GetFieldPlane(double pyZ, py::array_t<int> pyNUV, py::object pyEOut, py::object pyHOut);
+    std::tuple<py::array_t<std::complex<double>>, py::array_t<std::complex<double>>> GetFieldVolume(py::array_t<double> pyZ, py::array_t<int> pyNUV, int pyNWorkers);
+    py::array_t<double> GetWaves(std::string pyLayer, py::object pyOut);
+    py::array_t<std::complex<double>> GetPropagationConstants(std::string pyLayer);
+    py::dict GetModeTruncation(std::string pyLayer);
+    py::array_t<double> SweepFrequencies(py::array_t<double> pyFreqs, std::vector<std::string> pyLayers, py::array_t<double> pyOffsets, int pyNWorkers);
+    std::tuple<py::array_t<double>, py::array_t<double>> SweepAngles(py::array_t<double> pyAngles, py::array_t<double> pyPolS, py::array_t<double> pyPolP, int pyOrder, std::vector<std::string> pyLayers, py::array_t<double> pyOffsets, bool pyByG, int pyNWorkers);
+    py::array_t<double> SweepLayerThickness(std::string pyLayer, py::array_t<double> pyThicknesses, std::vector<std::string> pyLayers, py::array_t<double> pyOffsets);
+    py::dict GetMemoryReport();
+    size_t EstimatePeakMemory();
+    void ResetProfile(bool pyTrace);
+    py::dict GetProfile();
+    py::list GetProfileEvents();
 
 
     private:
     S4_Simulation* S;
+    // serializes solves on this simulation once the GIL is released;
+    // distinct simulations never share it
+    std::mutex mutex;
     double *Lr;//[4];
     unsigned int nG;
     /* static char *kwlist[] = {"Lattice", "NumBasis", NULL}; */
     };
 
+// python wrapper around the adaptive SpectrumSampler
+class PySpectrumSampler
+    {
+    public:
+    PySpectrumSampler(double pyX0, double pyX1, int pyInitialNumPoints, double pyRangeThreshold, double pyMaxBend, double pyMinDx, bool pyParallelize);
+    ~PySpectrumSampler();
+    bool IsDone();
+    bool IsParallelized();
+    int GetNumPoints();
+    double GetFrequency();
+    bool SubmitResult(double pyY);
+    py::array_t<double> GetFrequencies();
+    bool SubmitResults(py::array_t<double> pyY);
+    py::array_t<double> GetSpectrum();
+
+    private:
+    SpectrumSampler sampler;
+    };
+
+// python wrapper around the adaptive 2D function sampler
+class PyFunctionSampler2D
+    {
+    public:
+    PyFunctionSampler2D(py::array_t<double> pyXY, py::array_t<double> pyZ, double pyZTolAbs, double pyZTolRel, double pyMaxBend, double pyXYTol);
+    ~PyFunctionSampler2D();
+    void Add(py::array_t<double> pyXY, py::array_t<double> pyZ);
+    bool IsDone();
+    int GetNumRefine();
+    py::array_t<double> GetNext(int pyN);
+    std::tuple<py::array_t<double>, py::array_t<double>> GetSamples();
+    py::array_t<int> GetTriangles();
+
+    private:
+    function_sampler_2d sampler;
+    };
+
 #endif
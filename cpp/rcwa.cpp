@@ -20,12 +20,15 @@
 #include "config.h"
 
 #define _USE_MATH_DEFINES
+#include <algorithm>
 #include <cmath>
 #include <cstdlib>
 #include <cstring>
+#include <vector>
 #include <float.h>
 #include "rcwa.h"
 #include "fmm/fft_iface.h"
+#include "profile.h"
 #include <TBLAS.h>
 #ifdef HAVE_BLAS
 # include <TBLAS_ext.h>
@@ -34,6 +37,7 @@
 #ifdef HAVE_LAPACK
 # include <LinearSolve_lapack.h>
 # include <Eigensystems_lapack.h>
+# include <IRA.hpp>
 #else
 # include <Eigensystems.h>
 #endif
@@ -66,6 +70,10 @@ static inline void rcwa_free(void *ptr){
     std::complex<double> *work, const integer &lwork,
     double *rwork, integer *info
   );
+  extern "C" void zpotrf_(
+    const char *uplo, const integer &n,
+    std::complex<double> *a, const integer &lda, integer *info
+  );
 #endif
 
 static void SingularLinearSolve(
@@ -685,6 +693,382 @@ void SolveLayerEigensystem_real(
 }
 #endif // HAVE_LAPACK
 
+// Whether a matrix of nblocks x nblocks blocks, each 2n x 2n and indexed by
+// the x and y components of the G-vectors, has no entries coupling an x
+// component to a y component.
+static bool IsPolarizationDecoupled(size_t n, size_t nblocks, const std::complex<double> *a, size_t lda){
+  const size_t N = 2*n*nblocks;
+  for(size_t j = 0; j < N; ++j){
+    const size_t pj = (j / n) % 2;
+    for(size_t i = 0; i < N; ++i){
+      if((i / n) % 2 != pj && std::complex<double>(0) != a[i+j*lda]){
+        return false;
+      }
+    }
+  }
+  return true;
+}
+
+static bool AllZero(size_t n, const double *x){
+  for(size_t i = 0; i < n; ++i){
+    if(0 != x[i]){ return false; }
+  }
+  return true;
+}
+
+// Whether the modes of a layer split into two independent problems of size
+// n: when all ky are zero, as for a 1D lattice with in-plane incidence, kp
+// is block diagonal, and so is the eigenoperator if Epsilon2 is.
+static bool IsDecoupledLayer(size_t n, const double *ky, const std::complex<double> *Epsilon2, int epstype){
+  return EPSILON2_TYPE_FULL == epstype && AllZero(n, ky)
+    && IsPolarizationDecoupled(n, 1, Epsilon2, 2*n);
+}
+
+// Whether the S-matrix of a stack splits into two independent problems of
+// size n, one for each of the blocks of the layer modes. The modes of
+// uniform layers (phi == NULL) do not couple the blocks.
+static bool IsDecoupledStack(size_t nlayers, size_t n, const double *ky, const std::complex<double> **phi){
+  if(!AllZero(n, ky)){ return false; }
+  for(size_t l = 0; l < nlayers; ++l){
+    if(NULL != phi[l] && !IsPolarizationDecoupled(n, 1, phi[l], 2*n)){
+      return false;
+    }
+  }
+  return true;
+}
+
+// Fills the diagonal block of kp starting at off (0 or n) of a decoupled
+// layer, where kp = diag(omega^2, omega^2 - kx Epsilon_inv kx).
+static void MakeKPMatrixBlock(
+  std::complex<double> omega,
+  size_t n,
+  const double *kx,
+  const std::complex<double> *Epsilon_inv,
+  int epstype,
+  size_t off,
+  std::complex<double> *kp,
+  size_t ldkp
+){
+  const std::complex<double> omega2 = omega*omega;
+  if(0 == off){
+    RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,omega2, kp,ldkp);
+  }else if(EPSILON2_TYPE_BLKDIAG1_SCALAR == epstype || EPSILON2_TYPE_BLKDIAG2_SCALAR == epstype){
+    RNP::TBLAS::SetMatrix<'A'>(n,n, 0.,0., kp,ldkp);
+    for(size_t i = 0; i < n; ++i){
+      kp[i+i*ldkp] = omega2 - kx[i]*Epsilon_inv[0]*kx[i];
+    }
+  }else{
+    for(size_t j = 0; j < n; ++j){
+      for(size_t i = 0; i < n; ++i){
+        kp[i+j*ldkp] = -kx[i]*Epsilon_inv[i+j*n]*kx[j];
+      }
+      kp[j+j*ldkp] += omega2;
+    }
+  }
+}
+
+// Whether a is Hermitian up to rounding in the computation of the
+// Fourier coefficients and of Epsilon_inv.
+static bool IsHermitian(size_t n, const std::complex<double> *a, size_t lda){
+  double amax = 0;
+  for(size_t j = 0; j < n; ++j){
+    for(size_t i = 0; i < n; ++i){
+      const double aij = std::abs(a[i+j*lda]);
+      if(aij > amax){ amax = aij; }
+    }
+  }
+  const double tol = 1e-11 * amax;
+  for(size_t j = 0; j < n; ++j){
+    for(size_t i = j; i < n; ++i){
+      if(std::abs(a[i+j*lda] - std::conj(a[j+i*lda])) > tol){
+        return false;
+      }
+    }
+  }
+  return true;
+}
+
+#ifdef HAVE_LAPACK
+// Whether neither Q nor kp of SolveLayerEigensystem_hermitian can be
+// positive definite over the components off..off+m-1, judging from their
+// diagonals, which are positive for a positive definite matrix. Their
+// diagonal entries are
+//   Q:  Epsilon2 - kx^2 / omega^2 and Epsilon2 - ky^2 / omega^2
+//   kp: omega^2 - ky^2 Epsilon_inv and omega^2 - kx^2 Epsilon_inv
+// so this holds as soon as an order is evanescent, which is the common
+// case, and is found in O(m) instead of by the Cholesky factorizations.
+static bool IsPencilIndefinite(
+  double omega, size_t n, const double *kx, const double *ky,
+  const std::complex<double> *Epsilon_inv,
+  const std::complex<double> *Epsilon2,
+  size_t off, size_t m
+){
+  const double omega2 = omega*omega;
+  bool Q_positive = true, kp_positive = true;
+  for(size_t i = off; i < off+m; ++i){
+    const size_t g = (i < n ? i : i-n);
+    const double kQ = (i < n ? kx[g] : ky[g]);
+    const double kkp = (i < n ? ky[g] : kx[g]);
+    if(Epsilon2[i+i*2*n].real() - kQ*kQ / omega2 <= 0){
+      Q_positive = false;
+    }
+    if(omega2 - kkp*kkp*Epsilon_inv[g+g*n].real() <= 0){
+      kp_positive = false;
+    }
+    if(!Q_positive && !kp_positive){
+      return true;
+    }
+  }
+  return false;
+}
+
+// Solves Q*kp phi = phi diag(q^2) for Hermitian Q and kp of size m, one of
+// which must be positive definite. Factor whichever of Q and kp is positive
+// definite as F F^H. The eigenvectors of the Hermitian matrix C = F^H B F,
+// where B is the other one, are then related to those of Q*kp by phi = F C
+// if F factors Q, or phi = F^{-H} C if F factors kp, with the same
+// eigenvalues. work must hold 2*m*m complex and m real numbers.
+// Returns 0 on success, 1 if the conditions do not hold, or 2 if the
+// Hermitian eigensolver failed.
+static int SolveHermitianPencil(
+  size_t m,
+  const std::complex<double> *Q, size_t ldQ,
+  const std::complex<double> *kp, size_t ldkp,
+  std::complex<double> *q,
+  std::complex<double> *phi, size_t ldphi,
+  std::complex<double> *work
+){
+  if(!IsHermitian(m, Q, ldQ) || !IsHermitian(m, kp, ldkp)){
+    return 1;
+  }
+  std::complex<double> *F = work; // Cholesky factor
+  std::complex<double> *C = F + m*m;
+  double *lambda = (double*)(C + m*m);
+
+  integer info;
+  bool factored_Q = true;
+  RNP::TBLAS::CopyMatrix<'A'>(m,m, Q,ldQ, F,m);
+  zpotrf_("L", m, F, m, &info);
+  if(0 != info){
+    factored_Q = false;
+    RNP::TBLAS::CopyMatrix<'A'>(m,m, kp,ldkp, F,m);
+    zpotrf_("L", m, F, m, &info);
+  }
+  if(0 != info){
+    return 1;
+  }
+  for(size_t j = 1; j < m; ++j){
+    RNP::TBLAS::Fill(j, 0., &F[0+j*m], 1);
+  }
+  if(factored_Q){
+    RNP::TBLAS::CopyMatrix<'A'>(m,m, kp,ldkp, C,m);
+  }else{
+    RNP::TBLAS::CopyMatrix<'A'>(m,m, Q,ldQ, C,m);
+  }
+  RNP::TBLAS::MultTrM<'R','L','N','N'>(m,m, 1.,F,m, C,m);
+  RNP::TBLAS::MultTrM<'L','L','C','N'>(m,m, 1.,F,m, C,m);
+  info = RNP::HermitianEigensystem<'L'>(m, C, m, lambda);
+  if(0 != info){
+    return 2;
+  }
+  RNP::TBLAS::CopyMatrix<'A'>(m,m, C,m, phi,ldphi);
+  if(factored_Q){
+    RNP::TBLAS::MultTrM<'L','L','N','N'>(m,m, 1.,F,m, phi,ldphi);
+  }else{
+    RNP::TBLAS::SolveTrM<'L','L','C','N'>(m,m, 1.,F,m, phi,ldphi);
+  }
+  for(size_t i = 0; i < m; ++i){
+    q[i] = std::sqrt(std::complex<double>(lambda[i]));
+    if(q[i].imag() < 0){
+      q[i] = -q[i];
+    }
+  }
+  return 0;
+}
+#endif // HAVE_LAPACK
+
+int SolveLayerEigensystem_hermitian(
+  double omega,
+  size_t n,
+  const double *kx,
+  const double *ky,
+  const std::complex<double> *Epsilon_inv,
+  const std::complex<double> *Epsilon2,
+  int epstype,
+  std::complex<double> *q,
+  std::complex<double> *kp,
+  std::complex<double> *phi
+){
+#ifdef HAVE_LAPACK
+  if(EPSILON2_TYPE_FULL != epstype || 0 == omega || NULL == phi){
+    return 1;
+  }
+  const bool decoupled = IsDecoupledLayer(n, ky, Epsilon2, epstype);
+  if(decoupled
+    ? (IsPencilIndefinite(omega, n, kx, ky, Epsilon_inv, Epsilon2, 0, n)
+      || IsPencilIndefinite(omega, n, kx, ky, Epsilon_inv, Epsilon2, n, n))
+    : IsPencilIndefinite(omega, n, kx, ky, Epsilon_inv, Epsilon2, 0, 2*n)){
+    return 1;
+  }
+  const size_t n2 = 2*n;
+  const size_t n22 = n2*n2;
+
+  const size_t nwork = n22 + (NULL == kp ? n22 : 0);
+  std::complex<double> *work = (std::complex<double>*)rcwa_malloc(
+    sizeof(std::complex<double>) * (nwork + 2*n22) + sizeof(double) * n2
+  );
+  std::complex<double> *Q = work;
+  std::complex<double> *kp_use = (NULL != kp ? kp : Q + n22);
+  std::complex<double> *pencil_work = work + nwork;
+
+  MakeKPMatrix(omega, n, kx, ky, Epsilon_inv, epstype, NULL, kp_use, n2);
+
+  // Since [ky -kx] kp = omega^2 [ky -kx] and [kx ky] kp = omega^2 [kx ky],
+  // the eigenoperator Epsilon2*kp - [kx;ky][kx ky] factors as Q*kp with
+  //   Q = Epsilon2 - [kx;ky][kx ky] / omega^2
+  const double omega2 = omega*omega;
+  RNP::TBLAS::CopyMatrix<'A'>(n2,n2, Epsilon2,n2, Q,n2);
+  for(size_t i = 0; i < n; ++i){
+    Q[i+i*n2] -= kx[i]*kx[i] / omega2;
+    Q[i+n+i*n2] -= ky[i]*kx[i] / omega2;
+    Q[i+(i+n)*n2] -= kx[i]*ky[i] / omega2;
+    Q[i+n+(i+n)*n2] -= ky[i]*ky[i] / omega2;
+  }
+
+  int ret;
+  if(decoupled){
+    // Q and kp are block diagonal, so are the eigenvectors
+    RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,0., phi,n2);
+    ret = SolveHermitianPencil(n, Q,n2, kp_use,n2, q, phi,n2, pencil_work);
+    if(0 == ret){
+      ret = SolveHermitianPencil(n, &Q[n+n*n2],n2, &kp_use[n+n*n2],n2, q+n, &phi[n+n*n2],n2, pencil_work);
+    }
+  }else{
+    ret = SolveHermitianPencil(n2, Q,n2, kp_use,n2, q, phi,n2, pencil_work);
+  }
+  rcwa_free(work);
+  return ret;
+#else
+  return 1;
+#endif
+}
+
+#ifdef HAVE_LAPACK
+// Whether the Fourier coupling matrices of a layer are real.
+static bool IsRealLayer(size_t n, const std::complex<double> *Epsilon_inv, const std::complex<double> *Epsilon2){
+  for(size_t i = 0; i < n*n; ++i){
+    if(0 != Epsilon_inv[i].imag()){ return false; }
+  }
+  for(size_t i = 0; i < 4*n*n; ++i){
+    if(0 != Epsilon2[i].imag()){ return false; }
+  }
+  return true;
+}
+#endif // HAVE_LAPACK
+
+// Takes the square roots of the eigenvalues q^2 of a layer.
+static void EigenvaluesToQ(std::complex<double> omega, size_t n2, std::complex<double> *q){
+  for(size_t i = 0; i < n2; ++i){
+    if(0 == omega.imag()){ // Not bandsolving
+      q[i] = std::sqrt(q[i]);
+      if(q[i].imag() < 0){
+        q[i] = -q[i];
+      }
+    }else{ // performing some kind of bandsolving, need to choose the appropriate branch
+      if(q[i].real() < 0){
+        // branch cut should be just below positive real axis
+        q[i] = std::complex<double>(0,1) * std::sqrt(-q[i]);
+      }else{
+        // branch cut should be just below negative real axis
+        // This is the default behavior for sqrt(std::complex)
+        q[i] = std::sqrt(q[i]);
+      }
+    }
+  }
+}
+
+// Solves the eigensystem of a decoupled layer (see IsDecoupledLayer) as two
+// problems of size n. With ky = 0, the eigenoperator is
+//   [ omega^2 Epsilon2_xx - kx^2                     ]
+//   [                             Epsilon2_yy kp_yy  ]
+// and phi is block diagonal.
+static void SolveLayerEigensystem_decoupled(
+  std::complex<double> omega,
+  size_t n,
+  const double *kx,
+  const double *ky,
+  const std::complex<double> *Epsilon_inv,
+  const std::complex<double> *Epsilon2,
+  int epstype,
+  std::complex<double> *q,
+  std::complex<double> *kp,
+  std::complex<double> *phi
+){
+  const size_t n2 = 2*n;
+  if(NULL != kp){
+    MakeKPMatrix(omega, n, kx, ky, Epsilon_inv, epstype, NULL, kp, n2);
+  }
+
+  size_t lwork = (size_t)-1;
+  std::complex<double> dum;
+  double rdum;
+  RNP::Eigensystem(n, NULL, n, q, NULL, 1, phi, n2, &dum, &rdum, lwork);
+  const size_t eigenlwork = (size_t)dum.real();
+  std::complex<double> *work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*(2*n*n + eigenlwork));
+  std::complex<double> *op = work;
+  std::complex<double> *kpblock = op + n*n;
+  std::complex<double> *eigenwork = kpblock + n*n;
+  double *rwork = (double*)rcwa_malloc(sizeof(double)*2*n);
+
+#ifdef HAVE_LAPACK
+  // Real layers use real arithmetic, as SolveLayerEigensystem does for the
+  // coupled problem. The eigenvalues of propagating modes are then exactly
+  // real, so that they get the same q > 0, and the same split into forward
+  // and backward modes, as in the coupled problem.
+  const bool real = (n > 10 && 0 == omega.imag() && IsRealLayer(n, Epsilon_inv, Epsilon2));
+  double *rop = NULL, *reigenwork = NULL;
+  size_t reigenlwork = 0;
+  if(real){
+    double tmp;
+    RNP::Eigensystem_real(n, NULL, n, q, NULL, 1, phi, n2, &tmp, (size_t)-1);
+    reigenlwork = (size_t)tmp;
+    rop = (double*)rcwa_malloc(sizeof(double)*(n*n + reigenlwork));
+    reigenwork = rop + n*n;
+  }
+#endif
+
+  RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,0., phi,n2);
+  for(size_t off = 0; off < n2; off += n){
+    MakeKPMatrixBlock(omega, n, kx, Epsilon_inv, epstype, off, kpblock, n);
+    RNP::TBLAS::MultMM<'N','N'>(n,n,n, std::complex<double>(1.),&Epsilon2[off+off*n2],n2, kpblock,n, std::complex<double>(0.),op,n);
+    if(0 == off){
+      for(size_t i = 0; i < n; ++i){
+        op[i+i*n] -= kx[i]*kx[i];
+      }
+    }
+    int info;
+#ifdef HAVE_LAPACK
+    if(real){
+      for(size_t i = 0; i < n*n; ++i){
+        rop[i] = op[i].real();
+      }
+      info = RNP::Eigensystem_real(n, rop, n, q+off, NULL, 1, &phi[off+off*n2], n2, reigenwork, reigenlwork);
+    }else
+#endif
+    info = RNP::Eigensystem(n, op, n, q+off, NULL, 1, &phi[off+off*n2], n2, eigenwork, rwork, eigenlwork);
+    if(0 != info){
+      fprintf(stderr, "Layer eigensystem returned info = %d\n", info);
+    }
+  }
+  EigenvaluesToQ(omega, n2, q);
+
+#ifdef HAVE_LAPACK
+  rcwa_free(rop);
+#endif
+  rcwa_free(rwork);
+  rcwa_free(work);
+}
+
 void SolveLayerEigensystem(
   std::complex<double> omega,
   size_t n,
@@ -702,24 +1086,13 @@ void SolveLayerEigensystem(
 ){
   const size_t n2 = 2*n;
 
-#ifdef HAVE_LAPACK
-  bool isreal = (n > 10);
-  for(size_t j = 0; j < n && isreal; ++j){
-    for(size_t i = 0; i < n; ++i){
-      if(0 != Epsilon_inv[i+j*n].imag()){
-        isreal = false;
-        break;
-      }
-    }
-  }
-  for(size_t j = 0; j < n2 && isreal; ++j){
-    for(size_t i = 0; i < n2; ++i){
-      if(0 != Epsilon2[i+j*n2].imag()){
-        isreal = false;
-        break;
-      }
-    }
+  if((size_t)-1 != lwork && NULL != phi && IsDecoupledLayer(n, ky, Epsilon2, epstype)){
+    SolveLayerEigensystem_decoupled(omega, n, kx, ky, Epsilon_inv, Epsilon2, epstype, q, kp, phi);
+    return;
   }
+
+#ifdef HAVE_LAPACK
+  const bool isreal = (n > 10 && IsRealLayer(n, Epsilon_inv, Epsilon2));
   if(isreal && 0 == omega.imag() && EPSILON2_TYPE_FULL == epstype){
     SolveLayerEigensystem_real(
       omega.real(), n, kx, ky, Epsilon_inv, Epsilon2,
@@ -846,24 +1219,8 @@ void SolveLayerEigensystem(
 # endif
 #endif
 
-  for(size_t i = 0; i < n2; ++i){
-    // Set the \hat{q} vector (diagonal matrix) while we're at it
-    if(0 == omega.imag()){ // Not bandsolving
-      q[i] = std::sqrt(q[i]);
-      if(q[i].imag() < 0){
-        q[i] = -q[i];
-      }
-    }else{ // performing some kind of bandsolving, need to choose the appropriate branch
-      if(q[i].real() < 0){
-        // branch cut should be just below positive real axis
-        q[i] = std::complex<double>(0,1) * std::sqrt(-q[i]);
-      }else{
-        // branch cut should be just below negative real axis
-        // This is the default behavior for sqrt(std::complex)
-        q[i] = std::sqrt(q[i]);
-      }
-    }
-  }
+  // Set the \hat{q} vector (diagonal matrix) while we're at it
+  EigenvaluesToQ(omega, n2, q);
 #ifdef DUMP_MATRICES
   DUMP_STREAM << "q:" << std::endl;
   RNP::IO::PrintVector(n2,q,1, DUMP_STREAM) << std::endl << std::endl;
@@ -884,61 +1241,445 @@ void SolveLayerEigensystem(
 }
 
 
-void InitSMatrix(
-  size_t n,
-  std::complex<double> *S // size (4*n)^2
-){
-  const size_t n4 = 4*n;
-  RNP::TBLAS::SetMatrix<'A'>(n4,n4, 0.,1., S, n4);
-}
-void GetSMatrix(size_t nlayers,
-    size_t n, // glist.n
-    const double *kx, const double *ky,
-    std::complex<double> omega,
-    const double *thickness, // list of thicknesses
-    const std::complex<double> **q, // list of q vectors
-    const std::complex<double> **Epsilon_inv, // size (glist.n)^2; inv of usual dielectric Fourier coupling matrix
-    int *epstype,
-    const std::complex<double> **kp,
-    const std::complex<double> **phi,
-    std::complex<double> *S, // size (4*n)^2
-    std::complex<double> *work_,
-    size_t *iwork,
-    size_t lwork)
-    {
-    if(0 == nlayers)
-        {
-        return;
-        }
-    const size_t n2 = 2*n;
-    const size_t n4 = 2*n2;
-
-    if((size_t)-1 == lwork)
-        {
-        work_[0] = n4*(n4+1);
-        return;
-        }
-    std::complex<double> *work = work_;
-    if(NULL == work_ || lwork < n4*(n4+1))
-        {
-        work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*(n4*(n4+1)));
-        }
-    size_t *pivots = iwork;
-    if(NULL == iwork)
-        {
-        pivots = (size_t*)rcwa_malloc(sizeof(size_t)*n4);
-        }
+#ifdef HAVE_LAPACK
+// The eigenoperator Epsilon2*kp - [kx;ky][kx ky] of a layer (or its
+// adjoint), applied to vectors without forming it, for the Arnoldi
+// iteration. The wanted eigenvalues q^2 are those with the smallest |Im q|,
+// which is the same set for the operator and its adjoint.
+class LayerEigenoperator : public IRA::ComplexEigensystem{
+  const std::complex<double> omega;
+  const size_t n;
+  const double *kx, *ky;
+  const std::complex<double> *Epsilon_inv, *Epsilon2;
+  const int epstype;
+  const bool adjoint;
+  std::complex<double> *t; // length 2n
+public:
+  LayerEigenoperator(
+    std::complex<double> omega, size_t n, const double *kx, const double *ky,
+    const std::complex<double> *Epsilon_inv, const std::complex<double> *Epsilon2,
+    int epstype, bool adjoint, size_t nmodes, size_t narnoldi,
+    const IRA::ComplexEigensystem::Params &params, std::complex<double> *resid0
+  ):ComplexEigensystem(2*n, nmodes, narnoldi, false, 0., params, resid0),
+    omega(omega), n(n), kx(kx), ky(ky),
+    Epsilon_inv(Epsilon_inv), Epsilon2(Epsilon2), epstype(epstype),
+    adjoint(adjoint)
+  {
+    t = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>) * 2*n);
+  }
+  ~LayerEigenoperator(){ rcwa_free(t); }
 
-    RNP::TBLAS::SetMatrix<'A'>(n4,n4, 0.,1., S, n4);
+  void Apply(const std::complex<double> *x, std::complex<double> *y) const{
+    const size_t n2 = 2*n;
+    if(adjoint){
+      // MultKPMatrix takes omega^2 as is on the diagonal of kp^H
+      RNP::TBLAS::MultMV<'C'>(n2,n2, std::complex<double>(1.),Epsilon2,n2, x,1, std::complex<double>(0.),t,1);
+      MultKPMatrix("C", std::conj(omega), n, kx, ky, Epsilon_inv, epstype, NULL, 1, t,n2, y,n2);
+    }else{
+      MultKPMatrix("N", omega, n, kx, ky, Epsilon_inv, epstype, NULL, 1, x,n2, t,n2);
+      RNP::TBLAS::MultMV<'N'>(n2,n2, std::complex<double>(1.),Epsilon2,n2, t,1, std::complex<double>(0.),y,1);
+    }
+    for(size_t i = 0; i < n; ++i){
+      const std::complex<double> kdotx = kx[i]*x[i] + ky[i]*x[n+i];
+      y[i] -= kx[i]*kdotx;
+      y[n+i] -= ky[i]*kdotx;
+    }
+  }
+  static double ImQ(const std::complex<double> &q2){
+    return std::abs(std::sqrt(q2).imag());
+  }
 
-    std::complex<double> *t1 = work;
-    std::complex<double> *t2 = t1 + n2*n2;
-    std::complex<double> *in1 = t2 + n2*n2;
-    std::complex<double> *in2 = in1 + n2*n2;
-    std::complex<double> *d1 = in2 + n2*n2;
-    std::complex<double> *d2 = d1 + n2;
+  bool IsOpInPlace() const{ return false; }
+  void ApplyOp(size_t, const std::complex<double> *x, std::complex<double> *y){ Apply(x, y); }
+  bool IsBInPlace() const{ return true; }
+  void ApplyB(size_t, const std::complex<double> *, std::complex<double> *){}
+  void GetShifts(size_t, const std::complex<double> *, std::complex<double> *) const{}
+  bool EigenvalueCompare(const std::complex<double> &a, const std::complex<double> &b) const{
+    return ImQ(a) > ImQ(b);
+  }
+};
 
-    for(size_t l = 0; l < nlayers-1; ++l)
+// A fixed pseudorandom starting vector, so that the modes are reproducible
+// and no symmetry sector is left out.
+static void LayerStartVector(size_t n2, std::complex<double> *v){
+  unsigned int seed = 12345;
+  for(size_t i = 0; i < n2; ++i){
+    double r[2];
+    for(int j = 0; j < 2; ++j){
+      seed = 1103515245u * seed + 12345u;
+      r[j] = (double)(seed >> 8) / (double)(1u << 24) - 0.5;
+    }
+    v[i] = std::complex<double>(r[0], r[1]);
+  }
+}
+#endif
+
+int SolveLayerEigensystem_partial(
+  std::complex<double> omega,
+  size_t n,
+  const double *kx,
+  const double *ky,
+  const std::complex<double> *Epsilon_inv,
+  const std::complex<double> *Epsilon2,
+  int epstype,
+  size_t *nmodes_,
+  std::complex<double> *q,
+  std::complex<double> *kp,
+  std::complex<double> *phi,
+  double *residual,
+  double *approx_residual
+){
+#ifdef HAVE_LAPACK
+  const size_t n2 = 2*n;
+  // A few more modes than asked for, so that the truncation does not cut
+  // through a set of degenerate modes.
+  const size_t nwant = *nmodes_ + 8;
+  const size_t narnoldi = (nwant > 16 ? 2*nwant+16 : nwant+16);
+  // The restarted iteration loses to the dense solver once the Arnoldi
+  // basis is about a third of the problem, and sooner with a threaded
+  // BLAS, which speeds up the dense solver more (timed at n2 = 394, 770).
+  if(EPSILON2_TYPE_FULL != epstype || NULL == phi || 0 == *nmodes_ || 8*narnoldi > n2
+    || IsDecoupledLayer(n, ky, Epsilon2, epstype)){
+    return 1;
+  }
+
+  std::complex<double> *resid0 = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>) * n2);
+  IRA::ComplexEigensystem::Params params;
+  params.max_iterations = 300 + 4*nwant;
+  params.tol = 1e-12;
+  LayerStartVector(n2, resid0);
+  LayerEigenoperator op(omega, n, kx, ky, Epsilon_inv, Epsilon2, epstype,
+    false, nwant, narnoldi, params, resid0);
+  if(op.GetConvergedCount() < nwant){
+    rcwa_free(resid0);
+    return 2;
+  }
+  // The left eigenvectors of the same modes, to project the approximate
+  // modes below onto the complementary invariant subspace.
+  LayerStartVector(n2, resid0);
+  LayerEigenoperator adj(omega, n, kx, ky, Epsilon_inv, Epsilon2, epstype,
+    true, nwant, narnoldi, params, resid0);
+  if(adj.GetConvergedCount() < nwant){
+    rcwa_free(resid0);
+    return 2;
+  }
+  // Sort both sets of modes by |Im q| and extend the truncation past
+  // any modes of (nearly) equal decay.
+  std::vector<size_t> right(nwant), left(nwant);
+  for(size_t i = 0; i < nwant; ++i){ right[i] = left[i] = i; }
+  {
+    const std::complex<double> *lr = op.GetEigenvalues();
+    const std::complex<double> *ll = adj.GetEigenvalues();
+    std::sort(right.begin(), right.end(), [lr](size_t a, size_t b){
+      return LayerEigenoperator::ImQ(lr[a]) < LayerEigenoperator::ImQ(lr[b]);
+    });
+    std::sort(left.begin(), left.end(), [ll](size_t a, size_t b){
+      return LayerEigenoperator::ImQ(ll[a]) < LayerEigenoperator::ImQ(ll[b]);
+    });
+  }
+  // Propagating modes of a lossless layer all have Im q = 0 up to
+  // rounding, so |Im q| is compared relative to at least |omega|.
+  size_t nmodes = *nmodes_;
+  const double imq_scale = std::abs(omega);
+  for(; nmodes < nwant; ++nmodes){
+    const double a = LayerEigenoperator::ImQ(op.GetEigenvalues()[right[nmodes-1]]);
+    const double b = LayerEigenoperator::ImQ(op.GetEigenvalues()[right[nmodes]]);
+    if(b - a > 1e-6 * std::max(b, imq_scale)){ break; }
+  }
+  if(nwant == nmodes){
+    rcwa_free(resid0);
+    return 2;
+  }
+  *nmodes_ = nmodes;
+  for(size_t i = 0; i < nmodes; ++i){
+    RNP::TBLAS::Copy(n2, &op.GetEigenvectors()[0+right[i]*n2],1, &phi[0+i*n2],1);
+    q[i] = op.GetEigenvalues()[right[i]];
+  }
+
+  std::complex<double> *work = (std::complex<double>*)rcwa_malloc(
+    sizeof(std::complex<double>) * (n2 + n2*nmodes)
+  );
+  std::complex<double> *kpcol = work;
+  std::complex<double> *rows = work + n2;
+
+  // Residuals of the computed pairs
+  double maxres = 0;
+  double imq_max = 0;
+  for(size_t i = 0; i < nmodes; ++i){
+    op.Apply(&phi[0+i*n2], rows);
+    RNP::TBLAS::Axpy(n2, -q[i], &phi[0+i*n2],1, rows,1);
+    maxres = std::max(maxres, RNP::TBLAS::Norm2(n2, rows,1));
+    imq_max = std::max(imq_max, LayerEigenoperator::ImQ(q[i]));
+  }
+
+  // Pair each left eigenvector with the right one of nearest eigenvalue
+  // and form W = (U^H phi)^-1 U^H, so that I - phi W is the projector
+  // onto the invariant subspace of the omitted modes along the computed
+  // ones; also W op = diag(q) W.
+  std::vector<std::complex<double> > W(nmodes*n2);
+  std::vector<std::complex<double> > G(nmodes*nmodes);
+  {
+    const std::complex<double> *mu = adj.GetEigenvalues();
+    const std::complex<double> *U = adj.GetEigenvectors();
+    std::vector<bool> used(nmodes, false);
+    for(size_t i = 0; i < nmodes; ++i){
+      size_t p = nmodes;
+      for(size_t j = 0; j < nmodes; ++j){
+        if(!used[j] && (nmodes == p ||
+          std::abs(std::conj(mu[left[j]]) - q[i]) < std::abs(std::conj(mu[left[p]]) - q[i]))){
+          p = j;
+        }
+      }
+      used[p] = true;
+      p = left[p];
+      for(size_t l = 0; l < n2; ++l){
+        W[i+l*nmodes] = std::conj(U[l+p*n2]);
+      }
+    }
+  }
+  RNP::TBLAS::MultMM<'N','N'>(nmodes,nmodes,n2, 1.,&W[0],nmodes, phi,n2, 0.,&G[0],nmodes);
+  int info = 0;
+  RNP::LinearSolve<'N'>(nmodes, n2, &G[0], nmodes, &W[0], nmodes, &info);
+  if(0 != info){
+    rcwa_free(work);
+    rcwa_free(resid0);
+    return 2;
+  }
+
+  // Complete the basis with the unit vectors of the rows of phi that are
+  // least represented in the computed modes: greedily pick the row of
+  // largest norm and orthogonalize the remaining rows against it.
+  std::vector<double> norms(n2);
+  std::vector<bool> picked(n2, false);
+  for(size_t i = 0; i < n2; ++i){
+    for(size_t c = 0; c < nmodes; ++c){
+      rows[c+i*nmodes] = phi[i+c*n2];
+    }
+    norms[i] = RNP::TBLAS::Norm2(nmodes, &rows[0+i*nmodes],1);
+  }
+  for(size_t s = 0; s < nmodes; ++s){
+    size_t p = n2;
+    for(size_t i = 0; i < n2; ++i){
+      if(!picked[i] && (n2 == p || norms[i] > norms[p])){ p = i; }
+    }
+    picked[p] = true;
+    if(0 == norms[p]){ continue; }
+    std::complex<double> *u = &rows[0+p*nmodes];
+    RNP::TBLAS::Scale(nmodes, 1./norms[p], u,1);
+    for(size_t i = 0; i < n2; ++i){
+      if(picked[i]){ continue; }
+      std::complex<double> *r = &rows[0+i*nmodes];
+      std::complex<double> dot = 0;
+      for(size_t c = 0; c < nmodes; ++c){
+        dot += std::conj(u[c]) * r[c];
+      }
+      RNP::TBLAS::Axpy(nmodes, -dot, u,1, r,1);
+      norms[i] = RNP::TBLAS::Norm2(nmodes, r,1);
+    }
+  }
+  // The remaining rows are grouped into clusters of Fourier orders of
+  // nearly equal |k|, which the eigenoperator couples most strongly. The
+  // eigenoperator, projected by I - phi W, is restricted to each cluster
+  // and diagonalized, and the resulting modes projected likewise. The
+  // coupling between clusters is neglected.
+  std::vector<size_t> order(n);
+  for(size_t i = 0; i < n; ++i){ order[i] = i; }
+  std::sort(order.begin(), order.end(), [kx,ky](size_t a, size_t b){
+    return kx[a]*kx[a]+ky[a]*ky[a] < kx[b]*kx[b]+ky[b]*ky[b];
+  });
+  double epsmax = 0;
+  for(size_t j = 0; j < n2; ++j){
+    epsmax = std::max(epsmax, std::abs(Epsilon2[j+j*n2]));
+  }
+  const double coupling = std::abs(omega*omega) * epsmax;
+  const size_t max_cluster = 64;
+  std::vector<size_t> cluster;
+  std::vector<std::complex<double> > block, vecs, vals;
+  std::vector<std::complex<double> > lambda(n2); // approximate eigenvalues
+  const std::complex<double> omega2 = omega*omega;
+  double opnorm = 0;
+  size_t col = nmodes;
+  for(size_t s = 0; s < n; ){
+    cluster.clear();
+    const size_t i0 = order[s];
+    const double k0 = kx[i0]*kx[i0]+ky[i0]*ky[i0];
+    for(; s < n; ++s){
+      const size_t i = order[s];
+      const double ki = kx[i]*kx[i]+ky[i]*ky[i];
+      const size_t m = (picked[i] ? 0 : 1) + (picked[n+i] ? 0 : 1);
+      if(!cluster.empty() && (ki - k0 > coupling || cluster.size() + m > max_cluster)){
+        break;
+      }
+      if(!picked[i]){ cluster.push_back(i); }
+      if(!picked[n+i]){ cluster.push_back(n+i); }
+    }
+    const size_t b = cluster.size();
+    if(0 == b){ continue; }
+    // Elements of the eigenoperator: with
+    //   kp = omega^2 + r Epsilon_inv c,  r = [ky;-kx], c = [-ky kx]
+    // (see MakeKPMatrix), column j of kp is omega^2 e_j + c_j r Epsilon_inv_j
+    block.resize(b*b); vecs.resize(b*b); vals.resize(b);
+    for(size_t bj = 0; bj < b; ++bj){
+      const size_t j = cluster[bj];
+      const double c = (j < n ? -ky[j] : kx[j-n]);
+      for(size_t l = 0; l < n2; ++l){
+        const double r = (l < n ? ky[l] : -kx[l-n]);
+        kpcol[l] = c * r * Epsilon_inv[(l%n)+(j%n)*n];
+      }
+      kpcol[j] += omega2;
+      for(size_t bi = 0; bi < b; ++bi){
+        const size_t i = cluster[bi];
+        std::complex<double> sum = RNP::TBLAS::Dot(n2, &Epsilon2[i],n2, kpcol,1);
+        if(i % n == j % n){
+          sum -= (i < n ? kx[i%n] : ky[i%n]) * (j < n ? kx[j%n] : ky[j%n]);
+        }
+        for(size_t c = 0; c < nmodes; ++c){
+          sum -= phi[i+c*n2] * q[c] * W[c+j*nmodes];
+        }
+        block[bi+bj*b] = sum;
+      }
+    }
+    RNP::Eigensystem(b, &block[0], b, &vals[0], NULL, 1, &vecs[0], b, NULL, NULL, 0);
+    for(size_t bj = 0; bj < b; ++bj){
+      RNP::TBLAS::Fill(n2, std::complex<double>(0.), &phi[0+col*n2],1);
+      for(size_t bi = 0; bi < b; ++bi){
+        phi[cluster[bi]+col*n2] = vecs[bi+bj*b];
+      }
+      for(size_t c = 0; c < nmodes; ++c){
+        std::complex<double> s = 0;
+        for(size_t bi = 0; bi < b; ++bi){
+          s += W[c+cluster[bi]*nmodes] * vecs[bi+bj*b];
+        }
+        RNP::TBLAS::Axpy(n2, -s, &phi[0+c*n2],1, &phi[0+col*n2],1);
+      }
+      opnorm = std::max(opnorm, std::abs(vals[bj]));
+      lambda[col] = vals[bj];
+      // The approximate modes decay at least as fast as the computed ones
+      q[col] = vals[bj];
+      if(LayerEigenoperator::ImQ(q[col]) < imq_max){
+        q[col] = -imq_max*imq_max;
+      }
+      ++col;
+    }
+  }
+  if(NULL != residual){
+    *residual = (opnorm > 0 ? maxres / opnorm : maxres);
+  }
+  // The residuals of the approximate modes measure the neglected coupling
+  // between clusters. Forming all of them would cost as much as the dense
+  // solver, so only the slowest decaying ones, which carry fields furthest
+  // from the interfaces, are checked; as many as there are computed modes.
+  if(NULL != approx_residual){
+    std::vector<size_t> approx(n2-nmodes);
+    for(size_t i = 0; i < approx.size(); ++i){ approx[i] = nmodes+i; }
+    const size_t nsample = std::min(nmodes, approx.size());
+    std::partial_sort(approx.begin(), approx.begin()+nsample, approx.end(), [&lambda](size_t a, size_t b){
+      return LayerEigenoperator::ImQ(lambda[a]) < LayerEigenoperator::ImQ(lambda[b]);
+    });
+    double maxapprox = 0;
+    for(size_t i = 0; i < nsample; ++i){
+      const size_t c = approx[i];
+      const double norm = RNP::TBLAS::Norm2(n2, &phi[0+c*n2],1);
+      if(0 == norm){ continue; }
+      op.Apply(&phi[0+c*n2], rows);
+      RNP::TBLAS::Axpy(n2, -lambda[c], &phi[0+c*n2],1, rows,1);
+      maxapprox = std::max(maxapprox, RNP::TBLAS::Norm2(n2, rows,1) / norm);
+    }
+    *approx_residual = (opnorm > 0 ? maxapprox / opnorm : maxapprox);
+  }
+  EigenvaluesToQ(omega, n2, q);
+
+  if(NULL != kp){
+    MakeKPMatrix(omega, n, kx, ky, Epsilon_inv, epstype, NULL, kp, n2);
+  }
+  rcwa_free(work);
+  rcwa_free(resid0);
+  return 0;
+#else
+  return 1;
+#endif
+}
+
+// Forms B = kp*phi (kp if phi is NULL) for the modes [off, off+m) of a
+// layer; kp and phi are offset to them, with leading dimension ld (2n,
+// except for the reduced problems of SolveInterior_projected, which always
+// give kp). work is of size m^2 and only used for one polarization of a
+// decoupled layer.
+static void MakeBMatrix(
+  std::complex<double> omega,
+  size_t n,
+  const double *kx,
+  const double *ky,
+  const std::complex<double> *Epsilon_inv,
+  int epstype,
+  const std::complex<double> *kp,
+  const std::complex<double> *phi,
+  size_t ld, size_t off, size_t m,
+  std::complex<double> *B, // size m^2
+  std::complex<double> *work
+){
+  const size_t n2 = 2*n;
+  if(NULL == kp && n2 == m){
+    RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,0., B,n2);
+    if(NULL == phi){
+      MakeKPMatrix(omega, n, kx, ky, Epsilon_inv, epstype, kp, B,n2);
+    }else{
+      MultKPMatrix("N", omega, n, kx, ky, Epsilon_inv, epstype, kp, n2, phi,n2, B,n2);
+    }
+    return;
+  }
+  size_t ldkp = ld;
+  if(NULL == kp){
+    MakeKPMatrixBlock(omega, n, kx, Epsilon_inv, epstype, off, (NULL == phi ? B : work), m);
+    if(NULL == phi){ return; }
+    kp = work;
+    ldkp = m;
+  }
+  if(NULL == phi){
+    RNP::TBLAS::CopyMatrix<'A'>(m,m, kp,ldkp, B,m);
+  }else{
+    RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.),kp,ldkp, phi,ld, std::complex<double>(0.),B,m);
+  }
+}
+
+void InitSMatrix(
+  size_t n,
+  std::complex<double> *S // size (4*n)^2
+){
+  const size_t n4 = 4*n;
+  RNP::TBLAS::SetMatrix<'A'>(n4,n4, 0.,1., S, n4);
+}
+// Appends the layers to the S-matrix S for the modes [off, off+m) of each
+// of its halves. This is all of them (off = 0, m = 2n) unless the problem
+// is decoupled (see IsDecoupledStack), in which case the two polarizations
+// (m = n) are independent and S is only written for the one given. The
+// q, kp and phi of the layers are offset to the modes by the caller, with
+// leading dimension ld (normally 2n), and S is offset to the first of them.
+static void GetSMatrix_modes(size_t nlayers,
+    size_t n, // glist.n
+    const double *kx, const double *ky,
+    std::complex<double> omega,
+    const double *thickness,
+    const std::complex<double> **q,
+    const std::complex<double> **Epsilon_inv,
+    int *epstype,
+    const std::complex<double> **kp,
+    const std::complex<double> **phi,
+    size_t ld, size_t off, size_t m,
+    std::complex<double> *S, // leading dimension 2*ld
+    std::complex<double> *work, // length 4*m*m + 2*m
+    size_t *pivots)
+    {
+    const size_t n2 = ld;
+    const size_t n4 = 2*n2;
+    std::complex<double> *t1 = work;
+    std::complex<double> *t2 = t1 + m*m;
+    std::complex<double> *in1 = t2 + m*m;
+    std::complex<double> *in2 = in1 + m*m;
+    std::complex<double> *d1 = in2 + m*m;
+    std::complex<double> *d2 = d1 + m;
+
+    for(size_t l = 0; l < nlayers-1; ++l)
         {
         size_t lp1 = l+1;
         if(lp1 >= nlayers)
@@ -950,8 +1691,8 @@ void GetSMatrix(size_t nlayers,
         if((lp1 == l) || (q[l] == q[lp1] && ((NULL != kp[l] && kp[l] == kp[lp1]) || Epsilon_inv[l] == Epsilon_inv[lp1]) && phi[l] == phi[lp1]))
             {
             // This is a trivial interface, set to identity
-            RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,1., in1, n2);
-            RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,0., in2, n2);
+            RNP::TBLAS::SetMatrix<'A'>(m,m, 0.,1., in1, m);
+            RNP::TBLAS::SetMatrix<'A'>(m,m, 0.,0., in2, m);
             }
         else
             {
@@ -1023,90 +1764,50 @@ void GetSMatrix(size_t nlayers,
               }
             */
             // Make Bl in t1
-            RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,0., t1,n2);
-                {
-                if(NULL == phi[l])
-                    {
-                    if(NULL == kp[l])
-                        {
-                        MakeKPMatrix(omega, n, kx, ky, Epsilon_inv[l], epstype[l], kp[l], t1,n2);
-                        }
-                    else
-                        {
-                        RNP::TBLAS::CopyMatrix<'A'>(n2,n2, kp[l],n2, t1,n2);
-                        }
-                    }
-                else
-                    {
-                    MultKPMatrix("N", omega, n, kx, ky, Epsilon_inv[l], epstype[l], kp[l], n2, phi[l],n2, t1,n2);
-                    }
-                //for(size_t i = 0; i < n2; ++i){
-                //	RNP::TBLAS::Scale(n2, 1./q[l][i], &t1[0+i*n2], 1);
-                //}
-                }
+            MakeBMatrix(omega, n, kx, ky, Epsilon_inv[l], epstype[l], kp[l], phi[l], ld, off, m, t1, t2);
 #ifdef DUMP_MATRICES
       DUMP_STREAM << "Bl(" << l << ") = " << std::endl;
 # ifdef DUMP_MATRICES_LARGE
-      RNP::IO::PrintMatrix(n2,n2,t1,n2, DUMP_STREAM) << std::endl << std::endl;
+      RNP::IO::PrintMatrix(m,m,t1,m, DUMP_STREAM) << std::endl << std::endl;
 # else
-      RNP::IO::PrintVector(n2,t1,1, DUMP_STREAM) << std::endl << std::endl;
+      RNP::IO::PrintVector(m,t1,1, DUMP_STREAM) << std::endl << std::endl;
 # endif
 #endif
             // Make Blp1 in in1
-            RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,0., in1,n2);
-                {
-                if(NULL == phi[lp1])
-                    {
-                    if(NULL == kp[lp1])
-                        {
-                        MakeKPMatrix(omega, n, kx, ky, Epsilon_inv[lp1], epstype[lp1], kp[lp1], in1,n2);
-                        }
-                    else
-                        {
-                        RNP::TBLAS::CopyMatrix<'A'>(n2,n2, kp[lp1],n2, in1,n2);
-                        }
-                    }
-                else
-                    {
-                    MultKPMatrix("N", omega, n, kx, ky, Epsilon_inv[lp1], epstype[lp1], kp[lp1], n2, phi[lp1],n2, in1,n2);
-                    }
-                //for(size_t i = 0; i < n2; ++i){
-                //	RNP::TBLAS::Scale(n2, 1./q[lp1][i], &in1[0+i*n2], 1);
-                //}
-                }
+            MakeBMatrix(omega, n, kx, ky, Epsilon_inv[lp1], epstype[lp1], kp[lp1], phi[lp1], ld, off, m, in1, t2);
 #ifdef DUMP_MATRICES
     DUMP_STREAM << "Bl(" << l+1 << ") = " << std::endl;
 # ifdef DUMP_MATRICES_LARGE
-    RNP::IO::PrintMatrix(n2,n2,in1,n2, DUMP_STREAM) << std::endl << std::endl;
+    RNP::IO::PrintMatrix(m,m,in1,m, DUMP_STREAM) << std::endl << std::endl;
 # else
-    RNP::IO::PrintVector(n2,in1,1, DUMP_STREAM) << std::endl << std::endl;
+    RNP::IO::PrintVector(m,in1,1, DUMP_STREAM) << std::endl << std::endl;
 # endif
 #endif
             int solve_info;
             // Make Q in in1
-            //RNP::LinearSolve<'N'>(n2, n2, t1, n2, in1, n2, &solve_info, pivots);
-            SingularLinearSolve(n2,n2,n2, t1,n2, in1,n2, DBL_EPSILON);
+            //RNP::LinearSolve<'N'>(m, m, t1, m, in1, m, &solve_info, pivots);
+            SingularLinearSolve(m,m,m, t1,m, in1,m, DBL_EPSILON);
             // Now perform the diagonal scalings
-            for(size_t i = 0; i < n2; ++i)
+            for(size_t i = 0; i < m; ++i)
                 {
-                RNP::TBLAS::Scale(n2, q[l][i], &in1[i+0*n2], n2);
+                RNP::TBLAS::Scale(m, q[l][i], &in1[i+0*m], m);
                 }
                 {
                 double maxel = 0;
-                for(size_t i = 0; i < n2; ++i)
+                for(size_t i = 0; i < m; ++i)
                     {
                     double el = std::abs(q[lp1][i]);
                     if(el > maxel){ maxel = el; }
                     }
-                for(size_t i = 0; i < n2; ++i)
+                for(size_t i = 0; i < m; ++i)
                     {
                     double el = std::abs(q[lp1][i]);
                     if(el < DBL_EPSILON * maxel){
-                        RNP::TBLAS::Scale(n2, 0., &in1[0+i*n2], 1);
+                        RNP::TBLAS::Scale(m, 0., &in1[0+i*m], 1);
                         }
                     else
                         {
-                        RNP::TBLAS::Scale(n2, 1./q[lp1][i], &in1[0+i*n2], 1);
+                        RNP::TBLAS::Scale(m, 1./q[lp1][i], &in1[0+i*m], 1);
                         }
                     }
                 }
@@ -1114,88 +1815,88 @@ void GetSMatrix(size_t nlayers,
             // Make P in in2
             if(NULL == phi[lp1])
                 {
-                RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,1., in2,n2);
+                RNP::TBLAS::SetMatrix<'A'>(m,m, 0.,1., in2,m);
                 }
             else
                 {
-                RNP::TBLAS::CopyMatrix<'A'>(n2,n2, phi[lp1],n2, in2,n2);
+                RNP::TBLAS::CopyMatrix<'A'>(m,m, phi[lp1],n2, in2,m);
                 }
             if(NULL != phi[l])
                 {
-                RNP::TBLAS::CopyMatrix<'A'>(n2,n2, phi[l],n2, t1,n2);
-                RNP::LinearSolve<'N'>(n2, n2, t1, n2, in2, n2, &solve_info, pivots);
+                RNP::TBLAS::CopyMatrix<'A'>(m,m, phi[l],n2, t1,m);
+                RNP::LinearSolve<'N'>(m, m, t1, m, in2, m, &solve_info, pivots);
                 }
 
-            RNP::TBLAS::CopyMatrix<'A'>(n2,n2, in2,n2, t1,n2); // in2 = P, t1 = P, in1 = Q
-            RNP::TBLAS::Axpy(n2*n2, -1., in1,1, in2,1); // in2 = P-Q, t1 = P, in1 = Q
-            RNP::TBLAS::Axpy(n2*n2, 1., t1,1, in1,1); // in2 = P+Q, t1 = P, in1 = P+Q
-            RNP::TBLAS::Scale(n2*n2, 0.5, in1,1);
-            RNP::TBLAS::Scale(n2*n2, 0.5, in2,1);
+            RNP::TBLAS::CopyMatrix<'A'>(m,m, in2,m, t1,m); // in2 = P, t1 = P, in1 = Q
+            RNP::TBLAS::Axpy(m*m, -1., in1,1, in2,1); // in2 = P-Q, t1 = P, in1 = Q
+            RNP::TBLAS::Axpy(m*m, 1., t1,1, in1,1); // in2 = P+Q, t1 = P, in1 = P+Q
+            RNP::TBLAS::Scale(m*m, 0.5, in1,1);
+            RNP::TBLAS::Scale(m*m, 0.5, in2,1);
             }
 #ifdef DUMP_MATRICES
     DUMP_STREAM << "Interface1(" << l+1 << ") = " << std::endl;
 # ifdef DUMP_MATRICES_LARGE
-    RNP::IO::PrintMatrix(n2,n2,in1,n2, DUMP_STREAM) << std::endl << std::endl;
+    RNP::IO::PrintMatrix(m,m,in1,m, DUMP_STREAM) << std::endl << std::endl;
 # else
-    RNP::IO::PrintVector(n2,in1,1, DUMP_STREAM) << std::endl << std::endl;
+    RNP::IO::PrintVector(m,in1,1, DUMP_STREAM) << std::endl << std::endl;
 # endif
     DUMP_STREAM << "Interface2(" << l+1 << ") = " << std::endl;
 # ifdef DUMP_MATRICES_LARGE
-    RNP::IO::PrintMatrix(n2,n2,in2,n2, DUMP_STREAM) << std::endl << std::endl;
+    RNP::IO::PrintMatrix(m,m,in2,m, DUMP_STREAM) << std::endl << std::endl;
 # else
-    RNP::IO::PrintVector(n2,in2,1, DUMP_STREAM) << std::endl << std::endl;
+    RNP::IO::PrintVector(m,in2,1, DUMP_STREAM) << std::endl << std::endl;
 # endif
 #endif
 
-        for(size_t i = 0; i < n2; ++i)
+        for(size_t i = 0; i < m; ++i)
             {
             d1[i] = std::exp(q[l  ][i] * std::complex<double>(0,thickness[l  ]));
             d2[i] = std::exp(q[lp1][i] * std::complex<double>(0,thickness[lp1]));
             }
 
         // Make S11
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, -1.,&S[0+n2*n4],n4, in2,n2, 0.,t1,n2); // t1 = -S12 I21
-        for(size_t i = 0; i < n2; ++i)
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, -1.,&S[0+n2*n4],n4, in2,m, 0.,t1,m); // t1 = -S12 I21
+        for(size_t i = 0; i < m; ++i)
             { // t1 = -f_l S12 I21
-            RNP::TBLAS::Scale(n2, d1[i], &t1[i+0*n2], n2);
+            RNP::TBLAS::Scale(m, d1[i], &t1[i+0*m], m);
             }
-        RNP::TBLAS::Axpy(n2*n2, 1., in1,1, t1,1); // t1 = (I11 - f_l S12 I21)
+        RNP::TBLAS::Axpy(m*m, 1., in1,1, t1,1); // t1 = (I11 - f_l S12 I21)
 
-        RNP::TBLAS::SetMatrix<'A'>(n2,n2, 0.,1., t2,n2);
+        RNP::TBLAS::SetMatrix<'A'>(m,m, 0.,1., t2,m);
         int solve_info;
-        RNP::LinearSolve<'N'>(n2, n2, t1, n2, t2, n2, &solve_info, pivots); // t2 = (I11 - f_l S12 I21)^{-1}
+        RNP::LinearSolve<'N'>(m, m, t1, m, t2, m, &solve_info, pivots); // t2 = (I11 - f_l S12 I21)^{-1}
 
-        RNP::TBLAS::CopyMatrix<'A'>(n2,n2, &S[0+0*n4],n4, t1,n2);
-        for(size_t i = 0; i < n2; ++i){ // t1 = f_l S11
-            RNP::TBLAS::Scale(n2, d1[i], &t1[i+0*n2], n2);
+        RNP::TBLAS::CopyMatrix<'A'>(m,m, &S[0+0*n4],n4, t1,m);
+        for(size_t i = 0; i < m; ++i){ // t1 = f_l S11
+            RNP::TBLAS::Scale(m, d1[i], &t1[i+0*m], m);
             }
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,t2,n2, t1,n2, 0.,&S[0+0*n4],n4);
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,t2,m, t1,m, 0.,&S[0+0*n4],n4);
         // S11 is done, and we need to hold on to t2 = (I11 - f_l S12 I21)^{-1}
 
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,&S[0+n2*n4],n4, in1,n2, 0.,t1,n2); // t1 = S12 I22
-        for(size_t i = 0; i < n2; ++i)
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,&S[0+n2*n4],n4, in1,m, 0.,t1,m); // t1 = S12 I22
+        for(size_t i = 0; i < m; ++i)
             { // t1 = f_l S12 I22
-            RNP::TBLAS::Scale(n2, d1[i], &t1[i+0*n2], n2);
+            RNP::TBLAS::Scale(m, d1[i], &t1[i+0*m], m);
             }
-        RNP::TBLAS::Axpy(n2*n2, -1., in2,1, t1,1); // t1 = f_l S12 I22 - I12
-        for(size_t i = 0; i < n2; ++i)
+        RNP::TBLAS::Axpy(m*m, -1., in2,1, t1,1); // t1 = f_l S12 I22 - I12
+        for(size_t i = 0; i < m; ++i)
             { // t1 = (f_l S12 I22 - I12) f_{l+1}
-            RNP::TBLAS::Scale(n2, d2[i], &t1[0+i*n2], 1);
+            RNP::TBLAS::Scale(m, d2[i], &t1[0+i*m], 1);
             }
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,t2,n2, t1,n2, 0.,&S[0+n2*n4],n4);
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,t2,m, t1,m, 0.,&S[0+n2*n4],n4);
         // S12 done, and t2 can be reused
 
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,&S[n2+n2*n4],n4, in2,n2, 0.,t1,n2); // t1 = S22 I21
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,t1,n2, &S[0+0*n4],n4, 1.,&S[n2+0*n4],n4);
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,&S[n2+n2*n4],n4, in2,m, 0.,t1,m); // t1 = S22 I21
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,t1,m, &S[0+0*n4],n4, 1.,&S[n2+0*n4],n4);
         // S21 done, need to keep t1 = S22 I21
 
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,&S[n2+n2*n4],n4, in1,n2, 0.,t2,n2); // t2 = S22 I22
-        for(size_t i = 0; i < n2; ++i)
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,&S[n2+n2*n4],n4, in1,m, 0.,t2,m); // t2 = S22 I22
+        for(size_t i = 0; i < m; ++i)
             { // t2 = S22 I22 f_{l+1}
-            RNP::TBLAS::Scale(n2, d2[i], &t2[0+i*n2], 1);
+            RNP::TBLAS::Scale(m, d2[i], &t2[0+i*m], 1);
             }
-        RNP::TBLAS::CopyMatrix<'A'>(n2,n2, t2,n2, &S[n2+n2*n4],n4);
-        RNP::TBLAS::MultMM<'N','N'>(n2,n2,n2, 1.,t1,n2, &S[0+n2*n4],n4, 1.,&S[n2+n2*n4],n4);
+        RNP::TBLAS::CopyMatrix<'A'>(m,m, t2,m, &S[n2+n2*n4],n4);
+        RNP::TBLAS::MultMM<'N','N'>(m,m,m, 1.,t1,m, &S[0+n2*n4],n4, 1.,&S[n2+n2*n4],n4);
 
 #ifdef DUMP_MATRICES
     DUMP_STREAM << "S(1," << l+2 << ") = " << std::endl;
@@ -1206,6 +1907,75 @@ void GetSMatrix(size_t nlayers,
 # endif
 #endif
         }
+    }
+
+void GetSMatrix(size_t nlayers,
+    size_t n, // glist.n
+    const double *kx, const double *ky,
+    std::complex<double> omega,
+    const double *thickness, // list of thicknesses
+    const std::complex<double> **q, // list of q vectors
+    const std::complex<double> **Epsilon_inv, // size (glist.n)^2; inv of usual dielectric Fourier coupling matrix
+    int *epstype,
+    const std::complex<double> **kp,
+    const std::complex<double> **phi,
+    std::complex<double> *S, // size (4*n)^2
+    std::complex<double> *work_,
+    size_t *iwork,
+    size_t lwork)
+    {
+    if(0 == nlayers)
+        {
+        return;
+        }
+    const size_t n2 = 2*n;
+    const size_t n4 = 2*n2;
+
+    if((size_t)-1 == lwork)
+        {
+        work_[0] = n4*(n4+1);
+        return;
+        }
+    S4_ProfileScope profile_scope(NULL, S4_PROFILE_SMATRIX);
+    std::complex<double> *work = work_;
+    if(NULL == work_ || lwork < n4*(n4+1))
+        {
+        work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*(n4*(n4+1)));
+        }
+    size_t *pivots = iwork;
+    if(NULL == iwork)
+        {
+        pivots = (size_t*)rcwa_malloc(sizeof(size_t)*n4);
+        }
+
+    RNP::TBLAS::SetMatrix<'A'>(n4,n4, 0.,1., S, n4);
+
+    if(IsDecoupledStack(nlayers, n, ky, phi))
+        {
+        // Solve the two polarizations separately on views of the layers
+        const std::complex<double> **views = (const std::complex<double>**)rcwa_malloc(sizeof(std::complex<double>*)*3*nlayers);
+        const std::complex<double> **qv = views;
+        const std::complex<double> **kpv = qv + nlayers;
+        const std::complex<double> **phiv = kpv + nlayers;
+        for(size_t off = 0; off < n2; off += n)
+            {
+            for(size_t l = 0; l < nlayers; ++l)
+                {
+                qv[l] = q[l] + off;
+                kpv[l] = (NULL == kp[l] ? NULL : kp[l] + off+off*n2);
+                phiv[l] = (NULL == phi[l] ? NULL : phi[l] + off+off*n2);
+                }
+            GetSMatrix_modes(nlayers, n, kx, ky, omega, thickness, qv, Epsilon_inv, epstype, kpv, phiv,
+                n2, off, n, S + off+off*n4, work, pivots);
+            }
+        rcwa_free(views);
+        }
+    else
+        {
+        GetSMatrix_modes(nlayers, n, kx, ky, omega, thickness, q, Epsilon_inv, epstype, kp, phi,
+            n2, 0, n2, S, work, pivots);
+        }
+
     if(NULL == work_ || lwork < n4*(n4+1))
         {
         rcwa_free(work);
@@ -1241,6 +2011,7 @@ int SolveAll(
     iwork[0] = minwork;
     return 0;
   }
+  S4_ProfileScope profile_scope(NULL, S4_PROFILE_SOLVE);
   typedef std::complex<double> doublecomplex;
   doublecomplex *work = work_;
   if(0 == lwork && NULL == work_){
@@ -1735,6 +2506,7 @@ int SolveInterior(
 ){
   if(0 == nlayers){ return-1; }
   if(which_layer >= nlayers){ return -2; }
+  S4_ProfileScope profile_scope(NULL, S4_PROFILE_SOLVE);
 
   const size_t n2 = 2*n;
   const size_t n4 = 2*n2;
@@ -1756,15 +2528,11 @@ int SolveInterior(
 
   std::complex<double> *S0l = work;
   std::complex<double> *SlN = S0l + n4*n4;
-  std::complex<double> *S11a0 = SlN + n4*n4;
-  std::complex<double> *S22bN = S11a0 + n2;
-  std::complex<double> *work_GetSMatrix = S22bN + n2;
+  std::complex<double> *work_GetSMatrix = SlN + n4*n4;
+#ifdef DUMP_MATRICES
   std::complex<double> *al = ab;
   std::complex<double> *bl = al+n2;
-  std::complex<double> *temp = S0l;
-  size_t ldtemp = n4;
-
-  int info;
+#endif
 
   GetSMatrix(which_layer+1, n, kx, ky, omega,
     thickness, q, Epsilon_inv, epstype, kp, phi,
@@ -1798,72 +2566,537 @@ int SolveInterior(
 # endif
 #endif
 
+  SolveInteriorSMatrix(n, S0l, SlN, a0, bN, ab, work_GetSMatrix, pivots);
+
+#ifdef DUMP_MATRICES
+  DUMP_STREAM << "al:" << std::endl;
+  RNP::IO::PrintVector(n2,al,1, DUMP_STREAM) << std::endl << std::endl;
+  DUMP_STREAM << "bl:" << std::endl;
+  RNP::IO::PrintVector(n2,bl,1, DUMP_STREAM) << std::endl << std::endl;
+#endif
+
+  if(NULL == work_ || lwork < lwork_needed){
+    rcwa_free(work);
+  }
+  if(NULL == iwork){
+    rcwa_free(pivots);
+  }
+  return 0;
+}
+
+// Solves for the amplitudes al and bl of one block of size m of the modes.
+// S0l and SlN point to the first entry of the block within the S-matrices,
+// whose blocks are n2 x n2 with leading dimension 2*n2.
+static void SolveInteriorSMatrix_modes(
+  size_t n2, size_t m,
+  const std::complex<double> *S0l,
+  const std::complex<double> *SlN,
+  const std::complex<double> *a0, // length m
+  const std::complex<double> *bN, // length m
+  std::complex<double> *al, // length m
+  std::complex<double> *bl, // length m
+  std::complex<double> *work, // length m^2 + 2*m
+  size_t *pivots // length m
+){
+  const size_t n4 = 2*n2;
+  std::complex<double> *temp = work;
+  const size_t ldtemp = m;
+  std::complex<double> *S11a0 = temp + m*m;
+  std::complex<double> *S22bN = S11a0 + m;
+
+  int info;
+
   // both solutions only depend on the products S11(0,l)*a0 and S22(l,N)*bN
   if(NULL != a0){
-    RNP::TBLAS::MultMV<'N'>(n2, n2, std::complex<double>(1.0), &S0l[0+0*n4], n4,
+    RNP::TBLAS::MultMV<'N'>(m, m, std::complex<double>(1.0), &S0l[0+0*n4], n4,
       a0, 1,
       std::complex<double>(0.0), S11a0, 1);
   }else{
-    RNP::TBLAS::Fill(n2, 0., S11a0, 1);
+    RNP::TBLAS::Fill(m, 0., S11a0, 1);
   }
   if(NULL != bN){
-    RNP::TBLAS::MultMV<'N'>(n2, n2, std::complex<double>(1.0), &SlN[n2+n2*n4], n4,
+    RNP::TBLAS::MultMV<'N'>(m, m, std::complex<double>(1.0), &SlN[n2+n2*n4], n4,
       bN, 1,
       std::complex<double>(0.0), S22bN, 1);
   }else{
-    RNP::TBLAS::Fill(n2, 0., S22bN, 1);
+    RNP::TBLAS::Fill(m, 0., S22bN, 1);
   }
 
-  // We overwrite the upper left submatrix S11(0,l) since it's not needed anymore
-  // temp is set to S0l for this reason.
-
   // Compute -S_12(0,l)S_21(l,N)
-  RNP::TBLAS::MultMM<'N','N'>(n2, n2, n2, std::complex<double>(-1.0), &S0l[0+n2*n4], n4,
+  RNP::TBLAS::MultMM<'N','N'>(m, m, m, std::complex<double>(-1.0), &S0l[0+n2*n4], n4,
     &SlN[n2+0*n4], n4,
     std::complex<double>(0.0), temp, ldtemp);
-  for(size_t i = 0; i < n2; ++i){
+  for(size_t i = 0; i < m; ++i){
     temp[i+i*ldtemp] += 1.;
   } // temp = (1 - S_12(0,l)S_21(l,N))
 
-  RNP::TBLAS::MultMV<'N'>(n2, n2, std::complex<double>(1.0), &S0l[0+n2*n4], n4,
+  RNP::TBLAS::MultMV<'N'>(m, m, std::complex<double>(1.0), &S0l[0+n2*n4], n4,
     S22bN, 1,
     std::complex<double>(0.0), al, 1); // al = S_12(0,l)S_22(l,N)bN
-  RNP::TBLAS::Axpy(n2, std::complex<double>(1.0), S11a0, 1, al, 1); // al = S_11(0,l)*a0 + S_12(0,l)S_22(l,N)bN
+  RNP::TBLAS::Axpy(m, std::complex<double>(1.0), S11a0, 1, al, 1); // al = S_11(0,l)*a0 + S_12(0,l)S_22(l,N)bN
 
-  RNP::LinearSolve<'N'>(n2, 1, temp, ldtemp, al, n2, &info, pivots);
+  RNP::LinearSolve<'N'>(m, 1, temp, ldtemp, al, m, &info, pivots);
   // al done
 
   // Make the other matrix
   // Compute S_21(l,N)S_12(0,l)
-  RNP::TBLAS::MultMM<'N','N'>(n2, n2, n2, std::complex<double>(-1.0), &SlN[n2+0*n4], n4,
+  RNP::TBLAS::MultMM<'N','N'>(m, m, m, std::complex<double>(-1.0), &SlN[n2+0*n4], n4,
     &S0l[0+n2*n4], n4,
     std::complex<double>(0.0), temp, ldtemp);
-  for(size_t i = 0; i < n2; ++i){
+  for(size_t i = 0; i < m; ++i){
     temp[i+i*ldtemp] += 1.;
   } // temp = (1 - S_21(l,N)S_12(0,l))
 
-  RNP::TBLAS::MultMV<'N'>(n2, n2, std::complex<double>(1.0), &SlN[n2+0*n4], n4,
+  RNP::TBLAS::MultMV<'N'>(m, m, std::complex<double>(1.0), &SlN[n2+0*n4], n4,
     S11a0, 1,
     std::complex<double>(0.0), bl, 1); // bl = S_21(l,N)S_11(0,l)a0
-  RNP::TBLAS::Axpy(n2, std::complex<double>(1.0), S22bN, 1, bl, 1); // bl = S_21(l,N)S_11(0,l)a0 + S_22(l,N)bN
-  RNP::LinearSolve<'N'>(n2, 1, temp, ldtemp, bl, n2, &info, pivots);
+  RNP::TBLAS::Axpy(m, std::complex<double>(1.0), S22bN, 1, bl, 1); // bl = S_21(l,N)S_11(0,l)a0 + S_22(l,N)bN
+  RNP::LinearSolve<'N'>(m, 1, temp, ldtemp, bl, m, &info, pivots);
+}
 
-#ifdef DUMP_MATRICES
-  DUMP_STREAM << "al:" << std::endl;
-  RNP::IO::PrintVector(n2,al,1, DUMP_STREAM) << std::endl << std::endl;
-  DUMP_STREAM << "bl:" << std::endl;
-  RNP::IO::PrintVector(n2,bl,1, DUMP_STREAM) << std::endl << std::endl;
-#endif
+void SolveInteriorSMatrix(
+  size_t n, // glist.n
+  const std::complex<double> *S0l, // size (4*n)^2
+  const std::complex<double> *SlN, // size (4*n)^2
+  const std::complex<double> *a0, // length 2*n
+  const std::complex<double> *bN, // length 2*n
+  std::complex<double> *ab, // length 4*n
+  std::complex<double> *work_, // length (2*n)^2 + 4*n
+  size_t *iwork // length n2
+){
+  const size_t n2 = 2*n;
+  const size_t n4 = 2*n2;
+  const size_t lwork_needed = n2*n2 + 2*n2;
 
-  if(NULL == work_ || lwork < lwork_needed){
+  std::complex<double> *work = work_;
+  if(NULL == work_){
+    work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*lwork_needed);
+  }
+  size_t *pivots = iwork;
+  if(NULL == iwork){
+    pivots = (size_t*)rcwa_malloc(sizeof(size_t)*n2);
+  }
+
+  std::complex<double> *al = ab;
+  std::complex<double> *bl = al+n2;
+
+  if(IsPolarizationDecoupled(n, 2, S0l, n4) && IsPolarizationDecoupled(n, 2, SlN, n4)){
+    // Each block of the modes is solved for on its own
+    for(size_t off = 0; off < n2; off += n){
+      SolveInteriorSMatrix_modes(n2, n, &S0l[off+off*n4], &SlN[off+off*n4],
+        (NULL != a0 ? a0+off : NULL), (NULL != bN ? bN+off : NULL),
+        al+off, bl+off, work, pivots);
+    }
+  }else{
+    SolveInteriorSMatrix_modes(n2, n2, S0l, SlN, a0, bN, al, bl, work, pivots);
+  }
+
+  if(NULL == work_){
     rcwa_free(work);
   }
   if(NULL == iwork){
     rcwa_free(pivots);
   }
-  return 0;
 }
 
+// Combines one block of size m of the modes of two S-matrices. Sa, Sb and S
+// point to the first entry of the block, and their blocks are n2 x n2 with
+// leading dimension 2*n2.
+static void CombineSMatrix_modes(
+  size_t n2, size_t m,
+  const std::complex<double> *Sa,
+  const std::complex<double> *Sb,
+  std::complex<double> *S,
+  std::complex<double> *work, // length 3*m^2
+  size_t *pivots // length m
+){
+  const size_t n4 = 2*n2;
+  const size_t mm = m*m;
+
+  // Block (i,j) of an S-matrix M is at &M[i*n2+j*n2*n4]. With the stacks
+  // sharing layer l, [a_l;b_0] = Sa [a_0;b_l] and [a_N;b_l] = Sb [a_l;b_N].
+  const std::complex<double> *A11 = &Sa[0+0*n4], *A12 = &Sa[0+n2*n4];
+  const std::complex<double> *A21 = &Sa[n2+0*n4], *A22 = &Sa[n2+n2*n4];
+  const std::complex<double> *B11 = &Sb[0+0*n4], *B12 = &Sb[0+n2*n4];
+  const std::complex<double> *B21 = &Sb[n2+0*n4], *B22 = &Sb[n2+n2*n4];
+  std::complex<double> *M = work;
+  std::complex<double> *X = M + mm; // m x 2m
+  int info;
+
+  // X = (1 - A12 B21)^{-1} [ A11, A12 B22 ]
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(-1.0),A12,n4, B21,n4, std::complex<double>(0.0),M,m);
+  for(size_t i = 0; i < m; ++i){
+    M[i+i*m] += 1.;
+  }
+  RNP::TBLAS::CopyMatrix<'A'>(m,m, A11,n4, X,m);
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.0),A12,n4, B22,n4, std::complex<double>(0.0),X+mm,m);
+  RNP::LinearSolve<'N'>(m, 2*m, M,m, X,m, &info, pivots);
+  // S11 = B11 X1, S12 = B12 + B11 X2
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.0),B11,n4, X,m, std::complex<double>(0.0),&S[0+0*n4],n4);
+  RNP::TBLAS::CopyMatrix<'A'>(m,m, B12,n4, &S[0+n2*n4],n4);
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.0),B11,n4, X+mm,m, std::complex<double>(1.0),&S[0+n2*n4],n4);
+
+  // X = (1 - B21 A12)^{-1} [ B21 A11, B22 ]
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(-1.0),B21,n4, A12,n4, std::complex<double>(0.0),M,m);
+  for(size_t i = 0; i < m; ++i){
+    M[i+i*m] += 1.;
+  }
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.0),B21,n4, A11,n4, std::complex<double>(0.0),X,m);
+  RNP::TBLAS::CopyMatrix<'A'>(m,m, B22,n4, X+mm,m);
+  RNP::LinearSolve<'N'>(m, 2*m, M,m, X,m, &info, pivots);
+  // S21 = A21 + A22 X1, S22 = A22 X2
+  RNP::TBLAS::CopyMatrix<'A'>(m,m, A21,n4, &S[n2+0*n4],n4);
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.0),A22,n4, X,m, std::complex<double>(1.0),&S[n2+0*n4],n4);
+  RNP::TBLAS::MultMM<'N','N'>(m,m,m, std::complex<double>(1.0),A22,n4, X+mm,m, std::complex<double>(0.0),&S[n2+n2*n4],n4);
+}
+
+void CombineSMatrix(
+  size_t n, // glist.n
+  const std::complex<double> *Sa, // size (4*n)^2
+  const std::complex<double> *Sb, // size (4*n)^2
+  std::complex<double> *S, // size (4*n)^2
+  std::complex<double> *work_, // length 3*(2*n)^2
+  size_t *iwork // length n2
+){
+  const size_t n2 = 2*n;
+  const size_t n4 = 2*n2;
+  const size_t n22 = n2*n2;
+
+  std::complex<double> *work = work_;
+  if(NULL == work_){
+    work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*3*n22);
+  }
+  size_t *pivots = iwork;
+  if(NULL == iwork){
+    pivots = (size_t*)rcwa_malloc(sizeof(size_t)*n2);
+  }
+
+  if(IsPolarizationDecoupled(n, 2, Sa, n4) && IsPolarizationDecoupled(n, 2, Sb, n4)){
+    // So is the combined S-matrix; each block of the modes is combined on its own
+    RNP::TBLAS::SetMatrix<'A'>(n4,n4, 0.,0., S,n4);
+    for(size_t off = 0; off < n2; off += n){
+      CombineSMatrix_modes(n2, n, &Sa[off+off*n4], &Sb[off+off*n4], &S[off+off*n4], work, pivots);
+    }
+  }else{
+    CombineSMatrix_modes(n2, n2, Sa, Sb, S, work, pivots);
+  }
+
+  if(NULL == work_){
+    rcwa_free(work);
+  }
+  if(NULL == iwork){
+    rcwa_free(pivots);
+  }
+}
+
+
+// Y = U*X, where U is a symmetry basis of size 2n x m (see rcwa.h) and X
+// is m x ncols.
+static void BasisMult(
+  size_t n2, size_t m, const int *Urow, const double *Uval,
+  size_t ncols,
+  const std::complex<double> *X, size_t ldx,
+  std::complex<double> *Y, size_t ldy
+){
+  RNP::TBLAS::SetMatrix<'A'>(n2,ncols, 0.,0., Y,ldy);
+  for(size_t j = 0; j < ncols; ++j){
+    for(size_t i = 0; i < m; ++i){
+      for(size_t k = 0; k < 4; ++k){
+        const int r = Urow[4*i+k];
+        if(r >= 0){
+          Y[r+j*ldy] += Uval[4*i+k] * X[i+j*ldx];
+        }
+      }
+    }
+  }
+}
+// Y = U^T*X, where U is a symmetry basis of size 2n x m and X is 2n x ncols.
+static void BasisMultT(
+  size_t m, const int *Urow, const double *Uval,
+  size_t ncols,
+  const std::complex<double> *X, size_t ldx,
+  std::complex<double> *Y, size_t ldy
+){
+  for(size_t j = 0; j < ncols; ++j){
+    for(size_t i = 0; i < m; ++i){
+      std::complex<double> sum = 0;
+      for(size_t k = 0; k < 4; ++k){
+        const int r = Urow[4*i+k];
+        if(r >= 0){
+          sum += Uval[4*i+k] * X[r+j*ldx];
+        }
+      }
+      Y[i+j*ldy] = sum;
+    }
+  }
+}
+// Y = A*U, where A is 2n x 2n.
+static void MultBasis(
+  size_t n2, size_t m, const int *Urow, const double *Uval,
+  const std::complex<double> *A, size_t lda,
+  std::complex<double> *Y, size_t ldy
+){
+  RNP::TBLAS::SetMatrix<'A'>(n2,m, 0.,0., Y,ldy);
+  for(size_t j = 0; j < m; ++j){
+    for(size_t k = 0; k < 4; ++k){
+      const int r = Urow[4*j+k];
+      if(r >= 0){
+        RNP::TBLAS::Axpy(n2, Uval[4*j+k], &A[0+r*lda],1, &Y[0+j*ldy],1);
+      }
+    }
+  }
+}
+
+int SolveLayerEigensystem_projected(
+  std::complex<double> omega,
+  size_t n,
+  const double *kx,
+  const double *ky,
+  const std::complex<double> *Epsilon_inv,
+  const std::complex<double> *Epsilon2,
+  int epstype,
+  size_t m,
+  const int *Urow,
+  const double *Uval,
+  std::complex<double> *q,
+  std::complex<double> *kp,
+  std::complex<double> *phi
+){
+  const size_t n2 = 2*n;
+  const size_t kp_size = (NULL == kp ? n2*n2 : 0);
+
+  std::complex<double> dum;
+  double rdum;
+  RNP::Eigensystem(m, NULL, m, q, NULL, 1, phi, m, &dum, &rdum, (size_t)-1);
+  const size_t eigenlwork = (size_t)dum.real();
+  std::complex<double> *work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*(kp_size + 2*n2*m + 2*m*m + eigenlwork));
+  std::complex<double> *kp_use = (NULL != kp ? kp : work);
+  std::complex<double> *Y = work + kp_size;
+  std::complex<double> *Z = Y + n2*m;
+  std::complex<double> *op = Z + n2*m;
+  std::complex<double> *phir = op + m*m;
+  std::complex<double> *eigenwork = phir + m*m;
+  double *rwork = (double*)rcwa_malloc(sizeof(double)*2*m);
+
+  MakeKPMatrix(omega, n, kx, ky, Epsilon_inv, epstype, NULL, kp_use, n2);
+
+  // Z = (Epsilon2*kp - [kx;ky][kx ky])*U
+  MultBasis(n2, m, Urow, Uval, kp_use, n2, Y, n2);
+  RNP::TBLAS::MultMM<'N','N'>(n2,m,n2, std::complex<double>(1.),Epsilon2,n2, Y,n2, std::complex<double>(0.),Z,n2);
+  for(size_t j = 0; j < m; ++j){
+    for(size_t k = 0; k < 4; ++k){
+      const int r = Urow[4*j+k];
+      if(r < 0){ continue; }
+      const size_t g = (size_t)r % n;
+      const double kr = ((size_t)r < n ? kx[g] : ky[g]) * Uval[4*j+k];
+      Z[g  +j*n2] -= kx[g]*kr;
+      Z[g+n+j*n2] -= ky[g]*kr;
+    }
+  }
+  // The reduced eigenoperator is U^T*Z. The part of Z outside the span of
+  // U must vanish, or the layer does not have the symmetry of the basis.
+  BasisMultT(m, Urow, Uval, m, Z,n2, op,m);
+  double znorm = 0, rnorm = 0;
+  for(size_t i = 0; i < n2*m; ++i){
+    znorm += std::norm(Z[i]);
+  }
+  BasisMult(n2, m, Urow, Uval, m, op,m, Y,n2);
+  for(size_t i = 0; i < n2*m; ++i){
+    rnorm += std::norm(Z[i] - Y[i]);
+  }
+  int ret = 1;
+  if(rnorm <= 1e-12*znorm){
+    int info = RNP::Eigensystem(m, op, m, q, NULL, 1, phir, m, eigenwork, rwork, eigenlwork);
+    if(0 != info){
+      fprintf(stderr, "Layer eigensystem returned info = %d\n", info);
+    }
+    EigenvaluesToQ(omega, m, q);
+    // The modes outside the subspace are never excited; their q only needs
+    // to be nonzero.
+    for(size_t i = m; i < n2; ++i){
+      q[i] = 1.;
+    }
+    BasisMult(n2, m, Urow, Uval, m, phir,m, phi,n2);
+    RNP::TBLAS::SetMatrix<'A'>(n2,n2-m, 0.,0., &phi[0+m*n2],n2);
+    ret = 0;
+  }
+
+  rcwa_free(rwork);
+  rcwa_free(work);
+  return ret;
+}
+
+int GetModeAmplitudes_projected(
+  size_t n,
+  const std::complex<double> *phi,
+  size_t m,
+  const int *Urow,
+  const double *Uval,
+  const std::complex<double> *h,
+  std::complex<double> *a
+){
+  const size_t n2 = 2*n;
+  std::complex<double> *work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*(n2 + m + (NULL == phi ? 0 : m*m)));
+  std::complex<double> *hu = work;
+  std::complex<double> *hr = hu + n2;
+
+  BasisMultT(m, Urow, Uval, 1, h,n2, hr,m);
+  BasisMult(n2, m, Urow, Uval, 1, hr,m, hu,n2);
+  double hnorm = 0, rnorm = 0;
+  for(size_t i = 0; i < n2; ++i){
+    hnorm += std::norm(h[i]);
+    rnorm += std::norm(h[i] - hu[i]);
+  }
+  if(NULL == phi){
+    RNP::TBLAS::Copy(n2, hu,1, a,1);
+  }else{
+    // phi = [ U*phi_r, 0 ], so phi_r = U^T*phi
+    std::complex<double> *phir = hr + m;
+    BasisMultT(m, Urow, Uval, m, phi,n2, phir,m);
+    RNP::LinearSolve<'N'>(m,1, phir,m, hr,m, NULL, NULL);
+    RNP::TBLAS::Copy(m, hr,1, a,1);
+    RNP::TBLAS::Fill(n2-m, 0., a+m,1);
+  }
+  rcwa_free(work);
+  return (rnorm <= 1e-20*hnorm) ? 0 : 1;
+}
+
+int SolveInterior_projected(
+  size_t nlayers,
+  size_t which_layer,
+  size_t n,
+  const double *kx, const double *ky,
+  std::complex<double> omega,
+  const double *thickness,
+  const std::complex<double> **q,
+  const std::complex<double> **Epsilon_inv,
+  int *epstype,
+  const std::complex<double> **kp,
+  const std::complex<double> **phi,
+  size_t m,
+  const int *Urow,
+  const double *Uval,
+  const std::complex<double> *a0,
+  const std::complex<double> *bN,
+  std::complex<double> *ab
+){
+  if(0 == nlayers){ return -1; }
+  if(which_layer >= nlayers){ return -2; }
+  S4_ProfileScope profile_scope(NULL, S4_PROFILE_SOLVE);
+
+  const size_t n2 = 2*n;
+  const size_t mm = m*m;
+
+  // The layers of the reduced problem. Layers that share their modes also
+  // share the reduced ones, so that their interfaces stay trivial.
+  const std::complex<double> **views = (const std::complex<double>**)rcwa_malloc(sizeof(std::complex<double>*)*3*nlayers);
+  const std::complex<double> **qr = views;
+  const std::complex<double> **kpr = qr + nlayers;
+  const std::complex<double> **phir = kpr + nlayers;
+  std::complex<double> *layers = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*nlayers*(m + 2*mm));
+  // kp and kp*U while reducing the layers, then the two S-matrices, the
+  // amplitudes and the workspace of GetSMatrix_modes
+  const size_t lwork = std::max(n2*n2 + n2*m, 12*mm + 6*m);
+  std::complex<double> *work = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>)*lwork);
+  size_t *pivots = (size_t*)rcwa_malloc(sizeof(size_t)*m);
+
+  for(size_t l = 0; l < nlayers; ++l){
+    size_t same = l;
+    for(size_t k = 0; k < l; ++k){
+      if(q[k] == q[l] && kp[k] == kp[l] && phi[k] == phi[l] && Epsilon_inv[k] == Epsilon_inv[l]){
+        same = k;
+        break;
+      }
+    }
+    if(same != l){
+      qr[l] = qr[same];
+      kpr[l] = kpr[same];
+      phir[l] = phir[same];
+      continue;
+    }
+    std::complex<double> *lq = layers + l*(m + 2*mm);
+    std::complex<double> *lkp = lq + m;
+    std::complex<double> *lphi = lkp + mm;
+
+    // kp_r = U^T*kp*U
+    const std::complex<double> *kp_full = kp[l];
+    std::complex<double> *Y = work + n2*n2;
+    if(NULL == kp_full){
+      MakeKPMatrix(omega, n, kx, ky, Epsilon_inv[l], epstype[l], NULL, work, n2);
+      kp_full = work;
+    }
+    MultBasis(n2, m, Urow, Uval, kp_full, n2, Y, n2);
+    BasisMultT(m, Urow, Uval, m, Y,n2, lkp,m);
+    kpr[l] = lkp;
+
+    if(NULL == phi[l]){
+      // The columns of U are modes of a uniform layer
+      for(size_t j = 0; j < m; ++j){
+        lq[j] = q[l][Urow[4*j]];
+      }
+      qr[l] = lq;
+      phir[l] = NULL;
+    }else{
+      BasisMultT(m, Urow, Uval, m, phi[l],n2, lphi,m);
+      qr[l] = q[l];
+      phir[l] = lphi;
+    }
+  }
+
+  std::complex<double> *S0l = work;
+  std::complex<double> *SlN = S0l + 4*mm;
+  std::complex<double> *a0r = SlN + 4*mm;
+  std::complex<double> *bNr = a0r + m;
+  std::complex<double> *alr = bNr + m;
+  std::complex<double> *blr = alr + m;
+  std::complex<double> *work_modes = blr + m;
+
+  RNP::TBLAS::SetMatrix<'A'>(2*m,2*m, 0.,1., S0l,2*m);
+  RNP::TBLAS::SetMatrix<'A'>(2*m,2*m, 0.,1., SlN,2*m);
+  GetSMatrix_modes(which_layer+1, n, kx, ky, omega,
+    thickness, qr, Epsilon_inv, epstype, kpr, phir,
+    m, 0, m, S0l, work_modes, pivots);
+  GetSMatrix_modes(nlayers-which_layer, n, kx, ky, omega,
+    thickness+which_layer, qr+which_layer, Epsilon_inv+which_layer, epstype+which_layer, kpr+which_layer, phir+which_layer,
+    m, 0, m, SlN, work_modes, pivots);
+
+  // The exterior amplitudes in the reduced basis
+  if(NULL != a0){
+    if(NULL == phi[0]){
+      BasisMultT(m, Urow, Uval, 1, a0,n2, a0r,m);
+    }else{
+      RNP::TBLAS::Copy(m, a0,1, a0r,1);
+    }
+  }
+  if(NULL != bN){
+    if(NULL == phi[nlayers-1]){
+      BasisMultT(m, Urow, Uval, 1, bN,n2, bNr,m);
+    }else{
+      RNP::TBLAS::Copy(m, bN,1, bNr,1);
+    }
+  }
+  SolveInteriorSMatrix_modes(m, m, S0l, SlN,
+    (NULL != a0 ? a0r : NULL), (NULL != bN ? bNr : NULL),
+    alr, blr, work_modes, pivots);
+
+  std::complex<double> *al = ab;
+  std::complex<double> *bl = al+n2;
+  if(NULL == phi[which_layer]){
+    BasisMult(n2, m, Urow, Uval, 1, alr,m, al,n2);
+    BasisMult(n2, m, Urow, Uval, 1, blr,m, bl,n2);
+  }else{
+    RNP::TBLAS::Copy(m, alr,1, al,1);
+    RNP::TBLAS::Fill(n2-m, 0., al+m,1);
+    RNP::TBLAS::Copy(m, blr,1, bl,1);
+    RNP::TBLAS::Fill(n2-m, 0., bl+m,1);
+  }
+
+  rcwa_free(pivots);
+  rcwa_free(work);
+  rcwa_free(layers);
+  rcwa_free(views);
+  return 0;
+}
 
 
 void TranslateAmplitudes(
@@ -2116,6 +3349,82 @@ void GetFieldAtPoint(
     rcwa_free(eh);
   }
 }
+void GetFieldAtPoints(
+  size_t n, // glist.n
+  const double *kx,
+  const double *ky,
+  std::complex<double> omega,
+  const std::complex<double> *q, // length 2*glist.n
+  const std::complex<double> *kp, // size (2*glist.n)^2 (k-parallel matrix)
+  const std::complex<double> *phi, // size (2*glist.n)^2
+  const std::complex<double> *epsilon_inv, // size (glist.n)^2, non NULL for efield != NULL
+  int epstype,
+  const std::complex<double> *ab, // length 4*glist.n
+  size_t npts,
+  const double *r, // length 2*npts, coordinates within layer
+  std::complex<double> *efield, // length 3*npts
+  std::complex<double> *hfield // length 3*npts
+){
+  const std::complex<double> z_zero(0.);
+  const std::complex<double> z_one(1.);
+  const size_t n2 = 2*n;
+  const size_t nblock = 64; // points per matrix product
+  const bool want_e = (NULL != efield && NULL != epsilon_inv);
+
+  std::complex<double> *eh = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>) * (8*n2 + 6*n + nblock*n + 6*nblock));
+  std::complex<double> *coeff = eh + 8*n2; // n x 6; Ex, Ey, Ez, Hx, Hy, Hz
+  std::complex<double> *phase = coeff + 6*n; // nblock x n
+  std::complex<double> *field = phase + nblock*n; // nblock x 6
+
+  GetInPlaneFieldVector(n, kx, ky, omega, q, epsilon_inv, epstype, kp, phi, ab, eh);
+  const std::complex<double> *hx  = &eh[3*n2+0];
+  const std::complex<double> *hy  = &eh[3*n2+n];
+  const std::complex<double> *ney = &eh[4*n2+0];
+  const std::complex<double> *ex  = &eh[4*n2+n];
+
+  if(want_e){
+    for(size_t i = 0; i < n; ++i){
+      eh[i] = (ky[i]*hx[i] - kx[i]*hy[i]);
+    }
+    if(EPSILON2_TYPE_BLKDIAG1_SCALAR == epstype || EPSILON2_TYPE_BLKDIAG2_SCALAR == epstype){
+      RNP::TBLAS::Scale(n, epsilon_inv[0], eh,1);
+      RNP::TBLAS::Copy(n, eh,1, &eh[n], 1);
+    }else{
+      RNP::TBLAS::MultMV<'N'>(n,n, z_one,epsilon_inv,n, eh,1, z_zero,&eh[n],1);
+    }
+  }
+  for(size_t i = 0; i < n; ++i){
+    coeff[i+0*n] = ex[i];
+    coeff[i+1*n] = -ney[i];
+    coeff[i+2*n] = (want_e ? eh[n+i] / omega : z_zero);
+    coeff[i+3*n] = hx[i];
+    coeff[i+4*n] = hy[i];
+    coeff[i+5*n] = (kx[i] * -ney[i] - ky[i] * ex[i]) / omega;
+  }
+
+  for(size_t p0 = 0; p0 < npts; p0 += nblock){
+    const size_t m = (npts - p0 < nblock ? npts - p0 : nblock);
+    for(size_t i = 0; i < n; ++i){
+      for(size_t p = 0; p < m; ++p){
+        const double theta = (kx[i]*r[2*(p0+p)+0] + ky[i]*r[2*(p0+p)+1]);
+        phase[p+i*m] = std::complex<double>(cos(theta),sin(theta));
+      }
+    }
+    RNP::TBLAS::MultMM<'N','N'>(m,6,n, z_one,phase,m, coeff,n, z_zero,field,m);
+    for(size_t p = 0; p < m; ++p){
+      for(size_t j = 0; j < 3; ++j){
+        if(want_e){
+          efield[3*(p0+p)+j] = field[p+j*m];
+        }
+        if(NULL != hfield){
+          hfield[3*(p0+p)+j] = field[p+(3+j)*m];
+        }
+      }
+    }
+  }
+
+  rcwa_free(eh);
+}
 void GetFieldOnGrid(
   size_t n, // glist.n
   int *G,
@@ -2131,23 +3440,46 @@ void GetFieldOnGrid(
   const double *xy0,
   std::complex<double> *efield,
   std::complex<double> *hfield
+){
+  // A single slice at zero offset leaves the amplitudes unchanged
+  const double dz = 0;
+  GetFieldOnGridSlices(n, G, kx, ky, omega, q, kp, phi, epsilon_inv, epstype,
+    ab, 0., 1, &dz, nxy, efield, hfield);
+}
+void GetFieldOnGridSlices(
+  size_t n, // glist.n
+  int *G,
+  const double *kx, const double *ky,
+  std::complex<double> omega,
+  const std::complex<double> *q, // length 2*glist.n
+  const std::complex<double> *kp, // size (2*glist.n)^2 (k-parallel matrix)
+  const std::complex<double> *phi, // size (2*glist.n)^2
+  const std::complex<double> *epsilon_inv, // size (glist.n)^2, non NULL for efield != NULL || kp == NULL
+  int epstype,
+  const std::complex<double> *ab0, // length 4*glist.n
+  double thickness,
+  size_t nz, const double *dz, // offsets of the slices within the layer
+  const size_t nxy[2], // number of points per lattice direction
+  std::complex<double> *efield,
+  std::complex<double> *hfield
 ){
   const std::complex<double> z_zero(0.);
   const std::complex<double> z_one(1.);
   const size_t n2 = 2*n;
+  const size_t n4 = 2*n2;
   const size_t N = nxy[0]*nxy[1];
   const int nxyoff[2] = { (int)(nxy[0]/2), (int)(nxy[1]/2) };
-  int inxy[2] = { (int)nxy[0], (int)nxy[1] };
   int inxy_rev[2] = { (int)nxy[1], (int)nxy[0] };
 
-  std::complex<double> *eh = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>) * 8*n2);
-
-  GetInPlaneFieldVector(n, kx, ky, omega, q, epsilon_inv, epstype, kp, phi, ab, eh);
+  std::complex<double> *eh = (std::complex<double>*)rcwa_malloc(sizeof(std::complex<double>) * (8*n2 + n4));
+  std::complex<double> *ab = eh + 8*n2;
   const std::complex<double> *hx  = &eh[3*n2+0];
   const std::complex<double> *hy  = &eh[3*n2+n];
   const std::complex<double> *ney = &eh[4*n2+0];
   const std::complex<double> *ex  = &eh[4*n2+n];
 
+  // The plans and buffers are shared by all slices. Every slice fills the
+  // same Fourier coefficients, so the rest of the input stays zero.
   std::complex<double> *from[6];
   std::complex<double> *to[6];
   fft_plan plan[6];
@@ -2158,46 +3490,54 @@ void GetFieldOnGrid(
     plan[i] = fft_plan_dft_2d(inxy_rev, from[i], to[i], 1);
   }
 
-  for(size_t i = 0; i < n; ++i){
-    eh[i] = (ky[i]*hx[i] - kx[i]*hy[i]);
-  }
-  if(EPSILON2_TYPE_BLKDIAG1_SCALAR == epstype || EPSILON2_TYPE_BLKDIAG2_SCALAR == epstype){
-    RNP::TBLAS::Scale(n, epsilon_inv[0], eh,1);
-    RNP::TBLAS::Copy(n, eh,1, &eh[n], 1);
-  }else{
-    RNP::TBLAS::MultMV<'N'>(n,n, z_one,epsilon_inv,n, eh,1, z_zero,&eh[n],1);
-  }
-  for(size_t i = 0; i < n; ++i){
-    const int iu = G[2*i+0];
-    const int iv = G[2*i+1];
-    if(
-      (nxyoff[0] - (int)nxy[0] < iu && iu <= nxyoff[0]) &&
-      (nxyoff[1] - (int)nxy[1] < iv && iv <= nxyoff[1])
-    ){
-      //todo: const std::complex<double> shift_phase(-i 2pi Lk.G.xy0);
-      const int ii = (iu >= 0 ? iu : iu + nxy[0]);
-      const int jj = (iv >= 0 ? iv : iv + nxy[1]);
-      from[0][ii+jj*nxy[0]] = hx[i];
-      from[1][ii+jj*nxy[0]] = hy[i];
-      from[2][ii+jj*nxy[0]] = (kx[i] * ney[i] + ky[i] * ex[i]) / omega;
-      from[3][ii+jj*nxy[0]] = ex[i];
-      from[4][ii+jj*nxy[0]] = -ney[i];
-      from[5][ii+jj*nxy[0]] = eh[n+i] / omega;
+  for(size_t k = 0; k < nz; ++k){
+    RNP::TBLAS::Copy(n4, ab0,1, ab,1);
+    TranslateAmplitudes(n, q, thickness, dz[k], ab);
+    GetInPlaneFieldVector(n, kx, ky, omega, q, epsilon_inv, epstype, kp, phi, ab, eh);
+
+    for(size_t i = 0; i < n; ++i){
+      eh[i] = (ky[i]*hx[i] - kx[i]*hy[i]);
+    }
+    if(EPSILON2_TYPE_BLKDIAG1_SCALAR == epstype || EPSILON2_TYPE_BLKDIAG2_SCALAR == epstype){
+      RNP::TBLAS::Scale(n, epsilon_inv[0], eh,1);
+      RNP::TBLAS::Copy(n, eh,1, &eh[n], 1);
+    }else{
+      RNP::TBLAS::MultMV<'N'>(n,n, z_one,epsilon_inv,n, eh,1, z_zero,&eh[n],1);
+    }
+    for(size_t i = 0; i < n; ++i){
+      const int iu = G[2*i+0];
+      const int iv = G[2*i+1];
+      if(
+        (nxyoff[0] - (int)nxy[0] < iu && iu <= nxyoff[0]) &&
+        (nxyoff[1] - (int)nxy[1] < iv && iv <= nxyoff[1])
+      ){
+        //todo: const std::complex<double> shift_phase(-i 2pi Lk.G.xy0);
+        const int ii = (iu >= 0 ? iu : iu + nxy[0]);
+        const int jj = (iv >= 0 ? iv : iv + nxy[1]);
+        from[0][ii+jj*nxy[0]] = hx[i];
+        from[1][ii+jj*nxy[0]] = hy[i];
+        from[2][ii+jj*nxy[0]] = (kx[i] * ney[i] + ky[i] * ex[i]) / omega;
+        from[3][ii+jj*nxy[0]] = ex[i];
+        from[4][ii+jj*nxy[0]] = -ney[i];
+        from[5][ii+jj*nxy[0]] = eh[n+i] / omega;
+      }
     }
-  }
 
-  for(unsigned i = 0; i < 6; ++i){
-    fft_plan_exec(plan[i]);
-  }
+    for(unsigned i = 0; i < 6; ++i){
+      fft_plan_exec(plan[i]);
+    }
 
-  for(size_t j = 0; j < nxy[1]; ++j){
-    for(size_t i = 0; i < nxy[0]; ++i){
-      hfield[3*(i+j*nxy[0])+0] = to[0][i+j*nxy[0]];
-      hfield[3*(i+j*nxy[0])+1] = to[1][i+j*nxy[0]];
-      hfield[3*(i+j*nxy[0])+2] = to[2][i+j*nxy[0]];
-      efield[3*(i+j*nxy[0])+0] = to[3][i+j*nxy[0]];
-      efield[3*(i+j*nxy[0])+1] = to[4][i+j*nxy[0]];
-      efield[3*(i+j*nxy[0])+2] = to[5][i+j*nxy[0]];
+    std::complex<double> *E = efield + 3*N*k;
+    std::complex<double> *H = hfield + 3*N*k;
+    for(size_t j = 0; j < nxy[1]; ++j){
+      for(size_t i = 0; i < nxy[0]; ++i){
+        H[3*(i+j*nxy[0])+0] = to[0][i+j*nxy[0]];
+        H[3*(i+j*nxy[0])+1] = to[1][i+j*nxy[0]];
+        H[3*(i+j*nxy[0])+2] = to[2][i+j*nxy[0]];
+        E[3*(i+j*nxy[0])+0] = to[3][i+j*nxy[0]];
+        E[3*(i+j*nxy[0])+1] = to[4][i+j*nxy[0]];
+        E[3*(i+j*nxy[0])+2] = to[5][i+j*nxy[0]];
+      }
     }
   }
 
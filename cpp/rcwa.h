@@ -40,6 +40,13 @@
 
 // To compute S-matrices, we require the eigenvector and
 // eigenvalue matrices.
+//
+// When all ky are zero, as for a 1D lattice with the plane of incidence
+// containing the lattice vector, and Epsilon2 does not couple the x and
+// y components, the modes split into two independent sets of size n.
+// The functions below detect this from the exact zeros in their inputs
+// and work on the two sets separately, at about a quarter of the cost.
+// The layout of q, kp, phi and of the S-matrices is unchanged.
 
 
 // Purpose
@@ -126,6 +133,94 @@ void SolveLayerEigensystem(
 	size_t lwork = 0 // set to -1 for query into work[0], at least 4*n*n+2*n
 );
 
+// Purpose
+// =======
+// Same as SolveLayerEigensystem, but for lossless layers at a real
+// frequency, where Epsilon_inv and Epsilon2 are Hermitian. The
+// eigenoperator is then the product
+//   (Epsilon2 - [ kx ] [ kx  ky ] / omega^2) * kp
+//               [ ky ]
+// of two Hermitian matrices, and if either one is positive definite
+// it is reduced with its Cholesky factor to a Hermitian eigenproblem,
+// solved by the divide and conquer algorithm (zheevd). This holds when
+// every order is propagating in the layer, such as for small numbers
+// of G-vectors or at high frequencies.
+//
+// Returns 0 on success. Returns 1, leaving q, kp and phi unspecified, if
+// the matrices are not Hermitian, neither factor is positive definite, or
+// LAPACK is unavailable, and 2 if the Hermitian eigensolver failed; the
+// general solver must then be used instead. Layers with an evanescent
+// order are ruled out from the diagonals of the two factors before any
+// of this work. Workspace is allocated internally.
+int SolveLayerEigensystem_hermitian(
+	double omega,
+	size_t n,
+	const double *kx,
+	const double *ky,
+	const std::complex<double> *Epsilon_inv, // size (glist.n)^2; inv of usual dielectric Fourier coupling matrix
+	const std::complex<double> *Epsilon2, // size (2*glist.n)^2 (dielectric/normal-field matrix)
+	int epstype,
+	std::complex<double> *q, // length 2*glist.n
+	std::complex<double> *kp, // size (2*glist.n)^2 (k-parallel matrix) (optional)
+	std::complex<double> *phi // size (2*glist.n)^2
+);
+
+// Purpose
+// =======
+// Same as SolveLayerEigensystem, but only the eigenmodes with the
+// smallest |Im q| (the propagating and weakly evanescent ones) are
+// computed, by the implicitly restarted Arnoldi method. The eigenoperator
+// is applied to vectors without being formed, in O(n^2) operations, so
+// the cost is O(n^2 nmodes) instead of the O(n^3) of the dense solver.
+// The left eigenvectors of the same modes are computed likewise from the
+// adjoint operator.
+//
+// The first nmodes columns of phi are the computed modes, sorted by
+// |Im q|. The remaining 2n-nmodes columns approximate the omitted modes:
+// the Fourier components least represented in the computed modes are
+// grouped into clusters of orders of nearly equal |k|, and the
+// eigenoperator, projected onto the invariant subspace of the omitted
+// modes, is diagonalized within each cluster, neglecting the coupling
+// between clusters. Their q are no smaller in imaginary part than those
+// of the computed modes. The error they cause across the layer is of the
+// order of exp(-Im(q) d) for the largest Im(q) of the computed modes, d
+// being the layer thickness. The error they cause at the interfaces of
+// the layer comes from the neglected coupling, which approx_residual
+// measures; it decreases as nmodes grows.
+//
+// nmodes      - (INPUT/OUTPUT) On entry, the number of modes wanted. On
+//               exit, the number computed, which is larger if needed to
+//               keep modes of equal |Im q| together.
+// residual    - (OUTPUT) The largest norm of the residual of the
+//               computed eigenpairs, relative to the largest magnitude
+//               of the approximate eigenvalues.
+// approx_residual - (OUTPUT) The same for the approximate modes, of which
+//               only the nmodes slowest decaying ones are checked, since
+//               forming all residuals would cost O(n^3). (optional)
+//
+// Returns 0 on success. Returns nonzero, leaving q, kp and phi
+// unspecified, if Epsilon2 is not full, the layer is decoupled (see
+// SolveLayerEigensystem), the Arnoldi basis for nmodes (about 2*nmodes+32
+// vectors) exceeds 2n/8, beyond which the method is not reliably cheaper
+// than the dense solver, the iteration did not converge, or
+// LAPACK is unavailable; the dense solver must then be used instead.
+// Workspace is allocated internally.
+int SolveLayerEigensystem_partial(
+	std::complex<double> omega,
+	size_t n,
+	const double *kx,
+	const double *ky,
+	const std::complex<double> *Epsilon_inv, // size (glist.n)^2; inv of usual dielectric Fourier coupling matrix
+	const std::complex<double> *Epsilon2, // size (2*glist.n)^2 (dielectric/normal-field matrix)
+	int epstype,
+	size_t *nmodes,
+	std::complex<double> *q, // length 2*glist.n
+	std::complex<double> *kp, // size (2*glist.n)^2 (k-parallel matrix) (optional)
+	std::complex<double> *phi, // size (2*glist.n)^2
+	double *residual,
+	double *approx_residual
+);
+
 // Purpose
 // =======
 // Same as SolveLayerEigensystem, but assumes Epsilon is eps*I.
@@ -341,6 +436,168 @@ int SolveInterior(
 	size_t lwork = 0 // set to -1 for query into work[0], at least 2*(4*n)^2 + 2*(2*n) + 4*n*(4*n+1)
 );
 
+// Purpose
+// =======
+// Same as SolveInterior, but with the S-matrices of the partial stacks
+// before and after the layer already computed (by GetSMatrix or
+// CombineSMatrix).
+//
+// Arguments
+// =========
+// n      - (INPUT) Number of Fourier orders.
+// S0l    - (INPUT) Matrix of size 4n x 4n. S-matrix of the layers up to
+//          and including the layer in which ab is computed.
+// SlN    - (INPUT) Matrix of size 4n x 4n. S-matrix of the layers from
+//          the layer in which ab is computed to the end of the stack.
+// a0, bN - (INPUT) Input mode amplitudes. (See SolveInterior).
+// ab     - (OUTPUT) Output mode amplitudes. (See SolveInterior).
+// work   - (WORK) Workspace of length (2*n)^2 + 4*n. If NULL, the space is
+//          internally allocated.
+// iwork  - (WORK) Integer workspace, of length 2n. If NULL, the the
+//          space is internally allocated.
+void SolveInteriorSMatrix(
+	size_t n, // glist.n
+	const std::complex<double> *S0l, // size (4*n)^2
+	const std::complex<double> *SlN, // size (4*n)^2
+	const std::complex<double> *a0, // length 2*n
+	const std::complex<double> *bN, // length 2*n
+	std::complex<double> *ab, // length 4*n
+	std::complex<double> *work = NULL, // length (2*n)^2 + 4*n
+	size_t *iwork = NULL // length n2
+);
+
+// Purpose
+// =======
+// Combines the S-matrices of two layer stacks that share a layer; the
+// first stack ends with the layer that the second stack starts with.
+// The result is the S-matrix of the combined stack (Redheffer star
+// product).
+//
+// Arguments
+// =========
+// n     - (INPUT) Number of Fourier orders.
+// Sa    - (INPUT) Matrix of size 4n x 4n. S-matrix of the first stack.
+// Sb    - (INPUT) Matrix of size 4n x 4n. S-matrix of the second stack.
+// S     - (OUTPUT) Matrix of size 4n x 4n. Must not overlap Sa or Sb.
+// work  - (WORK) Workspace of length 3*(2*n)^2. If NULL, the space is
+//         internally allocated.
+// iwork - (WORK) Integer workspace, of length 2n. If NULL, the the
+//         space is internally allocated.
+void CombineSMatrix(
+	size_t n, // glist.n
+	const std::complex<double> *Sa, // size (4*n)^2
+	const std::complex<double> *Sb, // size (4*n)^2
+	std::complex<double> *S, // size (4*n)^2
+	std::complex<double> *work = NULL, // length 3*(2*n)^2
+	size_t *iwork = NULL // length n2
+);
+
+//////////////////////// Mirror symmetric problems ////////////////////////
+
+// When the structure and the excitation are symmetric under mirrors, the
+// fields lie in a subspace of the in-plane field vectors [hx; hy] of size
+// 2n. A symmetry basis of m vectors spanning it is a 2n x m matrix U with
+// orthonormal real columns, each with at most 4 nonzero entries. Column
+// j has the entries Uval[4*j+k] in the rows Urow[4*j+k], k = 0..3, where
+// the first row is always valid and unused entries have Urow = -1.
+//
+// The functions below solve the problem restricted to the subspace. The
+// layers keep q, kp and phi of the usual sizes, so that the solution can
+// be used by the functions that follow, but only the first m modes of a
+// layer solved by SolveLayerEigensystem_projected are computed:
+//   phi = [ U phi_r  0 ],  q = [ q_r  1 ].
+// The other modes are never excited and their amplitudes are zero. The
+// modes of uniform layers (phi = NULL) are not changed.
+
+// Purpose
+// =======
+// Same as SolveLayerEigensystem, restricted to the subspace of a symmetry
+// basis. kp, if not NULL, is filled in full.
+//
+// Arguments
+// =========
+// m, Urow, Uval - (INPUT) The symmetry basis.
+// Other arguments are as for SolveLayerEigensystem.
+//
+// Returns
+// =======
+// 0 on success, 1 if the subspace is not invariant under the layer
+// eigenoperator (the layer does not have the symmetry of the basis).
+int SolveLayerEigensystem_projected(
+	std::complex<double> omega,
+	size_t n, // glist.n
+	const double *kx,
+	const double *ky,
+	const std::complex<double> *Epsilon_inv, // size (glist.n)^2
+	const std::complex<double> *Epsilon2, // size (2*glist.n)^2
+	int epstype,
+	size_t m,
+	const int *Urow, // length 4*m
+	const double *Uval, // length 4*m
+	std::complex<double> *q, // length 2*glist.n
+	std::complex<double> *kp, // size (2*glist.n)^2
+	std::complex<double> *phi // size (2*glist.n)^2
+);
+
+// Purpose
+// =======
+// Expresses an in-plane field vector h = [hx; hy] as the amplitudes of
+// the modes of a layer, for the projected problem. h is projected onto
+// the subspace of the symmetry basis.
+//
+// Arguments
+// =========
+// n             - (INPUT) Number of Fourier orders.
+// phi           - (INPUT) The phi of the layer, NULL for a uniform layer.
+// m, Urow, Uval - (INPUT) The symmetry basis.
+// h             - (INPUT) Length 2n. The field vector.
+// a             - (OUTPUT) Length 2n. The mode amplitudes.
+//
+// Returns
+// =======
+// 0 on success, 1 if h does not lie in the subspace.
+int GetModeAmplitudes_projected(
+	size_t n, // glist.n
+	const std::complex<double> *phi, // size (2*glist.n)^2
+	size_t m,
+	const int *Urow, // length 4*m
+	const double *Uval, // length 4*m
+	const std::complex<double> *h, // length 2*glist.n
+	std::complex<double> *a // length 2*glist.n
+);
+
+// Purpose
+// =======
+// Same as SolveInterior, restricted to the subspace of a symmetry basis.
+// The layers with phi must have been solved by
+// SolveLayerEigensystem_projected with the same basis. Only the
+// components of a0 and bN in the subspace are used.
+//
+// Arguments
+// =========
+// m, Urow, Uval - (INPUT) The symmetry basis.
+// Other arguments are as for SolveInterior. The workspace is allocated
+// internally.
+int SolveInterior_projected(
+	size_t nlayers,
+	size_t which_layer,
+	size_t n, // glist.n
+	const double *kx, const double *ky,
+	std::complex<double> omega,
+	const double *thickness, // list of thicknesses
+	const std::complex<double> **q, // list of q vectors
+	const std::complex<double> **Epsilon_inv, // size (glist.n)^2
+	int *epstype,
+	const std::complex<double> **kp,
+	const std::complex<double> **phi,
+	size_t m,
+	const int *Urow, // length 4*m
+	const double *Uval, // length 4*m
+	const std::complex<double> *a0, // length 2*n
+	const std::complex<double> *bN, // length 2*n
+	std::complex<double> *ab // length 4*n
+);
+
 //////////////////////// Solution manipulators ////////////////////////
 
 // Purpose
@@ -480,6 +737,42 @@ void GetFieldAtPoint(
 	std::complex<double> hfield[3],
 	std::complex<double> *work = NULL
 );
+
+// Purpose
+// =======
+// Returns the electric and/or magnetic field at many points of one
+// z-plane within a layer. The Fourier coefficients of the six field
+// components are formed once, and the Fourier series of all points are
+// summed together as a matrix product.
+//
+// Arguments
+// =========
+// n, kx, ky,  - (INPUT) As in GetFieldAtPoint.
+// omega, q,
+// kp, phi,
+// epsilon_inv,
+// epstype, ab
+// npts        - (INPUT) The number of points.
+// r           - (INPUT) Length 2*npts. The in-plane x- and y-coordinates
+//               of each point.
+// efield,     - (OUTPUT) Length 3*npts. The complex field at each point,
+// hfield        with the 3 components of a point stored contiguously.
+//               Either may be NULL if it is not needed.
+void GetFieldAtPoints(
+	size_t n, // glist.n
+	const double *kx, const double *ky,
+	std::complex<double> omega,
+	const std::complex<double> *q, // length 2*glist.n
+	const std::complex<double> *kp, // size (2*glist.n)^2 (k-parallel matrix)
+	const std::complex<double> *phi, // size (2*glist.n)^2
+	const std::complex<double> *epsilon_inv, // size (glist.n)^2, non NULL for efield != NULL || kp == NULL
+	int epstype,
+	const std::complex<double> *ab, // length 4*glist.n
+	size_t npts,
+	const double *r, // length 2*npts, coordinates within layer
+	std::complex<double> *efield, // length 3*npts
+	std::complex<double> *hfield // length 3*npts
+);
 void GetFieldOnGrid(
 	size_t n, // glist.n
 	int *G, // length 2*glist.n, pairs of uv coordinates of Lk
@@ -497,6 +790,42 @@ void GetFieldOnGrid(
 	std::complex<double> *hfield
 );
 
+// Purpose
+// =======
+// Returns the electric and magnetic fields on a grid for several z-offsets
+// within the same layer, as GetFieldOnGrid does for each one. Only the
+// propagation of the amplitudes differs between slices, so the FFT plans
+// and buffers are shared by all of them.
+//
+// Arguments
+// =========
+// ab0         - (INPUT) Length 4n. The mode amplitudes within the layer,
+//               as passed to TranslateAmplitudes.
+// thickness   - (INPUT) The thickness of the layer.
+// nz          - (INPUT) The number of slices.
+// dz          - (INPUT) Length nz. The offset of each slice within the
+//               layer.
+// efield,     - (OUTPUT) Length 3*nxy[0]*nxy[1]*nz. The fields of slice k
+// hfield        start at 3*nxy[0]*nxy[1]*k, laid out as in GetFieldOnGrid.
+// The remaining arguments are as in GetFieldOnGrid.
+void GetFieldOnGridSlices(
+	size_t n, // glist.n
+	int *G, // length 2*glist.n, pairs of uv coordinates of Lk
+	const double *kx, const double *ky,
+	std::complex<double> omega,
+	const std::complex<double> *q, // length 2*glist.n
+	const std::complex<double> *kp, // size (2*glist.n)^2 (k-parallel matrix)
+	const std::complex<double> *phi, // size (2*glist.n)^2
+	const std::complex<double> *epsilon_inv, // size (glist.n)^2
+	int epstype,
+	const std::complex<double> *ab0, // length 4*glist.n
+	double thickness,
+	size_t nz, const double *dz,
+	const size_t nxy[2], // number of points per lattice direction
+	std::complex<double> *efield,
+	std::complex<double> *hfield
+);
+
 // Purpose
 // =======
 // Returns the plane integral of the stress tensor over the unit cell
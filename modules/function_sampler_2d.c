@@ -213,11 +213,11 @@ function_sampler_2d function_sampler_2d_new(
 		T->v[1].r[0] = xy[4];
 		T->v[1].r[1] = xy[5];
 		T->v[1].r[2] = z[2];
-		T->v[1].id = id[2];
+		T->v[1].id = (NULL != id ? id[2] : 0);
 		T->v[2].r[0] = xy[2];
 		T->v[2].r[1] = xy[3];
 		T->v[2].r[2] = z[1];
-		T->v[2].id = id[1];
+		T->v[2].id = (NULL != id ? id[1] : 0);
 	}
 
 	/* Create the new halfedges */
@@ -322,6 +322,24 @@ void function_sampler_2d_get_max(
 	}
 }
 
+int function_sampler_2d_num_faces(const function_sampler_2d T){
+	if(NULL == T){ return 0; }
+	return T->nf;
+}
+
+void function_sampler_2d_get_faces(
+	const function_sampler_2d T, int *tri
+){
+	int i;
+	if(NULL == T){ return; }
+	for(i = 0; i < T->nf; ++i){
+		const int h = T->f[i].h;
+		tri[3*i+0] = FROM(h);
+		tri[3*i+1] = FROM(NEXT(h));
+		tri[3*i+2] = FROM(NEXT(NEXT(h)));
+	}
+}
+
 void DT_eval_bad(const function_sampler_2d T){
 	int i;
 	for(i = 0; i < T->nf; ++i){
@@ -449,7 +467,7 @@ int function_sampler_2d_get_refine(
 	T->tmp = (double*)realloc(T->tmp, sizeof(double) * nxy);
 	
 	/* Look through each interval */
-	for(i = 0; i+1 < T->nf; ++i){
+	for(i = 0; i < T->nf; ++i){
 		/* no priority */
 		/*
 		if(T->f[i].badness > 0){
@@ -15,6 +15,10 @@ typedef struct{
 	int range_bias;
 } function_sampler_2d_options;
 
+#ifdef __cplusplus
+extern "C" {
+#endif
+
 void function_sampler_2d_options_defaults(function_sampler_2d_options *options);
 function_sampler_2d function_sampler_2d_new(
 	const function_sampler_2d_options *options,
@@ -54,5 +58,18 @@ void function_sampler_2d_get_max(
 	double *xy, double *z, int *id
 );
 
+/* Returns the current number of triangles */
+int  function_sampler_2d_num_faces(const function_sampler_2d sampler);
+/* Gets the sample indices of the triangles, 3 per triangle in
+ * counterclockwise order. tri must hold 3*num_faces values.
+ */
+void function_sampler_2d_get_faces(
+	const function_sampler_2d sampler, int *tri
+);
+
+#ifdef __cplusplus
+} /* extern "C" */
+#endif
+
 
 #endif /* FUNCTION_SAMPLER_2D_H_INCLUDED */
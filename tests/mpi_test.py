@@ -12,3 +12,43 @@ comm = MPI.COMM_WORLD
 print(f"Hello! I am rank {comm.rank} from {comm.size} running in total...")
 
 comm.Barrier()
+
+# distributed sweep over frequency and slab thickness
+import S4.mpi
+
+
+def build(freq, thickness):
+    S = S4.Simulation()
+    S.create_new()
+    S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+    S.set_num_g(25)
+    S.add_material("vacuum", [1.0, 0.0])
+    S.add_material("silicon", [12.0, 0.1])
+    S.add_layer("top", 0.0, "vacuum")
+    S.add_layer("slab", thickness, "vacuum")
+    S.set_layer_pattern_circle("slab", "silicon", [0.0, 0.0], 0.2)
+    S.add_layer("bottom", 0.0, "vacuum")
+    S.set_excitation_planewave([0.0, 0.0], [1.0, 0.0], [0.0, 0.0])
+    S.set_frequency(freq)
+    return S
+
+
+grid = {"freq": np.linspace(0.4, 0.8, 7), "thickness": [0.25, 0.5, 0.75]}
+result = S4.mpi.sweep(build, grid, ["top", "bottom"], by_G=True)
+
+if comm.rank == 0:
+    flux, flux_by_G = result
+    assert flux.shape == (7, 3, 2, 4)
+    assert flux_by_G.shape[:3] == (7, 3, 2)
+    for i, freq in enumerate(grid["freq"]):
+        for j, thickness in enumerate(grid["thickness"]):
+            S = build(freq, thickness)
+            np.testing.assert_allclose(flux[i, j, 1],
+                                       S.get_poynting_flux("bottom"),
+                                       atol=1e-12)
+            np.testing.assert_allclose(flux_by_G[i, j, 0],
+                                       S.get_poynting_flux_by_G("top"),
+                                       atol=1e-12)
+    print("distributed sweep OK")
+else:
+    assert result is None
@@ -1,6 +1,55 @@
+import json
+import os
+import pickle
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import S4
 
+
+def make_slab(lattice=((1.0, 0.0), (0.0, 1.0)), num_g=25, loss=0.1,
+              hole=False, thickness=0.5, angles=(10.0, 0.0),
+              p_amp=(0.0, 0.0), frequency=0.6):
+    # a slab patterned with a circle of radius 0.2, silicon in vacuum or a
+    # hole in silicon, between vacuum half spaces
+    S = S4.Simulation()
+    S.create_new()
+    S.set_lattice(lattice)
+    S.set_num_g(num_g)
+    S.add_material("vacuum", [1.0, 0.0])
+    S.add_material("silicon", [12.0, loss])
+    background, circle = ("silicon", "vacuum") if hole else ("vacuum",
+                                                             "silicon")
+    S.add_layer("top", 0.0, "vacuum")
+    S.add_layer("slab", thickness, background)
+    S.set_layer_pattern_circle("slab", circle, [0.0, 0.0], 0.2)
+    S.add_layer("bottom", 0.0, "vacuum")
+    S.set_excitation_planewave(list(angles), [1.0, 0.0], list(p_amp))
+    S.set_frequency(frequency)
+    return S
+
+
+def make_stack(thicknesses, radius):
+    # vacuum half spaces around oxide layers patterned with silicon circles
+    S = S4.Simulation()
+    S.create_new()
+    S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+    S.set_num_g(25)
+    S.add_material("vacuum", [1.0, 0.0])
+    S.add_material("silicon", [12.0, 0.1])
+    S.add_material("oxide", [2.1, 0.0])
+    S.add_layer("top", 0.0, "vacuum")
+    for i, thickness in enumerate(thicknesses):
+        S.add_layer("L%d" % i, thickness, "oxide")
+        S.set_layer_pattern_circle("L%d" % i, "silicon", [0.0, 0.0],
+                                   radius[i])
+    S.add_layer("bottom", 0.0, "vacuum")
+    S.set_excitation_planewave([10.0, 0.0], [1.0, 0.0], [0.0, 0.0])
+    S.set_frequency(0.6)
+    return S
+
+
 class TestSetMethods(unittest.TestCase):
 
     def setUp(self):
@@ -38,3 +87,804 @@ class TestSetMethods(unittest.TestCase):
                                          [0.0, 0.0],
                                          verts,
                                          angle=0.0)
+
+class TestSweeps(unittest.TestCase):
+
+    def test_sweep_frequencies(self):
+        S = make_slab(angles=(0.0, 0.0))
+        freqs = [0.4, 0.5, 0.6, 0.7]
+        flux = S.sweep_frequencies(freqs, ["top", "bottom"], n_workers=2)
+        self.assertEqual(flux.shape, (4, 2, 4))
+        for i, f in enumerate(freqs):
+            S.set_frequency(f)
+            top = S.get_poynting_flux("top")
+            bottom = S.get_poynting_flux("bottom")
+            np.testing.assert_allclose(flux[i, 0], top, atol=1e-12)
+            np.testing.assert_allclose(flux[i, 1], bottom, atol=1e-12)
+
+        # the points keep the imaginary part of the current frequency
+        S.set_frequency(0.6, -0.01)
+        flux = S.sweep_frequencies([0.5, 0.6], ["top", "bottom"])
+        for i, f in enumerate([0.5, 0.6]):
+            S.set_frequency(f, -0.01)
+            np.testing.assert_allclose(flux[i, 0], S.get_poynting_flux("top"),
+                                       atol=1e-12)
+            np.testing.assert_allclose(flux[i, 1],
+                                       S.get_poynting_flux("bottom"),
+                                       atol=1e-12)
+
+    def test_sweep_layer_thickness(self):
+        S = make_stack([0.1, 0.2, 0.3, 0.15], [0.1, 0.2, 0.25, 0.15])
+        flux = S.get_poynting_flux("bottom")
+        thicknesses = [0.0, 0.05, 0.4, 1.2]
+        layers = ["top", "L0", "L2", "bottom"]
+        offsets = [0.0, 0.05, 0.1, 0.0]
+        sweep = S.sweep_layer_thickness("L2", thicknesses, layers, offsets)
+        self.assertEqual(sweep.shape, (4, 4, 4))
+        # the thickness of the layer is restored
+        np.testing.assert_allclose(S.get_poynting_flux("bottom"), flux)
+        for i, thickness in enumerate(thicknesses):
+            S.set_layer_thickness("L2", thickness)
+            for j, layer in enumerate(layers):
+                np.testing.assert_allclose(
+                    sweep[i, j], S.get_poynting_flux(layer, offsets[j]),
+                    atol=1e-12)
+
+    def test_sweep_angles(self):
+        S = make_slab(angles=(0.0, 0.0))
+        angles = [[0.0, 0.0], [10.0, 0.0], [20.0, 30.0], [40.0, 45.0]]
+        flux, flux_by_G = S.sweep_angles(angles, [1.0, 0.0], [0.5, 90.0],
+                                         ["top", "bottom"], by_G=True,
+                                         n_workers=2)
+        self.assertEqual(flux.shape, (4, 2, 4))
+        self.assertEqual(flux_by_G.shape, (4, 2, S.get_num_g(), 4))
+        for i, angle in enumerate(angles):
+            S.set_excitation_planewave(angle, [1.0, 0.0], [0.5, 90.0])
+            for j, layer in enumerate(["top", "bottom"]):
+                np.testing.assert_allclose(
+                    flux[i, j], S.get_poynting_flux(layer), atol=1e-12)
+                np.testing.assert_allclose(
+                    flux_by_G[i, j], S.get_poynting_flux_by_G(layer),
+                    atol=1e-12)
+
+
+class TestCopies(unittest.TestCase):
+
+    def test_clone(self):
+        S = make_slab()
+        flux_s = S.get_poynting_flux("bottom")
+        # the clone starts with the modes computed above
+        T = S.clone()
+        np.testing.assert_allclose(T.get_poynting_flux("bottom"), flux_s)
+        T.set_excitation_planewave([10.0, 0.0], [0.0, 0.0], [1.0, 0.0])
+        flux_p = T.get_poynting_flux("bottom")
+        # changing the clone leaves the original untouched
+        np.testing.assert_allclose(S.get_poynting_flux("bottom"), flux_s)
+        S.set_excitation_planewave([10.0, 0.0], [0.0, 0.0], [1.0, 0.0])
+        np.testing.assert_allclose(S.get_poynting_flux("bottom"), flux_p)
+        T.set_frequency(0.7)
+        del S
+        T.get_poynting_flux("bottom")
+
+    def test_spec_round_trip(self):
+        S = S4.Simulation()
+        S.create_new()
+        S.set_lattice([[1.0, 0.0], [0.2, 1.0]])
+        S.set_num_g(30)
+        S.add_material("vacuum", [1.0, 0.0])
+        S.add_material("silicon", [12.0, 0.1])
+        S.add_layer("top", 0.0, "vacuum")
+        S.add_layer("slab", 0.4, "vacuum")
+        S.set_layer_pattern_circle("slab", "silicon", [0.1, 0.0], 0.1)
+        S.set_layer_pattern_rectangle("slab", "silicon", [-0.25, 0.0],
+                                      [0.1, 0.3], angle=10.0)
+        S.set_layer_pattern_polygon("slab", "silicon", [0.25, 0.25],
+                                    [[0.1, 0.0], [0.0, 0.1], [-0.1, 0.0]],
+                                    angle=0.0)
+        S.add_layer("bottom", 0.0, "silicon")
+        S.set_excitation_planewave([15.0, 5.0], [1.0, 0.0], [0.5, 0.0])
+        S.set_frequency(0.55)
+        T = S4.Simulation.from_spec(S.to_spec())
+        U = pickle.loads(pickle.dumps(S))
+        for sim in (T, U):
+            self.assertEqual(sim.get_num_g(), S.get_num_g())
+            for layer in ("top", "bottom"):
+                np.testing.assert_allclose(sim.get_poynting_flux(layer),
+                                           S.get_poynting_flux(layer))
+        spec = U.to_spec()
+        self.assertEqual(spec["layers"]["names"], ["top", "slab", "bottom"])
+        self.assertEqual(list(spec["shapes"]["n_vertices"]), [0, 0, 3])
+
+
+class TestEpsilon(unittest.TestCase):
+
+    def test_epsilon_cache(self):
+        S = make_slab()
+
+        def builds(S, phase="epsilon_closed_form"):
+            return S.get_profile()[phase]["count"]
+
+        flux = S.get_poynting_flux("bottom")
+        self.assertEqual(builds(S), 1)
+        eigensolves = builds(S, "eigensolve")
+        S.set_frequency(0.7)
+        S.get_poynting_flux("bottom")
+        S.set_frequency(0.6)
+        np.testing.assert_allclose(S.get_poynting_flux("bottom"), flux)
+        # the frequency changes only re-ran the eigensolves
+        self.assertEqual(builds(S), 1)
+        self.assertEqual(builds(S, "eigensolve"), 3 * eigensolves)
+        # changing a material or an option rebuilds the matrices
+        T = S.clone()
+        T.set_material("silicon", [10.0, 0.1])
+        T.get_poynting_flux("bottom")
+        self.assertEqual(builds(T), 1)
+        T.use_discretized_epsilon()
+        self.assertEqual(builds(T, "epsilon_fft"), 0)
+        U = S4.Simulation.from_spec(T.to_spec())
+        np.testing.assert_allclose(T.get_poynting_flux("bottom"),
+                                   U.get_poynting_flux("bottom"))
+        self.assertEqual(builds(T, "epsilon_fft"), 1)
+        self.assertEqual(builds(T), 1)
+
+    def test_closed_form_epsilon(self):
+        # reflected and transmitted flux computed with the pattern
+        # transformed separately for every pair of G vectors
+        expected = {
+            "scalar": [-0.013884007465137271, 0.9876322364201795],
+            "lanczos": [-0.053891704504057496, 0.9556791355525087],
+            "polbasis": [-0.0067320374717388595, 1.0105102911622863],
+            "1d": [-0.2777768366250072, 0.6806988366656995],
+            "tensor": [-0.02242027778815137, 0.9896337524946559],
+        }
+        for case, flux in expected.items():
+            S = S4.Simulation()
+            S.create_new()
+            if case == "1d":
+                S.set_lattice([[1.0, 0.0], [0.0, 0.0]])
+            else:
+                S.set_lattice([[1.0, 0.2], [0.0, 0.9]])
+            S.set_num_g(41)
+            S.add_material("vacuum", [1.0, 0.0])
+            S.add_material("silicon", [12.0, 0.1])
+            S.add_material("aniso", [[[4.0, 0.1], [0.5, 0.0], [0.0, 0.0]],
+                                     [[0.5, 0.0], [3.0, 0.2], [0.0, 0.0]],
+                                     [[0.0, 0.0], [0.0, 0.0], [2.5, 0.0]]])
+            S.add_layer("top", 0.0, "vacuum")
+            S.add_layer("slab", 0.3, "vacuum")
+            material = "aniso" if case == "tensor" else "silicon"
+            if case == "1d":
+                S.set_layer_pattern_rectangle("slab", material, [0.1, 0.0],
+                                              [0.2, 0.0])
+            else:
+                S.set_layer_pattern_circle("slab", material, [0.2, 0.1],
+                                           0.15)
+                S.set_layer_pattern_rectangle("slab", material,
+                                              [-0.25, -0.2], [0.1, 0.15],
+                                              10.0)
+                S.set_layer_pattern_polygon("slab", material, [0.0, 0.3],
+                                            [[0.0, 0.0], [0.1, 0.0],
+                                             [0.0, 0.1]])
+            if case == "lanczos":
+                S.use_lanczos_smoothing()
+            elif case == "polbasis":
+                S.use_polarization_decomposition()
+            S.add_layer("bottom", 0.0, "vacuum")
+            S.set_excitation_planewave([20.0, 10.0], [1.0, 0.0], [0.3, 0.0])
+            S.set_frequency(0.7)
+            np.testing.assert_allclose(
+                [S.get_poynting_flux("top")[1],
+                 S.get_poynting_flux("bottom")[0]], flux, rtol=1e-10,
+                err_msg=case)
+
+
+class TestSMatrixCache(unittest.TestCase):
+
+    def test_changes_of_different_layers(self):
+        thicknesses = [0.1, 0.2, 0.3, 0.15]
+        radius = [0.1, 0.2, 0.25, 0.15]
+        S = make_stack(thicknesses, radius)
+        S.get_poynting_flux("bottom")
+        # L2 changes twice in a row, then other layers change
+        for i, thickness in ((2, 0.35), (2, 0.4), (0, 0.12), (3, 0.2)):
+            thicknesses[i] = thickness
+            S.set_layer_thickness("L%d" % i, thickness)
+            T = make_stack(thicknesses, radius)
+            for layer in ("top", "L1", "bottom"):
+                np.testing.assert_allclose(S.get_poynting_flux(layer),
+                                           T.get_poynting_flux(layer),
+                                           atol=1e-12)
+        radius[1] = 0.22
+        S.set_layer_pattern_circle("L1", "silicon", [0.0, 0.0], radius[1])
+        T = make_stack(thicknesses, radius)
+        np.testing.assert_allclose(S.get_poynting_flux("bottom"),
+                                   T.get_poynting_flux("bottom"), atol=1e-12)
+
+    def test_repeated_layer_changes(self):
+        thicknesses = [0.1, 0.2, 0.3, 0.15, 0.25, 0.2]
+        radius = [0.1, 0.2, 0.25, 0.15, 0.2, 0.1]
+        S = make_stack(thicknesses, radius)
+        S.get_poynting_flux("bottom")
+        S.set_frequency(0.61)
+        S.get_poynting_flux("bottom")
+        self.assertEqual(S.memory_report()["categories"]["smatrix_cache"], 0)
+        for n, thickness in enumerate((0.31, 0.32, 0.33, 0.34)):
+            thicknesses[2] = thickness
+            S.set_layer_thickness("L2", thickness)
+            S.reset_profile()
+            T = make_stack(thicknesses, radius)
+            T.set_frequency(0.61)
+            for layer in ("top", "L2", "bottom"):
+                np.testing.assert_allclose(
+                    S.get_poynting_flux(layer, 0.1),
+                    T.get_poynting_flux(layer, 0.1), atol=1e-12)
+            if n > 0:
+                # the stacks on either side of L2 are kept
+                self.assertGreater(
+                    S.memory_report()["categories"]["smatrix_cache"], 0)
+            if n > 1:
+                # only the two interfaces of L2 are recomputed
+                self.assertEqual(S.get_profile()["smatrix"]["count"], 2)
+        # they are dropped when another layer changes
+        thicknesses[4] = 0.3
+        S.set_layer_thickness("L4", 0.3)
+        T = make_stack(thicknesses, radius)
+        T.set_frequency(0.61)
+        np.testing.assert_allclose(S.get_poynting_flux("bottom"),
+                                   T.get_poynting_flux("bottom"), atol=1e-12)
+        self.assertEqual(S.memory_report()["categories"]["smatrix_cache"], 0)
+        # sweeps keep the partial S-matrices only while sweeping
+        S.set_layer_thickness("L4", 0.35)
+        S.get_poynting_flux("bottom")
+        S.set_layer_thickness("L4", 0.4)
+        S.get_poynting_flux("bottom")
+        S.sweep_layer_thickness("L2", [0.3, 0.4], ["bottom"])
+        self.assertEqual(S.memory_report()["categories"]["smatrix_cache"], 0)
+
+
+class TestFields(unittest.TestCase):
+
+    def test_get_fields_at_points(self):
+        S = make_slab(lattice=((1.0, 0.0), (0.2, 1.0)), angles=(10.0, 5.0),
+                      p_amp=(0.5, 30.0))
+        rng = np.random.default_rng(1)
+        points = rng.uniform(-0.5, 0.5, (40, 3))
+        points[:, 2] = rng.choice([-0.2, 0.0, 0.25, 0.5, 0.8], 40)
+        points[0, 2] = 0.3
+        e_field, h_field = S.get_fields_at_points(points)
+        self.assertEqual(e_field.shape, (40, 3))
+        self.assertEqual(h_field.shape, (40, 3))
+        for i, point in enumerate(points):
+            e, h = S.get_field_at_point(point)
+            np.testing.assert_allclose(e_field[i], e, atol=1e-12)
+            np.testing.assert_allclose(h_field[i], h, atol=1e-12)
+
+    def test_get_field_volume(self):
+        S = make_stack([0.2, 0.3], [0.15, 0.25])
+        z_values = [-0.1, 0.0, 0.1, 0.25, 0.45, 0.6]
+        e_field, h_field = S.get_field_volume(z_values, [12, 10],
+                                              n_workers=2)
+        self.assertEqual(e_field.shape, (6, 10, 12, 3))
+        for k, z in enumerate(z_values):
+            e, h = S.get_field_plane(z, [12, 10])
+            np.testing.assert_allclose(e_field[k], e, atol=1e-12)
+            np.testing.assert_allclose(h_field[k], h, atol=1e-12)
+
+    @unittest.skipUnless(os.path.exists("/proc/self/statm"),
+                         "needs /proc/self/statm")
+    def test_output_buffers(self):
+        def rss():
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        S = make_stack([0.2], [0.25])
+        e, h = S.get_field_plane(0.1, [16, 16])
+        waves = S.get_waves("L0")
+        flux = S.get_poynting_flux_by_G("L0")
+        e_out, h_out = np.empty_like(e), np.empty_like(h)
+        waves_out, flux_out = np.empty_like(waves), np.empty_like(flux)
+        self.assertIs(S.get_field_plane(0.1, [16, 16], out=(e_out, h_out))[0],
+                      e_out)
+        self.assertIs(S.get_waves("L0", out=waves_out), waves_out)
+        self.assertIs(S.get_poynting_flux_by_G("L0", out=flux_out), flux_out)
+        np.testing.assert_array_equal(e_out, e)
+        np.testing.assert_array_equal(h_out, h)
+        np.testing.assert_array_equal(waves_out, waves)
+        np.testing.assert_array_equal(flux_out, flux)
+        with self.assertRaises(RuntimeError):
+            S.get_waves("L0", out=np.empty((3, 2, 11)))
+        with self.assertRaises(RuntimeError):
+            S.get_poynting_flux_by_G("L0", out=np.empty(flux.shape, np.float32))
+
+        start = rss()
+        for i in range(10000):
+            S.get_field_plane(0.1, [16, 16])
+            S.get_waves("L0")
+            S.get_poynting_flux_by_G("L0", out=flux_out)
+        # the per-call outputs total about 300 MB if they are not freed
+        self.assertLess(rss() - start, 16 * 1024 * 1024)
+
+
+class TestCaches(unittest.TestCase):
+
+    def test_fft_plan_cache(self):
+        S = make_stack([0.2], [0.25])
+        e0, h0 = S.get_field_plane(0.1, [12, 10])
+        before = S4.get_fft_plan_cache_info()
+        e1, h1 = S.get_field_plane(0.1, [12, 10])
+        after = S4.get_fft_plan_cache_info()
+        self.assertGreaterEqual(after["hits"] - before["hits"], 6)
+        self.assertEqual(after["misses"], before["misses"])
+        np.testing.assert_array_equal(e0, e1)
+        np.testing.assert_array_equal(h0, h1)
+        self.addCleanup(S4.set_fft_plan_cache_size, before["capacity"])
+        S4.set_fft_plan_cache_size(2)
+        self.assertLessEqual(S4.get_fft_plan_cache_info()["size"], 2)
+
+    def test_layer_modes_cache(self):
+        reference = make_stack([0.2, 0.3], [0.15, 0.25])
+        expected = reference.get_poynting_flux("bottom")
+        S4.set_layer_modes_cache_budget(64 * 1024 * 1024)
+        try:
+            S4.clear_layer_modes_cache()
+            S = make_stack([0.2, 0.3], [0.15, 0.25])
+            S.get_poynting_flux("bottom")
+            info = S4.get_layer_modes_cache_info()
+            # top and bottom are the same vacuum layer
+            self.assertEqual((info["hits"], info["misses"]), (1, 3))
+            self.assertEqual(info["entries"], 3)
+
+            S = make_stack([0.2, 0.3], [0.15, 0.2])
+            flux = S.get_poynting_flux("bottom")
+            info = S4.get_layer_modes_cache_info()
+            self.assertEqual((info["hits"], info["misses"]), (4, 4))
+            S = make_stack([0.2, 0.3], [0.15, 0.25])
+            np.testing.assert_allclose(S.get_poynting_flux("bottom"),
+                                       expected, rtol=1e-12)
+
+            # shrinking the budget evicts the least recently used modes
+            S4.set_layer_modes_cache_budget(info["bytes"] // 2)
+            info = S4.get_layer_modes_cache_info()
+            self.assertLessEqual(info["bytes"], info["budget"])
+            self.assertLess(info["entries"], 4)
+            np.testing.assert_allclose(S.get_poynting_flux("bottom"),
+                                       expected, rtol=1e-12)
+        finally:
+            S4.set_layer_modes_cache_budget(0)
+            S4.clear_layer_modes_cache()
+
+
+class TestDiagnostics(unittest.TestCase):
+
+    def test_memory_report(self):
+        S = make_stack([0.2, 0.3], [0.15, 0.25])
+        S.get_poynting_flux("bottom")
+        n = S.get_num_g()
+        report = S.memory_report()
+        self.assertEqual(list(report["layers"]), ["top", "L0", "L1", "bottom"])
+        # patterned layers hold q, kp and phi; uniform ones only q and kp
+        self.assertEqual(report["layers"]["L0"]["modes"],
+                         16 * (2 * n + 2 * (2 * n) ** 2))
+        self.assertEqual(report["layers"]["top"]["modes"],
+                         16 * (2 * n + (2 * n) ** 2))
+        self.assertEqual(report["layers"]["L0"]["epsilon"], 16 * 5 * n * n)
+        # the amplitudes of all layers are counted once
+        self.assertNotIn("solution", report["layers"]["L0"])
+        self.assertGreaterEqual(report["categories"]["solution"],
+                                4 * (16 * 4 * n))
+        self.assertLess(report["categories"]["solution"],
+                        4 * (16 * 4 * n) + 256)
+        self.assertEqual(report["total"], sum(report["categories"].values()))
+        self.assertGreaterEqual(S.estimate_peak_memory(), report["total"])
+        self.assertEqual(S.estimate_peak_memory(),
+                         S4.estimate_peak_memory(n, 4, n_patterned=2))
+
+        S.use_less_memory()
+        S.set_frequency(0.65)
+        S.get_poynting_flux("bottom")
+        report = S.memory_report()
+        self.assertEqual(report["categories"]["smatrix_cache"], 0)
+        self.assertEqual(report["layers"]["L0"]["modes"],
+                         16 * (2 * n + (2 * n) ** 2))
+        self.assertLess(S4.estimate_peak_memory(n, 4, 2, use_less_memory=True),
+                        S4.estimate_peak_memory(n, 4, 2))
+
+    def test_profile(self):
+        S = make_stack([0.2, 0.3], [0.15, 0.25])
+        S.use_discretized_epsilon()
+        S.reset_profile(trace=True)
+        S.get_poynting_flux("bottom")
+        S.get_field_plane(0.1, [8, 8])
+        profile = S.get_profile()
+        for phase in ["epsilon_fft", "eigensolve", "solve", "fields", "fft"]:
+            self.assertGreater(profile[phase]["count"], 0, phase)
+            self.assertLessEqual(profile[phase]["self_seconds"],
+                                 profile[phase]["seconds"] + 1e-9)
+        self.assertEqual(profile["epsilon_closed_form"]["count"], 0)
+        # two patterned layers, one uniform layer shared by top and bottom
+        self.assertEqual(profile["epsilon_fft"]["count"], 2)
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "trace.json")
+        S.save_profile_trace(path)
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(sum(e["name"] == "fft" for e in events),
+                         profile["fft"]["count"])
+        S.reset_profile()
+        self.assertEqual(S.get_profile()["solve"]["count"], 0)
+        self.assertRaises(RuntimeError, S.save_profile_trace, path)
+
+
+class TestEigensolvers(unittest.TestCase):
+
+    def test_hermitian_eigensolver(self):
+        def solve(use, loss, freq=3.0):
+            S = S4.Simulation()
+            S.create_new()
+            S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+            S.set_num_g(41)
+            S.use_hermitian_eigensolver(use)
+            S.add_material("vacuum", [1.0, 0.0])
+            S.add_material("silicon", [12.0, loss])
+            S.add_material("oxide", [2.1, 0.0])
+            S.add_layer("top", 0.0, "vacuum")
+            S.add_layer("slab", 0.3, "silicon")
+            S.set_layer_pattern_circle("slab", "oxide", [0.1, 0.05], 0.25)
+            S.add_layer("bottom", 0.0, "vacuum")
+            S.set_excitation_planewave([10.0, 5.0], [1.0, 0.0], [0.0, 0.0])
+            # every order propagates in the slab at the default frequency
+            S.set_frequency(freq)
+            efield, hfield = S.get_field_plane(0.15, [8, 8])
+            return S, [S.get_poynting_flux("top"),
+                       S.get_poynting_flux("bottom"), efield.ravel()]
+
+        for loss in [0.0, 0.1]:
+            S, hermitian = solve(True, loss)
+            _, general = solve(False, loss)
+            for x, y in zip(hermitian, general):
+                np.testing.assert_allclose(x, y, atol=1e-10)
+        self.assertEqual(S.to_spec()["options"]["use_hermitian_eigensolver"],
+                         1)
+        # with evanescent orders the general eigensolver is used instead
+        _, hermitian = solve(True, 0.0, freq=0.6)
+        _, general = solve(False, 0.0, freq=0.6)
+        for x, y in zip(hermitian, general):
+            np.testing.assert_array_equal(x, y)
+        T = S4.Simulation()
+        T.create_new()
+        self.assertEqual(T.to_spec()["options"]["use_hermitian_eigensolver"],
+                         0)
+
+    def test_decoupled_polarizations(self):
+        def solve(phi, loss):
+            S = S4.Simulation()
+            S.create_new()
+            S.set_lattice(1.0)
+            S.set_num_g(41)
+            S.add_material("vacuum", [1.0, 0.0])
+            S.add_material("silicon", [12.0, loss])
+            S.add_material("oxide", [2.1, 0.0])
+            S.add_layer("top", 0.0, "vacuum")
+            S.add_layer("g1", 0.3, "oxide")
+            S.set_layer_pattern_rectangle("g1", "silicon", [0.1, 0.0],
+                                          [0.3, 0.0])
+            S.add_layer("spacer", 0.1, "oxide")
+            S.add_layer("g2", 0.2, "oxide")
+            S.set_layer_pattern_rectangle("g2", "silicon", [-0.1, 0.0],
+                                          [0.2, 0.0])
+            S.add_layer("bottom", 0.0, "silicon")
+            # with phi = 0, ky vanishes and the polarizations decouple
+            S.set_excitation_planewave([12.0, phi], [1.0, 0.0], [0.5, 0.3])
+            S.set_frequency(0.7)
+            efield, hfield = S.get_field_plane(0.25, [8, 1])
+            return [S.get_poynting_flux("top"), S.get_poynting_flux("spacer"),
+                    S.get_poynting_flux("bottom"), efield.ravel(),
+                    hfield.ravel()]
+
+        for loss in [0.0, 0.1]:
+            decoupled = solve(0.0, loss)
+            coupled = solve(1e-9, loss)
+            for x, y in zip(decoupled, coupled):
+                np.testing.assert_allclose(x, y, atol=1e-7)
+
+    def test_decoupled_interior_flux(self):
+        S = S4.Simulation()
+        S.create_new()
+        S.set_lattice(1.0)
+        S.set_num_g(21)
+        S.add_material("vacuum", [1.0, 0.0])
+        S.add_material("silicon", [12.0, 0.0])
+        S.add_material("oxide", [2.1, 0.0])
+        S.add_layer("top", 0.0, "vacuum")
+        S.add_layer("G0", 0.3, "oxide")
+        S.set_layer_pattern_rectangle("G0", "silicon", [0.0, 0.0], [0.2, 0.0])
+        S.add_layer("spacer", 0.2, "oxide")
+        S.add_layer("G1", 0.25, "vacuum")
+        S.set_layer_pattern_rectangle("G1", "silicon", [0.0, 0.0], [0.3, 0.0])
+        S.add_layer("bottom", 0.0, "oxide")
+        S.set_excitation_planewave([20.0, 0.0], [1.0, 0.0], [0.5, 0.3])
+        S.set_frequency(0.8)
+        # forward and backward flux inside the lossless layers, as given by
+        # the coupled eigensolver before the polarizations were decoupled
+        reference = {"G0": [1.1202947815092485, -0.7652319630666334],
+                     "spacer": [0.3841116093653347, -0.02904879092271964],
+                     "G1": [0.7928156785793818, -0.4377528601367673]}
+        for layer, flux in reference.items():
+            np.testing.assert_allclose(S.get_poynting_flux(layer)[:2], flux,
+                                       rtol=1e-10)
+
+    def test_symmetry(self):
+        def make(mirrors, parity, bar=True):
+            S = S4.Simulation()
+            S.create_new()
+            S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+            S.set_num_g(41)
+            S.use_symmetry(mirrors, parity)
+            S.add_material("vacuum", [1.0, 0.0])
+            S.add_material("silicon", [12.0, 0.1])
+            S.add_layer("top", 0.0, "vacuum")
+            S.add_layer("disk", 0.3, "vacuum")
+            S.set_layer_pattern_circle("disk", "silicon", [0.0, 0.0], 0.25)
+            if bar:
+                S.add_layer("bar", 0.2, "vacuum")
+                S.set_layer_pattern_rectangle("bar", "silicon", [0.0, 0.0],
+                                              [0.3, 0.1])
+            S.add_layer("bottom", 0.0, "vacuum")
+            # s-polarized at normal incidence: Ey, even under x -> -x
+            S.set_excitation_planewave([0.0, 0.0], [1.0, 0.0], [0.0, 0.0])
+            S.set_frequency(0.7)
+            return S
+
+        def solve(mirrors, parity):
+            S = make(mirrors, parity)
+            efield, hfield = S.get_field_plane(0.1, [8, 8])
+            return [S.get_poynting_flux("top"), S.get_poynting_flux("disk"),
+                    S.get_poynting_flux("bottom"), efield.ravel(),
+                    hfield.ravel()]
+
+        full = solve(None, "even")
+        for mirrors, parity in [("x", "even"), ("y", "odd"),
+                                ("xy", ("even", "odd"))]:
+            for x, y in zip(solve(mirrors, parity), full):
+                np.testing.assert_allclose(x, y, atol=1e-10)
+        with self.assertRaises(RuntimeError):
+            solve("x", "odd")
+
+        # the modes outside the sector are not computed and are marked NaN
+        S = make("xy", ("even", "odd"), bar=False)
+        q = S.get_propagation_constants("disk")
+        self.assertEqual(q.shape, (S.get_num_g(),))
+        valid = np.isfinite(q)
+        self.assertGreater(np.sum(valid), 0)
+        self.assertTrue(np.all(np.isnan(q[~valid])))
+        self.assertTrue(np.all(valid[:np.sum(valid)]))
+        self.assertLess(np.sum(valid), S.get_num_g())
+        self.assertTrue(np.all(np.isfinite(S.get_propagation_constants("top"))))
+
+    def test_partial_eigensolver(self):
+        def make(num_modes):
+            S = S4.Simulation()
+            S.create_new()
+            S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+            S.set_num_g(200)
+            S.set_num_modes(num_modes)
+            S.add_material("vacuum", [1.0, 0.0])
+            S.add_material("silicon", [12.0, 0.0])
+            S.add_material("oxide", [2.1, 0.0])
+            S.add_layer("top", 0.0, "vacuum")
+            S.add_layer("slab", 1.0, "oxide")
+            S.set_layer_pattern_circle("slab", "silicon", [0.1, 0.0], 0.25)
+            S.add_layer("bottom", 0.0, "vacuum")
+            S.set_excitation_planewave([10.0, 5.0], [1.0, 0.0], [0.0, 0.0])
+            S.set_frequency(0.6)
+            return S
+
+        def fluxes(S):
+            # the split of the slab flux depends on the sign rounding gives
+            # the q of its propagating modes, so only the net flux is kept
+            slab = S.get_poynting_flux("slab", 0.5)
+            return np.concatenate([S.get_poynting_flux("top"),
+                                   S.get_poynting_flux("bottom"),
+                                   [slab[0] + slab[1]]])
+
+        full = make(0)
+        # few enough modes for the Arnoldi method to be used; all of the
+        # propagating ones are kept together
+        partial = make(8)
+        error = np.max(np.abs(fluxes(partial) - fluxes(full)))
+        self.assertLess(error, 1e-2)
+        truncation = partial.get_mode_truncation("slab")
+        self.assertGreaterEqual(truncation["num_modes"], 8)
+        self.assertLess(truncation["num_modes"], truncation["num_total"])
+        self.assertEqual(truncation["num_total"], 2 * partial.get_num_g())
+        self.assertLess(truncation["residual"], 1e-10)
+        # the error comes from the interfaces, and is within the bound
+        self.assertGreater(truncation["approx_residual"], 0.0)
+        self.assertLess(error, truncation["interface_error"])
+        self.assertLess(truncation["interface_error"], 0.1)
+        truncation = full.get_mode_truncation("slab")
+        self.assertEqual(truncation["num_modes"], truncation["num_total"])
+        self.assertEqual(truncation["attenuation"], 0.0)
+        self.assertEqual(truncation["interface_error"], 0.0)
+
+
+class TestSamplers(unittest.TestCase):
+
+    def test_spectrum_sampler(self):
+        def lorentzian(f):
+            return 1.0 / (1.0 + ((f - 0.4) / 0.002)**2)
+
+        for parallelize in [True, False]:
+            sampler = S4.SpectrumSampler(0.1, 0.9, parallelize=parallelize)
+            for freqs in sampler:
+                self.assertEqual(np.ndim(freqs), 1 if parallelize else 0)
+                sampler.submit(lorentzian(freqs))
+            freqs, values = sampler.get_spectrum()
+            self.assertEqual(len(freqs), sampler.get_num_points())
+            self.assertEqual((freqs[0], freqs[-1]), (0.1, 0.9))
+            self.assertTrue(np.all(np.diff(freqs) > 0))
+            np.testing.assert_allclose(values, lorentzian(freqs))
+            # the initial grid spacing is 0.025; the peak gets refined
+            self.assertGreater(np.sum(np.abs(freqs - 0.4) < 0.01), 20)
+
+        # max_bend is an angle in degrees, as for FunctionSampler2D
+        num_points = []
+        for max_bend in [5.0, 10.0, 30.0]:
+            sampler = S4.SpectrumSampler(0.1, 0.9, max_bend=max_bend)
+            for freqs in sampler:
+                sampler.submit(lorentzian(freqs))
+            num_points.append(sampler.get_num_points())
+        self.assertGreater(num_points[0], num_points[1])
+        self.assertGreater(num_points[1], num_points[2])
+        with self.assertRaises(RuntimeError):
+            S4.SpectrumSampler(0.1, 0.9, max_bend=0.0)
+
+        S = make_slab(num_g=21, loss=0.0, hole=True, thickness=0.3,
+                      angles=(0.0, 0.0), frequency=0.5)
+        sampler = S4.SpectrumSampler(0.4, 0.6, initial_num_points=17)
+        freqs, values = sampler.run(S, "bottom", n_workers=2)
+        np.testing.assert_allclose(
+            values, S.sweep_frequencies(freqs, ["bottom"])[:, 0, 0])
+        with self.assertRaises(RuntimeError):
+            sampler = S4.SpectrumSampler(0.4, 0.6)
+            sampler.submit(np.zeros(3))
+
+    def test_function_sampler_2d(self):
+        def ring(xy):
+            r = np.hypot(xy[:, 0], xy[:, 1])
+            return np.exp(-((r - 0.5) / 0.1)**2)
+
+        u, v = np.meshgrid(np.linspace(-1.0, 1.0, 11),
+                           np.linspace(-1.0, 1.0, 11))
+        xy = np.column_stack([u.ravel(), v.ravel()])
+        sampler = S4.FunctionSampler2D(xy, ring(xy))
+        while not sampler.is_done() and len(sampler) < 1000:
+            points = sampler.get_next(50)
+            sampler.add(points, ring(points))
+        xy, z = sampler.get_samples()
+        triangles = sampler.get_triangles()
+        np.testing.assert_allclose(z, ring(xy))
+        # the triangles tile the square without overlaps
+        a, b, c = xy[triangles[:, 0]], xy[triangles[:, 1]], xy[triangles[:, 2]]
+        area = 0.5 * ((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) -
+                      (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+        self.assertTrue(np.all(area > 0))
+        self.assertAlmostEqual(area.sum(), 4.0)
+        r = np.hypot(xy[:, 0], xy[:, 1])
+        self.assertGreater(np.mean(np.abs(r - 0.5) < 0.2), 0.5)
+
+        S = make_slab(num_g=21, loss=0.0, hole=True, thickness=0.3,
+                      angles=(0.0, 0.0), frequency=0.5)
+        points, flux, triangles = S.sample_flux_map(
+            (0.4, 0.6), (0.0, 0.3), "bottom", [1.0, 0.0], [0.0, 0.0],
+            initial_grid=(5, 5), max_samples=60, n_workers=2)
+        self.assertEqual(points.shape, (60, 2))
+        self.assertEqual(triangles.shape[1], 3)
+        for (f, k), value in list(zip(points, flux))[::10]:
+            T = S.clone()
+            T.set_frequency(f)
+            if k > f:
+                # outside the light cone of the vacuum
+                self.assertEqual(value, 0.0)
+                continue
+            T.set_excitation_planewave([np.degrees(np.arcsin(k / f)), 0.0],
+                                       [1.0, 0.0], [0.0, 0.0])
+            self.assertAlmostEqual(T.get_poynting_flux("bottom")[0], value)
+        with self.assertRaises(RuntimeError):
+            S.sample_flux_map((0.0, 0.6), (0.0, 0.3), "bottom", [1.0, 0.0],
+                              [0.0, 0.0])
+
+    def test_auto_converge(self):
+        S = S4.Simulation()
+        S.create_new()
+        S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+        S.set_num_g(200)
+        S.add_material("vacuum", [1.0, 0.0])
+        S.add_material("oxide", [2.1, 0.0])
+        S.add_layer("top", 0.0, "vacuum")
+        S.add_layer("slab", 0.3, "vacuum")
+        S.set_layer_pattern_circle("slab", "oxide", [0.0, 0.0], 0.3)
+        S.add_layer("bottom", 0.0, "vacuum")
+        S.set_excitation_planewave([10.0, 0.0], [1.0, 0.0], [0.0, 0.0])
+        S.set_frequency(0.6)
+
+        result = S.auto_converge("forward", "bottom", rtol=1e-3)
+        self.assertTrue(result["converged"])
+        history = result["history"]
+        num_g = [step[0] for step in history]
+        self.assertTrue(all(a < b for a, b in zip(num_g, num_g[1:])))
+        self.assertLess(result["num_g"], num_g[-1])
+        self.assertEqual(S.get_num_g(), result["num_g"])
+        self.assertAlmostEqual(S.get_poynting_flux("bottom")[0],
+                               result["value"])
+        self.assertLess(abs(result["value"] - history[-1][2]),
+                        1e-3 * abs(history[-1][2]))
+        # every step is a closed shell of the truncation
+        T = S.clone()
+        for n in num_g:
+            T.set_num_g(n)
+            self.assertEqual(T.get_num_g(), n)
+
+        # a value passing near the limit early does not count as converged
+        values = iter([1.0, 2.0, 1.0005, 1.3, 1.0002, 1.0001])
+        result = S.auto_converge(lambda sim: next(values), rtol=1e-3,
+                                 apply=False)
+        self.assertTrue(result["converged"])
+        self.assertEqual(len(result["history"]), 6)
+        self.assertEqual(result["num_g"], result["history"][4][0])
+        self.assertEqual(result["value"], 1.0002)
+
+        S.use_discretized_epsilon()
+        flux = S.get_poynting_flux("bottom")
+        S.set_resolution(4)
+        self.assertEqual(S.to_spec()["options"]["resolution"], 4)
+        self.assertNotEqual(S.get_poynting_flux("bottom")[0], flux[0])
+        S.set_resolution(8)
+        result = S.auto_converge(lambda sim: sim.get_poynting_flux("bottom"),
+                                 rtol=1e-3, extrapolate=True)
+        self.assertTrue(result["converged"])
+        self.assertEqual(result["value"].shape, (4,))
+        self.assertIsNotNone(result["extrapolated"])
+        self.assertGreaterEqual(max(step[1] for step in result["history"]),
+                                16)
+
+
+class TestThreading(unittest.TestCase):
+
+    def make_simulation(self, freq):
+        S = S4.Simulation()
+        S.create_new()
+        S.set_lattice([[1.0, 0.0], [0.0, 1.0]])
+        S.set_num_g(25)
+        S.add_material("vacuum", [1.0, 0.0])
+        S.add_material("silicon", [12.0, 0.1])
+        S.add_layer("top", 0.0, "vacuum")
+        S.add_layer("slab", 0.5, "vacuum")
+        S.set_layer_pattern_rectangle("slab", "silicon", [0.0, 0.0],
+                                      [0.2, 0.3], angle=0.0)
+        S.add_layer("bottom", 0.0, "vacuum")
+        S.set_excitation_planewave([10.0, 0.0], [1.0, 0.0], [0.0, 0.0])
+        S.set_frequency(freq)
+        return S
+
+    def solve(self, freq):
+        S = self.make_simulation(freq)
+        results = []
+        for _ in range(5):
+            # changing the thickness forces a full re-solve every pass
+            S.set_layer_thickness("slab", 0.5)
+            results.append(S.get_poynting_flux("bottom"))
+            efield, hfield = S.get_field_plane(0.25, [8, 8])
+            results.append(efield.ravel())
+        return results
+
+    def test_concurrent_simulations(self):
+        n = 8
+        freqs = [0.4 + 0.05 * i for i in range(n)]
+        serial = [self.solve(f) for f in freqs]
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            threaded = list(pool.map(self.solve, freqs))
+        for a, b in zip(serial, threaded):
+            for x, y in zip(a, b):
+                np.testing.assert_allclose(x, y, atol=1e-12)